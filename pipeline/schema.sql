@@ -1,6 +1,16 @@
 DROP VIEW IF EXISTS avg_exh_rating;
 DROP VIEW IF EXISTS num_requests;
 DROP VIEW IF EXISTS request_over_time;
+DROP VIEW IF EXISTS ingest_progress;
+DROP VIEW IF EXISTS rating_history;
+DROP VIEW IF EXISTS request_history;
+DROP TABLE IF EXISTS rating_hourly;
+DROP TABLE IF EXISTS request_hourly;
+DROP TABLE IF EXISTS write_limit;
+DROP TABLE IF EXISTS ingest_shard;
+DROP TABLE IF EXISTS kafka_offset;
+DROP TABLE IF EXISTS interaction_sketch;
+DROP TABLE IF EXISTS write_watermark;
 DROP TABLE IF EXISTS request_interaction;
 DROP TABLE IF EXISTS rating_interaction;
 DROP TABLE IF EXISTS request;
@@ -80,13 +90,156 @@ CREATE TABLE rating_interaction(
   FOREIGN KEY(exhibition_id) REFERENCES exhibition(exhibition_id)
 );
 
+CREATE INDEX rating_interaction_event_at ON rating_interaction (event_at);
+
+CREATE INDEX request_interaction_event_at ON request_interaction (event_at);
+
+-- Interactions compacted out of the raw tables, counted per UTC hour.
+CREATE TABLE rating_hourly(
+  exhibition_id SMALLINT NOT NULL,
+  hour TIMESTAMPTZ NOT NULL,
+  rating_id SMALLINT NOT NULL,
+  interactions BIGINT NOT NULL,
+  PRIMARY KEY(exhibition_id, hour, rating_id),
+  FOREIGN KEY(exhibition_id) REFERENCES exhibition(exhibition_id),
+  FOREIGN KEY(rating_id) REFERENCES rating(rating_id)
+);
+
+CREATE TABLE request_hourly(
+  exhibition_id SMALLINT NOT NULL,
+  hour TIMESTAMPTZ NOT NULL,
+  request_id INT NOT NULL,
+  interactions BIGINT NOT NULL,
+  PRIMARY KEY(exhibition_id, hour, request_id),
+  FOREIGN KEY(exhibition_id) REFERENCES exhibition(exhibition_id),
+  FOREIGN KEY(request_id) REFERENCES request(request_id)
+);
+
+-- Every interaction, raw or compacted, each row weighted by interactions.
+CREATE VIEW rating_history AS (
+  SELECT
+    exhibition_id, rating_id, event_at, 1::BIGINT AS interactions
+  FROM
+    rating_interaction
+  UNION ALL
+  SELECT
+    exhibition_id, rating_id, hour, interactions
+  FROM
+    rating_hourly
+)
+;
+
+CREATE VIEW request_history AS (
+  SELECT
+    exhibition_id, request_id, event_at, 1::BIGINT AS interactions
+  FROM
+    request_interaction
+  UNION ALL
+  SELECT
+    exhibition_id, request_id, hour, interactions
+  FROM
+    request_hourly
+)
+;
+
+-- A museum's watermark is the sum of its rows; each connection bumps the
+-- row of its backend's pid modulo writer.WATERMARK_SLOTS.
+CREATE TABLE write_watermark(
+  museum_id SMALLINT NOT NULL,
+  slot SMALLINT NOT NULL,
+  rows_written BIGINT NOT NULL,
+  written_at TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY(museum_id, slot),
+  FOREIGN KEY(museum_id) REFERENCES museum(museum_id)
+);
+
+CREATE TABLE kafka_offset(
+  consumer_group TEXT NOT NULL,
+  topic TEXT NOT NULL,
+  kafka_partition INT NOT NULL,
+  next_offset BIGINT NOT NULL,
+  committed_at TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY(consumer_group, topic, kafka_partition)
+);
+
+CREATE TABLE interaction_sketch(
+  exhibition_id SMALLINT NOT NULL,
+  bucket_start TIMESTAMPTZ NOT NULL,
+  bucket_seconds INT NOT NULL,
+  sketch JSONB,
+  updated_at TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY(exhibition_id, bucket_seconds, bucket_start),
+  FOREIGN KEY(exhibition_id) REFERENCES exhibition(exhibition_id)
+);
+
+CREATE TABLE ingest_shard(
+  object_key TEXT NOT NULL,
+  museum_name VARCHAR(30) NOT NULL,
+  etag TEXT,
+  status VARCHAR(10) NOT NULL DEFAULT 'pending',
+  lease_owner TEXT,
+  leased_at TIMESTAMPTZ,
+  heartbeat_at TIMESTAMPTZ,
+  lease_expires_at TIMESTAMPTZ,
+  attempts SMALLINT NOT NULL DEFAULT 0,
+  rows_uploaded BIGINT,
+  rows_rejected BIGINT,
+  error TEXT,
+  queued_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  finished_at TIMESTAMPTZ,
+  PRIMARY KEY(object_key),
+  CHECK (status IN ('pending', 'leased', 'done', 'failed'))
+);
+
+CREATE INDEX ingest_shard_claimable ON ingest_shard (object_key)
+  WHERE status IN ('pending', 'leased');
+
+-- Write-rate limits, token buckets and live latency of each pipeline class.
+CREATE TABLE write_limit(
+  pipeline_class VARCHAR(30) NOT NULL,
+  rows_per_second DOUBLE PRECISION,
+  tx_per_second DOUBLE PRECISION,
+  burst_seconds DOUBLE PRECISION NOT NULL DEFAULT 1,
+  yield_above_ms DOUBLE PRECISION,
+  min_factor DOUBLE PRECISION NOT NULL DEFAULT 0.05,
+  rate_factor DOUBLE PRECISION NOT NULL DEFAULT 1,
+  row_tokens DOUBLE PRECISION NOT NULL DEFAULT 0,
+  tx_tokens DOUBLE PRECISION NOT NULL DEFAULT 0,
+  refilled_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  adjusted_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  commit_p99_ms DOUBLE PRECISION,
+  reported_at TIMESTAMPTZ,
+  PRIMARY KEY(pipeline_class),
+  CHECK (pipeline_class IN ('live', 'backfill')),
+  CHECK (burst_seconds > 0 AND min_factor > 0 AND min_factor <= 1)
+);
+
+CREATE VIEW ingest_progress AS (
+  SELECT
+    museum_name,
+    CASE
+      WHEN status = 'leased' AND lease_expires_at < NOW() THEN 'expired'
+      ELSE status
+    END AS state,
+    lease_owner,
+    COUNT(*) AS shards,
+    SUM(rows_uploaded) AS rows_uploaded,
+    MAX(heartbeat_at) AS last_heartbeat_at
+  FROM
+    ingest_shard
+  GROUP BY
+    museum_name, state, lease_owner
+)
+;
+
 CREATE VIEW avg_exh_rating AS (
   SELECT 
-    AVG(rating_value::REAL),
+    SUM(rating_value * interactions)::DOUBLE PRECISION
+      / SUM(interactions) AS avg,
     exhibition_name,
     public_id
   FROM  
-    rating_interaction
+    rating_history
   JOIN
     exhibition
   USING
@@ -104,9 +257,9 @@ CREATE VIEW num_requests AS (
   SELECT 
     exhibition_name,
     public_id,
-    COUNT(*) as number
+    SUM(interactions)::BIGINT as number
   FROM  
-    request_interaction
+    request_history
   JOIN 
     exhibition
   USING 
@@ -121,9 +274,9 @@ CREATE VIEW request_over_time AS (
     DATE_TRUNC('day', event_at) as day,
     exhibition_name,
     public_id,
-    COUNT(*) as number
+    SUM(interactions)::BIGINT as number
   FROM  
-    request_interaction
+    request_history
   JOIN  
     exhibition
   USING 
@@ -257,3 +410,10 @@ VALUES
 
 ;
 
+
+-- No rates are set, so the backfills are only slowed, in proportion to their
+-- own throughput, while the live p99 commit is above 250ms.
+INSERT INTO write_limit (pipeline_class, yield_above_ms) VALUES
+('live', NULL),
+('backfill', 250)
+;
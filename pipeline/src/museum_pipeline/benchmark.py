@@ -0,0 +1,400 @@
+"""Offline throughput benchmarks for the pipeline's stages.
+
+Every benchmark runs on generated data. The writer and bulk benchmarks
+also need local Postgres binaries, for a throwaway cluster, and are skipped
+without them.
+"""
+#pylint: disable=unused-variable
+import csv
+import datetime as dt
+import json
+import logging
+import random
+import subprocess
+import shutil
+import sys
+import tempfile
+from os import environ as ENV, path
+from time import perf_counter
+
+# Mirrors the lmnh rows seeded by schema.sql, so no database is needed.
+SEED_ID_DICT = {
+    "exhibition": {1: 1, 0: 2, 5: 3, 2: 4, 4: 5, 3: 6},
+    "rating": {0: 1, 1: 2, 2: 3, 3: 4, 4: 5},
+    "request": {0: 1, 1: 2}
+}
+OPENING = dt.time(hour=8, minute=45)
+CLOSING = dt.time(hour=18, minute=15)
+
+
+def iter_csv_rows(n: int, invalid_ratio: float = 0.0, seed: int = 0):
+    """Yields n rows in the format of the historical csvs.
+
+    Arguments:
+        n -- number of rows to generate
+        invalid_ratio -- fraction of rows with an unrecognised site
+        seed -- seed for the random number generator
+    """
+    rng = random.Random(seed)
+    day = dt.datetime(2023, 3, 6, 9)
+    for i in range(n):
+        at = day + dt.timedelta(seconds=i % 32400)
+        site = "99" if rng.random() < invalid_ratio else str(rng.randint(0, 5))
+        if rng.random() < 0.1:
+            val, request_type = "-1", f"{rng.randint(0, 1)}.0"
+        else:
+            val, request_type = str(rng.randint(0, 4)), ""
+        yield {"at": at.strftime("%Y-%m-%d %H:%M:%S"), "site": site,
+               "val": val, "type": request_type}
+
+
+def generate_csv_rows(n: int, invalid_ratio: float = 0.0,
+                      seed: int = 0) -> list[dict]:
+    """Returns n rows in the format of the historical csvs."""
+    return list(iter_csv_rows(n, invalid_ratio, seed))
+
+
+def generate_message(rng: random.Random, i: int,
+                     invalid_ratio: float = 0.0) -> dict:
+    """Returns the i-th kiosk message of a generated stream.
+
+    Invalid messages, and only invalid messages, have the site "99".
+    """
+    day = dt.datetime(2025, 1, 13, 9, tzinfo=dt.timezone.utc)
+    message = {"at": (day + dt.timedelta(seconds=i % 32400)).isoformat(),
+               "site": str(rng.randint(0, 5))}
+    if rng.random() < invalid_ratio:
+        message["site"] = "99"
+    if rng.random() < 0.1:
+        message["val"] = -1
+        message["type"] = rng.randint(0, 1)
+    else:
+        message["val"] = rng.randint(0, 4)
+    return message
+
+
+def generate_messages(n: int, invalid_ratio: float = 0.0,
+                      seed: int = 0) -> list[bytes]:
+    """Returns n encoded kiosk messages in the Kafka message format."""
+    rng = random.Random(seed)
+    return [json.dumps(generate_message(rng, i, invalid_ratio)).encode("UTF-8")
+            for i in range(n)]
+
+
+def _quiet_logger() -> logging.Logger:
+    """Returns a logger which discards everything, for rejected rows"""
+    logger = logging.getLogger("museum_pipeline.benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+def _timed(stage: str, rows: int, func, *args) -> dict:
+    """Times a single call of func, returning a result dict"""
+    started = perf_counter()
+    func(*args)
+    seconds = perf_counter() - started
+    return {"stage": stage, "rows": rows, "seconds": round(seconds, 4),
+            "rows_per_second": round(rows / seconds) if seconds else None}
+
+
+def benchmark_transform(rows: int) -> dict:
+    """Times _prepare_upload_data over generated csv rows"""
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.transform import _prepare_upload_data
+    data = generate_csv_rows(rows)
+    return _timed("transform", rows, _prepare_upload_data, data,
+                  SEED_ID_DICT, _quiet_logger())
+
+
+def benchmark_kafka(rows: int) -> dict:
+    """Times decoding and the process_* chain over generated messages"""
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.kafka_pipeline import (process_val, process_site,
+                                                process_at)
+    messages = generate_messages(rows)
+
+    def process_all():
+        for raw in messages:
+            message = process_val(json.loads(raw.decode("UTF-8")),
+                                  SEED_ID_DICT)
+            message = process_site(message, SEED_ID_DICT["exhibition"])
+            process_at(message, OPENING, CLOSING)
+
+    return _timed("kafka", rows, process_all)
+
+
+# Run in a fresh interpreter per loader, so each peak RSS is its own.
+_CSV_PROBE = """
+import json, resource, sys, time
+from museum_pipeline.{module} import {func}
+
+def high_water_kb():
+    with open("/proc/self/status", encoding="utf-8") as fp:
+        return next(int(l.split()[1]) for l in fp if l.startswith("VmHWM"))
+
+baseline = high_water_kb()
+started = time.perf_counter()
+{func}(sys.argv[1])
+seconds = time.perf_counter() - started
+peak = high_water_kb()
+workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+print(json.dumps({{"seconds": round(seconds, 4),
+                  "peak_rss_mb": round(peak / 1024, 1),
+                  "rss_growth_mb": round((peak - baseline) / 1024, 1),
+                  "worker_peak_rss_mb": round(workers / 1024, 1)}}))
+"""
+
+
+def benchmark_csv(rows: int) -> dict:
+    """Compares load_csv_data with load_csv_columns on a generated csv"""
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = path.join(directory, "lmnh_hist_data.csv")
+        with open(filepath, "w", encoding="utf-8", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=["at", "site", "val",
+                                                    "type"])
+            writer.writeheader()
+            writer.writerows(iter_csv_rows(rows))
+        result = {"stage": "csv", "rows": rows,
+                  "megabytes": round(path.getsize(filepath) / 2 ** 20, 1)}
+        for module, func in [("extract", "load_csv_data"),
+                             ("columnar", "load_csv_columns")]:
+            out = subprocess.run(
+                [sys.executable, "-c",
+                 _CSV_PROBE.format(module=module, func=func), filepath],
+                check=True, capture_output=True, text=True).stdout
+            result[func] = json.loads(out)
+    return result
+
+
+# The json formatter's keys in conf_logging.json.
+LOG_FMT_KEYS = {
+    "level": "levelname", "message": "message", "timestamp": "timestamp",
+    "logger": "name", "module": "module", "function": "funcName",
+    "line": "lineno", "thread_name": "threadName"
+}
+
+
+def _flood(queue_handler, listener, rows: int, logfile: str) -> dict:
+    """Logs rows error records through a queue handler, timing until the
+    listener has written them all"""
+    logger = logging.getLogger(f"benchmark.logging.{id(queue_handler)}")
+    logger.propagate = False
+    logger.handlers = [queue_handler]
+    listener.start()
+    started = perf_counter()
+    for i in range(rows):
+        logger.error("Row %s skipped.", i)
+    listener.stop()
+    seconds = perf_counter() - started
+    listener.handlers[0].close()
+    with open(logfile, "rb") as fp:
+        written = sum(1 for _ in fp)
+    return {"seconds": round(seconds, 4),
+            "records_per_second": round(rows / seconds) if seconds else None,
+            "written": written, "dropped": rows - written}
+
+
+def reference_log_format(formatter, record: logging.LogRecord) -> str:
+    """Formats a record as JSONFormatter did before its per-record work was
+    cached, building the dict field by field; the reference for its output
+    and speed"""
+    always_fields = {
+        "message": record.getMessage(),
+        "timestamp": dt.datetime.fromtimestamp(
+            record.created, tz=dt.timezone.utc).isoformat(),
+    }
+    if record.exc_info is not None:
+        always_fields["exc_info"] = formatter.formatException(record.exc_info)
+    if record.stack_info is not None:
+        always_fields["stack_info"] = formatter.formatStack(record.stack_info)
+    message = {
+        key: msg_val
+        if (msg_val := always_fields.pop(val, None)) is not None
+        else getattr(record, val)
+        for key, val in formatter.fmt_keys.items()
+    }
+    message.update(always_fields)
+    return json.dumps(message, default=str)
+
+
+def benchmark_logging(rows: int) -> dict:
+    """Compares the stdlib queue and file handlers with the bounded,
+    batching ones, logging a flood of records to a JSONL file"""
+    # pylint: disable=import-outside-toplevel
+    import logging.handlers
+    import queue
+    from museum_pipeline.pipeline_logger import (BatchingFileHandler,
+                                                 BatchingQueueListener,
+                                                 BoundedQueueHandler,
+                                                 JSONFormatter)
+
+    class ReferenceJSONFormatter(JSONFormatter):
+        """The formatter as it was, building each record's dict afresh"""
+        def format(self, record):
+            return reference_log_format(self, record)
+
+    result = {"stage": "logging", "rows": rows}
+    with tempfile.TemporaryDirectory() as tmp:
+        logfile = path.join(tmp, "stdlib.jsonl")
+        q = queue.Queue()
+        handler = logging.handlers.RotatingFileHandler(logfile,
+                                                       maxBytes=2 ** 40)
+        handler.setFormatter(ReferenceJSONFormatter(fmt_keys=LOG_FMT_KEYS))
+        result["stdlib"] = _flood(
+            logging.handlers.QueueHandler(q),
+            logging.handlers.QueueListener(q, handler,
+                                           respect_handler_level=True),
+            rows, logfile)
+
+        logfile = path.join(tmp, "bounded.jsonl")
+        q = queue.Queue(maxsize=10000)
+        handler = BatchingFileHandler(logfile, maxBytes=2 ** 40)
+        handler.setFormatter(JSONFormatter(fmt_keys=LOG_FMT_KEYS))
+        result["bounded"] = _flood(
+            BoundedQueueHandler(q, policy="drop"),
+            BatchingQueueListener(q, handler, respect_handler_level=True),
+            rows, logfile)
+    return result
+
+
+# Single-row writes take a round trip each, so they are timed on fewer rows.
+SINGLE_ROW_LIMIT = 20000
+
+
+def _formatted_messages(rows: int) -> list[dict]:
+    """Returns generated messages as the process_* functions format them"""
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.kafka_pipeline import (process_val, process_site,
+                                                process_at)
+    messages = []
+    for raw in generate_messages(rows):
+        message = process_val(json.loads(raw), SEED_ID_DICT)
+        message = process_site(message, SEED_ID_DICT["exhibition"])
+        messages.append(process_at(message, dt.time.min, dt.time.max))
+    return messages
+
+
+def benchmark_writer(rows: int) -> dict:
+    """Times each InteractionWriter mode against a throwaway Postgres, in
+    Kafka-sized batches of 500 rows and in one bulk write"""
+    # pylint: disable=import-outside-toplevel
+    result = {"stage": "writer", "rows": rows}
+    if shutil.which("initdb", path=ENV.get("PG_BIN")) is None:
+        result["skipped"] = "needs local Postgres binaries"
+        return result
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres, _truncate
+    from museum_pipeline.metrics import METRICS
+    from museum_pipeline.writer import MODES, InteractionWriter
+    messages = _formatted_messages(rows)
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        try:
+            for mode in MODES:
+                writer = InteractionWriter(mode)
+                n = min(rows, SINGLE_ROW_LIMIT) if mode == "single" else rows
+                result[mode] = {}
+                for shape, batch_size in (("batches_of_500", 500),
+                                          ("bulk", n)):
+                    _truncate(conn)
+                    round_trips = METRICS.get("writer_round_trips_total")
+                    started = perf_counter()
+                    for i in range(0, n, batch_size):
+                        writer.write(conn, messages[i:i + batch_size])
+                    seconds = perf_counter() - started
+                    result[mode][shape] = {
+                        "rows": n, "seconds": round(seconds, 4),
+                        "rows_per_second": round(n / seconds)
+                        if seconds else None,
+                        "round_trips": METRICS.get("writer_round_trips_total")
+                        - round_trips}
+        finally:
+            conn.close()
+    return result
+
+
+def benchmark_bulk(rows: int) -> dict:
+    """Compares the pipelined InteractionWriter with bulk_load, with and
+    without dropping indexes, loading into tables which already hold rows
+    rows and the schema's index on event_at"""
+    # pylint: disable=import-outside-toplevel
+    result = {"stage": "bulk", "rows": rows}
+    if shutil.which("initdb", path=ENV.get("PG_BIN")) is None:
+        result["skipped"] = "needs local Postgres binaries"
+        return result
+    from museum_pipeline.bulk_load import bulk_load
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres, _truncate
+    from museum_pipeline.transform import _prepare_upload_data
+    from museum_pipeline.writer import WRITER
+    data = _prepare_upload_data(generate_csv_rows(rows), SEED_ID_DICT,
+                                _quiet_logger())
+    strategies = {
+        "writer": lambda conn: WRITER.write_tables(conn, data),
+        "bulk": lambda conn: bulk_load(data, conn),
+        "bulk_drop_indexes": lambda conn: bulk_load(data, conn, True),
+    }
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        try:
+            for name, load in strategies.items():
+                _truncate(conn)
+                WRITER.write_tables(conn, data)
+                started = perf_counter()
+                loaded = load(conn)
+                seconds = perf_counter() - started
+                result[name] = {"seconds": round(seconds, 4),
+                                "rows_per_second": round(rows / seconds)
+                                if seconds else None}
+                if isinstance(loaded, dict):
+                    result[name]["phases"] = loaded["phases"]
+        finally:
+            conn.close()
+    return result
+
+
+def benchmark_parallel(rows: int) -> dict:
+    """Compares loads through a ParallelLoader with 1, 2 and 4 connections,
+    against a throwaway Postgres"""
+    # pylint: disable=import-outside-toplevel
+    result = {"stage": "parallel", "rows": rows}
+    if shutil.which("initdb", path=ENV.get("PG_BIN")) is None:
+        result["skipped"] = "needs local Postgres binaries"
+        return result
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres, _truncate
+    from museum_pipeline.parallel_load import ParallelLoader
+    from museum_pipeline.transform import _prepare_upload_data
+    data = _prepare_upload_data(generate_csv_rows(rows), SEED_ID_DICT,
+                                _quiet_logger())
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        try:
+            for connections in (1, 2, 4):
+                _truncate(conn)
+                loaded = ParallelLoader(get_env_conn, connections).load(data)
+                result[f"connections_{connections}"] = {
+                    "seconds": loaded["seconds"],
+                    "rows_per_second": loaded["rows_per_second"],
+                    "per_connection": [c["rows_per_second"]
+                                       for c in loaded["connections"]]}
+        finally:
+            conn.close()
+    return result
+
+
+BENCHMARKS = {
+    "transform": benchmark_transform,
+    "kafka": benchmark_kafka,
+    "csv": benchmark_csv,
+    "logging": benchmark_logging,
+    "writer": benchmark_writer,
+    "bulk": benchmark_bulk,
+    "parallel": benchmark_parallel,
+}
+
+
+def run_benchmarks(names: list[str], rows: int) -> list[dict]:
+    """Runs the named benchmarks, returning one result dict for each"""
+    return [BENCHMARKS[name](rows) for name in names]
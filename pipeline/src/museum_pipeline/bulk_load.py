@@ -0,0 +1,253 @@
+"""Bulk loading of large historical batches into the interaction tables.
+
+The InteractionWriter inserts straight into rating_interaction and
+request_interaction, so every row updates each of their indexes and fires
+their foreign key checks one at a time. A bulk load instead runs these
+phases in a single transaction, timing each:
+
+    stage     -- COPY the rows into an UNLOGGED staging table per target,
+                 which has no indexes or constraints and skips the WAL
+    validate  -- delete staged rows whose exhibition_id, rating_id or
+                 request_id has no row in exhibition, rating or request,
+                 one anti-join per key, counting them as rejects
+    drop      -- with drop_indexes, drop the targets' secondary indexes and
+                 foreign keys
+    move      -- INSERT ... SELECT every staged row into its target, and
+                 advance the write watermark
+    rebuild   -- with drop_indexes, recreate the indexes and re-add the
+                 foreign keys, each checked in one pass over the table
+    commit    -- drop the staging tables and commit
+
+A failure rolls everything back, staging tables included. Dropping indexes
+holds an ACCESS EXCLUSIVE lock on the targets until commit, blocking the
+Kafka pipeline and the reports for the whole load, and rebuilding reads the
+whole table, so it only pays off when the load is large relative to what
+is already there. The phase timings are there to make that call.
+"""
+#pylint: disable=unused-variable
+import csv
+import io
+from time import perf_counter
+
+from psycopg2 import sql
+
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.transform import RejectReport
+from museum_pipeline.writer import TABLES, WATERMARK_SLOTS
+
+PHASES = ("stage", "validate", "drop", "move", "rebuild", "commit")
+# (lookup table, its key, reject reason) checked for each staged column.
+_REFERENCES = {
+    "rating": (("exhibition", "exhibition_id", "unknown_exhibition"),
+               ("rating", "rating_id", "unknown_value")),
+    "request": (("exhibition", "exhibition_id", "unknown_exhibition"),
+                ("request", "request_id", "unknown_value")),
+}
+_VALUE_TYPES = {"rating": "SMALLINT", "request": "INT"}
+
+
+def _stage_name(table: str, pid: int) -> sql.Identifier:
+    return sql.Identifier(f"bulk_{table}_stage_{pid}")
+
+
+def _target(table: str) -> sql.Identifier:
+    return sql.Identifier(f"{table}_interaction")
+
+
+def _copy_rows(cur, stage: sql.Identifier, rows: list[dict]) -> None:
+    """COPYs rows into a staging table from one in-memory csv"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows((r["event_at"].isoformat(), r["exhibition_id"],
+                      r["value_id"]) for r in rows)
+    buffer.seek(0)
+    cur.copy_expert(sql.SQL(
+        "COPY {} (event_at, exhibition_id, value_id) FROM STDIN WITH CSV"
+    ).format(stage), buffer)
+
+
+def secondary_indexes(cur, table: str) -> list[tuple[str, str]]:
+    """Returns (name, definition) of a target's indexes which don't back
+    a primary key or constraint"""
+    cur.execute("""
+        SELECT
+            i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+        FROM
+            pg_index AS i
+        WHERE
+            i.indrelid = %s::regclass
+            AND NOT i.indisprimary
+            AND NOT EXISTS (SELECT 1 FROM pg_constraint AS c
+                            WHERE c.conindid = i.indexrelid)
+        ORDER BY 1;""", (f"{table}_interaction",))
+    return cur.fetchall()
+
+
+def foreign_keys(cur, table: str) -> list[tuple[str, str]]:
+    """Returns (name, definition) of a target's foreign keys"""
+    cur.execute("""
+        SELECT
+            conname, pg_get_constraintdef(oid)
+        FROM
+            pg_constraint
+        WHERE
+            conrelid = %s::regclass
+            AND contype = 'f'
+        ORDER BY 1;""", (f"{table}_interaction",))
+    return cur.fetchall()
+
+
+def _validate(cur, table: str, stage: sql.Identifier,
+              rejects: RejectReport) -> None:
+    """Deletes staged rows referencing missing keys, recording each one"""
+    for lookup, key, reason in _REFERENCES[table]:
+        column = "exhibition_id" if key == "exhibition_id" else "value_id"
+        cur.execute(sql.SQL("""
+            DELETE FROM {stage} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM {lookup} AS l
+                              WHERE l.{key} = s.{column})
+            RETURNING s.event_at, s.exhibition_id, s.value_id;""").format(
+            stage=stage, lookup=sql.Identifier(lookup),
+            key=sql.Identifier(key), column=sql.Identifier(column)))
+        for event_at, exhibition_id, value_id in cur.fetchall():
+            missing = exhibition_id if column == "exhibition_id" \
+                else value_id
+            rejects.add({"table": table, "event_at": event_at,
+                         "exhibition_id": exhibition_id,
+                         "value_id": value_id}, reason,
+                        f"{key} {missing} not in {lookup}")
+
+
+def _move(cur, table: str, stage: sql.Identifier) -> int:
+    """Inserts every staged row into its target, returning the count"""
+    cur.execute(sql.SQL("""
+        INSERT INTO {target} (event_at, exhibition_id, {value})
+        SELECT event_at, exhibition_id, value_id FROM {stage};""").format(
+        target=_target(table), value=sql.Identifier(f"{table}_id"),
+        stage=stage))
+    return cur.rowcount
+
+
+def _bump_watermarks(cur, stages: list[sql.Identifier]) -> None:
+    """Advances the write watermark by the rows moved, in one statement"""
+    cur.execute(sql.SQL("""
+        INSERT INTO write_watermark
+            (museum_id, slot, rows_written, written_at)
+        SELECT
+            museum_id, pg_backend_pid() % {slots}, COUNT(*), NOW()
+        FROM
+            ({staged}) AS s
+        JOIN
+            exhibition
+        USING
+            (exhibition_id)
+        GROUP BY
+            museum_id
+        ON CONFLICT (museum_id, slot) DO UPDATE SET
+            rows_written = write_watermark.rows_written
+                + EXCLUDED.rows_written,
+            written_at = EXCLUDED.written_at;""").format(
+        slots=sql.SQL(str(WATERMARK_SLOTS)), staged=sql.SQL(" UNION ALL ").join(
+            sql.SQL("SELECT exhibition_id FROM {}").format(stage)
+            for stage in stages)))
+
+
+def bulk_load(data: dict[str, list[dict]], conn, drop_indexes: bool = False,
+              rejects: RejectReport | None = None) -> dict:
+    """Loads rows through unlogged staging tables, in one transaction
+
+    Arguments:
+        data -- {"rating": [<row>, ...], "request": [<row>, ...]}, as
+            returned by _prepare_upload_data
+        conn -- psycopg2 connection, with no transaction open
+        drop_indexes -- drop the targets' secondary indexes and foreign keys
+            before the move and rebuild them after it (Default False)
+        rejects -- RejectReport to record rows failing validation in
+            (Default a new one)
+
+    Returns:
+        a dict of rows staged, loaded and rejected, the indexes and
+        foreign keys rebuilt, and the seconds each phase took
+    """
+    rejects = rejects if rejects is not None else RejectReport()
+    rejected_before = rejects.total
+    phases = dict.fromkeys(PHASES, 0.0)
+    tables = [t for t in TABLES if data.get(t)]
+    staged = loaded = 0
+    rebuilt = {"indexes": [], "foreign_keys": []}
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_backend_pid();")
+        pid = cur.fetchone()[0]
+        stages = {t: _stage_name(t, pid) for t in tables}
+
+        started = perf_counter()
+        for table, stage in stages.items():
+            cur.execute(sql.SQL(
+                "CREATE UNLOGGED TABLE {} (event_at TIMESTAMPTZ, "
+                "exhibition_id SMALLINT, value_id {});").format(
+                stage, sql.SQL(_VALUE_TYPES[table])))
+            _copy_rows(cur, stage, data[table])
+            staged += len(data[table])
+        phases["stage"] = perf_counter() - started
+
+        started = perf_counter()
+        for table, stage in stages.items():
+            _validate(cur, table, stage, rejects)
+        phases["validate"] = perf_counter() - started
+
+        dropped = {t: ([], []) for t in tables}
+        if drop_indexes:
+            started = perf_counter()
+            for table in tables:
+                indexes, keys = secondary_indexes(cur, table), \
+                    foreign_keys(cur, table)
+                for name, _ in keys:
+                    cur.execute(sql.SQL(
+                        "ALTER TABLE {} DROP CONSTRAINT {};").format(
+                        _target(table), sql.Identifier(name)))
+                for name, _ in indexes:
+                    cur.execute(sql.SQL("DROP INDEX {};").format(
+                        sql.SQL(name)))
+                dropped[table] = (indexes, keys)
+            phases["drop"] = perf_counter() - started
+
+        started = perf_counter()
+        for table, stage in stages.items():
+            loaded += _move(cur, table, stage)
+        if stages:
+            _bump_watermarks(cur, list(stages.values()))
+        phases["move"] = perf_counter() - started
+
+        if drop_indexes:
+            started = perf_counter()
+            for table, (indexes, keys) in dropped.items():
+                for name, definition in indexes:
+                    cur.execute(definition + ";")
+                    rebuilt["indexes"].append(name)
+                for name, definition in keys:
+                    cur.execute(sql.SQL(
+                        "ALTER TABLE {} ADD CONSTRAINT {} {};").format(
+                        _target(table), sql.Identifier(name),
+                        sql.SQL(definition)))
+                    rebuilt["foreign_keys"].append(name)
+            phases["rebuild"] = perf_counter() - started
+
+        started = perf_counter()
+        for stage in stages.values():
+            cur.execute(sql.SQL("DROP TABLE {};").format(stage))
+        conn.commit()
+        phases["commit"] = perf_counter() - started
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    METRICS.inc("bulk_rows_loaded_total", loaded)
+    for phase, seconds in phases.items():
+        METRICS.set(f"bulk_{phase}_seconds", round(seconds, 4))
+    return {"rows_staged": staged, "rows_loaded": loaded,
+            "rows_rejected": rejects.total - rejected_before,
+            "rebuilt": rebuilt,
+            "phases": {phase: round(seconds, 4)
+                       for phase, seconds in phases.items()}}
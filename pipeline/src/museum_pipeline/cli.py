@@ -0,0 +1,572 @@
+"""Single `museum-pipeline` entry point for every pipeline mode.
+
+Only the standard library is imported at module load. Each subcommand
+imports the backends it needs (boto3, psycopg2, confluent_kafka) when it
+runs, so --help and offline modes start quickly.
+"""
+#pylint: disable=unused-variable,import-outside-toplevel
+import json
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from importlib import import_module
+
+from museum_pipeline.benchmark import BENCHMARKS, run_benchmarks
+
+MUSEUMS = ("lmnh", "lms")
+REPORTS = ("avg_exh_rating", "num_requests", "request_over_time",
+           "approx_stats")
+SINKS = ("postgres", "parquet", "jsonl", "null")
+
+
+def _museum_pattern(value: str) -> tuple[str, str]:
+    museum, sep, regex = value.partition("=")
+    if not sep or museum not in MUSEUMS:
+        raise ArgumentTypeError(f"expected MUSEUM=REGEX, not {value!r}")
+    return museum, regex
+
+
+def add_sink_arguments(parser: ArgumentParser) -> None:
+    """Adds the choice of output sinks to a parser"""
+    parser.add_argument("-sink", nargs="+", choices=SINKS,
+                        default=["postgres"],
+                        help="Where to write rows. Several sinks are each "
+                        "written every batch. (Default postgres)")
+    parser.add_argument("-sink_dir", default="export",
+                        help="Directory the parquet and jsonl sinks write "
+                        "<museum>/<sink> under. (Default export)")
+
+
+def add_memory_argument(parser: ArgumentParser) -> None:
+    """Adds the memory instrumentation switch to a parser"""
+    parser.add_argument("-memory_report", default=None,
+                        help="Record the peak RSS and top allocating lines "
+                        "of each stage, and write them to this JSON file on "
+                        "exit. Slows the pipeline. (Default off)")
+
+
+def add_batch_arguments(parser: ArgumentParser) -> None:
+    """Adds the S3 batch pipeline's arguments to a parser"""
+    parser.add_argument("-config_logging", action="store_true",
+                        help="Enables command-line configuration of logging"
+                        " handlers.", default=False)
+    parser.add_argument("-stdout", choices=['true', 'false'],
+                        help="Choose whether to output logs to terminal."
+                        "(Default false)",
+                        default='false')
+    parser.add_argument("-file", choices=["true", "false"],
+                        help="Choose whether to output logs to file."
+                        "(Default true)",
+                        default='true')
+    parser.add_argument("-bucket", help="Name of the s3 bucket to connect to."
+                        "(Default .env[S3_BUCKET])",
+                        default=None)
+    parser.add_argument("-rows", type=int, help="Number of rows to upload.",
+                        default=None)
+    parser.add_argument("-museums", nargs="+", choices=MUSEUMS,
+                        default=["lmnh"],
+                        help="Museums to load, concurrently. (Default lmnh)")
+    parser.add_argument("-pattern", action="append", default=[],
+                        type=_museum_pattern,
+                        metavar="MUSEUM=REGEX",
+                        help="Regex matching the whole key of a museum's "
+                        "csvs, e.g. 'lms=lms/.*\\.csv'. (Default "
+                        "<museum>_hist_data_<int>.csv)")
+    parser.add_argument("-from", dest="date_from", default=None,
+                        help="Only load rows at or after this ISO8601 date "
+                        "or datetime, skipping csvs the shard index shows "
+                        "end earlier.")
+    parser.add_argument("-to", dest="date_to", default=None,
+                        help="Only load rows before this ISO8601 date or "
+                        "datetime, skipping csvs the shard index shows "
+                        "start later.")
+    parser.add_argument("-rejects_dir", default=None,
+                        help="Write every rejected row to "
+                        "<dir>/<museum>_rejects.csv. (Default not written)")
+    parser.add_argument("-bulk", action="store_true", default=False,
+                        help="Load through unlogged staging tables, checking "
+                        "foreign keys in one pass and moving the rows in one "
+                        "statement. Reports the time of each phase.")
+    parser.add_argument("-drop_indexes", action="store_true", default=False,
+                        help="Drop the interaction tables' secondary indexes "
+                        "and foreign keys during a bulk load, rebuilding them "
+                        "after. Locks the tables until it commits. Implies "
+                        "-bulk.")
+    parser.add_argument("-connections", type=int, default=1,
+                        help="Write each museum over this many connections "
+                        "at once, in key-disjoint slices. Ignored with "
+                        "-bulk. (Default 1)")
+    parser.add_argument("-transaction_rows", type=int, default=20000,
+                        help="Rows each connection commits per transaction. "
+                        "(Default 20000)")
+    parser.add_argument("-slice_by", choices=["day", "exhibition"],
+                        default="day",
+                        help="Key the -connections slices are disjoint on. "
+                        "(Default day)")
+    add_sink_arguments(parser)
+    add_memory_argument(parser)
+
+
+def normalise_batch_arguments(args: Namespace) -> Namespace:
+    """Converts the batch pipeline's 'true'/'false' flags to bools, and its
+    -pattern flags to a dict"""
+    args.stdout = args.stdout == 'true'
+    args.file = args.file == 'true'
+    args.patterns = dict(args.pattern)
+    args.bulk = args.bulk or args.drop_indexes
+    return args
+
+
+def add_kafka_arguments(parser: ArgumentParser) -> None:
+    """Adds the Kafka pipeline's arguments to a parser"""
+    parser.add_argument('-store', action="store_true", default=False,
+                        help="Enable logging to logs/pipeline.jsonl")
+    parser.add_argument('-batch_size', type=int, default=500,
+                        help="Rows per database write, or the starting "
+                        "size when tuned. (Default 500)")
+    parser.add_argument('-flush_interval', type=float, default=1.0,
+                        help="Maximum seconds a row waits before being "
+                        "written, or the starting interval when tuned. "
+                        "(Default 1)")
+    parser.add_argument('-fixed_batching', action="store_true", default=False,
+                        help="Keep -batch_size and -flush_interval fixed "
+                        "instead of tuning them at runtime.")
+    parser.add_argument('-target_latency', type=float, default=0.25,
+                        help="Seconds a batch write should take when tuned. "
+                        "(Default 0.25)")
+    parser.add_argument('-min_batch_size', type=int, default=50,
+                        help="Smallest tuned batch size. (Default 50)")
+    parser.add_argument('-max_batch_size', type=int, default=5000,
+                        help="Largest tuned batch size. (Default 5000)")
+    parser.add_argument('-min_flush_interval', type=float, default=0.1,
+                        help="Tuned flush interval once caught up. "
+                        "(Default 0.1)")
+    parser.add_argument('-max_flush_interval', type=float, default=2.0,
+                        help="Tuned flush interval while lagging. "
+                        "(Default 2)")
+    parser.add_argument('-max_lag', type=float, default=5.0,
+                        help="Seconds behind the topic at which the "
+                        "consumer counts as lagging. (Default 5)")
+    parser.add_argument('-db_timeout', type=float, default=5.0,
+                        help="Seconds before a database write is abandoned "
+                        "and spooled locally instead. (Default 5)")
+    parser.add_argument('-spool_dir', default="spool",
+                        help="Directory for rows waiting on the database. "
+                        "(Default spool)")
+    parser.add_argument('-spool_max_mb', type=float, default=512.0,
+                        help="Size at which the spool is full and consumption "
+                        "pauses. (Default 512)")
+    parser.add_argument('-record_dir', default=None,
+                        help="Also record every raw message consumed, with "
+                        "its Kafka timestamp, to compressed segments in "
+                        "<dir>/<museum>. (Default not recorded)")
+    parser.add_argument('-exactly_once', action="store_true", default=False,
+                        help="Commit each batch with its Kafka offsets in one "
+                        "database transaction, and start from the offsets "
+                        "stored there. Pauses instead of spooling while the "
+                        "database is down.")
+    parser.add_argument('-sketches', action="store_true", default=False,
+                        help="Keep approximate statistics per exhibition and "
+                        "time bucket in the interaction_sketch table, for "
+                        "the approx_stats report.")
+    parser.add_argument('-sketch_bucket', type=int, default=3600,
+                        help="Seconds of event time per sketch. "
+                        "(Default 3600)")
+    parser.add_argument('-sketch_interval', type=float, default=60.0,
+                        help="Seconds between sketch flushes. (Default 60)")
+    parser.add_argument('-no_fast_lane', action="store_true", default=False,
+                        help="Batch emergency requests with everything else "
+                        "instead of writing each one as it arrives on its "
+                        "own connection.")
+    parser.add_argument('-emergency_hook', default=None,
+                        help="Command to run for each emergency request "
+                        "written, with the row as JSON on its stdin. "
+                        "(Default none)")
+    add_sink_arguments(parser)
+    add_memory_argument(parser)
+
+
+def add_replay_arguments(parser: ArgumentParser) -> None:
+    """Adds the Kafka replay arguments to a parser"""
+    parser.add_argument('-replay_from', default=None,
+                        help="Replay the topic from this offset or ISO8601 "
+                        "datetime, then exit.")
+    parser.add_argument('-replay_to', default=None,
+                        help="Offset or ISO8601 datetime at which to stop "
+                        "replaying. (Default now)")
+
+
+def _museum_hours(museum: str) -> tuple:
+    """Returns the opening and closing times of a museum"""
+    module = import_module(f"museum_pipeline.{museum}_kafka_pipeline")
+    return module.START_TIME, module.END_TIME
+
+
+def _batch(args: Namespace) -> None:
+    from museum_pipeline import pipeline
+    pipeline.main(normalise_batch_arguments(args))
+
+
+def _index(args: Namespace) -> None:
+    from museum_pipeline import pipeline
+    args.patterns = dict(args.pattern)
+    pipeline.index_main(args)
+
+
+def _ingest(args: Namespace) -> None:
+    from museum_pipeline import work_queue
+    if args.action == "enqueue":
+        args.patterns = dict(args.pattern)
+        work_queue.enqueue_main(args)
+    elif args.action == "work":
+        work_queue.work_main(args)
+    else:
+        work_queue.status_main(args)
+
+
+def _consume(args: Namespace) -> None:
+    if args.workers is not None:
+        from museum_pipeline import supervisor
+        supervisor.main(args)
+        return
+    from museum_pipeline.kafka_pipeline import run_pipeline
+    run_pipeline(args.museum, *_museum_hours(args.museum), args)
+
+
+def _playback(args: Namespace) -> None:
+    from museum_pipeline.kafka_pipeline import playback_main
+    playback_main(args.museum, *_museum_hours(args.museum), args)
+
+
+def _benchmark(args: Namespace) -> None:
+    for result in run_benchmarks(args.targets or sorted(BENCHMARKS),
+                                 args.rows):
+        print(json.dumps(result))
+
+
+def _loadtest(args: Namespace) -> None:
+    from museum_pipeline.loadtest import run_loadtest
+    for report in run_loadtest(args.pipelines or ["batch", "kafka"],
+                               args.duration, args.rate, args.batch_rows,
+                               args.invalid_ratio, fsync=not args.no_fsync):
+        print(json.dumps(report))
+
+
+def _reporter(args: Namespace):
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.reporting import Reporter, TTLCache
+    return Reporter(get_env_conn, TTLCache(args.cache_size, args.ttl),
+                    args.watermark_interval)
+
+
+def _report(args: Namespace) -> None:
+    from museum_pipeline.reporting import parse_bound
+    reporter = _reporter(args)
+    try:
+        rows = reporter.report(args.report, args.museum,
+                               parse_bound(args.date_from),
+                               parse_bound(args.date_to), args.sketch_bucket)
+    finally:
+        reporter.close()
+    for row in rows:
+        print(json.dumps(row, default=str))
+
+
+def _serve(args: Namespace) -> None:
+    from museum_pipeline.reporting import make_server
+    server = make_server(_reporter(args), args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _compact(args: Namespace) -> None:
+    from datetime import timedelta
+    from museum_pipeline.compaction import compact
+    from museum_pipeline.extract import get_env_conn
+    conn = get_env_conn()
+    try:
+        print(json.dumps(compact(conn, timedelta(days=args.older_than),
+                                 args.batch_size, args.pause,
+                                 args.archive_dir)))
+    finally:
+        conn.close()
+
+
+def _reconcile(args: Namespace) -> None:
+    from museum_pipeline import reconcile
+    args.patterns = dict(args.pattern)
+    reconcile.main(args)
+
+
+def _limits(args: Namespace) -> None:
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.limiter import SETTINGS, limit_status, set_limits
+    conn = get_env_conn()
+    try:
+        if args.pipeline_class is not None:
+            set_limits(conn, args.pipeline_class,
+                       **{name: getattr(args, name) for name in SETTINGS
+                          if getattr(args, name) is not None})
+        for row in limit_status(conn):
+            print(json.dumps(row, default=str))
+    finally:
+        conn.close()
+
+
+def _add_cache_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument("-ttl", type=float, default=300.0,
+                        help="Seconds a cached report is kept. (Default 300)")
+    parser.add_argument("-cache_size", type=int, default=256,
+                        help="Number of cached reports. (Default 256)")
+    parser.add_argument("-watermark_interval", type=float, default=5.0,
+                        help="Seconds between checks for new writes. "
+                        "(Default 5)")
+
+
+def get_parser() -> ArgumentParser:
+    """Returns the parser for every subcommand"""
+    parser = ArgumentParser(
+        prog="museum-pipeline",
+        description="Pipes museum kiosk data from S3 or Kafka to an RDS DB."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser(
+        "batch", help="Upload historical csvs from an s3 bucket.")
+    add_batch_arguments(batch)
+    batch.set_defaults(func=_batch)
+
+    index = subparsers.add_parser(
+        "index", help="Index the time range of every csv in an s3 bucket.")
+    index.add_argument("-bucket", default=None,
+                       help="Name of the s3 bucket to index. "
+                       "(Default .env[S3_BUCKET])")
+    index.add_argument("-museums", nargs="+", choices=MUSEUMS,
+                       default=list(MUSEUMS),
+                       help="Museums whose csvs to index. (Default all)")
+    index.add_argument("-pattern", action="append", default=[],
+                       type=_museum_pattern, metavar="MUSEUM=REGEX",
+                       help="As for batch.")
+    index.set_defaults(func=_index)
+
+    ingest = subparsers.add_parser(
+        "ingest", help="Load an s3 bucket with any number of workers, "
+        "coordinated through the ingest_shard table.")
+    actions = ingest.add_subparsers(dest="action", required=True)
+    enqueue = actions.add_parser(
+        "enqueue", help="Queue the museums' csvs in a bucket.")
+    enqueue.add_argument("-bucket", default=None,
+                         help="Name of the s3 bucket to queue. "
+                         "(Default .env[S3_BUCKET])")
+    enqueue.add_argument("-museums", nargs="+", choices=MUSEUMS,
+                         default=list(MUSEUMS),
+                         help="Museums whose csvs to queue. (Default all)")
+    enqueue.add_argument("-pattern", action="append", default=[],
+                         type=_museum_pattern, metavar="MUSEUM=REGEX",
+                         help="As for batch.")
+    enqueue.add_argument("-requeue_failed", action="store_true",
+                         default=False,
+                         help="Also retry shards which have failed.")
+    work = actions.add_parser(
+        "work", help="Claim and load queued shards until none are left.")
+    work.add_argument("-bucket", default=None,
+                      help="Name of the s3 bucket the shards are in. "
+                      "(Default .env[S3_BUCKET])")
+    work.add_argument("-processes", type=int, default=1,
+                      help="Worker processes to run on this host. "
+                      "(Default 1)")
+    work.add_argument("-owner", default=None,
+                      help="Lease owner id. (Default <hostname>:<pid>)")
+    work.add_argument("-lease_seconds", type=float, default=60.0,
+                      help="Seconds a lease lasts without a heartbeat. "
+                      "(Default 60)")
+    work.add_argument("-heartbeat_interval", type=float, default=None,
+                      help="Seconds between heartbeats. (Default a third "
+                      "of -lease_seconds)")
+    work.add_argument("-max_attempts", type=int, default=3,
+                      help="Claims of a shard before it is marked failed. "
+                      "(Default 3)")
+    work.add_argument("-wait", type=float, default=None,
+                      help="Poll for new shards every this many seconds "
+                      "instead of exiting when the queue is empty.")
+    work.add_argument("-rejects_dir", default=None,
+                      help="Write each shard's rejected rows to "
+                      "<dir>/<shard>_rejects.csv. (Default not written)")
+    actions.add_parser(
+        "status", help="Print what is left and who is processing it.")
+    ingest.set_defaults(func=_ingest)
+
+    consume = subparsers.add_parser(
+        "consume", help="Consume a museum's Kafka topic.")
+    consume.add_argument("museum", choices=MUSEUMS)
+    add_kafka_arguments(consume)
+    add_replay_arguments(consume)
+    consume.add_argument("-workers", type=int, default=None,
+                         help="Run this many worker processes under a "
+                         "supervisor. (Default a single process)")
+    consume.add_argument("-report_interval", type=float, default=30.0,
+                         help="Seconds between supervisor throughput "
+                         "reports.")
+    consume.set_defaults(func=_consume)
+
+    replay = subparsers.add_parser(
+        "replay", help="Reprocess a range of a museum's Kafka topic.")
+    replay.add_argument("museum", choices=MUSEUMS)
+    add_kafka_arguments(replay)
+    add_replay_arguments(replay)
+    replay.set_defaults(func=_consume, workers=None)
+
+    playback = subparsers.add_parser(
+        "playback", help="Play a recorded Kafka stream through the "
+        "pipeline.")
+    playback.add_argument("museum", choices=MUSEUMS)
+    playback.add_argument("recording",
+                          help="Directory written by -record_dir.")
+    playback.add_argument("-speed", type=float, default=1.0,
+                          help="Multiple of the recorded rate to play at. "
+                          "(Default 1, real time)")
+    playback.add_argument("-max_speed", action="store_true", default=False,
+                          help="Play as fast as the pipeline can go.")
+    add_sink_arguments(playback)
+    playback.add_argument("-batch_size", type=int, default=500,
+                          help="Rows per write. (Default 500)")
+    playback.add_argument("-flush_interval", type=float, default=1.0,
+                          help="Maximum seconds a row waits before being "
+                          "written. (Default 1)")
+    playback.add_argument("-quiet", action="store_true", default=False,
+                          help="Don't log each message.")
+    playback.set_defaults(func=_playback)
+
+    benchmark = subparsers.add_parser(
+        "benchmark", help="Time the pipeline's stages on generated data.")
+    benchmark.add_argument("targets", nargs="*",
+                           choices=sorted(BENCHMARKS),
+                           help="Stages to time. (Default all)")
+    benchmark.add_argument("-rows", type=int, default=100000,
+                           help="Number of rows to generate.")
+    benchmark.set_defaults(func=_benchmark)
+
+    loadtest = subparsers.add_parser(
+        "loadtest", help="Soak test the pipelines against local stand-ins "
+        "for S3, Kafka and Postgres.")
+    loadtest.add_argument("pipelines", nargs="*",
+                          choices=["batch", "kafka", "distributed"],
+                          help="Pipelines to drive. (Default both)")
+    loadtest.add_argument("-duration", type=float, default=600.0,
+                          help="Seconds to drive the Kafka pipeline for.")
+    loadtest.add_argument("-rate", type=float, default=200.0,
+                          help="Kafka messages generated per second.")
+    loadtest.add_argument("-batch_rows", type=int, default=1000000,
+                          help="Rows of csv history to generate.")
+    loadtest.add_argument("-invalid_ratio", type=float, default=0.05,
+                          help="Fraction of generated rows which are invalid.")
+    loadtest.add_argument("-no_fsync", action="store_true", default=False,
+                          help="Run the local Postgres without fsync.")
+    loadtest.set_defaults(func=_loadtest)
+
+    report = subparsers.add_parser(
+        "report", help="Print a dashboard report as JSON lines.")
+    report.add_argument("report", choices=REPORTS)
+    report.add_argument("-museum", choices=MUSEUMS, default=None,
+                        help="Museum to report on. (Default all)")
+    report.add_argument("-from", dest="date_from", default=None,
+                        help="ISO8601 date or datetime to report from.")
+    report.add_argument("-to", dest="date_to", default=None,
+                        help="ISO8601 date or datetime to report up to, "
+                        "exclusive.")
+    report.add_argument("-sketch_bucket", type=int, default=3600,
+                        help="Seconds of event time per sketch merged by "
+                        "approx_stats. (Default 3600)")
+    _add_cache_arguments(report)
+    report.set_defaults(func=_report)
+
+    serve = subparsers.add_parser(
+        "serve", help="Serve the dashboard reports over HTTP.")
+    serve.add_argument("-host", default="127.0.0.1",
+                       help="Address to listen on. (Default 127.0.0.1)")
+    serve.add_argument("-port", type=int, default=8080,
+                       help="Port to listen on. (Default 8080)")
+    _add_cache_arguments(serve)
+    serve.set_defaults(func=_serve)
+
+    compact = subparsers.add_parser(
+        "compact", help="Move old interactions into hourly counts.")
+    compact.add_argument("-older_than", type=float, default=90.0,
+                         help="Age in days past which interactions are "
+                         "compacted. (Default 90)")
+    compact.add_argument("-batch_size", type=int, default=10000,
+                         help="Rows moved per transaction. (Default 10000)")
+    compact.add_argument("-pause", type=float, default=0.0,
+                         help="Seconds to wait between batches. (Default 0)")
+    compact.add_argument("-archive_dir", default=None,
+                         help="Append moved rows to "
+                         "<dir>/<table>/<date>.csv.gz, synced before "
+                         "they are deleted. "
+                         "(Default not archived)")
+    compact.set_defaults(func=_compact)
+
+    reconcile = subparsers.add_parser(
+        "reconcile", help="Compare the source data with the database per "
+        "exhibition and day, printing the days which differ.")
+    reconcile.add_argument("-bucket", default=None,
+                           help="Name of the s3 bucket to compare. "
+                           "(Default .env[S3_BUCKET])")
+    reconcile.add_argument("-museums", nargs="+", choices=MUSEUMS,
+                           default=list(MUSEUMS),
+                           help="Museums to compare. (Default all)")
+    reconcile.add_argument("-pattern", action="append", default=[],
+                           type=_museum_pattern, metavar="MUSEUM=REGEX",
+                           help="As for batch.")
+    reconcile.add_argument("-recording_dir", default=None,
+                           help="Compare the recordings in "
+                           "<dir>/<museum> rather than the bucket's csvs.")
+    reconcile.add_argument("-from", dest="date_from", default=None,
+                           help="ISO8601 date to compare from. "
+                           "(Default the first day)")
+    reconcile.add_argument("-to", dest="date_to", default=None,
+                           help="ISO8601 date to compare up to, exclusive. "
+                           "(Default the last day)")
+    reconcile.add_argument("-reload", action="store_true", default=False,
+                           help="Replace each differing day's rows in the "
+                           "database with the source's.")
+    reconcile.set_defaults(func=_reconcile)
+
+    limits = subparsers.add_parser(
+        "limits", help="Set a pipeline class's shared write limits, then "
+        "print every class's limits and throttle state.")
+    limits.add_argument("pipeline_class", nargs="?",
+                        choices=("live", "backfill"), default=None,
+                        help="Class to change. (Default none, only print)")
+    limits.add_argument("-rows_per_second", type=float, default=None,
+                        help="Rows the class may write per second, across "
+                        "all its processes; 0 for no limit. "
+                        "(Default unchanged)")
+    limits.add_argument("-tx_per_second", type=float, default=None,
+                        help="Transactions the class may commit per second; "
+                        "0 for no limit. (Default unchanged)")
+    limits.add_argument("-burst_seconds", type=float, default=None,
+                        help="Seconds of either rate which can be saved up "
+                        "while idle. (Default unchanged)")
+    limits.add_argument("-yield_above_ms", type=float, default=None,
+                        help="Live p99 commit latency above which the class "
+                        "slows down; 0 never to. (Default unchanged)")
+    limits.add_argument("-min_factor", type=float, default=None,
+                        help="Fraction of its rates the class is never "
+                        "slowed below. (Default unchanged)")
+    limits.set_defaults(func=_limits)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> None:
+    """Entry point of the museum-pipeline command"""
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.command == "replay" and args.replay_from is None:
+        parser.error("replay requires -replay_from")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Parallel, memory-mapped parsing of at,site,val,type csvs into columns.
+
+The file is split at newline boundaries and each chunk is parsed in a
+worker process, which maps the file itself so no row data is pickled on the
+way in. Rows come back as typed arrays rather than a dict per row:
+
+    at   -- array('q'), seconds since the epoch (the csv's naive times as UTC)
+    site -- array('i')
+    val  -- array('i')
+    type -- array('d'), NaN where the csv's type is empty
+
+Quoted fields are supported, but fields containing newlines are not; the
+kiosk csvs never have them.
+"""
+#pylint: disable=unused-variable
+import csv
+import mmap
+import multiprocessing as mp
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from os import cpu_count, path
+
+COLUMNS = ("at", "site", "val", "type")
+TYPECODES = {"at": "q", "site": "i", "val": "i", "type": "d"}
+# Below this size, starting worker processes costs more than it saves.
+MIN_PARALLEL_BYTES = 8 * 2 ** 20
+WINDOW_BYTES = 2 ** 20
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _chunk_bounds(mm: mmap.mmap, start: int, chunks: int,
+                  end: int | None = None) -> list[tuple]:
+    """Splits mm[start:end] into roughly equal spans ending after a newline"""
+    end = len(mm) if end is None else end
+    step = max((end - start) // chunks, 1)
+    bounds = []
+    while start < end:
+        stop = mm.find(b"\n", min(start + step, end - 1), end)
+        stop = end if stop == -1 else stop + 1
+        bounds.append((start, stop))
+        start = stop
+    return bounds
+
+
+def _seconds(at: str, days: dict) -> int:
+    """Parses '%Y-%m-%d %H:%M:%S' to epoch seconds, caching each date"""
+    day = at[:10]
+    if day not in days:
+        days[day] = (date.fromisoformat(day).toordinal() - _EPOCH) * 86400
+    if len(at) != 19 or at[10] != " " or at[13] != ":" or at[16] != ":":
+        raise ValueError(f"Unrecognised time {at}")
+    return days[day] + int(at[11:13]) * 3600 + int(at[14:16]) * 60 \
+        + int(at[17:19])
+
+
+def _parse_chunk(filepath: str, start: int, end: int,
+                 order: tuple) -> tuple[dict, int]:
+    """Parses the rows in a byte range of a file.
+
+    The range is decoded a window at a time, so only the column arrays grow
+    with the size of the range.
+
+    Returns:
+        a dict of column arrays, and the number of rows rejected
+    """
+    columns = {c: array(TYPECODES[c]) for c in COLUMNS}
+    rejected = 0
+    with open(filepath, "rb") as fp, \
+            mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for window_start, window_end in _chunk_bounds(
+                mm, start, max((end - start) // WINDOW_BYTES, 1), end):
+            rejected += _parse_text(
+                mm[window_start:window_end].decode("utf-8"), order, columns)
+    return columns, rejected
+
+
+def _parse_text(text: str, order: tuple, columns: dict) -> int:
+    """Appends the rows in some csv text to columns, returning rejects"""
+    at_col, site_col = columns["at"], columns["site"]
+    val_col, type_col = columns["val"], columns["type"]
+    lines = text.splitlines()
+    if '"' in text:
+        rows = csv.reader(lines)
+    else:
+        rows = (line.split(",") for line in lines)
+    i_at, i_site, i_val, i_type = order
+    days = {}
+    rejected = 0
+    nan = float("nan")
+    for row in rows:
+        if not row:
+            continue
+        try:
+            at = _seconds(row[i_at], days)
+            site = int(row[i_site])
+            val = int(row[i_val])
+            request_type = float(row[i_type]) if row[i_type] else nan
+        except (ValueError, IndexError):
+            rejected += 1
+            continue
+        at_col.append(at)
+        site_col.append(site)
+        val_col.append(val)
+        type_col.append(request_type)
+    return rejected
+
+
+def load_csv_columns(filepath: str, workers: int | None = None,
+                     min_parallel_bytes: int = MIN_PARALLEL_BYTES
+                     ) -> tuple[dict[str, array], int]:
+    """Loads an at,site,val,type csv into typed column arrays.
+
+    Arguments:
+        filepath -- path of the csv to load; its header may order the
+            columns in any way
+        workers -- number of worker processes (Default one per core)
+        min_parallel_bytes -- files smaller than this are parsed in-process
+
+    Returns:
+        a dict of {<column name>: <array>}, in file order, and the number
+        of rows which could not be parsed
+    """
+    if path.getsize(filepath) == 0:
+        return {c: array(TYPECODES[c]) for c in COLUMNS}, 0
+    with open(filepath, "rb") as fp, \
+            mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_end = mm.find(b"\n")
+        header_end = len(mm) if header_end == -1 else header_end + 1
+        header = next(csv.reader([mm[:header_end].decode("utf-8")]))
+        order = tuple(header.index(c) for c in COLUMNS)
+        workers = workers or cpu_count() or 1
+        if len(mm) < min_parallel_bytes:
+            workers = 1
+        bounds = _chunk_bounds(mm, header_end, workers)
+
+    if workers == 1 or len(bounds) <= 1:
+        results = [_parse_chunk(filepath, s, e, order) for s, e in bounds]
+    else:
+        with ProcessPoolExecutor(workers,
+                                 mp_context=mp.get_context("spawn")) as pool:
+            results = list(pool.map(_parse_chunk, [filepath] * len(bounds),
+                                    [s for s, _ in bounds],
+                                    [e for _, e in bounds],
+                                    [order] * len(bounds)))
+
+    columns = {c: array(TYPECODES[c]) for c in COLUMNS}
+    rejected = 0
+    for chunk, chunk_rejected in results:
+        for c in COLUMNS:
+            columns[c].extend(chunk[c])
+        rejected += chunk_rejected
+    return columns, rejected
@@ -0,0 +1,173 @@
+"""Retention for the raw interaction tables.
+
+compact() moves interactions older than a cutoff out of rating_interaction
+and request_interaction into hourly per-exhibition counts:
+
+    rating_hourly  (exhibition_id, hour, rating_id, interactions)
+    request_hourly (exhibition_id, hour, request_id, interactions)
+
+Rows are moved in batches of at most batch_size, oldest first. Each batch
+is one transaction, which locks the rows it takes with SKIP LOCKED, deletes
+them and adds them to their hours' counts. An interaction is therefore
+always counted exactly once, in the raw table or in an hourly count, and
+the rating_history and request_history views, which union the two, answer
+the same as the raw table alone did. The dashboard views and reports read
+those. A batch only locks the raw rows it moves and the hourly rows it
+updates, so the pipelines' inserts never wait on it; a pause between
+batches bounds its share of the database. Late rows older than the cutoff
+are moved by the next run.
+
+Hours are UTC hours, so reports by day agree with the raw data in any
+session time zone a whole number of hours from UTC. Date range filters
+apply to the hour of compacted interactions.
+
+With an archive directory, each batch's raw rows are appended to
+<dir>/<table>/<YYYY-MM-DD>.csv.gz by event date, as one gzip member per
+file, and synced to disk before the batch deletes them; if the archive
+can't be written the batch is rolled back. A batch rolled back after its
+rows were archived leaves them in the archive, so a rerun archives them
+again: archived rows may repeat, but are never missing.
+"""
+#pylint: disable=unused-variable
+import csv
+import gzip
+import io
+from collections import defaultdict
+from datetime import datetime as dt, timedelta, timezone
+from os import O_RDONLY, close, fsync, makedirs, open as os_open, path
+from time import perf_counter, sleep
+
+from psycopg2 import sql
+
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.writer import TABLES
+
+_SELECT = sql.SQL("""SELECT
+                         {id}, event_at, exhibition_id, {value}
+                     FROM
+                         {raw}
+                     WHERE
+                         event_at < %s
+                     ORDER BY
+                         event_at
+                     LIMIT
+                         %s
+                     FOR UPDATE SKIP LOCKED;""")
+
+_MOVE = sql.SQL("""WITH moved AS (
+                       DELETE FROM
+                           {raw}
+                       WHERE
+                           {id} = ANY(%s)
+                       RETURNING
+                           exhibition_id, event_at, {value}
+                   )
+                   INSERT INTO {hourly}
+                       (exhibition_id, hour, {value}, interactions)
+                   SELECT
+                       exhibition_id, DATE_TRUNC('hour', event_at, 'UTC'),
+                       {value}, COUNT(*)
+                   FROM
+                       moved
+                   GROUP BY
+                       1, 2, 3
+                   ON CONFLICT (exhibition_id, hour, {value}) DO UPDATE SET
+                       interactions = {hourly}.interactions
+                           + EXCLUDED.interactions;""")
+
+
+def _identifiers(table: str) -> dict:
+    return {"raw": sql.Identifier(f"{table}_interaction"),
+            "hourly": sql.Identifier(f"{table}_hourly"),
+            "id": sql.Identifier(f"{table}_interaction_id"),
+            "value": sql.Identifier(f"{table}_id")}
+
+
+def _archive(directory: str, table: str, rows: list[tuple]) -> None:
+    """Appends raw rows to gzipped csvs, one member per event date, and
+    syncs them to disk"""
+    by_day = defaultdict(list)
+    for _, event_at, exhibition_id, value in rows:
+        by_day[event_at.astimezone(timezone.utc).date()].append(
+            (event_at.isoformat(), exhibition_id, value))
+    table_dir = path.join(directory, table)
+    makedirs(table_dir, exist_ok=True)
+    for day, day_rows in by_day.items():
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(day_rows)
+        with open(path.join(table_dir, f"{day.isoformat()}.csv.gz"),
+                  "ab") as fp:
+            fp.write(gzip.compress(buffer.getvalue().encode("utf-8")))
+            fp.flush()
+            fsync(fp.fileno())
+    descriptor = os_open(table_dir, O_RDONLY)
+    try:
+        fsync(descriptor)
+    finally:
+        close(descriptor)
+
+
+def compact_table(conn, table: str, cutoff: dt, batch_size: int = 10000,
+                  pause: float = 0.0, archive_dir: str | None = None,
+                  max_batches: int | None = None) -> dict:
+    """Moves one table's interactions from before cutoff into hourly counts
+
+    Returns:
+        a summary dict of rows moved, batches and time taken
+    """
+    names = _identifiers(table)
+    select = _SELECT.format(**names)
+    move = _MOVE.format(**names)
+    started = perf_counter()
+    moved = batches = 0
+    cur = conn.cursor()
+    try:
+        while max_batches is None or batches < max_batches:
+            cur.execute(select, (cutoff, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                conn.commit()
+                break
+            try:
+                if archive_dir is not None:
+                    _archive(archive_dir, table, rows)
+                cur.execute(move, ([row[0] for row in rows],))
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+            moved += len(rows)
+            batches += 1
+            METRICS.inc(f"compaction_{table}_rows_total", len(rows))
+            if len(rows) < batch_size:
+                break
+            if pause:
+                sleep(pause)
+    finally:
+        cur.close()
+    return {"table": table, "rows_moved": moved, "batches": batches,
+            "seconds": round(perf_counter() - started, 3)}
+
+
+def compact(conn, older_than: timedelta, batch_size: int = 10000,
+            pause: float = 0.0, archive_dir: str | None = None,
+            now: dt | None = None) -> dict:
+    """Moves every interaction older than older_than into hourly counts
+
+    Arguments:
+        conn -- psycopg2 connection
+        older_than -- age at which interactions are compacted
+        batch_size -- rows moved per transaction (Default 10000)
+        pause -- seconds to wait between batches (Default 0)
+        archive_dir -- directory to archive raw rows to before they are
+            deleted (Default not archived)
+        now -- time the age is measured from (Default now)
+
+    Returns:
+        the cutoff and a summary per table
+    """
+    cutoff = (now or dt.now(timezone.utc)) - older_than
+    return {"cutoff": cutoff.isoformat(),
+            "tables": [compact_table(conn, table, cutoff, batch_size, pause,
+                                     archive_dir)
+                       for table in TABLES]}
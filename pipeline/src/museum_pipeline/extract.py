@@ -1,6 +1,6 @@
 #pylint: disable=unused-variable
 import csv
-from os import remove, environ as ENV
+from os import makedirs, path, remove, environ as ENV
 
 import boto3
 from botocore.client import BaseClient
@@ -33,6 +33,8 @@ def download_files(boto_client: boto3, bucket: str, files: list[str]) -> None:
         raise TypeError("All elements of positional argument 'files' "
                         "must be of type str.")
     for f in files:
+        if "/" in f:
+            makedirs(path.dirname(f"data/{f}"), exist_ok=True)
         boto_client.download_file(
            bucket, f, f"data/{f}"
         )
@@ -58,8 +60,14 @@ def get_filenames(boto_client: boto3, bucket: str) -> list[str]:
     return [x["Key"] for x in raw_data["Contents"]]
 
 
-def merge_csvs(csv_paths: list[str], cols: list[str], output_path: str
-               ) -> None:
+def get_object_etags(boto_client: boto3, bucket: str) -> dict[str, str]:
+    """Lists an s3 bucket, returning {<key>: <ETag>} for every object"""
+    raw_data = boto_client.list_objects_v2(Bucket=bucket)
+    return {x["Key"]: x.get("ETag") for x in raw_data["Contents"]}
+
+
+def merge_csvs(csv_paths: list[str], cols: list[str], output_path: str,
+               keep=None) -> None:
     """Merges a list of csvs with matching columns into a single csv.
 
     Arguments:
@@ -70,6 +78,8 @@ def merge_csvs(csv_paths: list[str], cols: list[str], output_path: str
             (n.b. these must match the columns in the existing csvs.)
         output_path -- a string representing the path you wish your output to
             be piped to. [Required]
+        keep -- a function of a row, returning whether to write it
+            (Default every row is written)
 
     Returns None, but merges the named csvs into one at the output path and
         deletes the named files
@@ -79,9 +89,9 @@ def merge_csvs(csv_paths: list[str], cols: list[str], output_path: str
         writer.writeheader()
         for c in csv_paths:
             with open(c, mode="r", encoding="utf-8") as fp_c:
-                contents = list(csv.DictReader(fp_c))
-                for row in contents:
-                    writer.writerow(row)
+                for row in csv.DictReader(fp_c):
+                    if keep is None or keep(row):
+                        writer.writerow(row)
         for c in csv_paths:
             remove(c)
 
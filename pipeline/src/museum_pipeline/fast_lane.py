@@ -0,0 +1,157 @@
+"""A low-latency path for emergency requests in the Kafka pipeline.
+
+Kiosk messages with val -1 and type 1, request_value 1 in the request
+table, are emergencies. consume_messages classifies each message as soon
+as it is validated. Emergencies are handed to an EmergencyLane, which
+writes each one in its own transaction on a dedicated connection, so they
+never wait behind a batch of ratings. Every other row goes down the
+batched path as before.
+
+If the lane's write fails, the row goes back to the batched path, which
+is flushed at once and spools it if the database is down. The message's
+offset is stored with the next batch either way, so a crash between the
+lane's commit and that batch writes the emergency again.
+
+Latencies are kept apart from the batched path's, in the
+emergency_write_ms_* and emergency_latency_ms_* gauges of METRICS.
+The latency is the time from the Kafka timestamp to the lane's commit.
+"""
+#pylint: disable=unused-variable
+import json
+import shlex
+import subprocess
+import threading
+from collections import deque
+from time import perf_counter
+
+import psycopg2
+
+from museum_pipeline.metrics import METRICS, percentile
+from museum_pipeline.writer import ROW_WRITER
+
+EMERGENCY_VALUE = 1
+
+
+def is_emergency(message: dict, id_dict: dict) -> bool:
+    """Returns whether a formatted message is an emergency request"""
+    return message["table"] == "request" \
+        and message["value_id"] == id_dict["request"].get(EMERGENCY_VALUE)
+
+
+def command_hook(command: str, logger, timeout: float = 10.0):
+    """Returns a notification hook which runs a local command per emergency,
+    with the row as JSON on its stdin, on a background thread"""
+    argv = shlex.split(command)
+
+    def run(payload: bytes) -> None:
+        try:
+            subprocess.run(argv, input=payload, timeout=timeout, check=True,
+                           capture_output=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            METRICS.inc("emergency_notify_failures_total")
+            logger.error(f"Emergency hook {command!r} failed: {e}")
+
+    def notify(message: dict) -> None:
+        payload = json.dumps({"event_at": message["event_at"].isoformat(),
+                              "exhibition_id": message["exhibition_id"],
+                              "request_id": message["value_id"]})
+        threading.Thread(target=run, args=(payload.encode("UTF-8"),),
+                         daemon=True).start()
+    return notify
+
+
+class EmergencyLane:
+    """Writes and commits emergency requests one at a time
+
+    Arguments:
+        connect -- callable returning a new psycopg2 connection, used only
+            by the lane
+        id_dict -- id mapping dict, as returned by load_id_dict
+        logger -- logging object
+        notify -- optional callable taking each written row, e.g. a
+            command_hook; it should return quickly (Default none)
+        window -- latencies kept for the percentile gauges (Default 1000)
+    """
+
+    def __init__(self, connect, id_dict: dict, logger, notify=None,
+                 window: int = 1000):
+        self.connect = connect
+        self.id_dict = id_dict
+        self.logger = logger
+        self.notify = notify
+        self.conn = None
+        self.rows = 0
+        self.write_seconds = deque(maxlen=window)
+        self.latency_seconds = deque(maxlen=window)
+
+    def accepts(self, message: dict) -> bool:
+        """Returns whether a formatted message is an emergency"""
+        return is_emergency(message, self.id_dict)
+
+    def __call__(self, message: dict, lag: float | None = None) -> bool:
+        """Writes and commits one emergency, returning whether it is now in
+        the database
+
+        Arguments:
+            message -- formatted Kafka message
+            lag -- seconds between the message's Kafka timestamp and its
+                arrival, if known
+        """
+        arrived = perf_counter()
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = self.connect()
+            ROW_WRITER.write(self.conn, [message])
+        except psycopg2.Error as e:
+            METRICS.inc("emergency_write_failures_total")
+            self.logger.error(f"Emergency write failed, batching it: {e}")
+            self._reset()
+            return False
+        seconds = perf_counter() - arrived
+        self.write_seconds.append(seconds)
+        if lag is not None:
+            self.latency_seconds.append(lag + seconds)
+        self._report()
+        if self.notify is not None:
+            try:
+                self.notify(message)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                METRICS.inc("emergency_notify_failures_total")
+                self.logger.error(f"Emergency notification failed: {e}")
+        return True
+
+    def _report(self) -> None:
+        """Updates the lane's metrics"""
+        METRICS.inc("emergency_rows_total")
+        self.rows += 1
+        report = self.report()
+        for name in ("write_ms", "latency_ms"):
+            if report[name]["max"] is not None:
+                for stat, value in report[name].items():
+                    METRICS.set(f"emergency_{name}_{stat}", value)
+
+    def report(self) -> dict:
+        """Returns the lane's row count and latency percentiles in ms"""
+        def ms(values: deque) -> dict:
+            if not values:
+                return {"p50": None, "p99": None, "max": None}
+            return {"p50": round(percentile(values, 50) * 1000, 2),
+                    "p99": round(percentile(values, 99) * 1000, 2),
+                    "max": round(max(values) * 1000, 2)}
+        return {"rows": self.rows, "write_ms": ms(self.write_seconds),
+                "latency_ms": ms(self.latency_seconds)}
+
+    def _reset(self) -> None:
+        if self.conn is None:
+            return
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            self.conn.close()
+        if self.conn.closed:
+            self.conn = None
+
+    def close(self) -> None:
+        """Closes the lane's connection"""
+        if self.conn is not None:
+            self.conn.close()
@@ -1,32 +1,66 @@
 """Library module for local kafka pipeline scripts"""
 #pylint: disable=unused-variable
-from os import environ as ENV
-from json import loads
+from os import environ as ENV, path
+from json import dumps, loads
+from functools import partial
+from time import perf_counter, monotonic, time as time_now
+from uuid import uuid4
 
 from dotenv import load_dotenv
-from confluent_kafka import Consumer
-from datetime import datetime as dt, time
+from confluent_kafka import (Consumer, KafkaError, TopicPartition,
+                             TIMESTAMP_NOT_AVAILABLE)
+from datetime import datetime as dt, time, timezone
 from argparse import ArgumentParser
 
+from museum_pipeline.cli import add_kafka_arguments, add_replay_arguments
 from museum_pipeline.extract import load_id_dict, get_env_conn
+from museum_pipeline.fast_lane import (EmergencyLane, command_hook,
+                                       is_emergency)
+from museum_pipeline.limiter import BACKFILL, LIVE, limited
+from museum_pipeline.memory import MEMORY, profiled, rss_mb
+from museum_pipeline.metrics import METRICS, percentile
+from museum_pipeline.offsets import (DatabaseUnavailable, ExactlyOnceWriter,
+                                     OffsetConflict)
+from museum_pipeline.spool import Spool, SpoolDrainer, SpooledWriter, SpoolFull
 from museum_pipeline.pipeline_logger import setup_logging
+from museum_pipeline.recording import Recorder, RecordingConsumer
+from museum_pipeline.sketches import SketchAggregator
+from museum_pipeline.sinks import PostgresSink, open_sink
+from museum_pipeline.tuning import BatchTuner
+from museum_pipeline.writer import ROW_WRITER
 
 
-def get_consumer_for(topics: list[str]) -> Consumer:
+def _consumer_config() -> dict:
+    """Returns the connection settings shared by every consumer"""
     load_dotenv()
-    consumer = Consumer(
-        {
-            "bootstrap.servers": ENV["KAFKA_BOOTSTRAP_SERVERS"],
-            "security.protocol": ENV["KAFKA_SECURITY_PROTOCOL"],
-            "sasl.mechanisms": ENV["KAFKA_SASL_MECHANISMS"],
-            "sasl.username": ENV["KAFKA_SASL_USERNAME"],
-            "sasl.password": ENV["KAFKA_SASL_PASSWORD"],
-            "group.id": ENV["KAFKA_GROUP_ID"],
-            "auto.offset.reset": "earliest"
-
-        }
-    )
-    consumer.subscribe(topics)
+    return {
+        "bootstrap.servers": ENV["KAFKA_BOOTSTRAP_SERVERS"],
+        "security.protocol": ENV["KAFKA_SECURITY_PROTOCOL"],
+        "sasl.mechanisms": ENV["KAFKA_SASL_MECHANISMS"],
+        "sasl.username": ENV["KAFKA_SASL_USERNAME"],
+        "sasl.password": ENV["KAFKA_SASL_PASSWORD"],
+    }
+
+
+def get_consumer_for(topics: list[str],
+                     offsets: ExactlyOnceWriter | None = None) -> Consumer:
+    """Returns a consumer subscribed to topics in the pipeline's group
+
+    With offsets, partitions start from the offsets stored in the database
+    and nothing is committed to Kafka.
+    """
+    config = _consumer_config()
+    config["group.id"] = ENV["KAFKA_GROUP_ID"]
+    config["auto.offset.reset"] = "earliest"
+    config["enable.auto.offset.store"] = False
+    if offsets is None:
+        consumer = Consumer(config)
+        consumer.subscribe(topics)
+        return consumer
+    config["enable.auto.commit"] = False
+    consumer = Consumer(config)
+    consumer.subscribe(topics, on_assign=offsets.on_assign,
+                       on_revoke=offsets.on_revoke)
     return consumer
 
 
@@ -95,48 +129,588 @@ def process_at(message: dict, start_time: time, end_time: time) -> None:
 
 
 def upload_message(message: dict, conn) -> None:
-    """Uploads formatted Kafka messages to the database"""
+    """Uploads a single formatted Kafka message to the database"""
     if message.get("table") not in {"request", "rating"}:
         raise ValueError("INVALID: Table name not recognised.")
+    ROW_WRITER.write(conn, [message])
 
-    cur = conn.cursor()
-    if message["table"] == "request":
-        cur.execute(
-            """
-            INSERT INTO request_interaction
-                (event_at, request_id, exhibition_id)
-            VALUES
-                (%(event_at)s, %(value_id)s, %(exhibition_id)s)
-            ;
-            """, message
-        )
-    else:
-        cur.execute(
-            """
-            INSERT INTO rating_interaction
-                (event_at, rating_id, exhibition_id)
-            VALUES
-                (%(event_at)s, %(value_id)s, %(exhibition_id)s)
-            ;
-            """, message
-        )
-    conn.commit()
-    cur.close()
-
-
-def get_cla():
+
+def parse_replay_bound(bound: str) -> tuple[str, int]:
+    """Parses a replay bound into ('offset', <int>) or ('timestamp', <ms>)
+
+    Arguments:
+        bound -- either a non-negative integer offset, or an ISO8601
+                 datetime (assumed UTC when no offset is given)
+    """
+    if bound.isdigit():
+        return "offset", int(bound)
+    try:
+        at = dt.fromisoformat(bound)
+    except ValueError as e:
+        raise ValueError(f"Replay bound '{bound}' is neither an offset nor "
+                         "an ISO8601 datetime.") from e
+    if at.tzinfo is None:
+        at = at.replace(tzinfo=timezone.utc)
+    return "timestamp", int(at.timestamp() * 1000)
+
+
+def _resolve_offsets(consumer: Consumer, topic: str, bound: tuple[str, int],
+                     partitions: list[int]) -> dict[int, int]:
+    """Returns the offset of a bound on each partition of a topic.
+
+    Timestamp bounds resolve to the first message at or after the timestamp;
+    where there is no such message, the partition's high watermark is used.
+    Offset bounds are clamped to the partition's watermarks.
+    """
+    watermarks = {
+        p: consumer.get_watermark_offsets(TopicPartition(topic, p),
+                                          timeout=10)
+        for p in partitions
+    }
+    kind, value = bound
+    if kind == "offset":
+        return {p: min(max(value, low), high)
+                for p, (low, high) in watermarks.items()}
+    found = consumer.offsets_for_times(
+        [TopicPartition(topic, p, value) for p in partitions], timeout=10)
+    return {tp.partition: tp.offset if tp.offset >= 0
+            else watermarks[tp.partition][1]
+            for tp in found}
+
+
+def get_replay_consumer(topic: str, start: tuple[str, int],
+                        end: tuple[str, int]
+                        ) -> tuple[Consumer, dict[int, int]]:
+    """Returns a consumer assigned to the start of a replay range.
+
+    The consumer uses a throwaway group id and never commits, so the offsets
+    of the live group are left alone.
+
+    Returns:
+        the consumer, and a dict of {<partition>: <end offset (exclusive)>}
+        for every partition which has messages to replay
+    """
+    config = _consumer_config()
+    config["group.id"] = f"{ENV["KAFKA_GROUP_ID"]}-replay-{uuid4().hex[:8]}"
+    config["enable.auto.commit"] = False
+    config["enable.partition.eof"] = True
+    consumer = Consumer(config)
+    metadata = consumer.list_topics(topic, timeout=10)
+    partitions = list(metadata.topics[topic].partitions)
+    start_offsets = _resolve_offsets(consumer, topic, start, partitions)
+    end_offsets = _resolve_offsets(consumer, topic, end, partitions)
+    end_offsets = {p: o for p, o in end_offsets.items()
+                   if o > start_offsets[p]}
+    consumer.assign([TopicPartition(topic, p, start_offsets[p])
+                     for p in end_offsets])
+    return consumer, end_offsets
+
+
+def _drop_finished(consumer: Consumer, topic: str,
+                   end_offsets: dict[int, int]) -> None:
+    """Drops the partitions whose position has reached their end offset.
+
+    The last offset before the end may never be delivered, being a
+    transaction marker or compacted away, so a replay can't wait for it.
+    """
+    if not end_offsets:
+        return
+    for tp in consumer.position([TopicPartition(topic, p)
+                                 for p in end_offsets]):
+        if tp.offset >= end_offsets[tp.partition]:
+            del end_offsets[tp.partition]
+
+
+def run_replay(museum: str, start: time, end: time, replay_from: str,
+               replay_to: str, logger, batch_size: int = 5000,
+               recorder: Recorder | None = None,
+               sinks: list[str] | None = None,
+               sink_dir: str = "export") -> dict:
+    """Reprocesses a range of a museum topic, then returns.
+
+    Messages are validated as in run_pipeline, but uploaded in batches, and
+    invalid messages are counted rather than logged one by one.
+
+    Parameters:
+        - museum -- str, name of the museum as it appears in you database
+        - start, end -- datetime.time, opening hours of the museum
+        - replay_from -- str, offset or ISO8601 datetime to start from
+        - replay_to -- str, offset or ISO8601 datetime to stop before
+        - logger -- logging object
+        - batch_size -- int, number of rows to upload per transaction
+        - recorder -- optional Recorder, which records every message
+                      replayed
+        - sinks -- names of the sinks to write to (Default ["postgres"])
+        - sink_dir -- directory the file sinks write under
+
+    Returns:
+        a summary dict of rows uploaded, messages rejected and time taken
+    """
+    started = perf_counter()
+    consumer, end_offsets = get_replay_consumer(
+        museum, parse_replay_bound(replay_from), parse_replay_bound(replay_to))
+    conn = get_env_conn()
+    sink = open_sink(sinks or ["postgres"], sink_dir, PostgresSink(conn))
+    rows = 0
+    rejected = {}
+    batch = []
+    try:
+        id_dict = load_id_dict(conn, museum)
+        while end_offsets:
+            for msg in consumer.consume(batch_size, 1.0):
+                if msg.error() is not None:
+                    if msg.error().code() == KafkaError._PARTITION_EOF:
+                        end_offsets.pop(msg.partition(), None)
+                    else:
+                        logger.error(msg.error().str())
+                    continue
+                end_offset = end_offsets.get(msg.partition())
+                if end_offset is None:
+                    continue
+                if msg.offset() + 1 >= end_offset:
+                    del end_offsets[msg.partition()]
+                if msg.offset() >= end_offset:
+                    continue
+                if recorder is not None:
+                    recorder.record(msg)
+                if msg.value() is None:
+                    continue
+                try:
+                    message = loads(msg.value().decode("UTF-8"))
+                    message = process_val(message, id_dict)
+                    message = process_site(message, id_dict["exhibition"])
+                    message = process_at(message, start, end)
+                    batch.append(message)
+                except (KeyError, ValueError, TypeError) as e:
+                    rejected[str(e)] = rejected.get(str(e), 0) + 1
+            _drop_finished(consumer, museum, end_offsets)
+            if len(batch) >= batch_size or (batch and not end_offsets):
+                rows += sink(batch)
+                batch = []
+    finally:
+        consumer.close()
+        sink.close()
+        conn.close()
+        if recorder is not None:
+            recorder.close()
+    summary = {
+        "museum": museum,
+        "rows": rows,
+        "rejected": rejected,
+        "seconds": round(perf_counter() - started, 3)
+    }
+    logger.info(summary)
+    return summary
+
+
+def get_cla(argv: list[str] | None = None):
     """Returns cli argument values"""
     parser = ArgumentParser(
         prog='Sigma Labs Data Pipeline',
         description='Pipes data from a Kafka stream to an RDS DB.'
     )
-    parser.add_argument('-store', action="store_true", default=False,
-                        help="Enable logging to logs/pipeline.jsonl")
-    args = parser.parse_args()
+    add_kafka_arguments(parser)
+    add_replay_arguments(parser)
+    args = parser.parse_args(argv)
     return args
 
 
-def run_pipeline(museum: str, start: time, end: time) -> None:
+def _next_offsets(msgs: list) -> dict[tuple[str, int], int]:
+    """Returns the offset after the last of msgs on each partition"""
+    return {(msg.topic(), msg.partition()): msg.offset() + 1 for msg in msgs}
+
+
+def _store_offsets(consumer: Consumer, msgs: list) -> None:
+    """Marks messages as handled, so the next auto-commit includes them"""
+    latest = _next_offsets(msgs)
+    if latest:
+        consumer.store_offsets(offsets=[
+            TopicPartition(topic, partition, offset)
+            for (topic, partition), offset in latest.items()])
+
+
+def _lag(msg) -> float | None:
+    """Returns the seconds since a message was produced, if it is known"""
+    timestamp_type, timestamp = msg.timestamp()
+    if timestamp_type == TIMESTAMP_NOT_AVAILABLE:
+        return None
+    return max(0.0, time_now() - timestamp / 1000)
+
+
+def _write_batch(consumer: Consumer, write, batch: list[dict],
+                 logger, held: tuple = ()):
+    """Writes a batch, pausing consumption for as long as the spool is full
+
+    Returns what write returned, e.g. 'db' or 'spool' for a SpooledWriter.
+    An ExactlyOnceWriter which can't reach the database is retried the same
+    way.
+
+    The consumer is polled while paused to keep its group membership. A
+    rebalance can assign it partitions which aren't paused, so the whole
+    assignment is paused before every poll, and a message polled anyway is
+    sought back to, to be consumed again once the batch is written.
+    Partitions in held, (topic, partition) pairs paused by someone else,
+    stay paused.
+    """
+    paused = False
+    try:
+        while True:
+            try:
+                return write(batch)
+            except (SpoolFull, DatabaseUnavailable) as e:
+                if not paused:
+                    logger.warning(f"{e} Pausing consumption.")
+                    paused = True
+                consumer.pause(consumer.assignment())
+                msg = consumer.poll(1.0)
+                if msg is not None and msg.error() is None:
+                    consumer.seek(TopicPartition(msg.topic(), msg.partition(),
+                                                 msg.offset()))
+    finally:
+        if paused:
+            consumer.resume([tp for tp in consumer.assignment()
+                             if (tp.topic, tp.partition) not in held])
+
+
+def consume_messages(consumer: Consumer, write, id_dict: dict, start: time,
+                     end: time, logger, should_stop=None, processed=None,
+                     batch_size: int = 500, flush_interval: float = 1.0,
+                     metrics_interval: float = 60.0,
+                     tuner: BatchTuner | None = None,
+                     recorder: Recorder | None = None,
+                     fast_lane: EmergencyLane | None = None,
+                     exactly_once: bool = False,
+                     sketches: SketchAggregator | None = None) -> None:
+    """Polls a consumer, writing valid messages in batches, until told to stop
+
+    A message's offset is only stored for commit once the batch holding it is
+    durable, in the database or the spool. Emergencies accepted by fast_lane
+    are written as soon as they arrive instead, and their offsets stored with
+    the next batch.
+
+    With exactly_once, write is an ExactlyOnceWriter, called with each batch
+    and the offsets it takes each partition to, which it commits together.
+    Batches of only invalid messages are written too, to move the offsets
+    on. Emergencies then flush the batch at once instead of taking the fast
+    lane, whose separate commit would break the guarantee. Partitions the
+    writer couldn't read offsets for on assignment are retried between
+    polls.
+
+    Parameters:
+        - consumer -- confluent_kafka.Consumer, subscribed to a museum topic
+                      with enable.auto.offset.store disabled
+        - write -- callable taking a list of formatted messages, which
+                   returns once they are durable; e.g. a SpooledWriter
+        - id_dict -- id mapping dict, as returned by load_id_dict
+        - start, end -- datetime.time, opening hours of the museum
+        - logger -- logging object
+        - should_stop -- optional callable, checked between polls; the loop
+                         flushes and returns once it returns True
+                         (Default never)
+        - processed -- optional multiprocessing.Value, incremented for every
+                       row written
+        - batch_size -- int, number of rows at which to flush
+        - flush_interval -- float, seconds after which to flush regardless
+        - metrics_interval -- float, seconds between metrics log lines
+        - tuner -- optional BatchTuner, which replaces batch_size and
+                   flush_interval after each flush (Default fixed)
+        - recorder -- optional Recorder, which records every message
+                      consumed, valid or not (Default not recorded)
+        - fast_lane -- optional EmergencyLane, which writes emergency
+                       requests outside the batches (Default batched)
+        - exactly_once -- bool, whether write commits offsets with the rows
+                          (Default offsets stored for Kafka to commit)
+        - sketches -- optional SketchAggregator, which sketches every valid
+                      message and is flushed as it falls due and on return
+                      (Default not sketched)
+    """
+    batch = []
+    handled = []
+    urgent = False
+    last_flush = last_metrics = monotonic()
+    while True:
+        if tuner is not None:
+            batch_size = tuner.batch_size
+            flush_interval = tuner.flush_interval
+        stopping = should_stop is not None and should_stop()
+        if exactly_once:
+            write.resume_pending()
+        msg = None if stopping else consumer.poll(
+            max(min(flush_interval, 1.0), 0.01))
+
+        if msg is not None and msg.error() is not None:
+            logger.error(msg.error().str())
+        elif msg is not None:
+            handled.append(msg)
+            if recorder is not None:
+                recorder.record(msg)
+            try:
+                if msg.value() is not None:
+                    message = loads(msg.value().decode("UTF-8"))
+                    message = process_val(message, id_dict)
+                    message = process_site(message, id_dict["exhibition"])
+                    message = process_at(message, start, end)
+                    if sketches is not None:
+                        sketches.observe(message)
+                    if exactly_once and is_emergency(message, id_dict):
+                        batch.append(message)
+                        urgent = True
+                    elif fast_lane is None or not fast_lane.accepts(message):
+                        batch.append(message)
+                    elif fast_lane(message, _lag(msg)):
+                        logger.info(message)
+                        if processed is not None:
+                            processed.value += 1
+                    else:
+                        batch.append(message)
+                        urgent = True
+            except (KeyError, ValueError, TypeError) as e:
+                logger.error(str(e))
+
+        if handled and (stopping or urgent or len(batch) >= batch_size
+                        or monotonic() - last_flush >= flush_interval):
+            seconds = None
+            if batch or exactly_once:
+                started = monotonic()
+                write_batch = write
+                if exactly_once:
+                    write_batch = partial(write,
+                                          offsets=_next_offsets(handled))
+                try:
+                    with MEMORY.stage("kafka.write"):
+                        written_to = _write_batch(
+                            consumer, write_batch, batch, logger,
+                            tuple(write.pending) if exactly_once else ())
+                except OffsetConflict as e:
+                    logger.warning(str(e))
+                    batch = []
+                    written_to = None
+                if written_to not in ("spool", None):
+                    seconds = monotonic() - started
+                for message in batch:
+                    logger.info(message)
+                if processed is not None:
+                    processed.value += len(batch)
+            if not exactly_once:
+                _store_offsets(consumer, handled)
+            if tuner is not None:
+                tuner.observe(len(batch), seconds, _lag(handled[-1]))
+            batch = []
+            handled = []
+            urgent = False
+            last_flush = monotonic()
+        if sketches is not None:
+            if stopping:
+                sketches.flush()
+            else:
+                sketches.maybe_flush()
+        if monotonic() - last_metrics >= metrics_interval:
+            METRICS.set("rss_mb", round(rss_mb() or 0.0, 1))
+            logger.info({"metrics": METRICS.snapshot()})
+            last_metrics = monotonic()
+        if stopping:
+            return
+
+
+def _db_connector(timeout: float):
+    """Returns a function opening connections with a statement timeout"""
+    def connect():
+        conn = get_env_conn()
+        cur = conn.cursor()
+        cur.execute("SET statement_timeout = %s;", (int(timeout * 1000),))
+        conn.commit()
+        cur.close()
+        return conn
+    return connect
+
+
+def consume_museum(museum: str, start: time, end: time, args, logger,
+                   id_dict: dict | None = None, spool_dir: str | None = None,
+                   should_stop=None, processed=None,
+                   record_dir: str | None = None,
+                   sink_dir: str | None = None) -> None:
+    """Consumes a museum topic, spooling locally whenever the DB lags
+
+    With args.exactly_once, batches are instead written with their offsets
+    through an ExactlyOnceWriter, and consumption pauses while the database
+    is down. Anything left in the spool by an earlier run is still drained.
+
+    Parameters:
+        - museum -- str, name of the museum as it appears in you database
+        - start, end -- datetime.time, opening hours of the museum
+        - args -- argparse.Namespace, with the arguments of get_cla
+        - logger -- logging object
+        - id_dict -- id mapping dict (Default loaded from the database)
+        - spool_dir -- directory for this consumer's spool
+                       (Default args.spool_dir/<museum>)
+        - should_stop, processed -- as for consume_messages
+        - record_dir -- directory to record this consumer's raw messages in
+                        (Default args.record_dir/<museum>, if set)
+        - sink_dir -- directory for this consumer's file sinks
+                      (Default args.sink_dir/<museum>)
+    """
+    connect = _db_connector(args.db_timeout)
+    if id_dict is None:
+        conn = get_env_conn()
+        try:
+            id_dict = load_id_dict(conn, museum)
+        finally:
+            conn.close()
+        logger.info(id_dict)
+    if spool_dir is None:
+        spool_dir = path.join(args.spool_dir, museum)
+    spool = Spool(spool_dir, int(args.spool_max_mb * 2 ** 20))
+    if args.exactly_once:
+        if args.sink != ["postgres"]:
+            raise ValueError("-exactly_once only writes to the postgres "
+                             "sink.")
+        writer = sink = ExactlyOnceWriter(connect, ENV["KAFKA_GROUP_ID"],
+                                          logger)
+    else:
+        writer = SpooledWriter(connect, spool, logger)
+        if sink_dir is None:
+            sink_dir = path.join(args.sink_dir, museum)
+        sink = open_sink(args.sink, sink_dir, writer)
+    drainer = SpoolDrainer(spool, connect, logger)
+    drainer.start()
+    tuner = None
+    if not args.fixed_batching:
+        tuner = BatchTuner(args.batch_size, args.flush_interval,
+                           args.target_latency, args.min_batch_size,
+                           args.max_batch_size, args.min_flush_interval,
+                           args.max_flush_interval, args.max_lag)
+    if record_dir is None and args.record_dir is not None:
+        record_dir = path.join(args.record_dir, museum)
+    recorder = Recorder(record_dir) if record_dir is not None else None
+    fast_lane = None
+    if "postgres" in args.sink and not args.no_fast_lane \
+            and not args.exactly_once:
+        notify = None
+        if args.emergency_hook is not None:
+            notify = command_hook(args.emergency_hook, logger)
+        fast_lane = EmergencyLane(connect, id_dict, logger, notify)
+    sketches = None
+    if args.sketches:
+        sketches = SketchAggregator(connect, id_dict, logger,
+                                    args.sketch_bucket, args.sketch_interval)
+    consumer = get_consumer_for(
+        [museum], writer if args.exactly_once else None)
+    try:
+        consume_messages(consumer, sink, id_dict, start, end, logger,
+                         should_stop=should_stop, processed=processed,
+                         batch_size=args.batch_size,
+                         flush_interval=args.flush_interval, tuner=tuner,
+                         recorder=recorder, fast_lane=fast_lane,
+                         exactly_once=args.exactly_once, sketches=sketches)
+    finally:
+        consumer.close()
+        if sketches is not None:
+            sketches.close()
+        if fast_lane is not None:
+            fast_lane.close()
+            logger.info({"emergency_lane": fast_lane.report()})
+        drainer.stop()
+        if sink is not writer:
+            sink.close()
+        writer.close()
+        spool.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def run_playback(recording: str, write, id_dict: dict, start: time,
+                 end: time, logger, speed: float | None = 1.0,
+                 batch_size: int = 500, flush_interval: float = 1.0) -> dict:
+    """Plays a recording through consume_messages and a writer.
+
+    Parameters:
+        - recording -- directory of a Recorder's segments
+        - write -- callable taking a list of formatted messages, as for
+                   consume_messages
+        - id_dict -- id mapping dict, as returned by load_id_dict
+        - start, end -- datetime.time, opening hours of the museum
+        - logger -- logging object
+        - speed -- float, multiple of the recorded rate to play at, or None
+                   for as fast as possible
+        - batch_size, flush_interval -- as for consume_messages
+
+    Returns:
+        a summary dict of messages played, rows written and rejected, time
+        taken against the recorded span, and write latencies
+    """
+    consumer = RecordingConsumer(recording, speed)
+    latencies = []
+    rows = 0
+
+    def timed_write(batch: list[dict]):
+        nonlocal rows
+        started = perf_counter()
+        result = write(batch)
+        latencies.append(perf_counter() - started)
+        rows += len(batch)
+        return result
+
+    started = perf_counter()
+    try:
+        consume_messages(consumer, timed_write, id_dict, start, end, logger,
+                         should_stop=lambda: consumer.exhausted,
+                         batch_size=batch_size,
+                         flush_interval=flush_interval)
+    finally:
+        consumer.close()
+    seconds = perf_counter() - started
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "messages": consumer.released,
+        "rows_written": rows,
+        "messages_rejected": consumer.released - rows,
+        "seconds": round(seconds, 3),
+        "recorded_seconds": round(consumer.recorded_seconds, 3),
+        "speed": round(consumer.recorded_seconds / seconds, 2)
+        if seconds else None,
+        "messages_per_second": round(consumer.released / seconds, 1)
+        if seconds else None,
+        "write_latency_ms": {"p50": ms(percentile(latencies, 50)),
+                             "p99": ms(percentile(latencies, 99)),
+                             "max": ms(max(latencies, default=None))}
+    }
+
+
+def playback_main(museum: str, start: time, end: time, args) -> dict:
+    """Plays a recording of a museum's topic into its sinks, and prints a
+    JSON summary
+
+    Parameters:
+        - museum -- str, name of the museum as it appears in you database
+        - start, end -- datetime.time, opening hours of the museum
+        - args -- argparse.Namespace, with recording, speed, max_speed,
+                  sink, sink_dir, batch_size, flush_interval and quiet
+    """
+    logger = setup_logging(f"{museum}_playback", ["stdout"])
+    logger.disabled = args.quiet
+    conn = get_env_conn()
+    try:
+        id_dict = load_id_dict(conn, museum)
+        sink = open_sink(args.sink, path.join(args.sink_dir, museum),
+                         PostgresSink(conn))
+        try:
+            summary = run_playback(args.recording, sink, id_dict, start,
+                                   end, logger,
+                                   None if args.max_speed else args.speed,
+                                   args.batch_size, args.flush_interval)
+        finally:
+            sink.close()
+    finally:
+        conn.close()
+    summary = {"museum": museum, "sink": args.sink, **summary}
+    print(dumps(summary))
+    return summary
+
+
+def run_pipeline(museum: str, start: time, end: time, args=None) -> None:
     """Handles the core logic of the pipeline
 
     Parameters:
@@ -145,8 +719,11 @@ def run_pipeline(museum: str, start: time, end: time) -> None:
                    disregarded
         - end -- datetime.time, time after which interactions should be
                  disregarded
+        - args -- argparse.Namespace, as returned by get_cla (Default parsed
+                  from the command line)
     """
-    args = get_cla()
+    if args is None:
+        args = get_cla()
     handlers: list[str]
     if args.store:
         handlers = ["file"]
@@ -154,31 +731,19 @@ def run_pipeline(museum: str, start: time, end: time) -> None:
         handlers = ["stdout"]
     logger = setup_logging(f"{museum}_kafka_pipeline", handlers)
 
-    consumer = get_consumer_for([museum])
-    conn = get_env_conn()
-    try:
-        id_dict = load_id_dict(conn, museum)
-        logger.info(id_dict)
-
-        while True:
-            msg = consumer.poll(1.0)
-
-            if msg is None:
-                continue
-            if msg.error() is not None:
-                logger.error(msg.error().str())
-                continue
-            if msg.value() is None:
-                continue
+    pipeline_class = BACKFILL if args.replay_from is not None else LIVE
+    with profiled(args.memory_report, logger), \
+            limited(_db_connector(args.db_timeout), pipeline_class, logger):
+        if args.replay_from is not None:
+            replay_to = args.replay_to
+            if replay_to is None:
+                replay_to = dt.now(timezone.utc).isoformat()
+            recorder = None
+            if args.record_dir is not None:
+                recorder = Recorder(path.join(args.record_dir, museum))
+            run_replay(museum, start, end, args.replay_from, replay_to,
+                       logger, recorder=recorder, sinks=args.sink,
+                       sink_dir=path.join(args.sink_dir, museum))
+            return
 
-            try:
-                msg = loads(msg.value().decode("UTF-8"))
-                msg = process_val(msg, id_dict)
-                msg = process_site(msg, id_dict["exhibition"])
-                msg = process_at(msg, start, end)
-                upload_message(msg, conn)
-                logger.info(msg)
-            except (KeyError, ValueError, TypeError) as e:
-                logger.error(str(e))
-    finally:
-        conn.close()
+        consume_museum(museum, start, end, args, logger)
@@ -0,0 +1,415 @@
+"""Shared write-rate limits, so backfills don't starve the live pipelines.
+
+Every process writing interactions belongs to a pipeline class: "live" for
+the Kafka consumers, "backfill" for the batch pipeline, the ingest workers
+and Kafka replays. Each class has a row in write_limit holding its limits,
+in rows and transactions per second, and a token bucket for each limit.
+The buckets are in the database, so every process of a class, on any host,
+draws on the same ones.
+
+Before each write the InteractionWriter reserves its rows and one
+transaction from its class's buckets, in one UPDATE which refills them for
+the time since the last reservation, up to burst_seconds of the rate, and
+takes the tokens. A bucket may go into debt; the writer then sleeps until
+the debt would be repaid, so writers are served in the order they asked
+and a wait costs one round trip however long it is. The UPDATE runs on the
+limiter's own autocommit connection, never inside a write's transaction.
+
+Live consumers report the p99 of their recent commit latencies to the live
+row every report_interval seconds; within one interval the worst report
+wins. A class with yield_above_ms set adapts its rate_factor, which scales
+both of its rates, every adjust_interval seconds: halving it, down to
+min_factor, while the live p99 is above yield_above_ms, and adding
+RECOVERY_STEP back, up to 1, while it isn't or no live consumer has
+reported lately. One process of the class makes each adjustment, through a
+conditional UPDATE. The live class is never slowed for the backfills.
+
+A class that yields but has no rates set, as the backfills in a new
+database, scales the rate it achieves instead: each writer, after a write
+that took t seconds, sleeps t * (1 / rate_factor - 1) before its next, so
+it writes at rate_factor of its unthrottled throughput. It reads the
+factor once per adjust_interval.
+
+Limits are read from write_limit every refresh_interval seconds, and a
+class with neither rates nor yield_above_ms set costs no round trips. If
+write_limit can't be reached, writes go ahead unthrottled.
+"""
+#pylint: disable=unused-variable
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from museum_pipeline.metrics import METRICS, percentile
+
+LIVE = "live"
+BACKFILL = "backfill"
+CLASSES = (LIVE, BACKFILL)
+SETTINGS = ("rows_per_second", "tx_per_second", "burst_seconds",
+            "yield_above_ms", "min_factor")
+RECOVERY_STEP = 0.1
+
+_RESERVE = """
+    UPDATE
+        write_limit
+    SET
+        row_tokens = CASE WHEN rows_per_second IS NULL THEN 0 ELSE LEAST(
+            rows_per_second * rate_factor * burst_seconds,
+            row_tokens + rows_per_second * rate_factor
+                * EXTRACT(EPOCH FROM clock_timestamp() - refilled_at)
+                    ::DOUBLE PRECISION)
+            - %(rows)s END,
+        tx_tokens = CASE WHEN tx_per_second IS NULL THEN 0 ELSE LEAST(
+            tx_per_second * rate_factor * burst_seconds,
+            tx_tokens + tx_per_second * rate_factor
+                * EXTRACT(EPOCH FROM clock_timestamp() - refilled_at)
+                    ::DOUBLE PRECISION)
+            - 1 END,
+        refilled_at = clock_timestamp()
+    WHERE
+        pipeline_class = %(class)s
+    RETURNING
+        row_tokens, tx_tokens, rows_per_second * rate_factor,
+        tx_per_second * rate_factor, rate_factor;"""
+
+_ADJUST = """
+    UPDATE
+        write_limit AS w
+    SET
+        rate_factor = CASE
+            WHEN live.p99 > w.yield_above_ms
+                THEN GREATEST(w.min_factor, w.rate_factor / 2)
+            ELSE LEAST(1, w.rate_factor + %(step)s) END,
+        adjusted_at = clock_timestamp()
+    FROM
+        (SELECT
+             MAX(commit_p99_ms) FILTER (WHERE reported_at
+                 > clock_timestamp() - %(stale)s * INTERVAL '1 second')
+             AS p99
+         FROM
+             write_limit
+         WHERE
+             pipeline_class = %(live)s) AS live
+    WHERE
+        w.pipeline_class = %(class)s
+    AND
+        w.yield_above_ms IS NOT NULL
+    AND
+        w.adjusted_at <= clock_timestamp() - %(interval)s * INTERVAL '1 second'
+    RETURNING
+        w.rate_factor, live.p99;"""
+
+_FACTOR = """
+    SELECT
+        rate_factor
+    FROM
+        write_limit
+    WHERE
+        pipeline_class = %s;"""
+
+_REPORT = """
+    UPDATE
+        write_limit
+    SET
+        commit_p99_ms = CASE
+            WHEN reported_at IS NULL OR reported_at
+                <= clock_timestamp() - %(interval)s * INTERVAL '1 second'
+                THEN %(p99)s
+            ELSE GREATEST(commit_p99_ms, %(p99)s) END,
+        reported_at = CASE
+            WHEN reported_at IS NULL OR reported_at
+                <= clock_timestamp() - %(interval)s * INTERVAL '1 second'
+                THEN clock_timestamp()
+            ELSE reported_at END
+    WHERE
+        pipeline_class = %(class)s;"""
+
+
+def paced_wait(write_seconds: float, factor: float) -> float:
+    """Returns the seconds to sleep after a write so a writer runs at
+    factor of its unthrottled throughput"""
+    if factor >= 1:
+        return 0.0
+    return write_seconds * (1 / factor - 1)
+
+
+def debt_wait(row_tokens: float, tx_tokens: float, row_rate: float | None,
+              tx_rate: float | None) -> float:
+    """Returns the seconds until both buckets are out of debt"""
+    wait = 0.0
+    for tokens, rate in ((row_tokens, row_rate), (tx_tokens, tx_rate)):
+        if rate and tokens < 0:
+            wait = max(wait, -tokens / rate)
+    return wait
+
+
+class WriteLimiter:
+    """Throttles a process's writes to its pipeline class's shared limits
+
+    Disabled, and free, until started.
+
+    Arguments:
+        refresh_interval -- seconds between reads of the class's limits
+        report_interval -- seconds between live latency reports
+        adjust_interval -- seconds between rate_factor adjustments
+        clock, pause -- monotonic clock and sleep, replaceable in tests
+    """
+
+    def __init__(self, refresh_interval: float = 5.0,
+                 report_interval: float = 1.0, adjust_interval: float = 2.0,
+                 clock=monotonic, pause=sleep):
+        self.refresh_interval = refresh_interval
+        self.report_interval = report_interval
+        self.adjust_interval = adjust_interval
+        self.clock = clock
+        self.pause = pause
+        self.connect = None
+        self.pipeline_class = None
+        self.logger = None
+        self.conn = None
+        self.limits = None
+        self.factor = 1.0
+        self.commits = deque(maxlen=1000)
+        self._refreshed_at = self._reported_at = self._adjusted_at = None
+        self._lock = threading.Lock()
+        self._waited = threading.local()
+        self._written = threading.local()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the limiter has been started"""
+        return self.pipeline_class is not None
+
+    def start(self, connect, pipeline_class: str, logger=None) -> None:
+        """Throttles this process's writes as pipeline_class's
+
+        Arguments:
+            connect -- callable returning a new psycopg2 connection
+            pipeline_class -- one of CLASSES
+            logger -- logging object (Default failures aren't logged)
+        """
+        if pipeline_class not in CLASSES:
+            raise ValueError(f"Unknown pipeline class {pipeline_class}")
+        with self._lock:
+            self._close()
+            self.connect = connect
+            self.pipeline_class = pipeline_class
+            self.logger = logger
+            self.limits = None
+            self.factor = 1.0
+            self.commits.clear()
+            self._refreshed_at = self._reported_at = None
+            self._adjusted_at = None
+
+    def stop(self) -> None:
+        """Stops throttling and closes the limiter's connection"""
+        with self._lock:
+            self._close()
+            self.pipeline_class = None
+
+    def _close(self) -> None:
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+            self.conn = None
+
+    def _cursor(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+            self.conn.autocommit = True
+        return self.conn.cursor()
+
+    def _failed(self, error: psycopg2.Error) -> None:
+        """Drops the connection and lets writes through until the next
+        refresh"""
+        METRICS.inc("write_limit_errors_total")
+        if self.logger is not None:
+            self.logger.warning(f"Write limits unavailable, not throttling: "
+                                f"{error}")
+        self._close()
+        self.limits = {}
+        self._refreshed_at = self.clock()
+
+    def _due(self, last: float | None, interval: float) -> bool:
+        return last is None or self.clock() - last >= interval
+
+    def _refresh(self, cur) -> None:
+        cur.execute("SELECT rows_per_second, tx_per_second, yield_above_ms "
+                    "FROM write_limit WHERE pipeline_class = %s;",
+                    (self.pipeline_class,))
+        row = cur.fetchone()
+        self.limits = {} if row is None else dict(
+            zip(("rows_per_second", "tx_per_second", "yield_above_ms"), row))
+        self._refreshed_at = self.clock()
+        prefix = f"write_limit_{self.pipeline_class}"
+        METRICS.set(f"{prefix}_rows_per_second_limit",
+                    self.limits.get("rows_per_second"))
+        METRICS.set(f"{prefix}_tx_per_second_limit",
+                    self.limits.get("tx_per_second"))
+
+    def _adjust(self, cur, read: bool) -> None:
+        """Adjusts the class's rate_factor if no process has this interval;
+        with read, also reads the factor into self.factor"""
+        self._adjusted_at = self.clock()
+        cur.execute(_ADJUST, {"step": RECOVERY_STEP,
+                              "stale": 3 * self.report_interval,
+                              "live": LIVE, "class": self.pipeline_class,
+                              "interval": self.adjust_interval})
+        row = cur.fetchone()
+        if row is not None:
+            METRICS.set("write_limit_live_commit_p99_ms", row[1])
+            METRICS.inc(f"write_limit_{self.pipeline_class}_adjustments_total")
+        elif read:
+            cur.execute(_FACTOR, (self.pipeline_class,))
+            row = cur.fetchone()
+        if read:
+            self.factor = 1.0 if row is None else row[0]
+
+    def acquire(self, rows: int) -> float:
+        """Reserves rows and one transaction, sleeping off any debt, or in
+        a class without rates paces the write to the class's rate_factor
+
+        Returns:
+            the seconds slept
+        """
+        if not self.enabled:
+            return 0.0
+        prefix = f"write_limit_{self.pipeline_class}"
+        with self._lock:
+            row = None
+            try:
+                if self._due(self._refreshed_at, self.refresh_interval):
+                    self._refresh(self._cursor())
+                rated = self.limits.get("rows_per_second") is not None \
+                    or self.limits.get("tx_per_second") is not None
+                yields = self.limits.get("yield_above_ms") is not None
+                if not rated and not yields:
+                    return 0.0
+                cur = self._cursor()
+                if yields and self._due(self._adjusted_at,
+                                        self.adjust_interval):
+                    self._adjust(cur, read=not rated)
+                if rated:
+                    cur.execute(_RESERVE, {"rows": rows,
+                                           "class": self.pipeline_class})
+                    row = cur.fetchone()
+            except psycopg2.Error as e:
+                self._failed(e)
+                return 0.0
+            if not rated:
+                wait = paced_wait(getattr(self._written, "seconds", 0.0),
+                                  self.factor)
+                self._written.seconds = 0.0
+                METRICS.set(f"{prefix}_rate_factor", self.factor)
+            elif row is None:
+                return 0.0
+            else:
+                row_tokens, tx_tokens, row_rate, tx_rate, factor = row
+                wait = debt_wait(row_tokens, tx_tokens, row_rate, tx_rate)
+                METRICS.set(f"{prefix}_rows_per_second", row_rate)
+                METRICS.set(f"{prefix}_tx_per_second", tx_rate)
+                METRICS.set(f"{prefix}_rate_factor", factor)
+        self._waited.seconds = getattr(self._waited, "seconds", 0.0) + wait
+        METRICS.set(f"{prefix}_throttled_seconds", round(wait, 3))
+        if wait > 0:
+            METRICS.inc(f"{prefix}_waits_total")
+            METRICS.inc(f"{prefix}_wait_seconds_total", wait)
+            self.pause(wait)
+        return wait
+
+    def observe(self, seconds: float) -> None:
+        """Records a committed write's latency, less the time this thread
+        slept for the limits since its last, to pace this thread's next
+        write; live consumers report the p99 of the latest to the live
+        class's row"""
+        seconds -= getattr(self._waited, "seconds", 0.0)
+        self._waited.seconds = 0.0
+        self._written.seconds = seconds
+        if self.pipeline_class != LIVE:
+            return
+        with self._lock:
+            self.commits.append(seconds)
+            if not self._due(self._reported_at, self.report_interval):
+                return
+            self._reported_at = self.clock()
+            p99 = round(percentile(self.commits, 99) * 1000, 3)
+            self.commits.clear()
+            METRICS.set("write_limit_commit_p99_ms", p99)
+            try:
+                self._cursor().execute(_REPORT, {
+                    "p99": p99, "class": LIVE,
+                    "interval": self.report_interval})
+            except psycopg2.Error as e:
+                self._failed(e)
+
+    def state(self) -> dict:
+        """Returns the class's limits and this process's throttle metrics"""
+        prefix = f"write_limit_{self.pipeline_class}"
+        snapshot = METRICS.snapshot()
+        return {"pipeline_class": self.pipeline_class,
+                **(self.limits or {}),
+                **{name[len(prefix) + 1:]: value
+                   for name, value in snapshot.items()
+                   if name.startswith(prefix + "_")}}
+
+
+LIMITER = WriteLimiter()
+
+
+@contextmanager
+def limited(connect, pipeline_class: str, logger=None):
+    """Throttles the writes made inside it as pipeline_class's, then logs
+    the throttle state"""
+    LIMITER.start(connect, pipeline_class, logger)
+    try:
+        yield LIMITER
+    finally:
+        if logger is not None:
+            logger.info({"write_limit": LIMITER.state()})
+        LIMITER.stop()
+
+
+def set_limits(conn, pipeline_class: str, **settings) -> None:
+    """Changes a class's settings, a value of 0 clearing a rate or
+    yield_above_ms; the buckets refill from empty at the new rates"""
+    if pipeline_class not in CLASSES:
+        raise ValueError(f"Unknown pipeline class {pipeline_class}")
+    unknown = set(settings) - set(SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown write limit settings {sorted(unknown)}")
+    clearable = ("rows_per_second", "tx_per_second", "yield_above_ms")
+    values = {name: (value or None) if name in clearable else value
+              for name, value in settings.items()}
+    cur = conn.cursor()
+    try:
+        cur.execute("INSERT INTO write_limit (pipeline_class) VALUES (%s) "
+                    "ON CONFLICT (pipeline_class) DO NOTHING;",
+                    (pipeline_class,))
+        if values:
+            assignments = ", ".join(f"{name} = %({name})s" for name in values)
+            cur.execute(f"UPDATE write_limit SET {assignments}, "
+                        "row_tokens = 0, tx_tokens = 0, rate_factor = 1, "
+                        "refilled_at = NOW() "
+                        "WHERE pipeline_class = %(class)s;",
+                        {**values, "class": pipeline_class})
+    finally:
+        cur.close()
+    conn.commit()
+
+
+def limit_status(conn) -> list[dict]:
+    """Returns every class's settings and throttle state"""
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        cur.execute("SELECT pipeline_class, rows_per_second, tx_per_second, "
+                    "burst_seconds, yield_above_ms, min_factor, rate_factor, "
+                    "commit_p99_ms, reported_at, adjusted_at "
+                    "FROM write_limit ORDER BY pipeline_class;")
+        return [dict(row) for row in cur.fetchall()]
+    finally:
+        cur.close()
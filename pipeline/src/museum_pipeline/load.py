@@ -1,9 +1,12 @@
 #pylint: disable=unused-variable
 import psycopg2
-from psycopg2.extras import execute_values
 
+from museum_pipeline.writer import WRITER, InteractionWriter
 
-def _upload_data(data: dict[str: list[tuple]], conn: psycopg2) -> None:
+
+def _upload_data(data: dict[str: list[tuple]], conn: psycopg2,
+                 commit: bool = True,
+                 writer: InteractionWriter = WRITER) -> None:
     """Uploads data to a database over a psycopg2 connection
 
     Arguments:
@@ -29,33 +32,27 @@ def _upload_data(data: dict[str: list[tuple]], conn: psycopg2) -> None:
                     ]
             }
         conn -- psycopg2 connection
+        commit -- whether to commit, or leave the rows in the caller's open
+            transaction
+        writer -- InteractionWriter to write with (Default the shared,
+            pipelined one)
     """
-    cur = conn.cursor()
-    execute_values(
-        cur,
-        """
-        INSERT INTO rating_interaction
-            (event_at, rating_id, exhibition_id)
-        VALUES
-            %s
-        ;
-        """,
-        data["rating"],
-        "(%(event_at)s, %(value_id)s, %(exhibition_id)s)"
-    )
-    execute_values(
-        cur,
-        """
-        INSERT INTO request_interaction
-            (event_at, exhibition_id, request_id)
-        VALUES
-            %s
-        ;
-        """,
-        data["request"],
-        "(%(event_at)s, %(exhibition_id)s, %(value_id)s)"
-    )
-    conn.commit()
+    writer.write_tables(conn, data, commit)
 
 
+def upload_messages(messages: list[dict], conn,
+                    writer: InteractionWriter = WRITER) -> int:
+    """Uploads a batch of formatted Kafka messages in a single transaction
 
+    Arguments:
+        messages -- list of messages, as returned by the process_* functions
+        conn -- psycopg2 connection
+        writer -- InteractionWriter to write with (Default the shared,
+            pipelined one)
+
+    Returns:
+        the number of rows uploaded
+    """
+    if any(m.get("table") not in {"request", "rating"} for m in messages):
+        raise ValueError("INVALID: Table name not recognised.")
+    return writer.write(conn, messages)
@@ -0,0 +1,473 @@
+"""End-to-end load and soak tests against local stand-ins.
+
+Postgres is a throwaway cluster started with the local `initdb`/`pg_ctl`
+binaries, listening on a unix socket only. S3 is a directory of csv shards
+behind a boto-compatible client, and Kafka is a consumer which generates
+kiosk traffic at a target rate. Nothing touches the network.
+"""
+#pylint: disable=unused-variable
+import csv
+import hashlib
+import io
+import json
+import logging
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from os import (environ as ENV, chdir, getcwd, listdir, makedirs, path,
+                sysconf)
+from time import perf_counter, sleep
+
+from botocore.client import BaseClient
+from botocore.exceptions import ClientError
+from psycopg2 import connect
+
+from museum_pipeline.benchmark import (generate_csv_rows, generate_message,
+                                       OPENING, CLOSING)
+from museum_pipeline.metrics import percentile
+
+DEFAULT_SCHEMA = path.join(path.dirname(__file__), "..", "..", "schema.sql")
+
+
+@contextmanager
+def local_postgres(schema_path: str = DEFAULT_SCHEMA, fsync: bool = True):
+    """Starts a throwaway Postgres cluster with the schema applied.
+
+    Sets the PIPELINE_TARGET_* environment variables, so get_env_conn
+    connects to it, and yields its socket directory.
+    """
+    pg_ctl = shutil.which("pg_ctl", path=ENV.get("PG_BIN")) or "pg_ctl"
+    initdb = shutil.which("initdb", path=ENV.get("PG_BIN")) or "initdb"
+    root = tempfile.mkdtemp(prefix="museum-loadtest-pg-")
+    data_dir = path.join(root, "data")
+    options = f"-c listen_addresses='' -c unix_socket_directories='{root}'"
+    if not fsync:
+        options += " -c fsync=off -c synchronous_commit=off"
+    subprocess.run([initdb, "-D", data_dir, "-A", "trust", "-U", "postgres"],
+                   check=True, capture_output=True)
+    subprocess.run([pg_ctl, "-D", data_dir, "-o", options, "-w",
+                    "-l", path.join(root, "postgres.log"), "start"],
+                   check=True, capture_output=True)
+    try:
+        admin = connect(host=root, user="postgres", dbname="postgres")
+        admin.autocommit = True
+        admin.cursor().execute("CREATE DATABASE museum;")
+        admin.close()
+        with open(schema_path, "r", encoding="utf-8") as fp:
+            schema = fp.read()
+        conn = connect(host=root, user="postgres", dbname="museum")
+        conn.cursor().execute(schema)
+        conn.commit()
+        conn.close()
+        ENV.update({"PIPELINE_TARGET_HOST": root,
+                    "PIPELINE_TARGET_USER": "postgres",
+                    "PIPELINE_TARGET_PASSWORD": "",
+                    "PIPELINE_TARGET_DBNAME": "museum",
+                    "PIPELINE_TARGET_PORT": "5432"})
+        yield root
+    finally:
+        subprocess.run([pg_ctl, "-D", data_dir, "-m", "fast", "stop"],
+                       check=False, capture_output=True)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+class LocalS3(BaseClient):
+    """The parts of a boto3 s3 client used by extract, over a directory"""
+
+    def __init__(self, root: str):  # pylint: disable=super-init-not-called
+        self.root = root
+
+    def _etag(self, filepath: str) -> str:
+        with open(filepath, "rb") as fp:
+            return f'"{hashlib.md5(fp.read()).hexdigest()}"'
+
+    def list_objects_v2(self, Bucket: str) -> dict:  # pylint: disable=invalid-name
+        """Lists the files in <root>/<Bucket>"""
+        keys = sorted(listdir(path.join(self.root, Bucket)))
+        return {"Contents": [
+            {"Key": k, "ETag": self._etag(path.join(self.root, Bucket, k))}
+            for k in keys]}
+
+    def get_object(self, Bucket: str, Key: str) -> dict:  # pylint: disable=invalid-name
+        """Returns <root>/<Bucket>/<Key> as a streaming body"""
+        filepath = path.join(self.root, Bucket, Key)
+        if not path.exists(filepath):
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        with open(filepath, "rb") as fp:
+            return {"Body": io.BytesIO(fp.read())}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes) -> dict:  # pylint: disable=invalid-name
+        """Writes Body to <root>/<Bucket>/<Key>"""
+        with open(path.join(self.root, Bucket, Key), "wb") as fp:
+            fp.write(Body)
+        return {}
+
+    def download_file(self, bucket: str, key: str, filename: str) -> None:
+        """Copies <root>/<bucket>/<key> to filename"""
+        shutil.copyfile(path.join(self.root, bucket, key), filename)
+
+
+def write_shards(root: str, bucket: str, rows: int, shards: int,
+                 invalid_ratio: float = 0.0) -> int:
+    """Writes generated lmnh_hist_data_NN.csv shards into a LocalS3 bucket.
+
+    Returns:
+        the number of valid rows written
+    """
+    makedirs(path.join(root, bucket), exist_ok=True)
+    data = generate_csv_rows(rows, invalid_ratio)
+    per_shard = -(-rows // shards)
+    for i in range(shards):
+        shard_path = path.join(root, bucket, f"lmnh_hist_data_{i:02}.csv")
+        with open(shard_path, "w", encoding="utf-8", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=["at", "site", "val",
+                                                    "type"])
+            writer.writeheader()
+            writer.writerows(data[i * per_shard:(i + 1) * per_shard])
+    return sum(row["site"] != "99" for row in data)
+
+
+class _Message:
+    """The parts of a confluent_kafka.Message used by the pipeline"""
+
+    def __init__(self, value: bytes, offset: int, produced_at: float):
+        self._value = value
+        self._offset = offset
+        self.produced_at = produced_at
+
+    def value(self) -> bytes:
+        """Returns the encoded message"""
+        return self._value
+
+    def error(self) -> None:
+        """Generated messages never carry errors"""
+        return None
+
+    def topic(self) -> str:
+        """Generated messages all live on one topic"""
+        return "lmnh"
+
+    def partition(self) -> int:
+        """Generated messages all live on partition 0"""
+        return 0
+
+    def offset(self) -> int:
+        """Returns the position of the message in the stream"""
+        return self._offset
+
+    def timestamp(self) -> tuple[int, int]:
+        """Returns (TIMESTAMP_CREATE_TIME, <ms>) like confluent_kafka"""
+        return 1, int(self.produced_at * 1000)
+
+
+class GeneratedConsumer:
+    """A Kafka consumer stand-in producing kiosk traffic at a fixed rate.
+
+    Message i is due at start + i / rate; its production time is the time it
+    was due, so a pipeline that falls behind accrues latency.
+    """
+
+    def __init__(self, rate: float, invalid_ratio: float = 0.0,
+                 seed: int = 0):
+        self.rate = rate
+        self.invalid_ratio = invalid_ratio
+        self.rng = random.Random(seed)
+        self.started = perf_counter()
+        self.sent = 0
+        self.valid_sent = 0
+        self.in_flight = deque()
+
+    def poll(self, timeout: float = 1.0) -> _Message | None:
+        """Returns the next message once it is due, or None on timeout"""
+        due = self.started + self.sent / self.rate
+        wait = due - perf_counter()
+        if wait > timeout:
+            sleep(timeout)
+            return None
+        if wait > 0:
+            sleep(wait)
+        message = generate_message(self.rng, self.sent, self.invalid_ratio)
+        msg = _Message(json.dumps(message).encode("UTF-8"), self.sent, due)
+        self.sent += 1
+        if message["site"] != "99":
+            self.valid_sent += 1
+            self.in_flight.append(due)
+        return msg
+
+    def consume(self, num_messages: int = 1,
+                timeout: float = 1.0) -> list[_Message]:
+        """Returns up to num_messages messages"""
+        messages = []
+        deadline = perf_counter() + timeout
+        while len(messages) < num_messages and perf_counter() < deadline:
+            msg = self.poll(max(deadline - perf_counter(), 0))
+            if msg is not None:
+                messages.append(msg)
+        return messages
+
+    def store_offsets(self, *args, **kwargs) -> None:
+        """Offsets are not tracked"""
+
+    def assignment(self) -> list:
+        """There are no real partitions to pause or resume"""
+        return []
+
+    def pause(self, partitions: list) -> None:
+        """Pausing only stops the pipeline taking messages, as with Kafka"""
+
+    def resume(self, partitions: list) -> None:
+        """See pause"""
+
+    def close(self) -> None:
+        """Nothing to release"""
+
+
+class TimedConnection:
+    """Wraps a psycopg2 connection, recording end-to-end latency on commit.
+
+    The pipeline is synchronous, so every valid message handed out by the
+    consumer before a commit is durable once that commit returns.
+    """
+
+    def __init__(self, conn, consumer: GeneratedConsumer):
+        self._conn = conn
+        self._consumer = consumer
+        self.latencies = []
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self) -> None:
+        """Commits, then records the latency of each newly durable message"""
+        self._conn.commit()
+        now = perf_counter()
+        while self._consumer.in_flight:
+            self.latencies.append(now - self._consumer.in_flight.popleft())
+
+
+class RSSSampler(threading.Thread):
+    """Samples this process's resident set size once a second"""
+
+    def __init__(self, interval: float = 1.0):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples = [current_rss()]
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.samples.append(current_rss())
+
+    def report(self) -> dict:
+        """Stops sampling and returns RSS statistics in MB"""
+        self.stopped.set()
+        self.samples.append(current_rss())
+        mb = [s / 2 ** 20 for s in self.samples]
+        return {"start": round(mb[0], 1), "end": round(mb[-1], 1),
+                "peak": round(max(mb), 1), "growth": round(mb[-1] - mb[0], 1)}
+
+
+def current_rss() -> int:
+    """Returns the resident set size of this process in bytes"""
+    with open("/proc/self/statm", "r", encoding="utf-8") as fp:
+        return int(fp.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+
+
+def _count_rows(conn) -> int:
+    cur = conn.cursor()
+    cur.execute("""SELECT
+                        (SELECT COUNT(*) FROM rating_interaction)
+                        + (SELECT COUNT(*) FROM request_interaction);""")
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+
+def _truncate(conn) -> None:
+    cur = conn.cursor()
+    cur.execute("TRUNCATE rating_interaction, request_interaction;")
+    conn.commit()
+    cur.close()
+
+
+def _quiet_logger() -> logging.Logger:
+    logger = logging.getLogger("museum_pipeline.loadtest")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+def soak_kafka(duration: float, rate: float,
+               invalid_ratio: float = 0.0) -> dict:
+    """Drives consume_messages with generated traffic for a duration.
+
+    Requires PIPELINE_TARGET_* to point at a database with the schema
+    applied, as local_postgres arranges.
+    """
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.extract import get_env_conn, load_id_dict
+    from museum_pipeline.fast_lane import EmergencyLane
+    from museum_pipeline.kafka_pipeline import consume_messages
+    from museum_pipeline.load import upload_messages
+    raw_conn = get_env_conn()
+    _truncate(raw_conn)
+    id_dict = load_id_dict(raw_conn, "lmnh")
+    consumer = GeneratedConsumer(rate, invalid_ratio)
+    conn = TimedConnection(raw_conn, consumer)
+    fast_lane = EmergencyLane(get_env_conn, id_dict, _quiet_logger())
+    sampler = RSSSampler()
+    sampler.start()
+    started = perf_counter()
+    consume_messages(consumer, partial(upload_messages, conn=conn), id_dict,
+                     OPENING, CLOSING,
+                     _quiet_logger(),
+                     should_stop=lambda: perf_counter() - started > duration,
+                     fast_lane=fast_lane)
+    seconds = perf_counter() - started
+    fast_lane.close()
+    rows = _count_rows(raw_conn)
+    raw_conn.close()
+    return {
+        "pipeline": "kafka",
+        "seconds": round(seconds, 1),
+        "target_rate": rate,
+        "messages_sent": consumer.sent,
+        "rows_expected": consumer.valid_sent,
+        "rows_in_db": rows,
+        "rows_correct": rows == consumer.valid_sent,
+        "rows_per_second": round(rows / seconds, 1),
+        "latency_ms": {
+            "p50": _ms(percentile(conn.latencies, 50)),
+            "p99": _ms(percentile(conn.latencies, 99)),
+            "max": _ms(max(conn.latencies, default=None))
+        },
+        "emergency": fast_lane.report(),
+        "rss_mb": sampler.report()
+    }
+
+
+def soak_batch(rows: int, shards: int = 10,
+               invalid_ratio: float = 0.0) -> dict:
+    """Runs the S3 batch pipeline over generated shards.
+
+    Requires PIPELINE_TARGET_* to point at a database with the schema
+    applied, as local_postgres arranges.
+    """
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.pipeline import run_batch
+    workdir = tempfile.mkdtemp(prefix="museum-loadtest-s3-")
+    previous_dir = getcwd()
+    conn = get_env_conn()
+    try:
+        _truncate(conn)
+        expected = write_shards(path.join(workdir, "s3"), "bucket", rows,
+                                shards, invalid_ratio)
+        makedirs(path.join(workdir, "data"))
+        chdir(workdir)
+        sampler = RSSSampler()
+        sampler.start()
+        started = perf_counter()
+        run_batch(LocalS3(path.join(workdir, "s3")), "bucket", conn,
+                  _quiet_logger())
+        seconds = perf_counter() - started
+        uploaded = _count_rows(conn)
+    finally:
+        chdir(previous_dir)
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "pipeline": "batch",
+        "seconds": round(seconds, 1),
+        "rows_generated": rows,
+        "rows_expected": expected,
+        "rows_in_db": uploaded,
+        "rows_correct": uploaded == expected,
+        "rows_per_second": round(uploaded / seconds, 1),
+        "rss_mb": sampler.report()
+    }
+
+
+def _distributed_worker(root: str, bucket: str, index: int) -> dict:
+    """Entry point of a soak_distributed worker process"""
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.work_queue import run_worker
+    return run_worker(LocalS3(root), bucket, get_env_conn, _quiet_logger(),
+                      f"loadtest/{index}", lease_seconds=5.0)
+
+
+def soak_distributed(rows: int, shards: int = 10, workers: int = 4) -> dict:
+    """Runs the work-table ingest with several worker processes.
+
+    One shard is first leased to a worker which never loads it, with an
+    already-expired lease, so the run also shows a crashed worker's shard
+    being taken over. Requires PIPELINE_TARGET_* to point at a database
+    with the schema applied, as local_postgres arranges.
+    """
+    # pylint: disable=import-outside-toplevel
+    import multiprocessing as mp
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.pipeline import MUSEUM_PATTERNS
+    from museum_pipeline.work_queue import (claim_shard, queue_bucket,
+                                            shard_status)
+    workdir = tempfile.mkdtemp(prefix="museum-loadtest-s3-")
+    root = path.join(workdir, "s3")
+    conn = get_env_conn()
+    try:
+        _truncate(conn)
+        conn.cursor().execute("TRUNCATE ingest_shard;")
+        conn.commit()
+        expected = write_shards(root, "bucket", rows, shards)
+        queue_bucket(LocalS3(root), "bucket", conn,
+                     {"lmnh": MUSEUM_PATTERNS["lmnh"]})
+        claim_shard(conn, "loadtest/crashed", lease_seconds=0)
+        started = perf_counter()
+        with mp.get_context("spawn").Pool(workers) as pool:
+            summaries = pool.starmap(_distributed_worker,
+                                     [(root, "bucket", i)
+                                      for i in range(workers)])
+        seconds = perf_counter() - started
+        uploaded = _count_rows(conn)
+        status = shard_status(conn)
+    finally:
+        conn.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "pipeline": "distributed",
+        "seconds": round(seconds, 1),
+        "workers": workers,
+        "shards_per_worker": [s["shards"] for s in summaries],
+        "shards_done": sum(r["shards"] for r in status
+                           if r["state"] == "done"),
+        "rows_expected": expected,
+        "rows_in_db": uploaded,
+        "rows_correct": uploaded == expected,
+        "rows_per_second": round(uploaded / seconds, 1)
+    }
+
+
+def _ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def run_loadtest(pipelines: list[str], duration: float, rate: float,
+                 batch_rows: int, invalid_ratio: float = 0.0,
+                 schema_path: str = DEFAULT_SCHEMA,
+                 fsync: bool = True) -> list[dict]:
+    """Starts the local stand-ins and runs each named pipeline against them"""
+    reports = []
+    with local_postgres(schema_path, fsync):
+        if "batch" in pipelines:
+            reports.append(soak_batch(batch_rows,
+                                      invalid_ratio=invalid_ratio))
+        if "kafka" in pipelines:
+            reports.append(soak_kafka(duration, rate, invalid_ratio))
+        if "distributed" in pipelines:
+            reports.append(soak_distributed(batch_rows))
+    return reports
@@ -0,0 +1,210 @@
+"""Per-stage memory instrumentation of the pipelines.
+
+Each pipeline stage runs inside MEMORY.stage(<name>). Instrumentation is
+off by default, and then a stage costs one attribute check. Once
+MEMORY.start() has been called, every stage records:
+
+    calls, seconds -- how often the stage ran and for how long in total
+    rss_start_mb, rss_end_mb -- resident set size on entry and exit of its
+        last call
+    peak_rss_mb -- highest resident set size during any call, read from
+        VmHWM after resetting it on entry through /proc/self/clear_refs
+        (Linux); where the reset isn't allowed, the process's peak so far
+    peak_traced_mb -- highest Python heap use during any call, above what
+        was allocated on entry, from tracemalloc
+    top_allocators -- for the call with the highest traced peak, the
+        source lines holding the most memory allocated during it when it
+        returned
+
+Both peaks are process-wide. Stages running at the same time on other
+threads, such as several museums in one batch, add to each other's peaks,
+so profile one museum at a time for clean figures. Nested stages are
+folded into their parent's peaks.
+"""
+#pylint: disable=unused-variable
+import json
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+from museum_pipeline.metrics import METRICS
+
+MB = 2 ** 20
+
+
+def _status_kb(field: str) -> int | None:
+    """Returns a field of /proc/self/status in kB, or None off Linux"""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as fp:
+            return next((int(line.split()[1]) for line in fp
+                         if line.startswith(field + ":")), None)
+    except OSError:
+        return None
+
+
+def rss_mb() -> float | None:
+    """Returns this process's resident set size in MB"""
+    kb = _status_kb("VmRSS")
+    return None if kb is None else kb / 1024
+
+
+def peak_rss_mb() -> float | None:
+    """Returns this process's peak resident set size in MB"""
+    kb = _status_kb("VmHWM")
+    return None if kb is None else kb / 1024
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak resident set size to the current one, returning
+    whether the kernel allowed it"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class MemoryProfiler:
+    """Records the memory each named stage uses, once started
+
+    Arguments:
+        top -- allocating source lines to keep per stage (Default 10)
+        frames -- stack frames tracemalloc keeps per allocation (Default 1)
+    """
+
+    def __init__(self, top: int = 10, frames: int = 1):
+        self.top = top
+        self.frames = frames
+        self.enabled = False
+        self.stages = {}
+        self._started_tracing = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self) -> None:
+        """Turns instrumentation on, starting tracemalloc if needed"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        self.enabled = True
+
+    def stop(self) -> None:
+        """Turns instrumentation off, keeping what was recorded"""
+        self.enabled = False
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def reset(self) -> None:
+        """Forgets every recorded stage"""
+        with self._lock:
+            self.stages = {}
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _fold_into_parent(self, stack: list) -> None:
+        """Carries the peaks so far into the enclosing stage, before a
+        nested stage resets them"""
+        if not stack:
+            return
+        parent = stack[-1]
+        parent["peak_traced"] = max(parent["peak_traced"],
+                                    tracemalloc.get_traced_memory()[1])
+        parent["peak_rss"] = max(parent["peak_rss"], peak_rss_mb() or 0.0)
+
+    @contextmanager
+    def stage(self, name: str):
+        """Records the memory used by the code it wraps as stage `name`"""
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        self._fold_into_parent(stack)
+        frame = {"peak_traced": 0, "peak_rss": 0.0}
+        stack.append(frame)
+        before = tracemalloc.take_snapshot()
+        traced_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        reset_peak_rss()
+        rss_start = rss_mb()
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started
+            frame["peak_traced"] = max(frame["peak_traced"],
+                                       tracemalloc.get_traced_memory()[1])
+            frame["peak_rss"] = max(frame["peak_rss"], peak_rss_mb() or 0.0)
+            after = tracemalloc.take_snapshot()
+            stack.pop()
+            if stack:
+                stack[-1]["peak_traced"] = max(stack[-1]["peak_traced"],
+                                               frame["peak_traced"])
+                stack[-1]["peak_rss"] = max(stack[-1]["peak_rss"],
+                                            frame["peak_rss"])
+            self._record(name, seconds, rss_start, frame,
+                         max(frame["peak_traced"] - traced_start, 0),
+                         before, after)
+
+    def _record(self, name: str, seconds: float, rss_start: float | None,
+                frame: dict, peak_traced: int, before, after) -> None:
+        with self._lock:
+            entry = self.stages.setdefault(name, {
+                "calls": 0, "seconds": 0.0, "peak_rss_mb": 0.0,
+                "peak_traced_mb": 0.0, "top_allocators": []})
+            entry["calls"] += 1
+            entry["seconds"] = round(entry["seconds"] + seconds, 4)
+            entry["rss_start_mb"] = round(rss_start or 0.0, 1)
+            entry["rss_end_mb"] = round(rss_mb() or 0.0, 1)
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"],
+                                       round(frame["peak_rss"], 1))
+            if peak_traced / MB >= entry["peak_traced_mb"]:
+                entry["peak_traced_mb"] = round(peak_traced / MB, 2)
+                ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+                          tracemalloc.Filter(False, __file__)]
+                before = before.filter_traces(ignore)
+                after = after.filter_traces(ignore)
+                entry["top_allocators"] = [
+                    {"where": str(stat.traceback),
+                     "size_kb": round(stat.size_diff / 1024, 1),
+                     "count": stat.count_diff}
+                    for stat in after.compare_to(before, "lineno")[:self.top]
+                    if stat.size_diff > 0]
+        METRICS.set(f"memory_{name}_peak_rss_mb", entry["peak_rss_mb"])
+        METRICS.set(f"memory_{name}_peak_traced_mb", entry["peak_traced_mb"])
+
+    def report(self) -> dict:
+        """Returns every stage's figures, and the highest peak RSS of any"""
+        with self._lock:
+            stages = {name: dict(entry) for name, entry in self.stages.items()}
+        return {"peak_rss_mb": max((s["peak_rss_mb"] for s in stages.values()),
+                                   default=None),
+                "stages": stages}
+
+
+MEMORY = MemoryProfiler()
+
+
+@contextmanager
+def profiled(report_path: str | None, logger=None):
+    """Instruments every stage run inside it, then logs the report and
+    writes it to report_path as JSON; does nothing if report_path is None"""
+    if report_path is None:
+        yield
+        return
+    MEMORY.reset()
+    MEMORY.start()
+    try:
+        yield
+    finally:
+        MEMORY.stop()
+        report = MEMORY.report()
+        if logger is not None:
+            logger.info({"memory": report})
+        with open(report_path, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
@@ -0,0 +1,43 @@
+"""Process-wide counters and gauges, reported through the pipeline logs"""
+#pylint: disable=unused-variable
+import threading
+
+
+class Metrics:
+    """A thread-safe registry of named numeric values"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, name: str, value) -> None:
+        """Sets a gauge"""
+        with self._lock:
+            self._values[name] = value
+
+    def inc(self, name: str, amount=1) -> None:
+        """Increments a counter, starting it at zero if it is new"""
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name: str, default=0):
+        """Returns the current value of a metric"""
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of every metric, for logging"""
+        with self._lock:
+            return dict(self._values)
+
+
+def percentile(values, pct: float) -> float | None:
+    """Returns the nearest-rank percentile of a collection of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(-(-pct * len(ordered) // 100)) - 1, 0)
+    return ordered[rank]
+
+
+METRICS = Metrics()
@@ -0,0 +1,290 @@
+"""Exactly-once Kafka ingest, with consumer offsets kept in Postgres.
+
+In this mode each batch of interactions is written in one transaction with
+the next offset of every partition it was read from, in the kafka_offset
+table. A batch and its offsets are committed together or not at all, so a
+crash at any point neither loses nor repeats a row, with no per-row dedupe.
+Kafka's own committed offsets are not moved.
+
+On assignment, whether at startup or after a rebalance, each partition is
+started from the offset stored for it. A partition with no stored offset,
+e.g. the first time a group which has been committing to Kafka runs in
+this mode, starts from the group's committed Kafka offset, which seeds
+kafka_offset, so nothing it already loaded is loaded again; with neither it
+starts from the earliest message, as auto.offset.reset does. If the offsets
+can't be read, the assigned partitions are paused instead, and started by
+resume_pending once they can.
+
+Offsets are fenced: a write only moves a partition's offset on from the
+value this consumer last read or wrote. If another consumer has moved it
+on, e.g. after this one lost the partition during a long write, or this
+consumer no longer holds the partition, the transaction is rolled back,
+the batch dropped, and the consumer rewound to the stored offsets.
+"""
+#pylint: disable=unused-variable
+from time import monotonic, perf_counter
+
+import psycopg2
+from confluent_kafka import OFFSET_BEGINNING, KafkaException, TopicPartition
+
+from museum_pipeline.limiter import LIMITER
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.writer import WRITER
+
+
+class OffsetConflict(Exception):
+    """Raised when a batch's offsets were moved on by another consumer; the
+    batch was not written"""
+
+
+class DatabaseUnavailable(Exception):
+    """Raised when a batch could not be written; it may be retried"""
+
+
+class ExactlyOnceWriter:
+    """Writes batches together with the offsets they take each partition to
+
+    Arguments:
+        connect -- callable returning a new psycopg2 connection
+        group -- Kafka consumer group id the offsets are stored under
+        logger -- logging object
+        retry_interval -- seconds between attempts to start partitions
+            whose offsets couldn't be read (Default 5)
+    """
+
+    def __init__(self, connect, group: str, logger, writer=WRITER,
+                 retry_interval: float = 5.0):
+        self.connect = connect
+        self.group = group
+        self.logger = logger
+        self.writer = writer
+        self.retry_interval = retry_interval
+        self.conn = None
+        self.consumer = None
+        # (topic, partition) -> next offset stored, or None if no row yet,
+        # for every partition currently assigned and started.
+        self.positions = {}
+        # Assigned partitions left paused until their offsets can be read.
+        self.pending = []
+        self._pending_at = None
+
+    def _connection(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+        return self.conn
+
+    def load(self, partitions: list[tuple[str, int]]) -> dict:
+        """Returns the stored next offset of each partition which has one"""
+        conn = self._connection()
+        cur = conn.cursor()
+        try:
+            cur.execute("""SELECT
+                               topic, kafka_partition, next_offset
+                           FROM
+                               kafka_offset
+                           WHERE
+                               consumer_group = %s
+                           AND
+                               (topic, kafka_partition) IN (SELECT * FROM
+                                   UNNEST(%s::TEXT[], %s::INT[]));""",
+                        (self.group, [t for t, _ in partitions],
+                         [p for _, p in partitions]))
+            stored = {(topic, partition): offset
+                      for topic, partition, offset in cur.fetchall()}
+        finally:
+            cur.close()
+        conn.commit()
+        return stored
+
+    def _seed(self, offsets: dict) -> None:
+        """Stores offsets for partitions which have none stored yet"""
+        conn = self._connection()
+        cur = conn.cursor()
+        try:
+            for (topic, partition), offset in offsets.items():
+                cur.execute("""INSERT INTO kafka_offset
+                                   (consumer_group, topic, kafka_partition,
+                                    next_offset, committed_at)
+                               VALUES
+                                   (%s, %s, %s, %s, NOW())
+                               ON CONFLICT DO NOTHING;""",
+                            (self.group, topic, partition, offset))
+        finally:
+            cur.close()
+        conn.commit()
+
+    def _starting_offsets(self, consumer,
+                          keys: list[tuple[str, int]]) -> dict:
+        """Returns the stored next offset of each partition which has one,
+        first seeding kafka_offset with the group's committed Kafka offset
+        of any partition which has none"""
+        stored = self.load(keys)
+        missing = [TopicPartition(*key) for key in keys if key not in stored]
+        if not missing or consumer is None:
+            return stored
+        committed = {(tp.topic, tp.partition): tp.offset
+                     for tp in consumer.committed(missing, timeout=10)
+                     if tp.error is None and tp.offset >= 0}
+        if not committed:
+            return stored
+        self._seed(committed)
+        METRICS.inc("offsets_seeded_total", len(committed))
+        self.logger.info({"offsets_seeded": {
+            f"{t}-{p}": o for (t, p), o in committed.items()}})
+        return self.load(keys)
+
+    def _start(self, keys: list[tuple[str, int]], stored: dict) -> list:
+        """Records the stored offsets of newly started partitions, returning
+        them as TopicPartitions at the offsets to start from"""
+        partitions = []
+        for key in keys:
+            self.positions[key] = stored.get(key)
+            partitions.append(TopicPartition(
+                *key, stored.get(key, OFFSET_BEGINNING)))
+        return partitions
+
+    def on_assign(self, consumer, partitions: list) -> None:
+        """Rebalance callback: starts each partition at its stored offset,
+        or pauses them all if the offsets can't be read"""
+        self.consumer = consumer
+        keys = [(tp.topic, tp.partition) for tp in partitions]
+        try:
+            stored = self._starting_offsets(consumer, keys)
+        except (psycopg2.Error, KafkaException) as e:
+            METRICS.inc("offset_load_failures_total")
+            self._reset()
+            self.logger.warning(f"Stored offsets unavailable, pausing "
+                                f"assigned partitions: {e}")
+            consumer.assign(partitions)
+            consumer.pause(partitions)
+            self.pending = keys
+            self._pending_at = monotonic()
+            return
+        self.pending = []
+        consumer.assign(self._start(keys, stored))
+        self.logger.info({"assigned": {f"{t}-{p}": o for (t, p), o
+                                       in self.positions.items()}})
+
+    def resume_pending(self) -> None:
+        """Starts the partitions paused by on_assign at their stored
+        offsets, once they can be read; tried every retry_interval"""
+        if not self.pending \
+                or monotonic() - self._pending_at < self.retry_interval:
+            return
+        self._pending_at = monotonic()
+        try:
+            stored = self._starting_offsets(self.consumer, self.pending)
+        except (psycopg2.Error, KafkaException) as e:
+            METRICS.inc("offset_load_failures_total")
+            self._reset()
+            self.logger.warning(f"Stored offsets still unavailable: {e}")
+            return
+        partitions = self._start(self.pending, stored)
+        for tp in partitions:
+            self.consumer.seek(tp)
+        self.consumer.resume(partitions)
+        self.pending = []
+        self.logger.info({"assigned": {f"{t}-{p}": o for (t, p), o
+                                       in self.positions.items()}})
+
+    def on_revoke(self, _consumer, partitions: list) -> None:
+        """Rebalance callback: forgets partitions this consumer has lost
+
+        confluent_kafka passes the consumer to every rebalance callback
+        """
+        for tp in partitions:
+            self.positions.pop((tp.topic, tp.partition), None)
+        lost = {(tp.topic, tp.partition) for tp in partitions}
+        self.pending = [key for key in self.pending if key not in lost]
+
+    def rewind(self) -> None:
+        """Seeks every started partition back to its stored offset"""
+        keys = list(self.positions)
+        stored = self._starting_offsets(self.consumer, keys)
+        for tp in self._start(keys, stored):
+            if self.consumer is not None:
+                self.consumer.seek(tp)
+
+    def _save_offsets(self, cur, offsets: dict) -> bool:
+        """Moves each partition's stored offset on from its last known
+        value, returning False if any had been moved by someone else"""
+        for (topic, partition), offset in offsets.items():
+            if (topic, partition) not in self.positions:
+                return False
+            previous = self.positions[(topic, partition)]
+            if previous is None:
+                cur.execute("""INSERT INTO kafka_offset
+                                   (consumer_group, topic, kafka_partition,
+                                    next_offset, committed_at)
+                               VALUES
+                                   (%s, %s, %s, %s, NOW())
+                               ON CONFLICT DO NOTHING;""",
+                            (self.group, topic, partition, offset))
+            else:
+                cur.execute("""UPDATE kafka_offset SET
+                                   next_offset = %s,
+                                   committed_at = NOW()
+                               WHERE
+                                   consumer_group = %s
+                               AND
+                                   topic = %s
+                               AND
+                                   kafka_partition = %s
+                               AND
+                                   next_offset = %s;""",
+                            (offset, self.group, topic, partition, previous))
+            if cur.rowcount != 1:
+                return False
+        return True
+
+    def __call__(self, messages: list[dict], offsets: dict) -> str:
+        """Writes a batch and its offsets in one transaction
+
+        Arguments:
+            messages -- formatted Kafka messages, possibly none
+            offsets -- {(topic, partition): <next offset>} of every
+                partition the batch's messages, valid or not, came from
+
+        Raises OffsetConflict, having rewound the consumer, if the offsets
+        were moved on by another consumer, and DatabaseUnavailable if the
+        write failed; either way nothing was written.
+        """
+        try:
+            conn = self._connection()
+            started = perf_counter()
+            self.writer.write(conn, messages, commit=False)
+            cur = conn.cursor()
+            try:
+                saved = self._save_offsets(cur, offsets)
+            finally:
+                cur.close()
+            if not saved:
+                conn.rollback()
+                METRICS.inc("offset_conflicts_total")
+                self.rewind()
+                raise OffsetConflict("Offsets moved on by another consumer; "
+                                     "batch dropped and partitions rewound.")
+            conn.commit()
+            if messages:
+                LIMITER.observe(perf_counter() - started)
+        except psycopg2.Error as e:
+            METRICS.inc("db_write_failures_total")
+            self._reset()
+            raise DatabaseUnavailable(f"Database write failed: {e}") from e
+        self.positions.update(offsets)
+        return "db"
+
+    def _reset(self) -> None:
+        if self.conn is None:
+            return
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            self.conn.close()
+        if self.conn.closed:
+            self.conn = None
+
+    def close(self) -> None:
+        """Closes the connection"""
+        if self.conn is not None:
+            self.conn.close()
@@ -0,0 +1,197 @@
+"""Parallel loading of prepared batch rows over several connections.
+
+A ParallelLoader splits rows prepared by the batch pipeline into key-disjoint
+slices, by event date or by exhibition, and writes each slice on its own
+connection and thread through the InteractionWriter. Keys are dealt to
+slices largest first, each to the slice with fewest rows so far, so the
+slices are about the same size and no key is written by two connections.
+
+Each connection commits every transaction_rows rows, so no transaction
+holds more than that many rows' locks and WAL. A transaction which fails is
+retried on a new connection up to retries times; after that its slice stops,
+and its rows from that transaction on are left unloaded, in unloaded. The
+other slices carry on, and every row before the failed transaction stays
+committed, so the result says exactly which rows are in the database.
+
+Every transaction also bumps its museum's write watermark, as a single
+writer's do, in the watermark row of its connection's backend, so the
+connections don't queue on one row's lock.
+"""
+#pylint: disable=unused-variable
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import psycopg2
+
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.writer import TABLES, WRITER, InteractionWriter
+
+SLICE_KEYS = {
+    "day": lambda row: row["event_at"].date().isoformat(),
+    "exhibition": lambda row: row["exhibition_id"],
+}
+
+
+def slice_rows(data: dict[str, list[dict]], slices: int,
+               by: str = "day") -> list[dict]:
+    """Splits rows into at most `slices` key-disjoint, similarly sized
+    slices
+
+    Arguments:
+        data -- {"rating": [<row>, ...], "request": [<row>, ...]}
+        slices -- number of slices wanted
+        by -- key of SLICE_KEYS to keep slices disjoint on (Default day)
+
+    Returns:
+        a list of {"keys": [<key>, ...], "data": <rows split by table>},
+        without empty slices
+    """
+    key_of = SLICE_KEYS[by]
+    by_key = {}
+    for table in TABLES:
+        for row in data.get(table, []):
+            by_key.setdefault(key_of(row), {t: [] for t in TABLES}
+                              )[table].append(row)
+    sizes = {key: sum(len(rows) for rows in tables.values())
+             for key, tables in by_key.items()}
+    result = [{"keys": [], "data": {t: [] for t in TABLES}, "rows": 0}
+              for _ in range(max(1, slices))]
+    for key in sorted(by_key, key=lambda k: (-sizes[k], str(k))):
+        target = min(result, key=lambda s: s["rows"])
+        target["keys"].append(key)
+        target["rows"] += sizes[key]
+        for table in TABLES:
+            target["data"][table].extend(by_key[key][table])
+    return [{"keys": sorted(s["keys"]), "data": s["data"]}
+            for s in result if s["rows"]]
+
+
+def _transactions(data: dict[str, list[dict]], size: int) -> list[dict]:
+    """Cuts a slice's rows into consecutive transactions of at most size
+    rows"""
+    flat = [(table, row) for table in TABLES for row in data.get(table, [])]
+    chunks = []
+    for i in range(0, len(flat), size):
+        chunk = {table: [] for table in TABLES}
+        for table, row in flat[i:i + size]:
+            chunk[table].append(row)
+        chunks.append(chunk)
+    return chunks
+
+
+class ParallelLoader:
+    """Writes prepared rows through several connections at once
+
+    Arguments:
+        connect -- callable returning a new psycopg2 connection
+        connections -- connections, and slices, to load with (Default 4)
+        transaction_rows -- rows committed per transaction (Default 20000)
+        by -- key of SLICE_KEYS to slice rows on (Default day)
+        retries -- times a failed transaction is retried on a new
+            connection (Default 1)
+        logger -- logging object (Default failures aren't logged)
+    """
+
+    def __init__(self, connect, connections: int = 4,
+                 transaction_rows: int = 20000, by: str = "day",
+                 retries: int = 1, logger=None,
+                 writer: InteractionWriter = WRITER):
+        if connections < 1 or transaction_rows < 1:
+            raise ValueError("connections and transaction_rows must be "
+                             "positive.")
+        if by not in SLICE_KEYS:
+            raise ValueError(f"Unknown slice key {by}")
+        self.connect = connect
+        self.connections = connections
+        self.transaction_rows = transaction_rows
+        self.by = by
+        self.retries = retries
+        self.logger = logger
+        self.writer = writer
+        self.unloaded = {table: [] for table in TABLES}
+        self._lock = threading.Lock()
+
+    def _load_slice(self, index: int, piece: dict) -> dict:
+        """Writes one slice on its own connection, returning its stats"""
+        chunks = _transactions(piece["data"], self.transaction_rows)
+        stats = {"connection": index, "keys": piece["keys"],
+                 "rows": sum(len(rows) for rows in piece["data"].values()),
+                 "rows_loaded": 0, "transactions": 0, "retries": 0,
+                 "error": None}
+        started = perf_counter()
+        conn = None
+        number = 0
+        try:
+            for number, chunk in enumerate(chunks):
+                attempts = 0
+                while True:
+                    try:
+                        if conn is None:
+                            conn = self.connect()
+                        loaded = self.writer.write_tables(conn, chunk)
+                        break
+                    except psycopg2.Error:
+                        _discard(conn)
+                        conn = None
+                        if attempts >= self.retries:
+                            raise
+                        attempts += 1
+                        stats["retries"] += 1
+                        METRICS.inc("parallel_load_retries_total")
+                stats["rows_loaded"] += loaded
+                stats["transactions"] += 1
+                METRICS.inc("parallel_load_transactions_total")
+        except psycopg2.Error as e:
+            METRICS.inc("parallel_load_failures_total")
+            stats["error"] = f"{type(e).__name__}: {e}".strip()
+            if self.logger is not None:
+                self.logger.error(f"Parallel load connection {index} "
+                                  f"failed after {stats['rows_loaded']} "
+                                  f"rows: {e}")
+            with self._lock:
+                for chunk in chunks[number:]:
+                    for table in TABLES:
+                        self.unloaded[table].extend(chunk[table])
+        finally:
+            if conn is not None:
+                conn.close()
+        stats["seconds"] = round(perf_counter() - started, 3)
+        stats["rows_per_second"] = round(
+            stats["rows_loaded"] / stats["seconds"], 1) \
+            if stats["seconds"] else 0.0
+        return stats
+
+    def load(self, data: dict[str, list[dict]]) -> dict:
+        """Writes rows split by table through every connection
+
+        Rows of slices which failed are added to unloaded.
+
+        Returns:
+            a summary of rows loaded and failed, aggregate throughput and
+            the stats of each connection
+        """
+        slices = slice_rows(data, self.connections, self.by)
+        started = perf_counter()
+        with ThreadPoolExecutor(max(1, len(slices))) as executor:
+            stats = list(executor.map(self._load_slice, range(len(slices)),
+                                      slices))
+        seconds = round(perf_counter() - started, 3)
+        loaded = sum(s["rows_loaded"] for s in stats)
+        METRICS.inc("parallel_load_rows_total", loaded)
+        return {"rows_loaded": loaded,
+                "rows_failed": sum(s["rows"] - s["rows_loaded"]
+                                   for s in stats),
+                "seconds": seconds,
+                "rows_per_second": round(loaded / seconds, 1)
+                if seconds else 0.0,
+                "connections": stats}
+
+
+def _discard(conn) -> None:
+    """Closes a connection a write failed on"""
+    if conn is not None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
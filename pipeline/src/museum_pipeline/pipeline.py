@@ -1,49 +1,52 @@
-from os import environ as ENV
+from os import environ as ENV, makedirs, path
 import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
 
 from dotenv import load_dotenv
 from boto3 import client
-from psycopg2 import connect
+from botocore.exceptions import ClientError
+from psycopg2.pool import ThreadedConnectionPool
 
 
+from museum_pipeline.cli import (add_batch_arguments,
+                                 normalise_batch_arguments)
 from museum_pipeline.pipeline_logger import setup_logging
 from museum_pipeline.extract import (download_files,
                                      get_filenames,
+                                     get_env_conn,
+                                     get_object_etags,
                                      merge_csvs,
                                      load_csv_data,
                                      load_id_dict)
 from museum_pipeline.transform import (_prepare_upload_data,
-                                       filter_strings)
-from museum_pipeline.load import _upload_data
+                                       filter_strings,
+                                       RejectReport)
+from museum_pipeline.sinks import (ParallelPostgresSink, PostgresSink,
+                                   open_sink)
+from museum_pipeline.parallel_load import ParallelLoader
+from museum_pipeline.limiter import BACKFILL, limited
+from museum_pipeline.memory import MEMORY, profiled
+from museum_pipeline.shard_index import (ShardIndex, format_bound, in_range,
+                                         normalize_at)
 
+MUSEUM_PATTERNS = {
+    "lmnh": r"lmnh_hist_data_\d+.csv",
+    "lms": r"lms_hist_data_\d+.csv",
+}
 
-def __get_cla() -> dict:
+
+def __get_cla(argv: list[str] | None = None) -> argparse.Namespace:
     """Parses user arguments"""
     parser = argparse.ArgumentParser(
         prog='Sigma Lab Data Pipeline',
         description='Pipes data from an s3 bucket to and RDS DB.',
         epilog='Good Luck!'
     )
-    parser.add_argument("-config_logging", action="store_true",
-                        help="Enables command-line configuration of logging"
-                        " handlers.", default=False)
-    parser.add_argument("-stdout", choices=['true', 'false'],
-                        help="Choose whether to output logs to terminal."
-                        "(Default false)",
-                        default='false')
-    parser.add_argument("-file", choices=["true", "false"],
-                        help="Choose whether to output logs to file."
-                        "(Default true)",
-                        default='true')
-    parser.add_argument("-bucket", help="Name of the s3 bucket to connect to."
-                        "(Default .env[S3_BUCKET])",
-                        default=None)
-    parser.add_argument("-rows", type=int, help="Number of rows to upload.",
-                        default=None)
-    args = parser.parse_args()
-    args.stdout = args.stdout == 'true'
-    args.file = args.stdout == 'true'
-    return args
+    add_batch_arguments(parser)
+    return normalise_batch_arguments(parser.parse_args(argv))
 
 
 def _setup_handlers(args):
@@ -56,14 +59,240 @@ def _setup_handlers(args):
     return handlers
 
 
-def main():
-    """main function"""
-    args = __get_cla()
-    if args.config_logging:
-        handlers = _setup_handlers(args)
-        logger = setup_logging("pipeline", handlers)
+def _row_in_range(row: dict, start: str | None, end: str | None) -> bool:
+    return in_range(normalize_at(row["at"] or "") or "", start, end)
+
+
+def run_batch(boto_client, bucket: str, conn, logger,
+              rows: int | None = None, museum: str = "lmnh",
+              pattern: str | None = None,
+              files: list[str] | None = None,
+              rejects_dir: str | None = None,
+              index: ShardIndex | None = None,
+              date_from: str | None = None,
+              date_to: str | None = None,
+              bulk: bool = False,
+              drop_indexes: bool = False,
+              sinks: list[str] | None = None,
+              sink_dir: str = "export",
+              connections: int = 1,
+              transaction_rows: int = 20000,
+              slice_by: str = "day",
+              connect=None) -> dict:
+    """Loads every csv of a museum in a bucket into the database.
+
+    Arguments:
+        boto_client -- a boto3 s3 connection
+        bucket -- name of the s3 bucket to load from
+        conn -- psycopg2 connection
+        logger -- logging object
+        rows -- maximum number of rows to upload (Default all)
+        museum -- name of the museum as it appears in your database
+        pattern -- regex matching the whole key of each of the museum's csvs
+            (Default MUSEUM_PATTERNS[museum])
+        files -- keys in the bucket (Default listed from the bucket)
+        rejects_dir -- directory to write <museum>_rejects.csv to, with every
+            rejected row (Default not written)
+        index -- ShardIndex of the bucket, updated with every csv downloaded
+            (Default no index)
+        date_from, date_to -- only load rows with `at` in [date_from,
+            date_to), as "%Y-%m-%d %H:%M:%S" strings; csvs the index shows
+            to be outside the range are not downloaded (Default all rows)
+        bulk -- load through unlogged staging tables with bulk_load, rather
+            than the InteractionWriter (Default False)
+        drop_indexes -- with bulk, drop and rebuild the interaction tables'
+            secondary indexes and foreign keys around the load
+        sinks -- names of the sinks to write to (Default ["postgres"])
+        sink_dir -- directory the file sinks write under, in
+            <sink_dir>/<museum>/<sink> (Default export)
+        connections -- with more than 1, and without bulk, write through a
+            ParallelLoader with this many connections from connect, rather
+            than over conn (Default 1)
+        transaction_rows, slice_by -- the ParallelLoader's transaction_rows
+            and by (Default 20000, day)
+        connect -- callable returning a new psycopg2 connection
+
+    Returns:
+        a dict of the files, rows read, rows uploaded and rows rejected by
+        reason, with bulk the seconds each bulk_load phase took, and with
+        connections the ParallelLoader's summary and an error if any rows
+        weren't loaded
+    """
+    if files is None:
+        files = get_filenames(boto_client, bucket)
+    if pattern is None:
+        pattern = MUSEUM_PATTERNS[museum]
+    files = filter_strings(files, pattern)
+    skipped = 0
+    if index is not None and (date_from is not None or date_to is not None):
+        selected = index.select(files, date_from, date_to)
+        skipped = len(files) - len(selected)
+        files = selected
+    with MEMORY.stage(f"{museum}.download_files"):
+        download_files(boto_client, bucket, files)
+    logger.info(f"Downloaded {len(files)} {museum} files, skipped {skipped}")
+
+    paths = [f"data/{x}" for x in files]
+    if index is not None:
+        for key, filepath in zip(files, paths):
+            if index.get(key) is None:
+                index.scan(key, filepath)
+    keep = None
+    if date_from is not None or date_to is not None:
+        keep = partial(_row_in_range, start=date_from, end=date_to)
+    fieldnames = ["at", "site", "val", "type"]
+    master_csv_path = f"data/{museum}_hist_data.csv"
+    with MEMORY.stage(f"{museum}.merge_csvs"):
+        merge_csvs(paths, fieldnames, master_csv_path, keep)
+    logger.info(f"Merged {museum} csv")
+
+    with MEMORY.stage(f"{museum}.load_csv_data"):
+        csv_data = load_csv_data(master_csv_path)
+    id_dict = load_id_dict(conn, museum)
+    rejects = RejectReport(keep_rows=rejects_dir is not None)
+    with MEMORY.stage(f"{museum}.prepare_upload_data"):
+        payload_data = _prepare_upload_data(csv_data, id_dict, logger, rows,
+                                            rejects)
+    if connections > 1 and not bulk:
+        postgres = ParallelPostgresSink(ParallelLoader(
+            connect, connections, transaction_rows, slice_by, logger=logger))
     else:
-        logger = setup_logging("pipeline")
+        postgres = PostgresSink(conn, bulk, drop_indexes, rejects)
+    sink = open_sink(sinks or ["postgres"], path.join(sink_dir, museum),
+                     postgres)
+    try:
+        with MEMORY.stage(f"{museum}.write"):
+            uploaded = sink.write_tables(payload_data)
+    finally:
+        sink.close()
+    if rejects.total:
+        logger.warning({"museum": museum, "rejected": rejects.summary()})
+    if rejects_dir is not None:
+        makedirs(rejects_dir, exist_ok=True)
+        rejects.write_csv(path.join(rejects_dir, f"{museum}_rejects.csv"))
+    summary = {"files": len(files), "files_skipped": skipped,
+               "rows_read": len(csv_data),
+               "rows_uploaded": uploaded,
+               "rows_rejected": rejects.total,
+               "rejects": dict(rejects.counts)}
+    if getattr(sink, "phases", None) is not None:
+        summary["phases"] = sink.phases
+    if getattr(sink, "parallel", None) is not None:
+        summary["parallel"] = sink.parallel
+        if sink.parallel["rows_failed"]:
+            summary["error"] = (f"{sink.parallel['rows_failed']} rows not "
+                                "loaded; see parallel.connections.")
+    return summary
+
+
+def _run_museum(boto_client, bucket: str, pool, logger, museum: str,
+                pattern: str, rows: int | None, files: list[str],
+                **kwargs) -> dict:
+    """Runs run_batch for one museum on a pooled connection, or without a
+    pool on one of its own from kwargs["connect"], recording throughput
+    and any error rather than raising it"""
+    summary = {"museum": museum, "files": 0, "files_skipped": 0,
+               "rows_read": 0,
+               "rows_uploaded": 0, "rows_rejected": 0, "rejects": {},
+               "error": None}
+    started = perf_counter()
+    conn = pool.getconn() if pool is not None else kwargs["connect"]()
+    try:
+        summary.update(run_batch(boto_client, bucket, conn, logger, rows,
+                                 museum, pattern, files, **kwargs))
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        conn.rollback()
+        logger.exception(f"Upload of {museum} failed.")
+        summary["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if pool is not None:
+            pool.putconn(conn)
+        else:
+            conn.close()
+    summary["seconds"] = round(perf_counter() - started, 3)
+    summary["rows_per_second"] = round(
+        summary["rows_uploaded"] / summary["seconds"], 1) \
+        if summary["seconds"] else 0.0
+    return summary
+
+
+def run_batches(boto_client, bucket: str, pool, logger,
+                sources: dict[str, str], rows: int | None = None,
+                workers: int | None = None, **kwargs) -> list[dict]:
+    """Loads several museums' csvs from a bucket concurrently.
+
+    The bucket is listed once, and every museum shares the s3 client and
+    the connection pool; each museum uses its own id mapping. A failure in
+    one museum is recorded in its summary and doesn't stop the others.
+
+    Arguments:
+        boto_client -- a boto3 s3 connection, shared by every museum
+        bucket -- name of the s3 bucket to load from
+        pool -- psycopg2 ThreadedConnectionPool, with at least `workers`
+            connections, or None for each museum to open a connection,
+            only used to read its id mapping, from connect
+        logger -- logging object
+        sources -- dict of {<museum name>: <key pattern>}
+        rows -- maximum number of rows to upload per museum (Default all)
+        workers -- museums loaded at once (Default all of them)
+        kwargs -- rejects_dir, index, date_from, date_to, bulk,
+            drop_indexes, sinks, sink_dir, connections, transaction_rows,
+            slice_by and connect, as for run_batch
+
+    Returns:
+        a summary dict for each museum, in the order of sources
+    """
+    etags = get_object_etags(boto_client, bucket)
+    if kwargs.get("index") is not None:
+        kwargs["index"].reconcile(etags)
+    files = list(etags)
+    with ThreadPoolExecutor(workers or len(sources)) as executor:
+        futures = [executor.submit(_run_museum, boto_client, bucket, pool,
+                                   logger, museum, pattern, rows, files,
+                                   **kwargs)
+                   for museum, pattern in sources.items()]
+        return [f.result() for f in futures]
+
+
+def _load_index(boto_client, bucket: str, logger) -> ShardIndex | None:
+    """Reads the bucket's shard index, or returns None if it can't be read"""
+    try:
+        return ShardIndex.load(boto_client, bucket)
+    except (ClientError, ValueError, KeyError) as e:
+        logger.warning(f"Shard index unavailable, reading every shard: {e}")
+        return None
+
+
+def _save_index(index: ShardIndex | None, boto_client, bucket: str,
+                logger) -> None:
+    if index is None:
+        return
+    try:
+        index.save(boto_client, bucket)
+    except ClientError as e:
+        logger.warning(f"Shard index not saved: {e}")
+
+
+def build_index(boto_client, bucket: str, logger,
+                patterns: list[str]) -> int:
+    """Indexes every csv matching a pattern which isn't yet indexed
+
+    Returns:
+        the number of csvs indexed
+    """
+    index = ShardIndex.load(boto_client, bucket)
+    etags = get_object_etags(boto_client, bucket)
+    index.reconcile(etags)
+    keys = [k for pattern in patterns for k in filter_strings(list(etags),
+                                                              pattern)]
+    indexed = index.build(boto_client, bucket, keys)
+    index.save(boto_client, bucket)
+    logger.info(f"Indexed {indexed} of {len(keys)} csvs.")
+    return indexed
+
+
+def _s3(args: argparse.Namespace) -> tuple:
+    """Returns the bucket to load from and an s3 client"""
     load_dotenv()
     bucket: str
     if args.bucket is not None:
@@ -72,32 +301,74 @@ def main():
         bucket = ENV["S3_BUCKET"]
     boto_client = client("s3", aws_access_key_id=ENV["AWS_ACCESS_KEY"],
                          aws_secret_access_key=ENV["AWS_SECRET_KEY"])
-    logger.info("Established s3 connection.")
+    return bucket, boto_client
 
-    files = get_filenames(boto_client, bucket)
-    valid_patterns = r"lmnh_hist_data_\d+.csv"
-    files = filter_strings(files, valid_patterns)
-    download_files(boto_client, bucket, files)
-    logger.info("Downloaded files")
 
-    files = [f"data/{x}" for x in files]
-    fieldnames = ["at", "site", "val", "type"]
-    master_csv_path = "data/lmnh_hist_data.csv"
-    merge_csvs(files, fieldnames, master_csv_path)
-    logger.info("Merged csv")
-
-    csv_data = load_csv_data(master_csv_path)
-    with connect(
-        host=ENV["PIPELINE_TARGET_HOST"],
-        user=ENV["PIPELINE_TARGET_USER"],
-        password=ENV["PIPELINE_TARGET_PASSWORD"],
-        dbname=ENV["PIPELINE_TARGET_DBNAME"],
-        port=ENV["PIPELINE_TARGET_PORT"],
-    ) as conn:
-        id_dict = load_id_dict(conn, "lmnh")
-        payload_data = _prepare_upload_data(
-                csv_data, id_dict, logger, args.rows)
-        _upload_data(payload_data, conn)
+def index_main(args: argparse.Namespace) -> None:
+    """Builds the shard index of the museums' csvs in a bucket
+
+    Arguments:
+        args -- parsed arguments, with bucket, museums and patterns
+    """
+    logger = setup_logging("pipeline")
+    bucket, boto_client = _s3(args)
+    build_index(boto_client, bucket, logger,
+                [args.patterns.get(m, MUSEUM_PATTERNS[m])
+                 for m in args.museums])
+
+
+def main(args: argparse.Namespace | None = None):
+    """main function
+
+    Arguments:
+        args -- parsed arguments, as returned by __get_cla (Default parsed
+            from the command line)
+    """
+    if args is None:
+        args = __get_cla()
+    if args.config_logging:
+        handlers = _setup_handlers(args)
+        logger = setup_logging("pipeline", handlers)
+    else:
+        logger = setup_logging("pipeline")
+    bucket, boto_client = _s3(args)
+    logger.info("Established s3 connection.")
+
+    sources = {m: args.patterns.get(m, MUSEUM_PATTERNS[m])
+               for m in args.museums}
+    pool = None
+    if "postgres" in args.sink:
+        pool = ThreadedConnectionPool(
+            1, len(sources),
+            host=ENV["PIPELINE_TARGET_HOST"],
+            user=ENV["PIPELINE_TARGET_USER"],
+            password=ENV["PIPELINE_TARGET_PASSWORD"],
+            dbname=ENV["PIPELINE_TARGET_DBNAME"],
+            port=ENV["PIPELINE_TARGET_PORT"],
+        )
+    index = _load_index(boto_client, bucket, logger)
+    try:
+        # Profiled museums run one at a time, so each stage's peaks are
+        # its own.
+        with profiled(args.memory_report, logger), \
+                limited(get_env_conn, BACKFILL, logger):
+            summaries = run_batches(
+                boto_client, bucket, pool, logger, sources, args.rows,
+                workers=1 if args.memory_report else None,
+                rejects_dir=args.rejects_dir, index=index,
+                date_from=format_bound(args.date_from),
+                date_to=format_bound(args.date_to), bulk=args.bulk,
+                drop_indexes=args.drop_indexes, sinks=args.sink,
+                sink_dir=args.sink_dir, connections=args.connections,
+                transaction_rows=args.transaction_rows,
+                slice_by=args.slice_by, connect=get_env_conn)
+    finally:
+        if pool is not None:
+            pool.closeall()
+        _save_index(index, boto_client, bucket, logger)
+    for summary in summaries:
+        logger.info(summary)
+        print(json.dumps(summary))
     logger.info("Uploaded all files")
 
 
@@ -1,13 +1,19 @@
 #pylint: skip-file
+import copy
 import datetime
+import functools
 import json
 import logging
 import logging.config
 import logging.handlers
+import queue
+import threading
 from typing import override
 
 import atexit
 
+from museum_pipeline.metrics import METRICS
+
 
 class JSONFormatter(logging.Formatter):
     """A class for formatting log output to json"""
@@ -16,45 +22,210 @@ class JSONFormatter(logging.Formatter):
         """Initialises JSONFormatter class"""
         super().__init__()
         self.fmt_keys = fmt_keys if fmt_keys is not None else {}
+        # The output keys are fixed by fmt_keys, so work out once which
+        # computed fields are mapped and which are appended.
+        self._fields = list(self.fmt_keys.items())
+        self._mapped = set(self.fmt_keys.values())
+        self._encode = json.JSONEncoder(default=str).encode
+        self._second = (None, "")
+
+    def _timestamp(self, created: float) -> str:
+        """Formats a UTC isoformat timestamp, reusing the text of the
+        current second"""
+        second = int(created)
+        cached = self._second
+        if cached[0] != second:
+            cached = (second, datetime.datetime.fromtimestamp(
+                second, tz=datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S"))
+            self._second = cached
+        micro = round((created - second) * 1e6)
+        if micro == 0 or micro >= 1000000:
+            return datetime.datetime.fromtimestamp(
+                created, tz=datetime.timezone.utc).isoformat()
+        return f"{cached[1]}.{micro:06d}+00:00"
 
     @override
     def format(self, record: logging.LogRecord) -> str:
-
-        message = self._prepare_log_dict(record)
-        return json.dumps(message, default=str)
-
-    def _prepare_log_dict(self, record: logging.LogRecord) -> str:
         always_fields = {
             "message": record.getMessage(),
-            "timestamp": datetime.datetime.fromtimestamp(
-                record.created, tz=datetime.timezone.utc
-            ).isoformat(),
+            "timestamp": self._timestamp(record.created),
         }
         if record.exc_info is not None:
             always_fields["exc_info"] = self.formatException(record.exc_info)
         if record.stack_info is not None:
             always_fields["stack_info"] = self.formatStack(record.stack_info)
-        message = {
-            key: msg_val
-            if (msg_val := always_fields.pop(val, None)) is not None
-            else getattr(record, val)
-            for key, val in self.fmt_keys.items()
-                }
+        message = {key: always_fields[val] if val in always_fields
+                   else getattr(record, val) for key, val in self._fields}
+        for key, val in always_fields.items():
+            if key not in self._mapped:
+                message[key] = val
+        return self._encode(message)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler which never blocks on a full, bounded queue.
+
+    When the queue is full a record is dropped, and counted in the
+    log_records_dropped_total metric. With the "aggregate" policy, dropped
+    records are also counted by logger, level and message template, and one
+    "suppressed" record per template is queued once there is room again.
+    """
+
+    def __init__(self, queue, policy: str = "drop",
+                 max_aggregates: int = 100):
+        super().__init__(queue)
+        if policy not in ("drop", "aggregate"):
+            raise ValueError(f"Unknown overload policy {policy}")
+        self.policy = policy
+        self.max_aggregates = max_aggregates
+        self.dropped = 0
+        self._suppressed = {}
+        self._suppressed_lock = threading.Lock()
+
+    def _drop(self, record: logging.LogRecord) -> None:
+        with self._suppressed_lock:
+            self.dropped += 1
+            if self.policy == "aggregate":
+                key = (record.name, record.levelno, str(record.msg))
+                if key in self._suppressed \
+                        or len(self._suppressed) < self.max_aggregates:
+                    self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                else:
+                    key = (record.name, record.levelno, "<other messages>")
+                    self._suppressed[key] = self._suppressed.get(key, 0) + 1
+        METRICS.inc("log_records_dropped_total")
+
+    def flush_suppressed(self) -> None:
+        """Queues a summary record for each aggregated template"""
+        with self._suppressed_lock:
+            suppressed, self._suppressed = self._suppressed, {}
+        for (name, levelno, msg), count in suppressed.items():
+            record = logging.LogRecord(
+                name, levelno, __file__, 0,
+                f"Suppressed {count} records like: {msg}", None, None)
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except queue.Full:
+                with self._suppressed_lock:
+                    self._suppressed[(name, levelno, msg)] = \
+                        self._suppressed.get((name, levelno, msg), 0) + count
+
+    @override
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if self.formatter is not None or record.exc_info is not None \
+                or record.stack_info is not None:
+            return super().prepare(record)
+        # Without a formatter or traceback, formatting is just getMessage.
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        record.exc_text = None
+        return record
+
+    @override
+    def emit(self, record: logging.LogRecord) -> None:
+        if self.queue.full():
+            self._drop(record)
+            return
+        if self._suppressed:
+            self.flush_suppressed()
+        try:
+            self.enqueue(self.prepare(record))
+        except queue.Full:
+            self._drop(record)
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handleError(record)
 
-        message.update(always_fields)
 
-        return message
+class BatchingFileHandler(logging.handlers.RotatingFileHandler):
+    """A RotatingFileHandler which can write many records at once"""
 
+    def emit_batch(self, records: list[logging.LogRecord]) -> None:
+        """Formats records, and writes and flushes them in one write"""
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.shouldRollover(records[0]):
+                self.doRollover()
+            self.stream.write("".join(self.format(r) + self.terminator
+                                      for r in records))
+            self.flush()
+        except Exception:  # pylint: disable=broad-exception-caught
+            self.handleError(records[0])
 
-def setup_logging(logger_name: str, handlers: list[str] | None = None):
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """A QueueListener which takes every queued record at each wake-up, and
+    hands them to a BatchingFileHandler in one call"""
+
+    batch_size = 512
+
+    @override
+    def _monitor(self):
+        q = self.queue
+        stopping = False
+        while not stopping:
+            batch = [self.dequeue(True)]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(q.get_nowait())
+            except queue.Empty:
+                pass
+            if self._sentinel in batch:
+                stopping = True
+                batch = batch[:batch.index(self._sentinel)]
+            self._handle_batch([self.prepare(r) for r in batch])
+            for _ in range(len(batch) + stopping):
+                q.task_done()
+
+    def _handle_batch(self, records: list[logging.LogRecord]) -> None:
+        if not records:
+            return
+        for handler in self.handlers:
+            if self.respect_handler_level:
+                accepted = [r for r in records if r.levelno >= handler.level]
+            else:
+                accepted = records
+            if not accepted:
+                continue
+            if isinstance(handler, BatchingFileHandler):
+                with handler.lock:
+                    handler.emit_batch(
+                        [r for r in accepted if handler.filter(r)])
+            else:
+                for record in accepted:
+                    handler.handle(record)
+
+    @override
+    def enqueue_sentinel(self):
+        # Wait for room, rather than failing, if the queue is bounded.
+        self.queue.put(self._sentinel)
+
+
+@functools.cache
+def load_logging_config(path: str = "conf_logging.json") -> dict:
+    """Reads a logging config once per process; callers must not mutate it"""
+    with open(path, "r", encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def setup_logging(logger_name: str, handlers: list[str] | None = None,
+                  config: dict | None = None):
     logger = logging.getLogger(logger_name)
-    with open("conf_logging.json", "r", encoding="utf-8") as fp:
-        config = json.load(fp)
+    if config is None:
+        config = load_logging_config()
+    config = copy.deepcopy(config)
     if handlers is not None:
         config["handlers"]["queue_handler"]["handlers"] = handlers
     logging.config.dictConfig(config)
     queue_handler = logging.getHandlerByName("queue_handler")
     if queue_handler is not None:
         queue_handler.listener.start()
-        atexit.register(queue_handler.listener.stop)
+        atexit.register(_stop_queue_handler, queue_handler)
     return logger
+
+
+def _stop_queue_handler(queue_handler) -> None:
+    if isinstance(queue_handler, BoundedQueueHandler):
+        queue_handler.flush_suppressed()
+    queue_handler.listener.stop()
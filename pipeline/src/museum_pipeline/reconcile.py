@@ -0,0 +1,565 @@
+"""Reconciliation of the source data with the database, bucket by bucket.
+
+Rows are grouped into buckets of (museum, exhibition_id, day) and each
+bucket is summarised by a digest of three numbers:
+
+    count  -- rows in the bucket
+    fine   -- the sum, mod 2**64, of a 64-bit hash of every row's table,
+              event_at to the microsecond, exhibition_id and value id
+    coarse -- the same sum, with event_at truncated to the hour
+
+Sums don't depend on row order, so digests of shards, segments or hours
+add up to the digest of their union, and a missing, extra, repeated or
+altered row changes the sum. The hash is the first 16 hex digits of the
+MD5 of the row's text, which Postgres computes identically, so the
+database's digests are one GROUP BY over the interaction tables, sent back
+as one row per bucket.
+
+Interactions compacted into the hourly tables have no event_at finer than
+the hour, and count with their interactions as multiplicity in coarse
+only. A bucket holding compacted interactions is compared on count and
+coarse, and every other bucket on count and fine.
+
+Days and times are the wall clock of the database session's time zone,
+which is how the batch pipeline's naive csv times were stored; Kafka times
+are converted to it. Compacted hours are UTC hours, so they fall in the
+right day in any time zone a whole number of hours from UTC.
+
+The csv side's digests are kept per shard in the bucket's shard index,
+against the shard's ETag and the id mapping they were computed with, so a
+nightly run only reads shards which are new or have changed, and the
+database side is bounded to the days asked for.
+
+A targeted reload replaces each differing bucket, in its own transaction,
+with the source's rows for it: the bucket's raw and compacted rows are
+deleted and the source's inserted through the InteractionWriter. Only the
+shards whose digests hold a differing bucket are read again.
+"""
+#pylint: disable=unused-variable
+import csv
+import hashlib
+import json
+import tempfile
+from datetime import date, datetime as dt, time
+from importlib import import_module
+from os import path, walk
+from time import perf_counter
+from zoneinfo import ZoneInfo
+
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.recording import list_segments, read_recording
+from museum_pipeline.shard_index import ShardIndex, scan_csv
+from museum_pipeline.transform import _validate_row
+from museum_pipeline.writer import TABLES, WRITER
+
+_MOD = 2 ** 64
+_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+_SQL_TIME_FORMAT = "YYYY-MM-DD HH24:MI:SS.US"
+_SQL_HASH = "('x' || LEFT(MD5({text}), 16))::BIT(64)::BIGINT::NUMERIC"
+_VALUE_COLUMNS = {table: f"{table}_id" for table in TABLES}
+
+
+def _hash(text: str) -> int:
+    return int(hashlib.md5(text.encode("utf-8"),
+                           usedforsecurity=False).hexdigest()[:16], 16)
+
+
+def _local(at: dt, tz: ZoneInfo) -> dt:
+    """Returns a time as a naive wall clock time in tz; naive times are
+    taken to be already"""
+    if at.tzinfo is None:
+        return at
+    return at.astimezone(tz).replace(tzinfo=None)
+
+
+def _row_text(table: str, at: dt, exhibition_id: int, value_id: int) -> str:
+    return f"{table}|{at.strftime(_TIME_FORMAT)}|{exhibition_id}|{value_id}"
+
+
+class Digests:
+    """Digests of (museum, exhibition_id, day) buckets"""
+
+    def __init__(self, buckets: dict | None = None):
+        # (museum, exhibition_id, day) -> [count, fine, coarse, compacted]
+        self.buckets = buckets if buckets is not None else {}
+
+    def add(self, key: tuple, fine: int, coarse: int, count: int = 1,
+            compacted: int = 0) -> None:
+        """Adds rows' hashes to a bucket"""
+        digest = self.buckets.setdefault(key, [0, 0, 0, 0])
+        digest[0] += count
+        digest[1] = (digest[1] + fine) % _MOD
+        digest[2] = (digest[2] + coarse) % _MOD
+        digest[3] += compacted
+
+    def add_row(self, museum: str, table: str, row: dict, tz: ZoneInfo
+                ) -> None:
+        """Adds a prepared row, with event_at, exhibition_id and value_id"""
+        at = _local(row["event_at"], tz)
+        hour = at.replace(minute=0, second=0, microsecond=0)
+        self.add((museum, row["exhibition_id"], at.date().isoformat()),
+                 _hash(_row_text(table, at, row["exhibition_id"],
+                                 row["value_id"])),
+                 _hash(_row_text(table, hour, row["exhibition_id"],
+                                 row["value_id"])))
+
+    def merge(self, other: "Digests") -> None:
+        """Adds every bucket of another Digests to this one"""
+        for key, (count, fine, coarse, compacted) in other.buckets.items():
+            self.add(key, fine, coarse, count, compacted)
+
+    def between(self, day_from: str | None, day_to: str | None
+                ) -> "Digests":
+        """Returns the buckets with days in [day_from, day_to)"""
+        return Digests({key: digest for key, digest in self.buckets.items()
+                        if (day_from is None or key[2] >= day_from)
+                        and (day_to is None or key[2] < day_to)})
+
+    def to_dict(self) -> dict:
+        """Returns the digests of one museum's buckets as JSON-able data"""
+        return {f"{key[1]}|{key[2]}": digest[:3]
+                for key, digest in self.buckets.items()}
+
+    @classmethod
+    def from_dict(cls, museum: str, data: dict) -> "Digests":
+        """Reads digests written by to_dict"""
+        digests = cls()
+        for key, (count, fine, coarse) in data.items():
+            exhibition_id, day = key.split("|")
+            digests.add((museum, int(exhibition_id), day), fine, coarse,
+                        count)
+        return digests
+
+
+def _fingerprint(id_dict: dict) -> str:
+    """Returns a short fingerprint of an id mapping, which digests depend
+    on"""
+    return hashlib.md5(json.dumps(id_dict, sort_keys=True,
+                                  default=str).encode("utf-8"),
+                       usedforsecurity=False).hexdigest()[:16]
+
+
+def _csv_rows(filepath: str, id_dict: dict):
+    """Yields (table, row) of every valid row of a csv, as the batch
+    pipeline would load it"""
+    with open(filepath, "r", encoding="utf-8") as fp:
+        for row in csv.DictReader(fp):
+            processed, reason, message = _validate_row(row, id_dict)
+            if reason is None:
+                yield processed["table"], processed["data"]
+
+
+def _download(boto_client, bucket: str, key: str, directory: str) -> str:
+    filepath = path.join(directory, "shard.csv")
+    boto_client.download_file(bucket, key, filepath)
+    return filepath
+
+
+def csv_digests(boto_client, bucket: str, index, museum: str,
+                keys: list[str], id_dict: dict, tz: ZoneInfo) -> Digests:
+    """Returns the digests of a museum's csvs, reading only shards whose
+    digests aren't in the index for this id mapping
+
+    Arguments:
+        boto_client -- a boto3 s3 connection
+        bucket -- name of the s3 bucket
+        index -- the bucket's ShardIndex, reconciled with its listing;
+            digests read are recorded in it
+        museum -- name of the museum the csvs belong to
+        keys -- keys of the museum's csvs
+        id_dict -- the museum's id mapping
+        tz -- time zone of the database session
+    """
+    fingerprint = _fingerprint(id_dict)
+    digests = Digests()
+    with tempfile.TemporaryDirectory() as tmp:
+        for key in keys:
+            entry = index.get(key)
+            if entry is not None and entry.get("id_map") == fingerprint:
+                digests.merge(Digests.from_dict(museum, entry["digests"]))
+                continue
+            filepath = _download(boto_client, bucket, key, tmp)
+            shard = Digests()
+            for table, row in _csv_rows(filepath, id_dict):
+                shard.add_row(museum, table, row, tz)
+            METRICS.inc("reconcile_shards_read_total")
+            index.update(key, {**(entry or scan_csv(filepath)),
+                               "id_map": fingerprint,
+                               "digests": shard.to_dict()})
+            digests.merge(shard)
+    return digests
+
+
+def _shards_holding(index, keys: list[str], buckets: set) -> list[str]:
+    """Returns the shards whose digests hold any of a museum's buckets,
+    or every shard without digests"""
+    wanted = {f"{exhibition_id}|{day}" for _, exhibition_id, day in buckets}
+    return [key for key in keys
+            if (index.get(key) or {}).get("digests") is None
+            or wanted & set(index.get(key)["digests"])]
+
+
+def csv_bucket_rows(boto_client, bucket: str, index, museum: str,
+                    keys: list[str], id_dict: dict, tz: ZoneInfo,
+                    buckets: set) -> dict:
+    """Returns the rows of a museum's csvs in the given buckets, split by
+    bucket and then table"""
+    rows = {key: {table: [] for table in TABLES} for key in buckets}
+    with tempfile.TemporaryDirectory() as tmp:
+        for key in _shards_holding(index, keys, buckets):
+            for table, row in _csv_rows(_download(boto_client, bucket, key,
+                                                  tmp), id_dict):
+                day = _local(row["event_at"], tz).date().isoformat()
+                target = rows.get((museum, row["exhibition_id"], day))
+                if target is not None:
+                    target[table].append(row)
+    return rows
+
+
+def _segment_directories(directory: str) -> list[str]:
+    """Returns every directory under a museum's recording which holds
+    segments, e.g. one per supervised worker"""
+    return sorted(root for root, _, files in walk(directory)
+                  if list_segments(root))
+
+
+def recording_rows(directory: str, id_dict: dict, start: time, end: time):
+    """Yields (table, row) of every valid message in a museum's recording,
+    as the Kafka pipeline would load it"""
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.kafka_pipeline import (process_at, process_site,
+                                                process_val)
+    for segments in _segment_directories(directory):
+        for msg in read_recording(segments):
+            if msg.value() is None:
+                continue
+            try:
+                message = json.loads(msg.value().decode("UTF-8"))
+                message = process_val(message, id_dict)
+                message = process_site(message, id_dict["exhibition"])
+                message = process_at(message, start, end)
+            except (KeyError, ValueError, TypeError):
+                continue
+            yield message["table"], message
+
+
+def recording_digests(directory: str, museum: str, id_dict: dict,
+                      start: time, end: time, tz: ZoneInfo) -> Digests:
+    """Returns the digests of a museum's recorded Kafka traffic"""
+    digests = Digests()
+    for table, row in recording_rows(directory, id_dict, start, end):
+        digests.add_row(museum, table, row, tz)
+    return digests
+
+
+def database_timezone(conn) -> ZoneInfo:
+    """Returns the time zone of a connection's session"""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT current_setting('TimeZone');")
+        name = cur.fetchone()[0]
+    finally:
+        cur.close()
+    conn.commit()
+    return ZoneInfo(name)
+
+
+def _digest_query(table: str) -> str:
+    value = _VALUE_COLUMNS[table]
+    local = "(event_at AT TIME ZONE %(tz)s)"
+    hour = "(hour AT TIME ZONE %(tz)s)"
+    text = ("'{table}|' || TO_CHAR({at}, '{fmt}') || '|' || exhibition_id "
+            "|| '|' || {value}")
+    fine = _SQL_HASH.format(text=text.format(table=table, at=local,
+                                             fmt=_SQL_TIME_FORMAT,
+                                             value=value))
+    coarse = _SQL_HASH.format(text=text.format(
+        table=table, at=f"DATE_TRUNC('hour', {local})", fmt=_SQL_TIME_FORMAT,
+        value=value))
+    compacted = _SQL_HASH.format(text=text.format(
+        table=table, at=hour, fmt=_SQL_TIME_FORMAT, value=value))
+    return f"""SELECT
+                   exhibition_id, {local}::DATE AS day,
+                   1::BIGINT AS n, 0::BIGINT AS compacted,
+                   {fine} AS fine, {coarse} AS coarse
+               FROM
+                   {table}_interaction
+               WHERE
+                   (%(from)s::TIMESTAMP IS NULL
+                    OR event_at >= %(from)s::TIMESTAMP AT TIME ZONE %(tz)s)
+               AND
+                   (%(to)s::TIMESTAMP IS NULL
+                    OR event_at < %(to)s::TIMESTAMP AT TIME ZONE %(tz)s)
+               UNION ALL
+               SELECT
+                   exhibition_id, {hour}::DATE,
+                   interactions, interactions,
+                   0, interactions * {compacted}
+               FROM
+                   {table}_hourly
+               WHERE
+                   (%(from)s::TIMESTAMP IS NULL
+                    OR hour >= %(from)s::TIMESTAMP AT TIME ZONE %(tz)s)
+               AND
+                   (%(to)s::TIMESTAMP IS NULL
+                    OR hour < %(to)s::TIMESTAMP AT TIME ZONE %(tz)s)"""
+
+
+DIGEST_QUERY = f"""
+    SELECT
+        museum_name, exhibition_id, day::TEXT,
+        SUM(n), SUM(fine) %% {_MOD}, SUM(coarse) %% {_MOD}, SUM(compacted)
+    FROM
+        ({" UNION ALL ".join(_digest_query(table) for table in TABLES)})
+            AS interactions
+    JOIN
+        exhibition
+    USING
+        (exhibition_id)
+    JOIN
+        museum
+    USING
+        (museum_id)
+    WHERE
+        museum_name = ANY(%(museums)s)
+    GROUP BY
+        1, 2, 3;"""
+
+
+def database_digests(conn, museums: list[str], tz: ZoneInfo,
+                     day_from: str | None = None,
+                     day_to: str | None = None) -> Digests:
+    """Returns the digests of the museums' buckets in the database, for
+    days in [day_from, day_to)"""
+    cur = conn.cursor()
+    try:
+        cur.execute(DIGEST_QUERY, {"tz": tz.key, "museums": museums,
+                                   "from": day_from, "to": day_to})
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+    conn.commit()
+    digests = Digests()
+    for museum, exhibition_id, day, count, fine, coarse, compacted in rows:
+        digests.add((museum, exhibition_id, day), int(fine) % _MOD,
+                    int(coarse) % _MOD, int(count), int(compacted))
+    return digests
+
+
+def compare(source: Digests, database: Digests) -> list[dict]:
+    """Returns a description of every bucket whose digests differ, in
+    bucket order"""
+    differences = []
+    for key in sorted(source.buckets.keys() | database.buckets.keys()):
+        ours = source.buckets.get(key, [0, 0, 0, 0])
+        theirs = database.buckets.get(key, [0, 0, 0, 0])
+        compacted = theirs[3] > 0
+        column = 2 if compacted else 1
+        if ours[0] == theirs[0] and ours[column] == theirs[column]:
+            continue
+        differences.append({"museum": key[0], "exhibition_id": key[1],
+                            "day": key[2], "source_rows": ours[0],
+                            "db_rows": theirs[0],
+                            "compacted_rows": theirs[3],
+                            "difference": "count" if ours[0] != theirs[0]
+                            else "rows"})
+    return differences
+
+
+_DELETE = [
+    f"""DELETE FROM {table}_{kind}
+        WHERE
+            exhibition_id = %(exhibition_id)s
+        AND
+            {column} >= %(day)s::TIMESTAMP AT TIME ZONE %(tz)s
+        AND
+            {column} < (%(day)s::DATE + 1)::TIMESTAMP AT TIME ZONE %(tz)s;"""
+    for table in TABLES
+    for kind, column in (("interaction", "event_at"), ("hourly", "hour"))
+]
+
+
+def reload_buckets(conn, rows: dict, tz: ZoneInfo) -> int:
+    """Replaces each bucket's rows in the database with the source's
+
+    Arguments:
+        conn -- psycopg2 connection
+        rows -- {(museum, exhibition_id, day): <rows split by table>}
+        tz -- time zone of the database session
+
+    Returns:
+        the number of rows inserted
+    """
+    inserted = 0
+    for (museum, exhibition_id, day), data in sorted(rows.items()):
+        params = {"exhibition_id": exhibition_id, "day": day, "tz": tz.key}
+        cur = conn.cursor()
+        try:
+            for statement in _DELETE:
+                cur.execute(statement, params)
+            inserted += WRITER.write_tables(conn, data, commit=False)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        METRICS.inc("reconcile_buckets_reloaded_total")
+    return inserted
+
+
+def day_bounds(date_from: str | None, date_to: str | None) -> tuple:
+    """Converts ISO8601 -from and -to dates to bucket days, the end
+    exclusive"""
+    return tuple(None if bound is None else date.fromisoformat(bound)
+                 .isoformat() for bound in (date_from, date_to))
+
+
+def reconcile(conn, sources: dict, day_from: str | None = None,
+              day_to: str | None = None) -> tuple[Digests, list[dict]]:
+    """Compares the sources' digests with the database's
+
+    Arguments:
+        conn -- psycopg2 connection
+        sources -- {<museum>: <Digests of its source>}
+        day_from, day_to -- only compare days in [day_from, day_to)
+            (Default every day)
+
+    Returns:
+        the source digests of the compared days, and the differences
+    """
+    source = Digests()
+    for digests in sources.values():
+        source.merge(digests.between(day_from, day_to))
+    tz = database_timezone(conn)
+    database = database_digests(conn, list(sources), tz, day_from, day_to)
+    METRICS.set("reconcile_buckets", len(source.buckets.keys()
+                                         | database.buckets.keys()))
+    differences = compare(source, database)
+    METRICS.set("reconcile_buckets_differing", len(differences))
+    return source, differences
+
+
+def _recording_hours(museum: str) -> tuple[time, time]:
+    """Returns the opening and closing times of a museum"""
+    module = import_module(f"museum_pipeline.{museum}_kafka_pipeline")
+    return module.START_TIME, module.END_TIME
+
+
+def _recording_bucket_rows(directory: str, museum: str, id_dict: dict,
+                           tz: ZoneInfo, buckets: set) -> dict:
+    """Returns the rows of a museum's recording in the given buckets, split
+    by bucket and then table"""
+    rows = {key: {table: [] for table in TABLES} for key in buckets}
+    for table, row in recording_rows(directory, id_dict,
+                                     *_recording_hours(museum)):
+        day = _local(row["event_at"], tz).date().isoformat()
+        target = rows.get((museum, row["exhibition_id"], day))
+        if target is not None:
+            target[table].append(row)
+    return rows
+
+
+class _CsvSource:
+    """A bucket's csvs, and the shard index their digests are kept in"""
+
+    def __init__(self, args, logger):
+        # pylint: disable=import-outside-toplevel
+        from museum_pipeline.extract import get_object_etags
+        from museum_pipeline.pipeline import (MUSEUM_PATTERNS, _load_index,
+                                              _s3)
+        from museum_pipeline.transform import filter_strings
+        self.logger = logger
+        self.bucket, self.client = _s3(args)
+        etags = get_object_etags(self.client, self.bucket)
+        self.index = _load_index(self.client, self.bucket, logger) \
+            or ShardIndex()
+        self.index.reconcile(etags)
+        self.keys = {m: filter_strings(list(etags), args.patterns.get(
+            m, MUSEUM_PATTERNS[m])) for m in args.museums}
+
+    def digests(self, museum: str, id_dict: dict, tz: ZoneInfo) -> Digests:
+        """Returns the digests of a museum's csvs"""
+        return csv_digests(self.client, self.bucket, self.index, museum,
+                           self.keys[museum], id_dict, tz)
+
+    def rows(self, museum: str, id_dict: dict, tz: ZoneInfo,
+             buckets: set) -> dict:
+        """Returns a museum's rows in the given buckets"""
+        return csv_bucket_rows(self.client, self.bucket, self.index, museum,
+                               self.keys[museum], id_dict, tz, buckets)
+
+    def close(self) -> None:
+        """Saves the digests read back to the shard index"""
+        # pylint: disable=import-outside-toplevel
+        from museum_pipeline.pipeline import _save_index
+        _save_index(self.index, self.client, self.bucket, self.logger)
+
+
+class _RecordingSource:
+    """Recorded Kafka traffic, in <directory>/<museum>"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def digests(self, museum: str, id_dict: dict, tz: ZoneInfo) -> Digests:
+        """Returns the digests of a museum's recording"""
+        return recording_digests(path.join(self.directory, museum), museum,
+                                 id_dict, *_recording_hours(museum), tz)
+
+    def rows(self, museum: str, id_dict: dict, tz: ZoneInfo,
+             buckets: set) -> dict:
+        """Returns a museum's rows in the given buckets"""
+        return _recording_bucket_rows(path.join(self.directory, museum),
+                                      museum, id_dict, tz, buckets)
+
+    def close(self) -> None:
+        """Nothing to release"""
+
+
+def main(args) -> dict:
+    """Reconciles the museums' csvs, or recordings, with the database,
+    printing each differing bucket and a summary as JSON lines
+
+    Arguments:
+        args -- parsed arguments, with bucket, museums, patterns,
+            recording_dir, date_from, date_to and reload
+    """
+    # pylint: disable=import-outside-toplevel
+    from museum_pipeline.extract import get_env_conn, load_id_dict
+    from museum_pipeline.pipeline_logger import setup_logging
+    logger = setup_logging("reconcile")
+    started = perf_counter()
+    day_from, day_to = day_bounds(args.date_from, args.date_to)
+    conn = get_env_conn()
+    source = None
+    try:
+        tz = database_timezone(conn)
+        id_dicts = {m: load_id_dict(conn, m) for m in args.museums}
+        source = _RecordingSource(args.recording_dir) \
+            if args.recording_dir is not None else _CsvSource(args, logger)
+        digests, differences = reconcile(
+            conn, {m: source.digests(m, id_dicts[m], tz)
+                   for m in args.museums}, day_from, day_to)
+        for difference in differences:
+            print(json.dumps(difference))
+        reloaded = 0
+        for museum in args.museums if args.reload else []:
+            buckets = {(d["museum"], d["exhibition_id"], d["day"])
+                       for d in differences if d["museum"] == museum}
+            if buckets:
+                reloaded += reload_buckets(
+                    conn, source.rows(museum, id_dicts[museum], tz,
+                                      buckets), tz)
+    finally:
+        conn.close()
+        if source is not None:
+            source.close()
+    summary = {"buckets": len(digests.buckets),
+               "buckets_differing": len(differences),
+               "source_rows": sum(d[0] for d in digests.buckets.values()),
+               "rows_reloaded": reloaded,
+               "seconds": round(perf_counter() - started, 3)}
+    logger.info(summary)
+    print(json.dumps(summary))
+    return summary
@@ -0,0 +1,283 @@
+"""Recordings of raw Kafka traffic, and playback of them through the pipeline.
+
+A Recorder appends every consumed message to numbered segment files in a
+directory: its raw value, topic, partition, offset and Kafka timestamp,
+exactly as the consumer saw it, invalid messages included. Each segment is
+a gzip stream of records:
+
+    <header: timestamp ms, offset, partition, timestamp type,
+             topic length, value length (-1 for a null value)>
+    <topic bytes><value bytes>
+
+The open segment is named <n>.rec.gz.part, and renamed to <n>.rec.gz once
+closed, after segment_bytes of records or segment_seconds. The recorder
+flushes at most once every flush_interval seconds, so a crash loses at most
+that much of the tail; readers stop at a torn record.
+
+A RecordingConsumer plays a recording back as a stand-in for a
+confluent_kafka.Consumer, so consume_messages runs it through process_val,
+process_site, process_at and the writer exactly as it runs live traffic.
+Messages are released at their recorded spacing, divided by speed, or as
+fast as they can be consumed when speed is None.
+"""
+#pylint: disable=unused-variable
+import gzip
+import struct
+from os import listdir, makedirs, path, rename
+from time import monotonic, sleep, time as time_now
+
+from confluent_kafka import TIMESTAMP_CREATE_TIME, TIMESTAMP_NOT_AVAILABLE
+
+from museum_pipeline.metrics import METRICS
+
+MAGIC = b"MUSREC01"
+SUFFIX = ".rec.gz"
+_HEADER = struct.Struct("<qqiBhi")
+
+
+class RecordedMessage:
+    """The parts of a confluent_kafka.Message used by the pipeline"""
+
+    __slots__ = ("_value", "_topic", "_partition", "_offset",
+                 "_timestamp_type", "recorded_timestamp", "replayed_at")
+
+    def __init__(self, value: bytes | None, topic: str, partition: int,
+                 offset: int, timestamp_type: int, timestamp: int):
+        self._value = value
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._timestamp_type = timestamp_type
+        self.recorded_timestamp = timestamp
+        self.replayed_at = None
+
+    def value(self) -> bytes | None:
+        """Returns the raw message value"""
+        return self._value
+
+    def error(self) -> None:
+        """Recorded messages never carry errors"""
+        return None
+
+    def topic(self) -> str:
+        """Returns the topic the message was recorded from"""
+        return self._topic
+
+    def partition(self) -> int:
+        """Returns the partition the message was recorded from"""
+        return self._partition
+
+    def offset(self) -> int:
+        """Returns the message's offset in its recorded partition"""
+        return self._offset
+
+    def timestamp(self) -> tuple[int, int]:
+        """Returns the recorded timestamp, or once played back the time the
+        message was released, so consumer lag reflects the playback"""
+        if self.replayed_at is None:
+            return self._timestamp_type, self.recorded_timestamp
+        return TIMESTAMP_CREATE_TIME, int(self.replayed_at * 1000)
+
+
+def _segment_number(name: str) -> int:
+    return int(name.split(".")[0])
+
+
+def list_segments(directory: str) -> list[str]:
+    """Returns the segment files of a recording in order, including an
+    unclosed .part segment left by a crash"""
+    return sorted((f for f in listdir(directory)
+                   if f.endswith(SUFFIX) or f.endswith(SUFFIX + ".part")),
+                  key=_segment_number)
+
+
+def read_segment(filepath: str):
+    """Yields the RecordedMessages in a segment, stopping at a torn
+    record"""
+    with gzip.open(filepath, "rb") as fp:
+        try:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filepath} is not a recording segment.")
+            while True:
+                header = fp.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    return
+                (timestamp, offset, partition, timestamp_type, topic_length,
+                 value_length) = _HEADER.unpack(header)
+                topic = fp.read(topic_length)
+                value = fp.read(value_length) if value_length >= 0 else None
+                if len(topic) < topic_length or (
+                        value is not None and len(value) < value_length):
+                    return
+                yield RecordedMessage(value, topic.decode("utf-8"),
+                                      partition, offset, timestamp_type,
+                                      timestamp)
+        except (EOFError, gzip.BadGzipFile):
+            return
+
+
+def read_recording(directory: str):
+    """Yields every message in a recording, in recorded order"""
+    for segment in list_segments(directory):
+        yield from read_segment(path.join(directory, segment))
+
+
+class Recorder:
+    """Appends raw consumed messages to compressed segment files"""
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 2 ** 20,
+                 segment_seconds: float = 3600.0,
+                 flush_interval: float = 1.0, compresslevel: int = 6,
+                 clock=monotonic):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+        self.clock = clock
+        makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self._next = _segment_number(segments[-1]) + 1 if segments else 0
+        self._current = None
+        self._current_path = None
+        self._opened_at = self._flushed_at = 0.0
+        self._written = 0
+
+    def _open(self) -> None:
+        self._current_path = path.join(self.directory,
+                                       f"{self._next:08}{SUFFIX}.part")
+        self._next += 1
+        self._current = gzip.open(  # pylint: disable=consider-using-with
+            self._current_path, "wb", compresslevel=self.compresslevel)
+        self._current.write(MAGIC)
+        self._opened_at = self._flushed_at = self.clock()
+        self._written = len(MAGIC)
+
+    def record(self, msg) -> None:
+        """Appends a consumed message, valid or not"""
+        if msg.error() is not None:
+            return
+        if self._current is None:
+            self._open()
+        value = msg.value()
+        topic = (msg.topic() or "").encode("utf-8")
+        timestamp_type, timestamp = msg.timestamp()
+        data = _HEADER.pack(timestamp, msg.offset(), msg.partition(),
+                            timestamp_type, len(topic),
+                            -1 if value is None else len(value)) \
+            + topic + (value or b"")
+        self._current.write(data)
+        self._written += len(data)
+        METRICS.inc("recorded_messages_total")
+        now = self.clock()
+        if self._written >= self.segment_bytes \
+                or now - self._opened_at >= self.segment_seconds:
+            self._close_segment()
+        elif now - self._flushed_at >= self.flush_interval:
+            self._current.flush()
+            self._flushed_at = now
+
+    def _close_segment(self) -> None:
+        self._current.close()
+        rename(self._current_path, self._current_path[:-len(".part")])
+        self._current = None
+
+    def close(self) -> None:
+        """Closes the open segment"""
+        if self._current is not None:
+            self._close_segment()
+
+
+class RecordingConsumer:
+    """Plays a recording back through the Consumer methods the pipeline
+    uses
+
+    Arguments:
+        directory -- the recording
+        speed -- multiple of the recorded rate to release messages at
+            (Default None, as fast as they are polled)
+    """
+
+    def __init__(self, directory: str, speed: float | None = 1.0,
+                 clock=monotonic, wall_clock=time_now, sleeper=sleep):
+        if speed is not None and speed <= 0:
+            raise ValueError("Playback speed must be positive.")
+        self.speed = speed
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.sleeper = sleeper
+        self.exhausted = False
+        self.released = 0
+        self.recorded_seconds = 0.0
+        self._messages = read_recording(directory)
+        self._pending = None
+        self._first_timestamp = None
+        self._started_at = None
+
+    def _peek(self) -> RecordedMessage | None:
+        if self._pending is None and not self.exhausted:
+            self._pending = next(self._messages, None)
+            if self._pending is None:
+                self.exhausted = True
+        return self._pending
+
+    def _due_in(self, msg: RecordedMessage) -> float:
+        if self.speed is None \
+                or msg.timestamp()[0] == TIMESTAMP_NOT_AVAILABLE:
+            return 0.0
+        if self._first_timestamp is None:
+            self._first_timestamp = msg.recorded_timestamp
+            self._started_at = self.clock()
+        offset = (msg.recorded_timestamp - self._first_timestamp) / 1000
+        return self._started_at + offset / self.speed - self.clock()
+
+    def poll(self, timeout: float = 1.0) -> RecordedMessage | None:
+        """Returns the next message once it is due, or None if it isn't
+        due within timeout or the recording has ended"""
+        msg = self._peek()
+        if msg is None:
+            return None
+        wait = self._due_in(msg)
+        if wait > timeout:
+            self.sleeper(timeout)
+            return None
+        if wait > 0:
+            self.sleeper(wait)
+        self._pending = None
+        if msg.timestamp()[0] != TIMESTAMP_NOT_AVAILABLE:
+            if self._first_timestamp is None:
+                self._first_timestamp = msg.recorded_timestamp
+            self.recorded_seconds = max(
+                self.recorded_seconds,
+                (msg.recorded_timestamp - self._first_timestamp) / 1000)
+        msg.replayed_at = self.wall_clock()
+        self.released += 1
+        return msg
+
+    def consume(self, num_messages: int = 1,
+                timeout: float = 1.0) -> list[RecordedMessage]:
+        """Returns up to num_messages due messages"""
+        msgs = []
+        while len(msgs) < num_messages:
+            msg = self.poll(timeout if not msgs else 0)
+            if msg is None:
+                break
+            msgs.append(msg)
+        return msgs
+
+    def store_offsets(self, *args, **kwargs) -> None:
+        """Playback has no offsets to commit"""
+
+    def assignment(self) -> list:
+        """Playback has no partitions"""
+        return []
+
+    def pause(self, partitions: list) -> None:
+        """Nothing to pause"""
+
+    def resume(self, partitions: list) -> None:
+        """Nothing to resume"""
+
+    def close(self) -> None:
+        """Stops reading the recording"""
+        self._messages.close()
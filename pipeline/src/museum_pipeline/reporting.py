@@ -0,0 +1,394 @@
+"""Cached read access to the dashboard aggregates.
+
+Serves the same aggregates as the avg_exh_rating, num_requests and
+request_over_time views, over raw and compacted interactions alike,
+filtered by museum and date range. approx_stats instead merges the Kafka
+consumer's interaction sketches into approximate per-exhibition statistics,
+reading one small row per exhibition and hour rather than the interactions.
+
+Results are cached in-process; an entry is dropped once it is older than
+the cache's TTL or once its museum's write watermark, which the pipelines
+advance in each write transaction, has moved. Watermarks are polled at most
+once every watermark_interval seconds, which bounds how stale a result can
+be while data is arriving and how often a busy report is recomputed.
+
+An optional HTTP server exposes each report as GET /<report>, with museum,
+from and to query parameters.
+"""
+#pylint: disable=unused-variable
+import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime as dt, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import parse_qs, urlsplit
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.sketches import merge_rows
+
+_FILTER = """
+        museum_name = COALESCE(%(museum)s, museum_name)
+        AND event_at >= COALESCE(%(start)s::TIMESTAMPTZ, '-infinity')
+        AND event_at < COALESCE(%(end)s::TIMESTAMPTZ, 'infinity')
+"""
+
+REPORTS = {
+    "avg_exh_rating": f"""
+        SELECT
+            museum_name,
+            SUM(rating_value * interactions)::DOUBLE PRECISION
+                / SUM(interactions) AS avg,
+            exhibition_name,
+            public_id
+        FROM
+            rating_history
+        JOIN
+            exhibition
+        USING
+            (exhibition_id)
+        JOIN
+            museum
+        USING
+            (museum_id)
+        JOIN
+            rating
+        USING
+            (rating_id)
+        WHERE {_FILTER}
+        GROUP BY
+            museum_name, public_id, exhibition_name
+        ORDER BY
+            museum_name, public_id
+        ;
+    """,
+    "num_requests": f"""
+        SELECT
+            museum_name,
+            exhibition_name,
+            public_id,
+            SUM(interactions)::BIGINT as number
+        FROM
+            request_history
+        JOIN
+            exhibition
+        USING
+            (exhibition_id)
+        JOIN
+            museum
+        USING
+            (museum_id)
+        WHERE {_FILTER}
+        GROUP BY
+            museum_name, public_id, exhibition_name
+        ORDER BY
+            museum_name, public_id
+        ;
+    """,
+    "request_over_time": f"""
+        SELECT
+            museum_name,
+            DATE_TRUNC('day', event_at) as day,
+            exhibition_name,
+            public_id,
+            SUM(interactions)::BIGINT as number
+        FROM
+            request_history
+        JOIN
+            exhibition
+        USING
+            (exhibition_id)
+        JOIN
+            museum
+        USING
+            (museum_id)
+        WHERE {_FILTER}
+        GROUP BY
+            museum_name, day, exhibition_name, public_id
+        ORDER BY
+            day DESC, museum_name ASC, public_id ASC
+        ;
+    """,
+    "approx_stats": """
+        SELECT
+            museum_name,
+            exhibition_name,
+            public_id,
+            bucket_seconds,
+            sketch
+        FROM
+            interaction_sketch
+        JOIN
+            exhibition
+        USING
+            (exhibition_id)
+        JOIN
+            museum
+        USING
+            (museum_id)
+        WHERE
+            museum_name = COALESCE(%(museum)s, museum_name)
+            AND bucket_start >= COALESCE(%(start)s::TIMESTAMPTZ, '-infinity')
+            AND bucket_start < COALESCE(%(end)s::TIMESTAMPTZ, 'infinity')
+            AND bucket_seconds = %(bucket_seconds)s
+            AND sketch IS NOT NULL
+        ;
+    """,
+}
+
+# Reports whose rows are combined in Python before they are returned.
+_MERGERS = {"approx_stats": merge_rows}
+
+_MISSING = object()
+
+
+def parse_bound(bound: str | None) -> dt | None:
+    """Parses an ISO8601 date or datetime, treating naive times as UTC"""
+    if bound is None or bound == "":
+        return None
+    if len(bound) == 10:
+        parsed = dt.combine(date.fromisoformat(bound), dt.min.time())
+    else:
+        parsed = dt.fromisoformat(bound)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+class TTLCache:
+    """A least-recently-used cache whose entries expire and carry a tag.
+
+    An entry is only returned while it is younger than ttl and was stored
+    with the tag it is looked up with.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 300.0,
+                 clock=monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, tag):
+        """Returns a cached value, or _MISSING"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                METRICS.inc("report_cache_misses_total")
+                return _MISSING
+            stored_at, stored_tag, value = entry
+            if stored_tag != tag or self.clock() - stored_at >= self.ttl:
+                del self._entries[key]
+                METRICS.inc("report_cache_misses_total")
+                return _MISSING
+            self._entries.move_to_end(key)
+            METRICS.inc("report_cache_hits_total")
+            return value
+
+    def put(self, key, tag, value) -> None:
+        """Stores a value, evicting the least recently used entries"""
+        with self._lock:
+            self._entries[key] = (self.clock(), tag, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                METRICS.inc("report_cache_evictions_total")
+            METRICS.set("report_cache_entries", len(self._entries))
+
+
+class Reporter:
+    """Runs the dashboard reports through a watermark-checked cache
+
+    Queries share a pool of at most max_connections read-only connections,
+    opened as needed and kept until close, so a server starting a thread
+    per request doesn't open a connection per request.
+    """
+
+    def __init__(self, connect, cache: TTLCache | None = None,
+                 watermark_interval: float = 5.0, clock=monotonic,
+                 max_connections: int = 4):
+        self.connect = connect
+        self.cache = cache if cache is not None else TTLCache(clock=clock)
+        self.watermark_interval = watermark_interval
+        self.clock = clock
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._watermarks = {}
+        self._polled_at = None
+        self._watermark_lock = threading.Lock()
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+    @contextmanager
+    def _cursor(self):
+        """Yields a cursor on a pooled connection, waiting for one to be
+        free; a connection a query failed on is closed rather than reused"""
+        with self._slots:
+            with self._idle_lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or conn.closed:
+                conn = self.connect()
+                conn.set_session(readonly=True, autocommit=True)
+                METRICS.inc("report_connections_opened_total")
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    yield cur
+            except psycopg2.Error:
+                conn.close()
+                raise
+            finally:
+                if not conn.closed:
+                    with self._idle_lock:
+                        self._idle.append(conn)
+
+    def close(self) -> None:
+        """Closes the pooled connections"""
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def watermarks(self) -> dict[str, int]:
+        """Returns the rows written to each museum, polled at most once
+        every watermark_interval seconds"""
+        with self._watermark_lock:
+            now = self.clock()
+            if self._polled_at is None \
+                    or now - self._polled_at >= self.watermark_interval:
+                with self._cursor() as cur:
+                    cur.execute("""SELECT
+                                        museum_name,
+                                        SUM(rows_written) AS rows_written
+                                    FROM
+                                        write_watermark
+                                    JOIN
+                                        museum
+                                    USING
+                                        (museum_id)
+                                    GROUP BY
+                                        museum_name;""")
+                    self._watermarks = {row["museum_name"]:
+                                        row["rows_written"]
+                                        for row in cur.fetchall()}
+                self._polled_at = now
+            return self._watermarks
+
+    def _tag(self, museum: str | None):
+        watermarks = self.watermarks()
+        if museum is None:
+            return tuple(sorted(watermarks.items()))
+        return watermarks.get(museum, 0)
+
+    def _key_lock(self, key) -> threading.Lock:
+        with self._key_locks_lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def report(self, name: str, museum: str | None = None,
+               start: dt | None = None, end: dt | None = None,
+               bucket_seconds: int = 3600) -> list[dict]:
+        """Returns the rows of a report
+
+        Arguments:
+            name -- one of REPORTS
+            museum -- museum name to report on (Default every museum)
+            start, end -- half-open range of event times to include
+                (Default unbounded)
+            bucket_seconds -- width of the sketches approx_stats merges
+                (Default 3600)
+        """
+        if name not in REPORTS:
+            raise KeyError(f"Unknown report {name}")
+        key = (name, museum, start, end, bucket_seconds)
+        tag = self._tag(museum)
+        rows = self.cache.get(key, tag)
+        if rows is not _MISSING:
+            return rows
+        # Concurrent requests for the same report wait for one query.
+        with self._key_lock(key):
+            rows = self.cache.get(key, tag)
+            if rows is _MISSING:
+                started = monotonic()
+                with self._cursor() as cur:
+                    cur.execute(REPORTS[name], {
+                        "museum": museum, "start": start, "end": end,
+                        "bucket_seconds": bucket_seconds})
+                    rows = [dict(row) for row in cur.fetchall()]
+                if name in _MERGERS:
+                    rows = _MERGERS[name](rows)
+                METRICS.set("report_query_seconds",
+                            round(monotonic() - started, 4))
+                self.cache.put(key, tag, rows)
+        with self._key_locks_lock:
+            self._key_locks.pop(key, None)
+        return rows
+
+
+def _jsonable(value):
+    if isinstance(value, (dt, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def make_server(reporter: Reporter, host: str = "127.0.0.1",
+                port: int = 8080) -> ThreadingHTTPServer:
+    """Returns an HTTP server answering
+    GET /<report>?museum=&from=&to=&bucket_seconds=, which closes the
+    reporter's connections when it is closed"""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Serves reports as JSON"""
+
+        def _send(self, status: int, body) -> None:
+            data = json.dumps(body, default=_jsonable).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Handles a report request"""
+            url = urlsplit(self.path)
+            name = url.path.strip("/")
+            if name == "":
+                self._send(200, {"reports": sorted(REPORTS)})
+                return
+            if name not in REPORTS:
+                self._send(404, {"error": f"Unknown report {name}"})
+                return
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                start = parse_bound(query.get("from"))
+                end = parse_bound(query.get("to"))
+                bucket_seconds = int(query.get("bucket_seconds", 3600))
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+                return
+            try:
+                rows = reporter.report(name, query.get("museum"), start, end,
+                                       bucket_seconds)
+            except psycopg2.Error as e:
+                self._send(503, {"error": str(e)})
+                return
+            self._send(200, rows)
+
+        def log_message(self, format, *args):  # pylint: disable=W0622
+            pass
+
+    class Server(ThreadingHTTPServer):
+        """Closes the reporter's connections along with the server"""
+
+        def server_close(self):
+            super().server_close()
+            reporter.close()
+
+    return Server((host, port), Handler)
@@ -0,0 +1,163 @@
+"""Sidecar index of the time range covered by each csv in the S3 bucket.
+
+The index is a JSON object stored in the bucket next to the csvs, holding
+for each key the ETag it was built from, the earliest and latest `at`, the
+row count and the set of sites. Entries whose object has since changed or
+gone are dropped when the index is reconciled with a bucket listing, so a
+rewritten shard is always re-read.
+
+Times are kept as the csvs' "%Y-%m-%d %H:%M:%S" strings, which sort in
+time order, so range checks and row filters are string comparisons.
+"""
+#pylint: disable=unused-variable
+import csv
+import json
+import re
+import tempfile
+import threading
+from datetime import date, datetime as dt
+from os import path
+
+from botocore.exceptions import ClientError
+
+from museum_pipeline.transform import parse_at
+
+INDEX_KEY = "hist_data_index.json"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+_AT = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+
+
+def format_bound(bound: str | None) -> str | None:
+    """Converts an ISO8601 date or datetime to the csvs' time format"""
+    if bound is None:
+        return None
+    if len(bound) == 10:
+        return date.fromisoformat(bound).strftime(TIME_FORMAT)
+    return dt.fromisoformat(bound).strftime(TIME_FORMAT)
+
+
+def normalize_at(at: str) -> str | None:
+    """Returns an `at` value in TIME_FORMAT, zero-padding the one-digit
+    fields rows may have, or None if it isn't a valid time"""
+    if _AT.fullmatch(at) is not None:
+        return at
+    parsed = parse_at(at)
+    return None if parsed is None else parsed.strftime(TIME_FORMAT)
+
+
+def in_range(at: str, start: str | None, end: str | None) -> bool:
+    """Returns whether an `at` value lies in [start, end)"""
+    return (start is None or at >= start) and (end is None or at < end)
+
+
+def scan_csv(filepath: str) -> dict:
+    """Reads a csv once, returning its index entry (without the ETag).
+
+    Rows whose `at` isn't a well-formed time are counted but don't affect
+    the range.
+    """
+    min_at = max_at = None
+    rows = 0
+    sites = set()
+    with open(filepath, "r", encoding="utf-8") as fp:
+        for row in csv.DictReader(fp):
+            rows += 1
+            sites.add(row.get("site"))
+            at = normalize_at(row.get("at") or "")
+            if at is None:
+                continue
+            if min_at is None or at < min_at:
+                min_at = at
+            if max_at is None or at > max_at:
+                max_at = at
+    return {"min_at": min_at, "max_at": max_at, "rows": rows,
+            "sites": sorted(s for s in sites if s is not None)}
+
+
+class ShardIndex:
+    """The per-object time ranges of a bucket's csvs"""
+
+    def __init__(self, objects: dict | None = None):
+        self.objects = objects if objects is not None else {}
+        self.etags = {}
+        self.changed = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, boto_client, bucket: str) -> "ShardIndex":
+        """Reads the index from the bucket, or starts an empty one"""
+        try:
+            body = boto_client.get_object(Bucket=bucket, Key=INDEX_KEY)["Body"]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey",
+                                                           "404"):
+                return cls()
+            raise
+        return cls(json.loads(body.read())["objects"])
+
+    def save(self, boto_client, bucket: str) -> None:
+        """Writes the index back to the bucket, if it has changed"""
+        with self._lock:
+            if not self.changed:
+                return
+            data = json.dumps({"version": 1, "objects": self.objects},
+                              sort_keys=True)
+            self.changed = False
+        boto_client.put_object(Bucket=bucket, Key=INDEX_KEY,
+                               Body=data.encode("utf-8"))
+
+    def reconcile(self, etags: dict[str, str]) -> None:
+        """Drops entries for objects which have changed or gone
+
+        Arguments:
+            etags -- {<key>: <ETag>} of every object in the bucket
+        """
+        with self._lock:
+            self.etags = dict(etags)
+            for key in list(self.objects):
+                if self.objects[key].get("etag") != etags.get(key):
+                    del self.objects[key]
+                    self.changed = True
+
+    def get(self, key: str) -> dict | None:
+        """Returns a key's entry, if it is indexed"""
+        with self._lock:
+            return self.objects.get(key)
+
+    def update(self, key: str, entry: dict) -> None:
+        """Records a scanned object, against the ETag it was listed with"""
+        with self._lock:
+            self.objects[key] = {**entry, "etag": self.etags.get(key)}
+            self.changed = True
+
+    def overlaps(self, key: str, start: str | None,
+                 end: str | None) -> bool | None:
+        """Returns whether a key may hold rows in [start, end), or None if it
+        isn't indexed"""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        if entry["min_at"] is None:
+            return entry["rows"] > 0
+        return (end is None or entry["min_at"] < end) \
+            and (start is None or entry["max_at"] >= start)
+
+    def select(self, keys: list[str], start: str | None,
+               end: str | None) -> list[str]:
+        """Returns the keys which must be opened to read [start, end)"""
+        return [k for k in keys if self.overlaps(k, start, end) is not False]
+
+    def scan(self, key: str, filepath: str) -> None:
+        """Indexes a downloaded object"""
+        self.update(key, scan_csv(filepath))
+
+    def build(self, boto_client, bucket: str, keys: list[str]) -> int:
+        """Downloads and indexes every key not already indexed, one at a
+        time, returning the number indexed"""
+        missing = [k for k in keys if self.get(k) is None]
+        with tempfile.TemporaryDirectory() as tmp:
+            for key in missing:
+                filepath = path.join(tmp, "object.csv")
+                boto_client.download_file(bucket, key, filepath)
+                self.scan(key, filepath)
+        return len(missing)
@@ -0,0 +1,353 @@
+"""Output sinks, which both pipelines write their validated rows through.
+
+A sink takes rows split by table, as the batch pipeline prepares them:
+
+    {"rating": [<row>, ...], "request": [<row>, ...]}
+
+each row a dict of event_at, exhibition_id and value_id. Called with a list
+of formatted Kafka messages, each with a "table" key, a sink splits them
+and writes them the same way, so any sink can be handed to
+consume_messages as its write callable.
+
+    postgres -- the database, through the InteractionWriter or bulk_load,
+                or through a ParallelLoader's several connections
+    parquet  -- local Parquet files, one directory per table partitioned by
+                event date, written in large row groups (needs pyarrow)
+    jsonl    -- one JSON line per row, appended to <table>.jsonl
+    null     -- counts rows and discards them, to time extract and
+                transform on their own
+
+Several sinks run together through a TeeSink, which writes each batch to
+every sink in turn, the database first. The file sinks are exports rather
+than stores of record: the Parquet sink holds up to row_group_size rows of
+each partition in memory until it fills or the sink closes, so a live
+pipeline should tee it with postgres rather than run it alone.
+"""
+#pylint: disable=unused-variable
+import json
+from os import getpid, makedirs, path
+
+from museum_pipeline.bulk_load import bulk_load
+from museum_pipeline.load import _upload_data
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.transform import RejectReport
+from museum_pipeline.writer import TABLES
+
+# The value column of each table, in the canonical column order.
+COLUMNS = {table: ("event_at", "exhibition_id", f"{table}_id")
+           for table in TABLES}
+
+
+def split_tables(messages: list[dict]) -> dict[str, list[dict]]:
+    """Splits formatted Kafka messages by their "table" key"""
+    data = {table: [] for table in TABLES}
+    for message in messages:
+        if message.get("table") not in data:
+            raise ValueError("INVALID: Table name not recognised.")
+        data[message["table"]].append(message)
+    return data
+
+
+class Sink:
+    """Base of the sinks: subclasses implement write_tables"""
+
+    name = None
+
+    def write_tables(self, data: dict[str, list[dict]]) -> int:
+        """Writes rows split by table, returning the number written"""
+        raise NotImplementedError
+
+    def __call__(self, messages: list[dict]) -> int:
+        """Writes a batch of formatted Kafka messages"""
+        return self.write_tables(split_tables(messages))
+
+    def close(self) -> None:
+        """Flushes anything buffered and releases the sink's files"""
+
+
+class RowSink(Sink):
+    """Base of the sinks which write every row given: subclasses implement
+    _write, and the rows are counted for them"""
+
+    def _write(self, data: dict[str, list[dict]]) -> None:
+        raise NotImplementedError
+
+    def write_tables(self, data: dict[str, list[dict]]) -> int:
+        self._write(data)
+        rows = sum(len(data.get(table, [])) for table in TABLES)
+        METRICS.inc(f"sink_{self.name}_rows_total", rows)
+        return rows
+
+
+class PostgresSink(RowSink):
+    """Writes to the database over one connection, committing each write
+
+    Arguments:
+        conn -- psycopg2 connection
+        bulk -- load through bulk_load rather than the InteractionWriter
+            (Default False)
+        drop_indexes, rejects -- as for bulk_load
+    """
+
+    name = "postgres"
+
+    def __init__(self, conn, bulk: bool = False, drop_indexes: bool = False,
+                 rejects: RejectReport | None = None):
+        self.conn = conn
+        self.bulk = bulk
+        self.drop_indexes = drop_indexes
+        self.rejects = rejects
+        self.phases = None
+
+    def write_tables(self, data: dict[str, list[dict]]) -> int:
+        if not self.bulk:
+            return super().write_tables(data)
+        loaded = bulk_load(data, self.conn, self.drop_indexes, self.rejects)
+        self.phases = loaded["phases"]
+        METRICS.inc("sink_postgres_rows_total", loaded["rows_loaded"])
+        return loaded["rows_loaded"]
+
+    def _write(self, data: dict[str, list[dict]]) -> None:
+        _upload_data(data, self.conn)
+
+
+class ParallelPostgresSink(Sink):
+    """Writes to the database through a ParallelLoader, keeping the
+    summary of its latest load in `parallel`
+
+    Rows the loader couldn't write are left in its unloaded rather than
+    raised, as the rest of the load is committed.
+    """
+
+    name = "postgres"
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.parallel = None
+
+    def write_tables(self, data: dict[str, list[dict]]) -> int:
+        self.parallel = self.loader.load(data)
+        METRICS.inc("sink_postgres_rows_total", self.parallel["rows_loaded"])
+        return self.parallel["rows_loaded"]
+
+
+class NullSink(RowSink):
+    """Discards every row, keeping only a count"""
+
+    name = "null"
+
+    def __init__(self):
+        self.rows = 0
+
+    def _write(self, data: dict[str, list[dict]]) -> None:
+        self.rows += sum(len(data.get(table, [])) for table in TABLES)
+
+
+class JsonlSink(RowSink):
+    """Appends each row as a JSON line to <directory>/<table>.jsonl,
+    flushing after every write"""
+
+    name = "jsonl"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        makedirs(directory, exist_ok=True)
+        self._files = {}
+
+    def _write(self, data: dict[str, list[dict]]) -> None:
+        for table in TABLES:
+            rows = data.get(table)
+            if not rows:
+                continue
+            if table not in self._files:
+                self._files[table] = open(  # pylint: disable=consider-using-with
+                    path.join(self.directory, f"{table}.jsonl"), "a",
+                    encoding="utf-8")
+            event_at, exhibition_id, value = COLUMNS[table]
+            fp = self._files[table]
+            fp.write("".join(json.dumps({
+                event_at: r["event_at"].isoformat(),
+                exhibition_id: r["exhibition_id"],
+                value: r["value_id"]}) + "\n" for r in rows))
+            fp.flush()
+
+    def close(self) -> None:
+        for fp in self._files.values():
+            fp.close()
+        self._files = {}
+
+
+class ParquetSink(RowSink):
+    """Writes each table to Parquet files partitioned by event date:
+
+        <directory>/<table>/event_date=<YYYY-MM-DD>/part-<pid>-<n>.parquet
+
+    Rows are buffered per partition and written as one row group once
+    row_group_size of them have arrived. A file is finished, and readable,
+    after file_row_groups row groups or when the sink closes.
+
+    Arguments:
+        directory -- root of the dataset
+        row_group_size -- rows per row group (Default 131072)
+        file_row_groups -- row groups per file (Default 16)
+        compression -- Parquet codec (Default zstd)
+    """
+
+    name = "parquet"
+
+    def __init__(self, directory: str, row_group_size: int = 131072,
+                 file_row_groups: int = 16, compression: str = "zstd"):
+        # pylint: disable=import-outside-toplevel
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("The parquet sink needs pyarrow: pip install "
+                              "'museum_pipeline[parquet]'") from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.file_row_groups = file_row_groups
+        self.compression = compression
+        self.files = []
+        self._schemas = {table: pyarrow.schema([
+            (COLUMNS[table][0], pyarrow.timestamp("us", tz="UTC")),
+            (COLUMNS[table][1], pyarrow.int16()),
+            (COLUMNS[table][2], pyarrow.int16() if table == "rating"
+             else pyarrow.int32())]) for table in TABLES}
+        self._buffers = {}
+        self._writers = {}
+        self._parts = 0
+
+    def _write(self, data: dict[str, list[dict]]) -> None:
+        for table in TABLES:
+            for row in data.get(table, []):
+                key = (table, row["event_at"].date().isoformat())
+                buffer = self._buffers.setdefault(key, [])
+                buffer.append(row)
+                if len(buffer) >= self.row_group_size:
+                    self._flush(key)
+
+    def _flush(self, key: tuple[str, str]) -> None:
+        """Writes a partition's buffered rows as one row group"""
+        rows = self._buffers.pop(key, None)
+        if not rows:
+            return
+        table, day = key
+        schema = self._schemas[table]
+        batch = self._pa.table([
+            self._pa.array([r["event_at"] for r in rows], schema[0].type),
+            self._pa.array([r["exhibition_id"] for r in rows],
+                           schema[1].type),
+            self._pa.array([r["value_id"] for r in rows], schema[2].type)],
+            schema=schema)
+        writer, groups = self._writers.get(key, (None, 0))
+        if writer is None:
+            directory = path.join(self.directory, table, f"event_date={day}")
+            makedirs(directory, exist_ok=True)
+            filepath = path.join(directory,
+                                 f"part-{getpid()}-{self._parts:05}.parquet")
+            self._parts += 1
+            writer = self._pq.ParquetWriter(filepath, schema,
+                                            compression=self.compression)
+            self.files.append(filepath)
+        writer.write_table(batch, row_group_size=len(rows))
+        METRICS.inc("sink_parquet_row_groups_total")
+        groups += 1
+        if groups >= self.file_row_groups:
+            writer.close()
+            self._writers.pop(key, None)
+        else:
+            self._writers[key] = (writer, groups)
+
+    def close(self) -> None:
+        for key in list(self._buffers):
+            self._flush(key)
+        for writer, _ in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+class TeeSink(Sink):
+    """Writes every batch to each of several sinks, in order
+
+    A sink may be any write callable, such as a SpooledWriter. The first
+    sink is the store of record, which open_sink makes the database; the
+    tee returns what it returned, so consume_messages still sees whether a
+    batch reached the database or the spool.
+
+    If a sink raises, the tee remembers which sinks took the batch, and
+    when the same batch is written again, as _write_batch retries a full
+    spool, only the others are written, so none gets the rows twice.
+    """
+
+    name = "tee"
+
+    def __init__(self, sinks: list):
+        self.sinks = sinks
+        self._batch = None
+        self._results = {}
+
+    def _write_each(self, batch, write):
+        if batch is not self._batch:
+            self._batch, self._results = batch, {}
+        for i, sink in enumerate(self.sinks):
+            if i not in self._results:
+                self._results[i] = write(sink, batch)
+        self._batch = None
+        return self._results[0]
+
+    def write_tables(self, data: dict[str, list[dict]]) -> int:
+        return self._write_each(data, lambda sink, d: sink.write_tables(d))
+
+    def __call__(self, messages: list[dict]):
+        return self._write_each(messages, lambda sink, m: sink(m))
+
+    @property
+    def phases(self) -> dict | None:
+        """The bulk_load phases of a bulk PostgresSink in the tee"""
+        return next((s.phases for s in self.sinks
+                     if getattr(s, "phases", None) is not None), None)
+
+    @property
+    def parallel(self) -> dict | None:
+        """The load summary of a ParallelPostgresSink in the tee"""
+        return next((s.parallel for s in self.sinks
+                     if getattr(s, "parallel", None) is not None), None)
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+
+SINKS = {
+    "postgres": PostgresSink,
+    "parquet": ParquetSink,
+    "jsonl": JsonlSink,
+    "null": NullSink,
+}
+
+
+def open_sink(names: list[str], directory: str, postgres=None):
+    """Returns the named sink, or a TeeSink of several
+
+    Arguments:
+        names -- keys of SINKS
+        directory -- where the file sinks write; parquet and jsonl each
+            get a subdirectory of it
+        postgres -- what to write with for "postgres", e.g. a PostgresSink
+            or a SpooledWriter, as only the caller knows its connections;
+            it is always written first
+    """
+    sinks = []
+    for name in names:
+        if name == "postgres":
+            if postgres is None:
+                raise ValueError("The postgres sink needs a database writer.")
+            sinks.insert(0, postgres)
+        elif name == "null":
+            sinks.append(NullSink())
+        else:
+            sinks.append(SINKS[name](path.join(directory, name)))
+    return sinks[0] if len(sinks) == 1 else TeeSink(sinks)
@@ -0,0 +1,419 @@
+"""Mergeable streaming sketches of the Kafka traffic.
+
+The Kafka consumer can keep, for each exhibition and time bucket (an hour
+by default), a BucketSketch of the interactions it validates:
+
+    count    -- interactions seen
+    ratings  -- count of each rating value, from which the mean and median
+                rating follow exactly
+    requests -- count of each request value
+    gaps     -- QuantileSketch of the seconds between successive events at
+                the exhibition, within 2% of the true value at any quantile
+    distinct -- HyperLogLog of distinct event keys, within about 3%
+
+Kiosk messages carry no session or visitor id, so by default the distinct
+key is the event's own (at, site, val, type), and the estimate counts
+distinct events. count minus that estimate then shows redelivered
+messages. A SketchAggregator can be given any other key function once
+messages carry one.
+
+Every part merges by addition, or by register-wise maximum for the
+HyperLogLog, so sketches from several workers, flushes or museums combine
+into the sketch of their union. The aggregator holds only what has arrived
+since its last flush; each flush merges that into the interaction_sketch
+table row of each bucket, under a row lock, and starts afresh. Rows are
+keyed by bucket width as well as start, so runs with different widths
+never merge into each other's rows. The sketches
+are approximate: they are flushed apart from the rows themselves, so a
+replay or a restart from older offsets counts its messages again.
+
+Inter-arrival gaps are measured within one consumer, so with several
+workers each sees a share of an exhibition's events and reports longer
+gaps than a single consumer would.
+"""
+#pylint: disable=unused-variable
+import base64
+import json
+import math
+from datetime import datetime as dt, timezone
+from hashlib import blake2b
+from time import monotonic
+
+import psycopg2
+
+from museum_pipeline.metrics import METRICS
+
+
+class QuantileSketch:
+    """A relative-error quantile sketch of positive values, after DDSketch
+
+    Values are counted in logarithmic bins, so any quantile is returned
+    within relative_accuracy of its true value. Values at or below
+    min_value are counted as zero.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.02,
+                 min_value: float = 1e-3):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zeros = 0
+        self.bins = {}
+
+    def add(self, value: float) -> None:
+        """Counts a value"""
+        self.count += 1
+        if value <= self.min_value:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+
+    def quantile(self, q: float) -> float | None:
+        """Returns the estimated q-quantile, for q in [0, 1]"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        """Adds another sketch with the same accuracy into this one"""
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge sketches of different accuracy.")
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+
+    def to_dict(self) -> dict:
+        """Returns the sketch as JSON-serialisable data"""
+        return {"accuracy": self.relative_accuracy, "count": self.count,
+                "zeros": self.zeros,
+                "bins": {str(i): c for i, c in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        """Rebuilds a sketch from to_dict's output"""
+        sketch = cls(data["accuracy"])
+        sketch.count = data["count"]
+        sketch.zeros = data["zeros"]
+        sketch.bins = {int(i): c for i, c in data["bins"].items()}
+        return sketch
+
+
+class HyperLogLog:
+    """A HyperLogLog distinct-count estimator over 2 ** precision registers
+
+    The standard error is about 1.04 / sqrt(2 ** precision): 3.3% at the
+    default precision, in a 1KB register array.
+    """
+
+    def __init__(self, precision: int = 10):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16.")
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+    def add(self, key: str) -> None:
+        """Counts a key"""
+        h = int.from_bytes(blake2b(key.encode("UTF-8"),
+                                   digest_size=8).digest(), "big")
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self) -> int:
+        """Returns the estimated number of distinct keys added"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+    def merge(self, other: "HyperLogLog") -> None:
+        """Takes the union of another estimator of the same precision"""
+        if other.precision != self.precision:
+            raise ValueError("Can't merge estimators of different precision.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def to_dict(self) -> dict:
+        """Returns the estimator as JSON-serialisable data"""
+        return {"precision": self.precision,
+                "registers": base64.b64encode(self.registers).decode()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HyperLogLog":
+        """Rebuilds an estimator from to_dict's output"""
+        hll = cls(data["precision"])
+        hll.registers = bytearray(base64.b64decode(data["registers"]))
+        return hll
+
+
+class BucketSketch:
+    """Everything sketched about one exhibition over one time bucket"""
+
+    def __init__(self):
+        self.count = 0
+        self.ratings = {}
+        self.requests = {}
+        self.gaps = QuantileSketch()
+        self.distinct = HyperLogLog()
+
+    def merge(self, other: "BucketSketch") -> None:
+        """Adds another bucket's sketch into this one"""
+        self.count += other.count
+        for mine, theirs in ((self.ratings, other.ratings),
+                             (self.requests, other.requests)):
+            for value, count in theirs.items():
+                mine[value] = mine.get(value, 0) + count
+        self.gaps.merge(other.gaps)
+        self.distinct.merge(other.distinct)
+
+    def summary(self) -> dict:
+        """Returns the approximate answers a dashboard needs"""
+        rated = sum(self.ratings.values())
+        median = None
+        if rated:
+            seen = 0
+            for value in sorted(self.ratings):
+                seen += self.ratings[value]
+                if seen * 2 >= rated:
+                    median = value
+                    break
+
+        def seconds(q):
+            value = self.gaps.quantile(q)
+            return None if value is None else round(value, 3)
+        return {
+            "interactions": self.count,
+            "distinct_events": self.distinct.estimate(),
+            "ratings": rated,
+            "mean_rating": round(sum(v * c for v, c in self.ratings.items())
+                                 / rated, 3) if rated else None,
+            "median_rating": median,
+            "rating_counts": {str(v): self.ratings[v]
+                              for v in sorted(self.ratings)},
+            "request_counts": {str(v): self.requests[v]
+                               for v in sorted(self.requests)},
+            "gap_seconds": {"p50": seconds(0.5), "p90": seconds(0.9),
+                            "p99": seconds(0.99)}
+        }
+
+    def to_dict(self) -> dict:
+        """Returns the sketch as JSON-serialisable data"""
+        return {"count": self.count,
+                "ratings": {str(v): c for v, c in self.ratings.items()},
+                "requests": {str(v): c for v, c in self.requests.items()},
+                "gaps": self.gaps.to_dict(),
+                "distinct": self.distinct.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BucketSketch":
+        """Rebuilds a sketch from to_dict's output"""
+        sketch = cls()
+        sketch.count = data["count"]
+        sketch.ratings = {int(v): c for v, c in data["ratings"].items()}
+        sketch.requests = {int(v): c for v, c in data["requests"].items()}
+        sketch.gaps = QuantileSketch.from_dict(data["gaps"])
+        sketch.distinct = HyperLogLog.from_dict(data["distinct"])
+        return sketch
+
+
+def event_key(message: dict) -> str:
+    """The default distinct key: the event itself"""
+    return f"{message['event_at'].isoformat()}|{message['exhibition_id']}" \
+        f"|{message['table']}|{message['value_id']}"
+
+
+class SketchAggregator:
+    """Sketches formatted Kafka messages per exhibition and time bucket,
+    flushing them to the interaction_sketch table every flush_interval
+
+    Arguments:
+        connect -- callable returning a new psycopg2 connection
+        id_dict -- id mapping dict, as returned by load_id_dict, to map
+            rating and request ids back to their values
+        logger -- logging object
+        bucket_seconds -- width of a time bucket (Default 3600)
+        flush_interval -- seconds between flushes (Default 60)
+        key -- callable returning a message's distinct key
+            (Default event_key)
+    """
+
+    def __init__(self, connect, id_dict: dict, logger,
+                 bucket_seconds: int = 3600, flush_interval: float = 60.0,
+                 key=event_key):
+        self.connect = connect
+        self.logger = logger
+        self.bucket_seconds = bucket_seconds
+        self.flush_interval = flush_interval
+        self.key = key
+        self.values = {table: {row_id: value
+                               for value, row_id in id_dict[table].items()}
+                       for table in ("rating", "request")}
+        self.buckets = {}
+        self.last_seen = {}
+        self.conn = None
+        self.flushed_at = monotonic()
+
+    def bucket_of(self, at: dt) -> dt:
+        """Returns the start of the bucket holding a time"""
+        seconds = int(at.timestamp())
+        return dt.fromtimestamp(seconds - seconds % self.bucket_seconds,
+                                timezone.utc)
+
+    def observe(self, message: dict) -> None:
+        """Adds a formatted Kafka message to its bucket's sketch"""
+        at = message["event_at"]
+        exhibition = message["exhibition_id"]
+        key = (exhibition, self.bucket_of(at))
+        sketch = self.buckets.get(key)
+        if sketch is None:
+            sketch = self.buckets[key] = BucketSketch()
+        sketch.count += 1
+        counts = sketch.ratings if message["table"] == "rating" \
+            else sketch.requests
+        value = self.values[message["table"]].get(message["value_id"])
+        counts[value] = counts.get(value, 0) + 1
+        previous = self.last_seen.get(exhibition)
+        if previous is not None and at >= previous:
+            sketch.gaps.add((at - previous).total_seconds())
+        if previous is None or at > previous:
+            self.last_seen[exhibition] = at
+        sketch.distinct.add(self.key(message))
+
+    def maybe_flush(self) -> None:
+        """Flushes if flush_interval has passed since the last flush"""
+        if monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> int:
+        """Merges every bucket sketched since the last flush into the
+        database, returning the number of buckets written
+
+        On failure the buckets are kept, to be merged by the next flush.
+        """
+        self.flushed_at = monotonic()
+        if not self.buckets:
+            return 0
+        started = monotonic()
+        try:
+            if self.conn is None or self.conn.closed:
+                self.conn = self.connect()
+            save_sketches(self.conn, self.buckets, self.bucket_seconds)
+        except psycopg2.Error as e:
+            METRICS.inc("sketch_flush_failures_total")
+            self.logger.warning(f"Sketch flush failed, keeping sketches: {e}")
+            if self.conn is not None and not self.conn.closed:
+                self.conn.close()
+            self.conn = None
+            return 0
+        flushed = len(self.buckets)
+        self.buckets = {}
+        METRICS.inc("sketch_buckets_flushed_total", flushed)
+        METRICS.set("sketch_flush_seconds", round(monotonic() - started, 4))
+        return flushed
+
+    def close(self) -> None:
+        """Flushes what is left and closes the connection"""
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+
+
+def save_sketches(conn, buckets: dict, bucket_seconds: int) -> None:
+    """Merges {(exhibition_id, bucket_start): BucketSketch} into the
+    interaction_sketch table in one transaction
+
+    Each row is locked while it is read, merged and written back, so
+    several workers can flush into the same buckets.
+    """
+    keys = sorted(buckets)
+    cur = conn.cursor()
+    try:
+        cur.execute("""INSERT INTO interaction_sketch
+                           (exhibition_id, bucket_start, bucket_seconds,
+                            sketch, updated_at)
+                       SELECT
+                           e, b, %s, NULL, NOW()
+                       FROM
+                           UNNEST(%s::SMALLINT[], %s::TIMESTAMPTZ[])
+                           AS k(e, b)
+                       ON CONFLICT (exhibition_id, bucket_seconds,
+                                    bucket_start) DO NOTHING;""",
+                    (bucket_seconds, [e for e, _ in keys],
+                     [b for _, b in keys]))
+        cur.execute("""SELECT
+                           exhibition_id, bucket_start, sketch
+                       FROM
+                           interaction_sketch
+                       WHERE
+                           bucket_seconds = %s
+                       AND
+                           (exhibition_id, bucket_start) IN (SELECT * FROM
+                               UNNEST(%s::SMALLINT[], %s::TIMESTAMPTZ[]))
+                       ORDER BY
+                           exhibition_id, bucket_start
+                       FOR UPDATE;""",
+                    (bucket_seconds, [e for e, _ in keys],
+                     [b for _, b in keys]))
+        merged = []
+        for exhibition, bucket, stored in cur.fetchall():
+            sketch = buckets[(exhibition, bucket)]
+            if stored is not None:
+                sketch = BucketSketch.from_dict(stored)
+                sketch.merge(buckets[(exhibition, bucket)])
+            merged.append((json.dumps(sketch.to_dict()), exhibition,
+                           bucket_seconds, bucket))
+        cur.executemany("""UPDATE interaction_sketch SET
+                               sketch = %s,
+                               updated_at = NOW()
+                           WHERE
+                               exhibition_id = %s
+                           AND
+                               bucket_seconds = %s
+                           AND
+                               bucket_start = %s;""", merged)
+    finally:
+        cur.close()
+    conn.commit()
+
+
+def merge_rows(rows: list[dict]) -> list[dict]:
+    """Merges interaction_sketch rows per exhibition into summaries
+
+    Arguments:
+        rows -- dicts of museum_name, exhibition_name, public_id,
+            bucket_seconds and sketch, as the approx_stats report selects
+            them, all of one bucket width
+
+    Raises ValueError if the rows are of several bucket widths, whose
+    sketches may count the same events.
+    """
+    if len({row["bucket_seconds"] for row in rows}) > 1:
+        raise ValueError("Sketches of different bucket widths can't be "
+                         "merged.")
+    merged = {}
+    for row in rows:
+        key = (row["museum_name"], row["public_id"], row["exhibition_name"])
+        sketch = BucketSketch.from_dict(row["sketch"])
+        if key in merged:
+            merged[key].merge(sketch)
+        else:
+            merged[key] = sketch
+    return [{"museum_name": museum, "exhibition_name": name,
+             "public_id": public_id, **sketch.summary()}
+            for (museum, public_id, name), sketch in sorted(merged.items())]
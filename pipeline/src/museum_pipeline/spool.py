@@ -0,0 +1,226 @@
+"""Local write-ahead spool for Kafka rows the database can't take yet.
+
+Rows are appended as JSON lines to segment files in a spool directory and
+fsynced before the append returns, so a spooled row is as durable as a
+committed one. A drainer thread bulk-loads closed segments back into the
+database and deletes each segment once its transaction commits; a crash
+between that commit and the delete replays the segment on restart.
+"""
+#pylint: disable=unused-variable
+import json
+import threading
+from datetime import datetime as dt
+from os import fsync, listdir, makedirs, path, remove
+from time import monotonic
+
+import psycopg2
+
+from museum_pipeline.load import upload_messages
+from museum_pipeline.metrics import METRICS
+
+
+class SpoolFull(Exception):
+    """Raised when an append would take the spool over its size limit"""
+
+
+def _encode(message: dict) -> str:
+    return json.dumps({"table": message["table"],
+                       "event_at": message["event_at"].isoformat(),
+                       "value_id": message["value_id"],
+                       "exhibition_id": message["exhibition_id"]})
+
+
+def _decode(line: str) -> dict:
+    message = json.loads(line)
+    message["event_at"] = dt.fromisoformat(message["event_at"])
+    return message
+
+
+class Spool:
+    """A size-bounded directory of append-only segment files"""
+
+    def __init__(self, directory: str, max_bytes: int,
+                 segment_bytes: int = 8 * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        makedirs(directory, exist_ok=True)
+        segments = self._segments()
+        self._next = int(segments[-1].split(".")[0]) + 1 if segments else 0
+        self._current = None
+        self.depth_bytes = 0
+        self.depth_rows = 0
+        for segment in segments:
+            self.depth_rows += len(self.read_segment(segment))
+            self.depth_bytes += path.getsize(self._path(segment))
+        self._report()
+
+    def _path(self, segment: str) -> str:
+        return path.join(self.directory, segment)
+
+    def _segments(self) -> list[str]:
+        return sorted(f for f in listdir(self.directory)
+                      if f.endswith(".jsonl"))
+
+    def _report(self) -> None:
+        METRICS.set("spool_depth_rows", self.depth_rows)
+        METRICS.set("spool_depth_bytes", self.depth_bytes)
+
+    def append(self, messages: list[dict]) -> None:
+        """Durably appends formatted messages to the current segment"""
+        data = "".join(_encode(m) + "\n" for m in messages).encode("UTF-8")
+        with self._lock:
+            if self.depth_bytes + len(data) > self.max_bytes:
+                raise SpoolFull(f"Spool at {self.directory} is full.")
+            if self._current is None:
+                self._current = open(  # pylint: disable=consider-using-with
+                    self._path(f"{self._next:08}.jsonl"), "ab")
+                self._next += 1
+            self._current.write(data)
+            self._current.flush()
+            fsync(self._current.fileno())
+            self.depth_bytes += len(data)
+            self.depth_rows += len(messages)
+            if self._current.tell() >= self.segment_bytes:
+                self._current.close()
+                self._current = None
+            self._report()
+        METRICS.inc("spooled_rows_total", len(messages))
+
+    def closed_segments(self) -> list[str]:
+        """Closes the current segment, and returns every segment to drain"""
+        with self._lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
+            return self._segments()
+
+    def read_segment(self, segment: str) -> list[dict]:
+        """Returns the messages in a segment, skipping a torn final line"""
+        messages = []
+        with open(self._path(segment), "r", encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    messages.append(_decode(line))
+                except ValueError:
+                    continue
+        return messages
+
+    def remove_segment(self, segment: str, rows: int) -> None:
+        """Deletes a segment whose rows are now in the database"""
+        size = path.getsize(self._path(segment))
+        remove(self._path(segment))
+        with self._lock:
+            self.depth_bytes -= size
+            self.depth_rows -= rows
+            self._report()
+
+    def close(self) -> None:
+        """Closes the current segment"""
+        self.closed_segments()
+
+
+class SpoolDrainer(threading.Thread):
+    """Bulk-loads spooled segments into the database in the background"""
+
+    def __init__(self, spool: Spool, connect, logger,
+                 interval: float = 5.0):
+        super().__init__(daemon=True, name="spool-drainer")
+        self.spool = spool
+        self.connect = connect
+        self.logger = logger
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.conn = None
+
+    def drain_once(self) -> int:
+        """Loads every closed segment, returning the number of rows loaded"""
+        if self.spool.depth_rows == 0:
+            return 0
+        if self.conn is None or self.conn.closed:
+            self.conn = self.connect()
+        loaded = 0
+        started = monotonic()
+        for segment in self.spool.closed_segments():
+            messages = self.spool.read_segment(segment)
+            upload_messages(messages, self.conn)
+            self.spool.remove_segment(segment, len(messages))
+            loaded += len(messages)
+        seconds = monotonic() - started
+        METRICS.inc("spool_drained_rows_total", loaded)
+        METRICS.set("spool_drain_rows_per_second",
+                    round(loaded / seconds, 1) if seconds else loaded)
+        return loaded
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                loaded = self.drain_once()
+                if loaded:
+                    self.logger.info(f"Drained {loaded} rows from the spool.")
+            except psycopg2.Error as e:
+                self.logger.warning(f"Spool drain failed: {e}")
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+
+    def stop(self) -> None:
+        """Stops the drainer and closes its connection"""
+        self.stopped.set()
+        self.join()
+        if self.conn is not None:
+            self.conn.close()
+
+
+class SpooledWriter:
+    """Writes batches to the database, or to the spool when it can't keep up.
+
+    A failed or timed-out write marks the database as down for retry_interval
+    seconds, during which batches go straight to the spool.
+    """
+
+    def __init__(self, connect, spool: Spool, logger,
+                 retry_interval: float = 5.0):
+        self.connect = connect
+        self.spool = spool
+        self.logger = logger
+        self.retry_interval = retry_interval
+        self.conn = None
+        self.down_until = 0.0
+
+    def __call__(self, messages: list[dict]) -> str:
+        """Makes a batch durable, returning where it went: 'db' or 'spool'
+
+        Raises SpoolFull if the database is unavailable and the spool is
+        full; the batch has then been written nowhere.
+        """
+        if monotonic() >= self.down_until:
+            try:
+                if self.conn is None or self.conn.closed:
+                    self.conn = self.connect()
+                upload_messages(messages, self.conn)
+                return "db"
+            except psycopg2.Error as e:
+                METRICS.inc("db_write_failures_total")
+                self.logger.warning(f"Database write failed, spooling: {e}")
+                self._reset()
+                self.down_until = monotonic() + self.retry_interval
+        self.spool.append(messages)
+        return "spool"
+
+    def _reset(self) -> None:
+        if self.conn is None:
+            return
+        try:
+            self.conn.rollback()
+        except psycopg2.Error:
+            self.conn.close()
+        if self.conn.closed:
+            self.conn = None
+
+    def close(self) -> None:
+        """Closes the connection and the spool's open segment"""
+        if self.conn is not None:
+            self.conn.close()
+        self.spool.close()
@@ -0,0 +1,238 @@
+"""Runs several Kafka pipeline workers for one museum under a supervisor"""
+#pylint: disable=unused-variable
+import copy
+import multiprocessing as mp
+import signal
+from os import cpu_count, environ as ENV, listdir, path
+from time import sleep, monotonic
+from datetime import time
+from argparse import ArgumentParser
+
+from confluent_kafka import Consumer
+
+from museum_pipeline import lmnh_kafka_pipeline, lms_kafka_pipeline
+from museum_pipeline.cli import add_kafka_arguments
+from museum_pipeline.kafka_pipeline import (_consumer_config, _db_connector,
+                                            consume_museum)
+from museum_pipeline.extract import load_id_dict, get_env_conn
+from museum_pipeline.limiter import LIVE, limited
+from museum_pipeline.memory import profiled
+from museum_pipeline.pipeline_logger import setup_logging, load_logging_config
+from museum_pipeline.spool import Spool, SpoolDrainer
+
+MUSEUM_HOURS = {
+    lmnh_kafka_pipeline.MUSEUM: (lmnh_kafka_pipeline.START_TIME,
+                                 lmnh_kafka_pipeline.END_TIME),
+    lms_kafka_pipeline.MUSEUM: (lms_kafka_pipeline.START_TIME,
+                                lms_kafka_pipeline.END_TIME),
+}
+
+
+def _run_worker(index: int, museum: str, start: time, end: time,
+                id_dict: dict, log_config: dict, args, processed) -> None:
+    """Entry point of a worker process.
+
+    SIGTERM asks the worker to flush its current batch, then leave the
+    consumer group and close its connections.
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = setup_logging(f"{museum}_kafka_worker_{index}",
+                           config=log_config)
+    record_dir = None
+    if args.record_dir is not None:
+        record_dir = path.join(args.record_dir, museum, str(index))
+    report = None
+    if args.memory_report is not None:
+        report = f"{args.memory_report}.{index}"
+    with profiled(report, logger), \
+            limited(_db_connector(args.db_timeout), LIVE, logger):
+        consume_museum(museum, start, end, args, logger, id_dict=id_dict,
+                       spool_dir=path.join(args.spool_dir, museum,
+                                           str(index)),
+                       should_stop=lambda: bool(stopping),
+                       processed=processed, record_dir=record_dir,
+                       sink_dir=path.join(args.sink_dir, museum, str(index)))
+    logger.info(f"Worker {index} drained.")
+
+
+def _orphaned_spools(spool_dir: str, workers: int) -> list[str]:
+    """Returns the spools under a museum's spool directory which hold rows
+    but belong to no worker, i.e. those of worker indexes at or above
+    workers, left by a run with more workers"""
+    if not path.isdir(spool_dir):
+        return []
+    orphans = []
+    for name in sorted(listdir(spool_dir)):
+        directory = path.join(spool_dir, name)
+        if name.isdigit() and int(name) >= workers \
+                and path.isdir(directory) \
+                and any(f.endswith(".jsonl") for f in listdir(directory)):
+            orphans.append(directory)
+    return orphans
+
+
+def _partition_count(museum: str) -> int:
+    """Returns the number of partitions in a museum's topic"""
+    config = _consumer_config()
+    config["group.id"] = ENV["KAFKA_GROUP_ID"]
+    consumer = Consumer(config)
+    try:
+        metadata = consumer.list_topics(museum, timeout=10)
+        return len(metadata.topics[museum].partitions)
+    finally:
+        consumer.close()
+
+
+def throughput_report(counts: list[int], previous: list[int],
+                      seconds: float) -> dict:
+    """Returns per-worker and total rows per second between two samples"""
+    rates = [round((now - then) / seconds, 1)
+             for now, then in zip(counts, previous)]
+    return {"rows_per_second": rates,
+            "total_rows_per_second": round(sum(rates), 1),
+            "total_rows": sum(counts)}
+
+
+def supervise(museum: str, workers: int, args, log_config: dict, logger,
+              report_interval: float = 30.0,
+              restart_delay: float = 5.0, drain_timeout: float = 60.0,
+              target=_run_worker) -> None:
+    """Starts a number of workers in one consumer group and keeps them alive.
+
+    Crashed workers are restarted, and SIGTERM or SIGINT is forwarded to the
+    workers as SIGTERM so each can drain before the supervisor exits. Workers
+    still running drain_timeout seconds later are killed.
+
+    Each worker drains its own spool, <spool_dir>/<museum>/<index>. Spools
+    of indexes no worker has, left by a run with more workers, are drained
+    by the supervisor until it exits.
+
+    Parameters:
+        - museum -- str, name of the museum as it appears in you database
+        - workers -- int, number of worker processes
+        - args -- argparse.Namespace, with the Kafka pipeline's arguments
+        - log_config -- dict, logging configuration shared by every worker
+        - logger -- logging object
+        - report_interval -- float, seconds between throughput reports
+        - restart_delay -- float, minimum seconds between restarts of a
+                           single worker
+        - drain_timeout -- float, seconds the workers get to drain
+        - target -- worker entry point, called with the arguments of
+                    _run_worker
+    """
+    start, end = MUSEUM_HOURS[museum]
+    conn = get_env_conn()
+    try:
+        id_dict = load_id_dict(conn, museum)
+    finally:
+        conn.close()
+
+    drainers = []
+    for directory in _orphaned_spools(path.join(args.spool_dir, museum),
+                                      workers):
+        logger.warning(f"Draining {directory}, which no worker owns.")
+        drainers.append(SpoolDrainer(
+            Spool(directory, int(args.spool_max_mb * 2 ** 20)),
+            _db_connector(args.db_timeout), logger))
+        drainers[-1].start()
+
+    ctx = mp.get_context("spawn")
+    counters = [ctx.Value("Q", 0) for _ in range(workers)]
+    processes: list = [None] * workers
+    started_at = [0.0] * workers
+
+    def start_worker(index: int) -> None:
+        processes[index] = ctx.Process(
+            target=target, name=f"{museum}-worker-{index}",
+            args=(index, museum, start, end, id_dict, log_config, args,
+                  counters[index]))
+        processes[index].start()
+        started_at[index] = monotonic()
+
+    stopping = []
+
+    def forward(signum, _frame):
+        stopping.append(signum)
+        for p in processes:
+            if p is not None and p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for i in range(workers):
+        start_worker(i)
+    logger.info(f"Started {workers} workers for {museum}.")
+
+    previous = [0] * workers
+    last_report = monotonic()
+    while not stopping:
+        sleep(1.0)
+        for i, p in enumerate(processes):
+            if p.is_alive() or stopping:
+                continue
+            if monotonic() - started_at[i] < restart_delay:
+                continue
+            logger.warning(f"Worker {i} exited with code {p.exitcode}; "
+                           "restarting.")
+            start_worker(i)
+        if monotonic() - last_report >= report_interval:
+            counts = [c.value for c in counters]
+            logger.info(throughput_report(counts, previous,
+                                          monotonic() - last_report))
+            previous = counts
+            last_report = monotonic()
+
+    deadline = monotonic() + drain_timeout
+    for i, p in enumerate(processes):
+        p.join(max(0.0, deadline - monotonic()))
+        if p.is_alive():
+            logger.warning(f"Worker {i} didn't drain within {drain_timeout}s; "
+                           "killing it.")
+            p.kill()
+            p.join()
+    for drainer in drainers:
+        drainer.stop()
+        if drainer.spool.depth_rows:
+            logger.warning(f"{drainer.spool.depth_rows} rows are still in "
+                           f"{drainer.spool.directory}; they will be "
+                           "drained on the next start.")
+    logger.info({"drained": museum,
+                 "total_rows": sum(c.value for c in counters)})
+
+
+def get_cla(argv: list[str] | None = None):
+    """Returns cli argument values"""
+    parser = ArgumentParser(
+        prog='Sigma Labs Data Pipeline Supervisor',
+        description='Runs parallel Kafka pipeline workers for one museum.'
+    )
+    parser.add_argument('museum', choices=sorted(MUSEUM_HOURS))
+    parser.add_argument('-workers', type=int, default=None,
+                        help="Number of worker processes. (Default the "
+                        "lesser of the core count and the partition count)")
+    add_kafka_arguments(parser)
+    parser.add_argument('-report_interval', type=float, default=30.0,
+                        help="Seconds between throughput reports.")
+    return parser.parse_args(argv)
+
+
+def main(args=None):
+    """main function"""
+    if args is None:
+        args = get_cla()
+    handlers = ["file"] if args.store else ["stdout"]
+    log_config = copy.deepcopy(load_logging_config())
+    log_config["handlers"]["queue_handler"]["handlers"] = handlers
+    logger = setup_logging(f"{args.museum}_kafka_supervisor",
+                           config=log_config)
+    workers = args.workers
+    if workers is None:
+        workers = min(cpu_count() or 1, _partition_count(args.museum))
+    supervise(args.museum, workers, args, log_config, logger,
+              args.report_interval)
+
+
+if __name__ == "__main__":
+    main()
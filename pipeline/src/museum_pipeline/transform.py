@@ -1,5 +1,9 @@
 #pylint: disable=unused-variable
+import csv
 import datetime as dt
+import io
+import re
+from collections import Counter
 from re import fullmatch
 
 
@@ -7,7 +11,8 @@ def _prepare_upload_data(
         data: list[dict],
         id_dict: dict,
         logger,
-        limit: int | None = float("inf")) -> dict[str: list[tuple]]: #pylint: disable=unsupported-binary-operation
+        limit: int | None = float("inf"),
+        rejects=None) -> dict[str: list[tuple]]: #pylint: disable=unsupported-binary-operation
     """Converts csv-formatted data into a form to be uploaded.
 
         Arguments:
@@ -45,6 +50,9 @@ def _prepare_upload_data(
 
             limit -- int limit of rows to output
 
+            rejects -- RejectReport to record bad rows in (Default a new one,
+                whose description is logged as a single warning)
+
         Returns:
             a dictionary containing two lists of dictionaries to upload,
             of the form:
@@ -75,6 +83,7 @@ def _prepare_upload_data(
     if not isinstance(id_dict, dict):
         raise TypeError("Required positional argument 'id_dict' must be a dict"
                         f", not {type(id_dict)}")
+    report = rejects if rejects is not None else RejectReport()
     upload_data = {"rating": [], "request": []}
     if limit is None:
         limit = float("inf")
@@ -82,16 +91,192 @@ def _prepare_upload_data(
     for row in data:
         if row_count >= limit:
             break
-        try:
-            processed_row = _prepare_upload_data_row(row, id_dict)
-            upload_data[processed_row["table"]].append(processed_row["data"])
-            row_count += 1
-        except (TypeError, KeyError, ValueError):
-            logger.exception(f"Row '{row}' skipped.")
+        processed_row, reason, message = _validate_row(row, id_dict)
+        if reason is not None:
+            report.add(row, reason, message)
             continue
+        upload_data[processed_row["table"]].append(processed_row["data"])
+        row_count += 1
+    if rejects is None and report.total:
+        logger.warning(report.describe())
     return upload_data
 
 
+# Reason code -> exception type raised by _prepare_upload_data_row.
+REJECT_REASONS = {
+    "not_a_dict": TypeError,
+    "missing_at": KeyError,
+    "at_type": TypeError,
+    "bad_at": ValueError,
+    "missing_site": KeyError,
+    "site_type": TypeError,
+    "site_not_numeric": ValueError,
+    "unknown_exhibition": KeyError,
+    "missing_type": KeyError,
+    "type_type": TypeError,
+    "bad_type": ValueError,
+    "missing_val": KeyError,
+    "val_type": TypeError,
+    "val_not_numeric": ValueError,
+    "unknown_value": ValueError,
+}
+_AT = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2}) (\d{1,2}):(\d{1,2}):(\d{1,2})")
+_REQUEST_TYPE = re.compile(r"\d+\.\d+")
+
+
+def parse_at(at: str) -> dt.datetime | None:
+    """Parses a csv `at` value as rows are validated, with one- or two-digit
+    month, day and time fields, returning None if it isn't a valid time"""
+    match = _AT.fullmatch(at)
+    if match is None:
+        return None
+    try:
+        return dt.datetime(*map(int, match.groups()))
+    except ValueError:
+        return None
+
+
+class RejectReport:
+    """Per-reason counts of rejected rows, with a few samples of each.
+
+    Attributes:
+        counts -- Counter of {<reason code>: <rows>}
+        messages -- {<reason code>: <error text of its first row>}
+        samples -- {<reason code>: [<row>, ...]}, at most max_samples each
+        rows -- every rejected (row, reason, message), if keep_rows is set
+    """
+
+    def __init__(self, max_samples: int = 5, keep_rows: bool = False):
+        self.max_samples = max_samples
+        self.keep_rows = keep_rows
+        self.counts = Counter()
+        self.messages = {}
+        self.samples = {}
+        self.rows = []
+
+    @property
+    def total(self) -> int:
+        """Number of rows rejected"""
+        return sum(self.counts.values())
+
+    def add(self, row, reason: str, message: str) -> None:
+        """Records a rejected row"""
+        self.counts[reason] += 1
+        if reason not in self.messages:
+            self.messages[reason] = message
+            self.samples[reason] = []
+        if len(self.samples[reason]) < self.max_samples:
+            self.samples[reason].append(row)
+        if self.keep_rows:
+            self.rows.append((row, reason, message))
+
+    def summary(self) -> dict:
+        """Returns {<reason>: {"count", "message", "samples"}}"""
+        return {reason: {"count": count, "message": self.messages[reason],
+                         "samples": self.samples[reason]}
+                for reason, count in self.counts.most_common()}
+
+    def describe(self) -> str:
+        """Returns a one-line description, for logging"""
+        reasons = ", ".join(f"{reason}: {count} ({self.messages[reason]})"
+                            for reason, count in self.counts.most_common())
+        return f"Rejected {self.total} rows; {reasons}"
+
+    def write_csv(self, path: str) -> None:
+        """Writes every kept row to a csv, with its reason and error text,
+        in a single write"""
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=REJECT_COLUMNS,
+                                extrasaction="ignore")
+        writer.writeheader()
+        for row, reason, message in self.rows:
+            writer.writerow({**(row if isinstance(row, dict) else {}),
+                             "reason": reason, "error": message})
+        with open(path, "w", encoding="utf-8", newline="") as fp:
+            fp.write(buffer.getvalue())
+
+
+REJECT_COLUMNS = ["at", "site", "val", "type", "reason", "error"]
+
+
+def _validate_row(row, id_dict: dict) -> tuple:
+    """Converts csv row of expected format to custom dict for uploading,
+    without raising.
+
+    Arguments:
+        row, id_dict -- as for _prepare_upload_data_row
+
+    Returns:
+        (<dict, as returned by _prepare_upload_data_row>, None, None) for a
+        good row, or (None, <reason code>, <error text>) for a bad one
+    """
+    if not isinstance(row, dict):
+        return (None, "not_a_dict", "All elements of 'data' must be dicts."
+                f"Recieved {type(row)} instead.")
+    if "at" not in row:
+        return None, "missing_at", "Expected column 'at' missing from row."
+    at = row["at"]
+    if not isinstance(at, str):
+        return (None, "at_type",
+                f"strptime() argument 1 must be str, not {type(at)}")
+    match = _AT.fullmatch(at)
+    if match is None:
+        return (None, "bad_at", f"time data {at!r} does not match format "
+                "'%Y-%m-%d %H:%M:%S'")
+    try:
+        at = dt.datetime(*map(int, match.groups()))
+    except ValueError as e:
+        return None, "bad_at", str(e)
+
+    if "site" not in row:
+        return None, "missing_site", "Expected column 'site' missing from row."
+    site = row["site"]
+    if not isinstance(site, str):
+        return (None, "site_type", "Type of column 'site' must be string,"
+                f"not {type(site)}")
+    if not site.isdecimal():
+        return (None, "site_not_numeric",
+                "Value of column 'site' must be numeric.")
+    site = id_dict["exhibition"].get(int(site))
+    if site is None:
+        return (None, "unknown_exhibition",
+                f"Exhibition {row["site"]} not recognised.")
+
+    if "type" not in row:
+        return None, "missing_type", "Expected column 'type' missing from row."
+    request_type = row["type"]
+    if not isinstance(request_type, str):
+        return (None, "type_type", "Type of column 'type' must be a string,"
+                f"not {type(request_type)}")
+    table: str
+    if request_type == "":
+        table = "rating"
+        if "val" not in row:
+            return (None, "missing_val",
+                    "Expected column 'val' missing from row.")
+        val = row["val"]
+    elif _REQUEST_TYPE.fullmatch(request_type) is not None:
+        table = "request"
+        val = str(int(float(request_type)))
+    else:
+        return (None, "bad_type",
+                f"Illegal value for type: {request_type}")
+
+    if not isinstance(val, str):
+        return (None, "val_type", "Type of column 'val' must be a string,"
+                f"not {type(val)}")
+    if not val.isdecimal() and val != '-1':
+        return (None, "val_not_numeric", "Value of column 'val' must be "
+                f"numeric.Value: {val}")
+    val_id = id_dict[table].get(int(val))
+    if val_id is None:
+        return (None, "unknown_value", "Value of column 'val' not "
+                f"recognised; {val} is not a recognised value for {table}.")
+    return ({"table": table,
+             "data": {"event_at": at, "exhibition_id": site,
+                      "value_id": val_id}}, None, None)
+
+
 def _prepare_upload_data_row(row: dict, id_dict: dict) -> tuple:
     """Converts csv row of expected format to custom dict for uploading.
 
@@ -115,52 +300,13 @@ def _prepare_upload_data_row(row: dict, id_dict: dict) -> tuple:
                     "value_id": <int: row value of <rating | request>>
                 }
         }
-    """
-    if not isinstance(row, dict):
-        raise TypeError("All elements of 'data' must be dicts."
-                        f"Recieved {type(row)} instead.")
-    if "at" not in row:
-        raise KeyError("Expected column 'at' missing from row.")
-    at = dt.datetime.strptime(row["at"], "%Y-%m-%d %H:%M:%S")
-
-    if "site" not in row:
-        raise KeyError("Expected column 'site' missing from row.")
-    site = row["site"]
-    if not isinstance(site, str):
-        raise TypeError("Type of column 'site' must be string,"
-                        f"not {type(site)}")
-    if not site.isnumeric():
-        raise ValueError("Value of column 'site' must be numeric.")
-    site = int(site)
-    if site not in id_dict["exhibition"]:
-        raise KeyError(f"Exhibition {row["site"]} not recognised.")
-    site = id_dict["exhibition"][site]
-
-    table: str
-    if row["type"] == "":
-        table = "rating"
-    elif fullmatch(r"\d+\.\d+", row["type"]) is not None:
-        table = "request"
-        row["val"] = str(int(float(row["type"])))
-    else:
-        raise ValueError(f"Illegal value for type: {row["type"]}")
 
-    if "val" not in row:
-        raise KeyError("Expected column 'val' missing from row.")
-    val = row["val"]
-    if not isinstance(val, str):
-        raise TypeError("Type of column 'val' must be a string,"
-                        f"not {type(val)}")
-    if not val.isnumeric() and val != '-1':
-        raise ValueError("Value of column 'val' must be numeric."
-                         f"Value: {val}")
-    val = int(val)
-    if val not in id_dict[table]:
-        raise ValueError("Value of column 'val' not recognised; "
-                         f"{val} is not a recognised value for {table}.")
-    val = id_dict[table][val]
-    return {"table": table,
-            "data": {"event_at": at, "exhibition_id": site, "value_id": val}}
+    Raises the exception type of REJECT_REASONS for a bad row.
+    """
+    processed_row, reason, message = _validate_row(row, id_dict)
+    if reason is not None:
+        raise REJECT_REASONS[reason](message)
+    return processed_row
 
 
 def filter_strings(to_filter: list[str], pattern: str) -> list[str]:
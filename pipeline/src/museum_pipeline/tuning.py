@@ -0,0 +1,86 @@
+"""Runtime tuning of the Kafka pipeline's flush size and interval.
+
+After each flush the tuner is told how many rows were written, how long the
+write took and how far behind the topic the consumer is. It then:
+
+- scales the batch size towards the one whose write would take
+  target_latency, by at most a factor of two per flush, and only grows it
+  when the batch filled up, so quiet periods don't inflate it;
+- flushes at max_interval while the consumer is lagging, so bursts are
+  written in as few transactions as possible, and at min_interval once it
+  has caught up, so single ratings reach the database quickly.
+
+Every change is recorded in METRICS: the batch_size and flush_interval
+gauges, batch_tuning_reason, and a batch_tuning_<reason>_total counter.
+"""
+#pylint: disable=unused-variable
+from museum_pipeline.metrics import METRICS
+
+REASONS = ("latency_above_target", "latency_below_target", "lagging",
+           "caught_up")
+
+
+class BatchTuner:
+    """Chooses the flush size and interval for consume_messages"""
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0,
+                 target_latency: float = 0.25, min_size: int = 50,
+                 max_size: int = 5000, min_interval: float = 0.1,
+                 max_interval: float = 2.0, max_lag: float = 5.0):
+        if not min_size <= max_size or not min_interval <= max_interval:
+            raise ValueError("Batch tuning bounds are inverted.")
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_lag = max_lag
+        self.batch_size = min(max(batch_size, min_size), max_size)
+        self.flush_interval = min(max(flush_interval, min_interval),
+                                  max_interval)
+        self.reason = None
+        METRICS.set("batch_size", self.batch_size)
+        METRICS.set("flush_interval", self.flush_interval)
+
+    def _change(self, reason: str) -> None:
+        self.reason = reason
+        METRICS.set("batch_tuning_reason", reason)
+        METRICS.inc(f"batch_tuning_{reason}_total")
+
+    def observe(self, rows: int, seconds: float | None,
+                lag: float | None) -> None:
+        """Adjusts the batch size and flush interval after a flush
+
+        Arguments:
+            rows -- rows in the flushed batch
+            seconds -- time the database write took, or None if the batch
+                didn't go to the database
+            lag -- seconds between the newest message's Kafka timestamp and
+                now, or None if unknown
+        """
+        if lag is not None:
+            METRICS.set("consumer_lag_seconds", round(lag, 3))
+            interval = self.max_interval if lag > self.max_lag \
+                else self.min_interval
+            if interval != self.flush_interval:
+                self.flush_interval = interval
+                METRICS.set("flush_interval", interval)
+                self._change("lagging" if lag > self.max_lag
+                             else "caught_up")
+
+        if rows == 0 or seconds is None:
+            return
+        METRICS.set("commit_latency_seconds", round(seconds, 4))
+        ratio = self.target_latency / seconds if seconds > 0 else 2.0
+        ratio = min(max(ratio, 0.5), 2.0)
+        # Within 10% of the target is close enough; growing is only useful
+        # when the batch actually filled.
+        if 0.9 <= ratio <= 1.1 or (ratio > 1 and rows < self.batch_size):
+            return
+        size = min(max(int(self.batch_size * ratio), self.min_size),
+                   self.max_size)
+        if size != self.batch_size:
+            self._change("latency_above_target" if size < self.batch_size
+                         else "latency_below_target")
+            self.batch_size = size
+            METRICS.set("batch_size", size)
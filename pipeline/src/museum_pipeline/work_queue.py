@@ -0,0 +1,461 @@
+"""Multi-node S3 ingest, coordinated through the ingest_shard work table.
+
+A coordinator lists the bucket once and records every museum csv as a
+pending shard. Any number of workers, on any number of hosts, then claim
+shards one at a time with an UPDATE over SELECT ... FOR UPDATE SKIP LOCKED,
+so two workers never claim the same shard and neither waits on the other.
+
+A claim is a lease: the worker's owner id and an expiry time. While a shard
+is loading, a heartbeat thread pushes the expiry forward on its own
+connection. If a worker dies the heartbeats stop, the lease expires, and
+the next claim picks the shard up again; a shard is given up as failed
+after max_attempts claims.
+
+A shard's rows and its move to 'done' are committed in one transaction,
+and only while the worker still holds the lease. A worker that lost its
+lease rolls its rows back, so each shard is loaded exactly once however
+many times it is claimed.
+
+The ingest_progress view answers what is left and who is processing it.
+"""
+#pylint: disable=unused-variable
+import argparse
+import json
+import multiprocessing as mp
+import socket
+import tempfile
+import threading
+from os import getpid, makedirs, path
+from time import perf_counter, sleep
+
+from psycopg2.extras import RealDictCursor, execute_values
+
+from museum_pipeline.extract import (get_env_conn, get_object_etags,
+                                     load_csv_data, load_id_dict)
+from museum_pipeline.limiter import BACKFILL, limited
+from museum_pipeline.load import _upload_data
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.pipeline import MUSEUM_PATTERNS, _s3
+from museum_pipeline.pipeline_logger import setup_logging
+from museum_pipeline.transform import (_prepare_upload_data, filter_strings,
+                                       RejectReport)
+
+
+def default_owner() -> str:
+    """Returns an owner id unique to this process: <hostname>:<pid>"""
+    return f"{socket.gethostname()}:{getpid()}"
+
+
+def enqueue_shards(conn, shards: dict[str, tuple[str, str | None]],
+                   requeue_failed: bool = False) -> int:
+    """Records shards as pending, leaving ones already queued as they are
+
+    Arguments:
+        conn -- psycopg2 connection
+        shards -- {<key>: (<museum name>, <ETag>)}
+        requeue_failed -- also make failed shards pending again, with
+            their attempts reset
+
+    Returns:
+        the number of shards newly queued or requeued
+    """
+    cur = conn.cursor()
+    rows = execute_values(
+        cur,
+        """
+        INSERT INTO ingest_shard
+            (object_key, museum_name, etag)
+        VALUES
+            %s
+        ON CONFLICT (object_key) DO NOTHING
+        RETURNING object_key
+        ;
+        """,
+        [(key, museum, etag) for key, (museum, etag) in shards.items()],
+        fetch=True
+    )
+    queued = len(rows)
+    if requeue_failed:
+        cur.execute("""UPDATE
+                            ingest_shard
+                        SET
+                            status = 'pending', attempts = 0, error = NULL,
+                            lease_owner = NULL, lease_expires_at = NULL
+                        WHERE
+                            status = 'failed'
+                            AND object_key = ANY(%s);""",
+                    (list(shards),))
+        queued += cur.rowcount
+    conn.commit()
+    cur.close()
+    return queued
+
+
+def claim_shard(conn, owner: str, lease_seconds: float = 60.0,
+                max_attempts: int = 3) -> dict | None:
+    """Leases the next pending or expired shard to owner
+
+    Expired leases which have used up their attempts are marked failed
+    first.
+
+    Returns:
+        {"object_key", "museum_name", "etag", "attempts"} of the claimed
+        shard, or None if there is nothing left to claim
+    """
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""UPDATE
+                        ingest_shard
+                    SET
+                        status = 'failed',
+                        error = COALESCE(error, 'lease expired'),
+                        finished_at = NOW()
+                    WHERE
+                        status = 'leased'
+                        AND lease_expires_at < NOW()
+                        AND attempts >= %s;""",
+                (max_attempts,))
+    cur.execute("""UPDATE
+                        ingest_shard
+                    SET
+                        status = 'leased',
+                        lease_owner = %(owner)s,
+                        leased_at = NOW(),
+                        heartbeat_at = NOW(),
+                        lease_expires_at = NOW()
+                            + %(lease)s * INTERVAL '1 second',
+                        attempts = attempts + 1
+                    WHERE
+                        object_key = (
+                            SELECT
+                                object_key
+                            FROM
+                                ingest_shard
+                            WHERE
+                                (status = 'pending'
+                                 OR (status = 'leased'
+                                     AND lease_expires_at < NOW()))
+                                AND attempts < %(max_attempts)s
+                            ORDER BY
+                                object_key
+                            LIMIT 1
+                            FOR UPDATE SKIP LOCKED
+                        )
+                    RETURNING
+                        object_key, museum_name, etag, attempts;""",
+                {"owner": owner, "lease": lease_seconds,
+                 "max_attempts": max_attempts})
+    shard = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return dict(shard) if shard is not None else None
+
+
+def renew_lease(conn, owner: str, key: str, lease_seconds: float) -> bool:
+    """Pushes a lease's expiry forward, returning False if owner has lost
+    it"""
+    cur = conn.cursor()
+    cur.execute("""UPDATE
+                        ingest_shard
+                    SET
+                        heartbeat_at = NOW(),
+                        lease_expires_at = NOW()
+                            + %s * INTERVAL '1 second'
+                    WHERE
+                        object_key = %s
+                        AND lease_owner = %s
+                        AND status = 'leased';""",
+                (lease_seconds, key, owner))
+    renewed = cur.rowcount == 1
+    conn.commit()
+    cur.close()
+    return renewed
+
+
+def finish_shard(cur, owner: str, key: str, rows_uploaded: int,
+                 rows_rejected: int) -> bool:
+    """Marks a shard done in the caller's transaction, returning False if
+    owner no longer holds its lease"""
+    cur.execute("""UPDATE
+                        ingest_shard
+                    SET
+                        status = 'done',
+                        rows_uploaded = %s,
+                        rows_rejected = %s,
+                        error = NULL,
+                        finished_at = NOW()
+                    WHERE
+                        object_key = %s
+                        AND lease_owner = %s
+                        AND status = 'leased';""",
+                (rows_uploaded, rows_rejected, key, owner))
+    return cur.rowcount == 1
+
+
+def release_shard(conn, owner: str, key: str, error: str,
+                  max_attempts: int = 3) -> None:
+    """Gives a shard back after a failed load, as pending, or as failed
+    once it has used up its attempts"""
+    cur = conn.cursor()
+    cur.execute("""UPDATE
+                        ingest_shard
+                    SET
+                        status = CASE WHEN attempts >= %s
+                                 THEN 'failed' ELSE 'pending' END,
+                        error = %s,
+                        lease_expires_at = NULL,
+                        finished_at = CASE WHEN attempts >= %s
+                                      THEN NOW() END
+                    WHERE
+                        object_key = %s
+                        AND lease_owner = %s
+                        AND status = 'leased';""",
+                (max_attempts, error, max_attempts, key, owner))
+    conn.commit()
+    cur.close()
+
+
+def shard_status(conn) -> list[dict]:
+    """Returns ingest_progress: shards and rows per museum, state and
+    owner, with each owner's latest heartbeat"""
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("""SELECT
+                        museum_name, state, lease_owner, shards,
+                        rows_uploaded, last_heartbeat_at
+                    FROM
+                        ingest_progress
+                    ORDER BY
+                        museum_name, state, lease_owner;""")
+    rows = [dict(row) for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    return rows
+
+
+class Heartbeat(threading.Thread):
+    """Renews one lease every interval seconds until stopped.
+
+    Runs on its own connection, since the worker's connection is inside
+    the shard's write transaction. Sets `lost` if the lease is taken over.
+    """
+
+    def __init__(self, connect, owner: str, key: str, lease_seconds: float,
+                 interval: float):
+        super().__init__(daemon=True)
+        self.connect = connect
+        self.owner = owner
+        self.key = key
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.lost = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        conn = self.connect()
+        try:
+            while not self._stop_event.wait(self.interval):
+                if not renew_lease(conn, self.owner, self.key,
+                                   self.lease_seconds):
+                    self.lost.set()
+                    return
+                METRICS.inc("lease_heartbeats_total")
+        finally:
+            conn.close()
+
+    def stop(self) -> None:
+        """Stops renewing and waits for the thread to finish"""
+        self._stop_event.set()
+        self.join()
+
+
+def load_shard(boto_client, bucket: str, conn, logger, shard: dict,
+               id_dict: dict, owner: str, heartbeat: Heartbeat | None = None,
+               rejects_dir: str | None = None) -> dict:
+    """Downloads one leased csv and loads it, committing only if the lease
+    is still held
+
+    Returns:
+        a summary dict of the shard, with "committed" False if the lease
+        was lost and the rows rolled back
+    """
+    key = shard["object_key"]
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = path.join(tmp, "shard.csv")
+        boto_client.download_file(bucket, key, filepath)
+        csv_data = load_csv_data(filepath)
+    rejects = RejectReport(keep_rows=rejects_dir is not None)
+    payload_data = _prepare_upload_data(csv_data, id_dict, logger, None,
+                                        rejects)
+    uploaded = sum(len(x) for x in payload_data.values())
+    if heartbeat is not None and heartbeat.lost.is_set():
+        committed = False
+    else:
+        _upload_data(payload_data, conn, commit=False)
+        with conn.cursor() as cur:
+            committed = finish_shard(cur, owner, key, uploaded,
+                                     rejects.total)
+    if not committed:
+        conn.rollback()
+        logger.warning(f"Lease on {key} lost; its rows were rolled back.")
+        METRICS.inc("leases_lost_total")
+        return {"key": key, "committed": False}
+    conn.commit()
+    if rejects_dir is not None and rejects.total:
+        makedirs(rejects_dir, exist_ok=True)
+        name = key.replace("/", "_").rsplit(".", 1)[0]
+        rejects.write_csv(path.join(rejects_dir, f"{name}_rejects.csv"))
+    return {"key": key, "committed": True, "rows_read": len(csv_data),
+            "rows_uploaded": uploaded, "rows_rejected": rejects.total}
+
+
+def run_worker(boto_client, bucket: str, connect, logger,
+               owner: str | None = None, lease_seconds: float = 60.0,
+               heartbeat_interval: float | None = None,
+               max_attempts: int = 3, wait: float | None = None,
+               rejects_dir: str | None = None,
+               should_stop=lambda: False) -> dict:
+    """Claims and loads shards until none are left.
+
+    Arguments:
+        boto_client -- a boto3 s3 connection
+        bucket -- name of the s3 bucket the shards are in
+        connect -- function returning a new psycopg2 connection; the worker
+            uses one, and each heartbeat one more
+        logger -- logging object
+        owner -- lease owner id (Default <hostname>:<pid>)
+        lease_seconds -- how long a lease lasts without a heartbeat
+        heartbeat_interval -- seconds between renewals (Default a third of
+            lease_seconds)
+        max_attempts -- claims of a shard before it is marked failed
+        wait -- when nothing is claimable, poll again after this many
+            seconds instead of returning (Default return)
+        rejects_dir -- directory to write each shard's rejected rows to
+            (Default not written)
+        should_stop -- function returning True once the worker should stop
+            claiming
+
+    Returns:
+        a summary dict of the shards and rows this worker loaded
+    """
+    owner = owner or default_owner()
+    interval = heartbeat_interval or lease_seconds / 3
+    summary = {"owner": owner, "shards": 0, "shards_failed": 0,
+               "leases_lost": 0, "rows_uploaded": 0, "rows_rejected": 0}
+    id_dicts = {}
+    conn = connect()
+    started = perf_counter()
+    try:
+        while not should_stop():
+            shard = claim_shard(conn, owner, lease_seconds, max_attempts)
+            if shard is None:
+                if wait is None:
+                    break
+                sleep(wait)
+                continue
+            key = shard["object_key"]
+            logger.info(f"Claimed {key} (attempt {shard['attempts']}).")
+            heartbeat = Heartbeat(connect, owner, key, lease_seconds,
+                                  interval)
+            heartbeat.start()
+            try:
+                museum = shard["museum_name"]
+                if museum not in id_dicts:
+                    id_dicts[museum] = load_id_dict(conn, museum)
+                    conn.commit()
+                result = load_shard(boto_client, bucket, conn, logger, shard,
+                                    id_dicts[museum], owner, heartbeat,
+                                    rejects_dir)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                conn.rollback()
+                logger.exception(f"Load of {key} failed.")
+                release_shard(conn, owner, key, f"{type(e).__name__}: {e}",
+                              max_attempts)
+                summary["shards_failed"] += 1
+                continue
+            finally:
+                heartbeat.stop()
+            if not result["committed"]:
+                summary["leases_lost"] += 1
+                continue
+            summary["shards"] += 1
+            summary["rows_uploaded"] += result["rows_uploaded"]
+            summary["rows_rejected"] += result["rows_rejected"]
+            METRICS.inc("shards_loaded_total")
+    finally:
+        conn.close()
+    summary["seconds"] = round(perf_counter() - started, 3)
+    return summary
+
+
+def queue_bucket(boto_client, bucket: str, conn, sources: dict[str, str],
+                 requeue_failed: bool = False) -> int:
+    """Lists a bucket and queues each museum's csvs
+
+    Arguments:
+        sources -- dict of {<museum name>: <key pattern>}
+
+    Returns:
+        the number of shards newly queued
+    """
+    etags = get_object_etags(boto_client, bucket)
+    shards = {}
+    for museum, pattern in sources.items():
+        for key in filter_strings(list(etags), pattern):
+            shards[key] = (museum, etags[key])
+    return enqueue_shards(conn, shards, requeue_failed)
+
+
+def enqueue_main(args: argparse.Namespace) -> None:
+    """Queues the museums' csvs in a bucket for workers to load
+
+    Arguments:
+        args -- parsed arguments, with bucket, museums, patterns and
+            requeue_failed
+    """
+    logger = setup_logging("pipeline")
+    bucket, boto_client = _s3(args)
+    conn = get_env_conn()
+    try:
+        queued = queue_bucket(boto_client, bucket, conn,
+                              {m: args.patterns.get(m, MUSEUM_PATTERNS[m])
+                               for m in args.museums},
+                              args.requeue_failed)
+    finally:
+        conn.close()
+    logger.info(f"Queued {queued} shards.")
+    print(json.dumps({"queued": queued}))
+
+
+def _work(args: argparse.Namespace, index: int) -> dict:
+    """Runs one worker, in this process or a child"""
+    logger = setup_logging("pipeline")
+    bucket, boto_client = _s3(args)
+    owner = args.owner or default_owner()
+    if args.processes > 1:
+        owner = f"{owner}/{index}"
+    with limited(get_env_conn, BACKFILL, logger):
+        return run_worker(boto_client, bucket, get_env_conn, logger, owner,
+                          args.lease_seconds, args.heartbeat_interval,
+                          args.max_attempts, args.wait, args.rejects_dir)
+
+
+def work_main(args: argparse.Namespace) -> None:
+    """Runs -processes workers until the queue is empty, printing a JSON
+    summary of each"""
+    if args.processes == 1:
+        summaries = [_work(args, 0)]
+    else:
+        with mp.get_context("spawn").Pool(args.processes) as pool:
+            summaries = pool.starmap(_work, [(args, i)
+                                             for i in range(args.processes)])
+    for summary in summaries:
+        print(json.dumps(summary))
+
+
+def status_main(args: argparse.Namespace) -> None:  # pylint: disable=W0613
+    """Prints ingest_progress as JSON lines"""
+    conn = get_env_conn()
+    try:
+        for row in shard_status(conn):
+            print(json.dumps(row, default=str))
+    finally:
+        conn.close()
@@ -0,0 +1,221 @@
+"""The one place rating and request interactions are written to the database.
+
+Both pipelines hand rows to an InteractionWriter, which inserts them with
+server-side prepared statements in one canonical column order:
+
+    rating_interaction  (event_at, exhibition_id, rating_id)
+    request_interaction (event_at, exhibition_id, request_id)
+
+Statements are PREPAREd once per connection, the first time the writer
+uses it, so each write only sends an EXECUTE and its parameters. Prepared
+statements belong to the database session rather than a transaction, so
+they survive rollbacks and last until the connection closes.
+
+The writer has three modes, trading statements for round trips:
+
+    single    -- one EXECUTE per row, each its own round trip
+    multi     -- one EXECUTE per table per page_size rows, the rows passed
+                 as arrays and inserted with UNNEST
+    pipelined -- the same array EXECUTEs, with up to depth of them sent in
+                 one round trip, so the client waits for results once per
+                 depth pages instead of once per page
+
+psycopg2 has no libpq pipeline mode, so pipelining sends several EXECUTEs
+as one multi-statement query; the server runs them in order and stops at
+the first error, which aborts the transaction as a failed single statement
+would.
+
+Every write advances the write watermark in the same transaction, and
+waits first for the process's shared write limits (see limiter.py). A
+museum's watermark is the sum of WATERMARK_SLOTS rows, each connection
+adding to the row of its backend's pid, so concurrent writers rarely wait
+on each other's row locks until they commit.
+"""
+#pylint: disable=unused-variable
+import threading
+import weakref
+from collections import Counter
+from time import perf_counter
+
+from museum_pipeline.limiter import LIMITER
+from museum_pipeline.metrics import METRICS
+
+MODES = ("single", "multi", "pipelined")
+TABLES = ("rating", "request")
+WATERMARK_SLOTS = 256
+
+_STATEMENTS = {
+    "mp_insert_rating_row": (
+        "(TIMESTAMPTZ, SMALLINT, SMALLINT)",
+        """INSERT INTO rating_interaction
+               (event_at, exhibition_id, rating_id)
+           VALUES
+               ($1, $2, $3)"""),
+    "mp_insert_request_row": (
+        "(TIMESTAMPTZ, SMALLINT, INT)",
+        """INSERT INTO request_interaction
+               (event_at, exhibition_id, request_id)
+           VALUES
+               ($1, $2, $3)"""),
+    "mp_insert_rating": (
+        "(TIMESTAMPTZ[], SMALLINT[], SMALLINT[])",
+        """INSERT INTO rating_interaction
+               (event_at, exhibition_id, rating_id)
+           SELECT * FROM UNNEST($1, $2, $3)"""),
+    "mp_insert_request": (
+        "(TIMESTAMPTZ[], SMALLINT[], INT[])",
+        """INSERT INTO request_interaction
+               (event_at, exhibition_id, request_id)
+           SELECT * FROM UNNEST($1, $2, $3)"""),
+    "mp_bump_watermarks": (
+        "(SMALLINT[], BIGINT[])",
+        f"""INSERT INTO write_watermark
+               (museum_id, slot, rows_written, written_at)
+           SELECT
+               museum_id, pg_backend_pid() % {WATERMARK_SLOTS}, SUM(n), NOW()
+           FROM
+               UNNEST($1, $2) AS w(exhibition_id, n)
+           JOIN
+               exhibition
+           USING
+               (exhibition_id)
+           GROUP BY
+               museum_id
+           ON CONFLICT (museum_id, slot) DO UPDATE SET
+               rows_written = write_watermark.rows_written
+                   + EXCLUDED.rows_written,
+               written_at = EXCLUDED.written_at"""),
+}
+
+_EXECUTE_ROW = "EXECUTE {name}_row (%s, %s, %s);"
+_EXECUTE_ARRAYS = "EXECUTE {name} (%s::TIMESTAMPTZ[], %s::SMALLINT[], " \
+    "%s::{value_type}[]);"
+_EXECUTE_BUMP = "EXECUTE mp_bump_watermarks (%s::SMALLINT[], %s::BIGINT[]);"
+_VALUE_TYPES = {"rating": "SMALLINT", "request": "INT"}
+
+
+class InteractionWriter:
+    """Writes interaction rows through per-connection prepared statements
+
+    Arguments:
+        mode -- one of MODES
+        page_size -- rows per EXECUTE in the multi and pipelined modes
+        depth -- EXECUTEs per round trip in the pipelined mode
+        limited -- whether writes wait for the process's write limits
+    """
+
+    def __init__(self, mode: str = "pipelined", page_size: int = 1000,
+                 depth: int = 8, limited: bool = True):
+        if mode not in MODES:
+            raise ValueError(f"Unknown write mode {mode}")
+        if page_size < 1 or depth < 1:
+            raise ValueError("page_size and depth must be positive.")
+        self.mode = mode
+        self.page_size = page_size
+        self.depth = depth
+        self.limited = limited
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _prepare(self, conn, cur) -> None:
+        """PREPAREs whichever statements the connection doesn't have yet"""
+        with self._lock:
+            prepared = self._prepared.get(conn)
+        if prepared is not None:
+            return
+        cur.execute("SELECT name FROM pg_prepared_statements "
+                    "WHERE name = ANY(%s);", (list(_STATEMENTS),))
+        existing = {row[0] for row in cur.fetchall()}
+        missing = [name for name in _STATEMENTS if name not in existing]
+        if missing:
+            cur.execute("".join(
+                f"PREPARE {name} {types} AS {sql};"
+                for name, (types, sql) in _STATEMENTS.items()
+                if name in missing))
+            METRICS.inc("writer_statements_prepared_total", len(missing))
+        with self._lock:
+            self._prepared[conn] = set(_STATEMENTS)
+
+    def _send(self, cur, statements: list[tuple[str, tuple]]) -> None:
+        """Sends statements in one round trip"""
+        if not statements:
+            return
+        cur.execute("\n".join(sql for sql, _ in statements),
+                    tuple(p for _, params in statements for p in params))
+        METRICS.inc("writer_round_trips_total")
+
+    def _statements(self, data: dict[str, list[dict]]) -> list[tuple]:
+        """Returns (sql, params) of each EXECUTE a write needs"""
+        statements = []
+        for table in TABLES:
+            rows = data.get(table, [])
+            if self.mode == "single":
+                sql = _EXECUTE_ROW.format(name=f"mp_insert_{table}")
+                statements.extend(
+                    (sql, (r["event_at"], r["exhibition_id"], r["value_id"]))
+                    for r in rows)
+                continue
+            sql = _EXECUTE_ARRAYS.format(name=f"mp_insert_{table}",
+                                         value_type=_VALUE_TYPES[table])
+            for i in range(0, len(rows), self.page_size):
+                page = rows[i:i + self.page_size]
+                statements.append((sql, ([r["event_at"] for r in page],
+                                         [r["exhibition_id"] for r in page],
+                                         [r["value_id"] for r in page])))
+        counts = Counter(r["exhibition_id"] for table in TABLES
+                         for r in data.get(table, []))
+        if counts:
+            statements.append((_EXECUTE_BUMP, (list(counts),
+                                               list(counts.values()))))
+        return statements
+
+    def write_tables(self, conn, data: dict[str, list[dict]],
+                     commit: bool = True) -> int:
+        """Inserts rows already split by table
+
+        Arguments:
+            conn -- psycopg2 connection
+            data -- {"rating": [<row>, ...], "request": [<row>, ...]}, each
+                row a dict of event_at, exhibition_id and value_id
+            commit -- whether to commit, or leave the rows in the caller's
+                open transaction
+
+        Returns:
+            the number of rows inserted
+        """
+        rows = sum(len(data.get(table, [])) for table in TABLES)
+        started = perf_counter()
+        if rows and self.limited:
+            LIMITER.acquire(rows)
+        cur = conn.cursor()
+        try:
+            if rows:
+                self._prepare(conn, cur)
+                statements = self._statements(data)
+                group = self.depth if self.mode == "pipelined" else 1
+                for i in range(0, len(statements), group):
+                    self._send(cur, statements[i:i + group])
+        finally:
+            cur.close()
+        if commit:
+            conn.commit()
+            if rows:
+                LIMITER.observe(perf_counter() - started)
+        METRICS.inc("writer_rows_total", rows)
+        return rows
+
+    def write(self, conn, messages: list[dict], commit: bool = True) -> int:
+        """Inserts formatted Kafka messages, each with a "table" key
+
+        Returns:
+            the number of rows inserted
+        """
+        data = {table: [] for table in TABLES}
+        for message in messages:
+            data[message["table"]].append(message)
+        return self.write_tables(conn, data, commit)
+
+
+WRITER = InteractionWriter()
+# Single live rows, the emergency lane's among them, bypass the write limits.
+ROW_WRITER = InteractionWriter("single", limited=False)
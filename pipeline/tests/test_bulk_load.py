@@ -0,0 +1,138 @@
+#pylint: skip-file
+import datetime
+from unittest.mock import MagicMock
+
+import pytest
+from psycopg2 import sql
+
+from museum_pipeline.bulk_load import PHASES, bulk_load
+from museum_pipeline.transform import RejectReport
+
+AT = datetime.datetime(2025, 1, 13, 9, tzinfo=datetime.timezone.utc)
+
+
+def render(query):
+    if isinstance(query, sql.Composed):
+        return "".join(render(q) for q in query.seq)
+    if isinstance(query, sql.Identifier):
+        return ".".join(f'"{s}"' for s in query.strings)
+    if isinstance(query, sql.SQL):
+        return query.string
+    return query
+
+
+class FakeCursor:
+    """Records rendered statements, answering catalog queries and DELETEs
+    from `results` by the first matching substring"""
+
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.statements = []
+        self.copied = {}
+        self.rowcount = 0
+        self._last = ""
+
+    def execute(self, query, params=None):
+        self._last = render(query)
+        self.statements.append(self._last)
+        if self._last.lstrip().startswith("INSERT INTO \"rating"):
+            self.rowcount = 2
+        elif "INSERT INTO \"request" in self._last:
+            self.rowcount = 1
+        if "FAIL" in self.results and self.results["FAIL"] in self._last:
+            raise RuntimeError("boom")
+
+    def copy_expert(self, query, fp):
+        self.copied[render(query).split()[1]] = fp.read()
+
+    def fetchone(self):
+        return (42,)
+
+    def fetchall(self):
+        for key, rows in self.results.items():
+            if key in self._last:
+                return rows
+        return []
+
+    def close(self):
+        pass
+
+
+def connection(cur):
+    conn = MagicMock()
+    conn.cursor.return_value = cur
+    return conn
+
+
+def data():
+    return {"rating": [{"event_at": AT, "exhibition_id": 1, "value_id": 3},
+                       {"event_at": AT, "exhibition_id": 9, "value_id": 3},
+                       {"event_at": AT, "exhibition_id": 2, "value_id": 4}],
+            "request": [{"event_at": AT, "exhibition_id": 1,
+                         "value_id": 2}]}
+
+
+def test_bulk_load_stages_validates_and_moves():
+    cur = FakeCursor({'"exhibition" AS l': [(AT, 9, 3)]})
+    conn = connection(cur)
+    rejects = RejectReport()
+    result = bulk_load(data(), conn, rejects=rejects)
+    assert cur.copied['"bulk_rating_stage_42"'].splitlines()[1] == \
+        "2025-01-13T09:00:00+00:00,9,3"
+    assert len(cur.copied['"bulk_request_stage_42"'].splitlines()) == 1
+    assert sum("CREATE UNLOGGED TABLE" in s for s in cur.statements) == 2
+    assert rejects.counts == {"unknown_exhibition": 2}
+    assert rejects.messages["unknown_exhibition"] == \
+        "exhibition_id 9 not in exhibition"
+    assert result["rows_staged"] == 4
+    assert result["rows_loaded"] == 3
+    assert result["rows_rejected"] == 2
+    assert set(result["phases"]) == set(PHASES)
+    assert not any(s.startswith(("ALTER", "DROP INDEX"))
+                   for s in cur.statements)
+    assert "write_watermark" in cur.statements[-3]
+    assert cur.statements[-2:] == ['DROP TABLE "bulk_rating_stage_42";',
+                                   'DROP TABLE "bulk_request_stage_42";']
+    conn.commit.assert_called_once()
+
+
+def test_bulk_load_drops_and_rebuilds_indexes():
+    cur = FakeCursor({
+        "pg_get_indexdef": [("rating_interaction_at", "CREATE INDEX "
+                             "rating_interaction_at ON rating_interaction "
+                             "USING btree (event_at)")],
+        "pg_get_constraintdef": [("fk_exhibition", "FOREIGN KEY "
+                                  "(exhibition_id) REFERENCES "
+                                  "exhibition(exhibition_id)")]})
+    result = bulk_load({"rating": data()["rating"]}, connection(cur),
+                       drop_indexes=True)
+    ddl = [s.strip() for s in cur.statements if s.strip().startswith(
+        ("ALTER", "DROP INDEX", "CREATE INDEX", "INSERT"))]
+    assert ddl[:2] == [
+        'ALTER TABLE "rating_interaction" DROP CONSTRAINT "fk_exhibition";',
+        "DROP INDEX rating_interaction_at;"]
+    assert ddl[2].startswith('INSERT INTO "rating_interaction"')
+    assert ddl[4] == "CREATE INDEX rating_interaction_at ON " \
+        "rating_interaction USING btree (event_at);"
+    assert ddl[5].startswith('ALTER TABLE "rating_interaction" ADD '
+                             'CONSTRAINT "fk_exhibition" FOREIGN KEY')
+    assert result["rebuilt"] == {"indexes": ["rating_interaction_at"],
+                                 "foreign_keys": ["fk_exhibition"]}
+
+
+def test_bulk_load_rolls_back_on_failure():
+    cur = FakeCursor({"FAIL": "INSERT INTO"})
+    conn = connection(cur)
+    with pytest.raises(RuntimeError):
+        bulk_load(data(), conn)
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+
+def test_bulk_load_of_nothing_only_commits():
+    cur = FakeCursor()
+    conn = connection(cur)
+    result = bulk_load({"rating": [], "request": []}, conn)
+    assert cur.statements == ["SELECT pg_backend_pid();"]
+    assert result["rows_loaded"] == 0
+    conn.commit.assert_called_once()
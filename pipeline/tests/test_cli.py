@@ -0,0 +1,104 @@
+#pylint: skip-file
+import subprocess
+import sys
+from time import perf_counter
+from unittest.mock import patch
+
+import pytest
+
+from museum_pipeline.cli import get_parser, main
+
+BACKENDS = ("boto3", "psycopg2", "confluent_kafka", "dotenv")
+# Generous enough for a slow CI runner; the backends alone take longer.
+STARTUP_BUDGET_SECONDS = 1.0
+
+
+def test_cli_import_does_not_load_backends():
+    code = ("import sys, museum_pipeline.cli; "
+            f"print([m for m in {BACKENDS!r} if m in sys.modules])")
+    out = subprocess.run([sys.executable, "-c", code], check=True,
+                         capture_output=True, text=True).stdout
+    assert out.strip() == "[]"
+
+
+def test_cli_help_startup_time():
+    started = perf_counter()
+    subprocess.run([sys.executable, "-m", "museum_pipeline.cli", "--help"],
+                   check=True, capture_output=True)
+    assert perf_counter() - started < STARTUP_BUDGET_SECONDS
+
+
+def test_batch_flags_are_normalised():
+    args = get_parser().parse_args(["batch", "-stdout", "true",
+                                    "-file", "false"])
+    assert args.stdout == "true"
+    with patch("museum_pipeline.pipeline.main") as mock_main:
+        args.func(args)
+    called = mock_main.call_args.args[0]
+    assert called.stdout is True
+    assert called.file is False
+
+
+def test_batch_patterns_are_parsed():
+    args = get_parser().parse_args(["batch", "-museums", "lmnh", "lms",
+                                    "-pattern", r"lms=lms/.*\.csv"])
+    with patch("museum_pipeline.pipeline.main") as mock_main:
+        args.func(args)
+    called = mock_main.call_args.args[0]
+    assert called.museums == ["lmnh", "lms"]
+    assert called.patterns == {"lms": r"lms/.*\.csv"}
+
+
+def test_batch_drop_indexes_implies_bulk():
+    args = get_parser().parse_args(["batch", "-drop_indexes"])
+    with patch("museum_pipeline.pipeline.main") as mock_main:
+        args.func(args)
+    called = mock_main.call_args.args[0]
+    assert called.bulk is True
+    assert called.drop_indexes is True
+
+
+def test_sinks_are_parsed_for_each_pipeline():
+    parser = get_parser()
+    assert parser.parse_args(["batch"]).sink == ["postgres"]
+    args = parser.parse_args(["consume", "lmnh", "-sink", "postgres",
+                              "parquet", "-sink_dir", "out"])
+    assert args.sink == ["postgres", "parquet"]
+    assert args.sink_dir == "out"
+    assert parser.parse_args(["playback", "lms", "rec", "-sink",
+                              "null"]).sink == ["null"]
+    with pytest.raises(SystemExit):
+        parser.parse_args(["batch", "-sink", "csv"])
+
+
+def test_batch_rejects_bad_pattern():
+    with pytest.raises(SystemExit):
+        get_parser().parse_args(["batch", "-pattern", "louvre=.*"])
+
+
+def test_ingest_dispatches_each_action():
+    with patch("museum_pipeline.work_queue.enqueue_main") as enqueue, \
+            patch("museum_pipeline.work_queue.work_main") as work:
+        main(["ingest", "enqueue", "-pattern", "lms=lms/.*"])
+        main(["ingest", "work", "-processes", "3"])
+    assert enqueue.call_args.args[0].patterns == {"lms": "lms/.*"}
+    assert work.call_args.args[0].processes == 3
+
+
+def test_replay_requires_start():
+    with pytest.raises(SystemExit):
+        main(["replay", "lmnh"])
+
+
+def test_consume_dispatches_to_run_pipeline():
+    with patch("museum_pipeline.kafka_pipeline.run_pipeline") as mock_run:
+        main(["consume", "lms", "-store"])
+    museum, start, end, args = mock_run.call_args.args
+    assert museum == "lms"
+    assert start < end
+    assert args.store
+
+
+def test_benchmark_prints_results(capsys):
+    main(["benchmark", "transform", "-rows", "100"])
+    assert '"stage": "transform"' in capsys.readouterr().out
@@ -0,0 +1,86 @@
+#pylint: skip-file
+import calendar
+import csv
+import datetime
+import math
+
+import pytest
+
+from museum_pipeline.columnar import load_csv_columns
+from museum_pipeline.benchmark import generate_csv_rows
+
+
+def _write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return str(path)
+
+
+def _epoch(at):
+    return calendar.timegm(
+        datetime.datetime.strptime(at, "%Y-%m-%d %H:%M:%S").timetuple())
+
+
+def test_columns_are_typed(tmp_path):
+    filepath = _write(tmp_path / "a.csv", "at,site,val,type\n"
+                      "2023-03-06 15:09:21,4,0,\n"
+                      "2023-03-06 15:09:22,3,-1,1.0\n")
+    columns, rejected = load_csv_columns(filepath)
+    assert rejected == 0
+    assert list(columns["at"]) == [_epoch("2023-03-06 15:09:21"),
+                                   _epoch("2023-03-06 15:09:22")]
+    assert list(columns["site"]) == [4, 3]
+    assert list(columns["val"]) == [0, -1]
+    assert math.isnan(columns["type"][0])
+    assert columns["type"][1] == 1.0
+
+
+def test_trailing_partial_line(tmp_path):
+    filepath = _write(tmp_path / "a.csv", "at,site,val,type\n"
+                      "2023-03-06 15:09:21,4,0,\n"
+                      "2023-03-06 15:09:22,3,2,")
+    columns, rejected = load_csv_columns(filepath)
+    assert list(columns["val"]) == [0, 2]
+
+
+def test_quoted_fields_and_header_order(tmp_path):
+    filepath = _write(tmp_path / "a.csv", 'site,at,type,val\n'
+                      '"4","2023-03-06 15:09:21","",0\n'
+                      '3,2023-03-06 15:09:22,"1.0","-1"\n')
+    columns, rejected = load_csv_columns(filepath)
+    assert rejected == 0
+    assert list(columns["site"]) == [4, 3]
+    assert list(columns["val"]) == [0, -1]
+
+
+def test_bad_rows_are_counted(tmp_path):
+    filepath = _write(tmp_path / "a.csv", "at,site,val,type\n"
+                      "2023-03-06 15:09:21,4,0,\n"
+                      "foo,4,0,\n"
+                      "2023-03-06 15:09:21,four,0,\n"
+                      "2023-03-06 15:09:21,4\n")
+    columns, rejected = load_csv_columns(filepath)
+    assert rejected == 3
+    assert len(columns["at"]) == 1
+
+
+def test_empty_file(tmp_path):
+    columns, rejected = load_csv_columns(_write(tmp_path / "a.csv", ""))
+    assert len(columns["at"]) == 0
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_matches_dictreader(tmp_path, workers):
+    rows = generate_csv_rows(5000)
+    filepath = str(tmp_path / "a.csv")
+    with open(filepath, "w", encoding="utf-8", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=["at", "site", "val", "type"])
+        writer.writeheader()
+        writer.writerows(rows)
+    columns, rejected = load_csv_columns(filepath, workers,
+                                         min_parallel_bytes=0)
+    assert rejected == 0
+    assert list(columns["at"]) == [_epoch(r["at"]) for r in rows]
+    assert list(columns["site"]) == [int(r["site"]) for r in rows]
+    assert list(columns["val"]) == [int(r["val"]) for r in rows]
+    assert [math.isnan(t) for t in columns["type"]] == [
+        r["type"] == "" for r in rows]
@@ -0,0 +1,171 @@
+#pylint: skip-file
+import csv
+import datetime
+import gzip
+import shutil
+from unittest.mock import MagicMock
+
+import pytest
+from psycopg2 import sql
+
+from museum_pipeline.compaction import compact, compact_table
+from museum_pipeline.metrics import METRICS
+
+UTC = datetime.timezone.utc
+AT = datetime.datetime(2025, 1, 13, 9, 30, tzinfo=UTC)
+
+
+def render(query):
+    if isinstance(query, sql.Composed):
+        return "".join(render(q) for q in query.seq)
+    if isinstance(query, sql.Identifier):
+        return ".".join(f'"{s}"' for s in query.strings)
+    return query.string
+
+
+class RawTable:
+    """Raw interaction rows behind a mock cursor, moved by the DELETE"""
+
+    def __init__(self, count):
+        self.rows = [(i, AT + datetime.timedelta(hours=i), 1, 3)
+                     for i in range(count)]
+        self.moved = []
+        self.statements = []
+        self.cur = MagicMock()
+        self.cur.execute.side_effect = self.execute
+        self.selected = []
+        self.cur.fetchall.side_effect = lambda: self.selected
+
+    def execute(self, query, params):
+        query = render(query)
+        self.statements.append(query)
+        if query.startswith("SELECT"):
+            cutoff, limit = params
+            self.selected = [row for row in self.rows
+                             if row[1] < cutoff][:limit]
+        else:
+            [ids] = params
+            self.moved.append(ids)
+            self.rows = [row for row in self.rows if row[0] not in ids]
+
+
+def conn_for(table):
+    conn = MagicMock()
+    conn.cursor.return_value = table.cur
+    return conn
+
+
+def test_moves_old_rows_in_bounded_batches():
+    table = RawTable(10)
+    conn = conn_for(table)
+    before = METRICS.get("compaction_rating_rows_total")
+    result = compact_table(conn, "rating", AT + datetime.timedelta(hours=7),
+                           batch_size=3)
+    assert result["rows_moved"] == 7
+    assert result["batches"] == 3
+    assert table.moved == [[0, 1, 2], [3, 4, 5], [6]]
+    assert [row[0] for row in table.rows] == [7, 8, 9]
+    assert conn.commit.call_count == 3
+    assert METRICS.get("compaction_rating_rows_total") - before == 7
+    assert "FOR UPDATE SKIP LOCKED" in table.statements[0]
+    assert '"rating_hourly"' in table.statements[1]
+
+
+def test_archives_rows_before_moving_them(tmp_path):
+    table = RawTable(30)
+    compact_table(conn_for(table), "request",
+                  AT + datetime.timedelta(hours=20), batch_size=8,
+                  archive_dir=str(tmp_path))
+    archived = {}
+    for day in sorted((tmp_path / "request").iterdir()):
+        with gzip.open(day, "rt", encoding="utf-8") as fp:
+            archived[day.name] = list(csv.reader(fp))
+    assert list(archived) == ["2025-01-13.csv.gz", "2025-01-14.csv.gz"]
+    assert sum(len(rows) for rows in archived.values()) == 20
+    assert archived["2025-01-13.csv.gz"][0] == [AT.isoformat(), "1", "3"]
+
+
+def test_failed_batch_is_rolled_back():
+    table = RawTable(5)
+    conn = conn_for(table)
+    table.cur.execute.side_effect = [None, RuntimeError("down")]
+    table.selected = table.rows
+    with pytest.raises(RuntimeError):
+        compact_table(conn, "rating", AT + datetime.timedelta(days=1))
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+
+def test_rows_are_archived_before_they_are_deleted(tmp_path):
+    table = RawTable(5)
+    conn = conn_for(table)
+    archived = []
+
+    def execute(query, params):
+        if render(query).startswith("SELECT"):
+            return table.execute(query, params)
+        archived.extend((tmp_path / "rating").iterdir())
+        raise RuntimeError("down")
+    table.cur.execute.side_effect = execute
+    with pytest.raises(RuntimeError):
+        compact_table(conn, "rating", AT + datetime.timedelta(days=1),
+                      archive_dir=str(tmp_path))
+    assert [day.name for day in archived] == ["2025-01-13.csv.gz"]
+    conn.commit.assert_not_called()
+
+
+def test_unwritable_archive_rolls_the_batch_back(tmp_path):
+    table = RawTable(5)
+    conn = conn_for(table)
+    (tmp_path / "rating").write_text("not a directory")
+    with pytest.raises(OSError):
+        compact_table(conn, "rating", AT + datetime.timedelta(days=1),
+                      archive_dir=str(tmp_path))
+    assert table.moved == []
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+
+def test_compact_covers_every_table_from_one_cutoff():
+    table = RawTable(0)
+    result = compact(conn_for(table), datetime.timedelta(days=90),
+                     now=AT)
+    assert result["cutoff"] == (AT - datetime.timedelta(days=90)).isoformat()
+    assert [t["table"] for t in result["tables"]] == ["rating", "request"]
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_reports_are_unchanged_by_compaction():
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres
+    from museum_pipeline.reporting import Reporter, TTLCache
+
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        cur = conn.cursor()
+        for i in range(200):
+            at = AT + datetime.timedelta(minutes=7 * i)
+            cur.execute("INSERT INTO rating_interaction (exhibition_id, "
+                        "rating_id, event_at) VALUES (%s, %s, %s);",
+                        (1 + i % 3, 1 + i % 5, at))
+            cur.execute("INSERT INTO request_interaction (exhibition_id, "
+                        "request_id, event_at) VALUES (%s, %s, %s);",
+                        (1 + i % 3, 1 + i % 2, at))
+        conn.commit()
+        reports = ("avg_exh_rating", "num_requests", "request_over_time")
+
+        def answers():
+            reporter = Reporter(get_env_conn, TTLCache(1, 0.0), 0.0)
+            return {name: reporter.report(name, None, None, None)
+                    for name in reports}
+
+        before = answers()
+        compact(conn, datetime.timedelta(hours=6),
+                now=AT + datetime.timedelta(hours=18), batch_size=50)
+        cur.execute("SELECT COUNT(*) FROM rating_interaction;")
+        remaining = cur.fetchone()[0]
+        conn.close()
+        after = answers()
+    assert 0 < remaining < 200
+    assert after == before
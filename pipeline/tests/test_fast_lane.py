@@ -0,0 +1,70 @@
+#pylint: skip-file
+import datetime
+import json
+import threading
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+
+from museum_pipeline.fast_lane import EmergencyLane, command_hook
+from museum_pipeline.metrics import METRICS
+
+ID_DICT = {"rating": {2: 4}, "exhibition": {1: 3}, "request": {0: 1, 1: 2}}
+AT = datetime.datetime(2025, 1, 13, 9, tzinfo=datetime.timezone.utc)
+
+
+def message(value_id=2, table="request"):
+    return {"table": table, "value_id": value_id, "exhibition_id": 3,
+            "event_at": AT}
+
+
+def test_accepts_only_emergencies():
+    lane = EmergencyLane(MagicMock(), ID_DICT, MagicMock())
+    assert lane.accepts(message())
+    assert not lane.accepts(message(value_id=1))
+    assert not lane.accepts(message(table="rating"))
+
+
+@patch("museum_pipeline.fast_lane.ROW_WRITER")
+def test_writes_on_its_own_connection_and_notifies(writer):
+    conn = MagicMock(closed=False)
+    connect = MagicMock(return_value=conn)
+    notify = MagicMock()
+    lane = EmergencyLane(connect, ID_DICT, MagicMock(), notify)
+    assert lane(message(), lag=0.5)
+    assert lane(message())
+    connect.assert_called_once()
+    assert writer.write.call_args.args == (conn, [message()])
+    assert notify.call_count == 2
+    report = lane.report()
+    assert report["rows"] == 2
+    assert report["latency_ms"]["max"] >= 500
+    assert METRICS.get("emergency_write_ms_max") == report["write_ms"]["max"]
+
+
+@patch("museum_pipeline.fast_lane.ROW_WRITER")
+def test_failed_write_hands_the_row_back(writer):
+    writer.write.side_effect = psycopg2.OperationalError("down")
+    conn = MagicMock(closed=False)
+    conn.rollback.side_effect = psycopg2.InterfaceError("closed")
+    conn.close.side_effect = lambda: setattr(conn, "closed", True)
+    notify = MagicMock()
+    lane = EmergencyLane(MagicMock(return_value=conn), ID_DICT, MagicMock(),
+                         notify)
+    assert not lane(message())
+    assert lane.conn is None
+    assert lane.rows == 0
+    notify.assert_not_called()
+
+
+def test_command_hook_pipes_the_row(tmp_path):
+    out = tmp_path / "out.json"
+    logger = MagicMock()
+    before = set(threading.enumerate())
+    command_hook(f"sh -c 'cat > {out}'", logger)(message())
+    for thread in set(threading.enumerate()) - before:
+        thread.join(5)
+    assert json.loads(out.read_text()) == {
+        "event_at": "2025-01-13T09:00:00+00:00", "exhibition_id": 3,
+        "request_id": 2}
+    logger.error.assert_not_called()
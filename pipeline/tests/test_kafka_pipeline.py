@@ -1,11 +1,21 @@
 #pylint: skip-file
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import datetime
+import time
 
 import pytest
 
+from confluent_kafka import KafkaError, TopicPartition, TIMESTAMP_CREATE_TIME
+
+from museum_pipeline.load import upload_messages
+from museum_pipeline.offsets import OffsetConflict
+from museum_pipeline.spool import SpoolFull
 from museum_pipeline.kafka_pipeline import (process_val, process_site,
-                                            process_at, upload_message)
+                                            process_at, upload_message,
+                                            consume_messages,
+                                            parse_replay_bound,
+                                            _resolve_offsets, _write_batch,
+                                            run_replay)
 
 
 def test_process_val_good():
@@ -122,29 +132,315 @@ def test_upload_message_bad_table():
     assert e.value.args[0] == "INVALID: Table name not recognised."
 
 
+def writer_calls(mock_con):
+    """Returns the SQL and params of each statement after the PREPAREs"""
+    calls = mock_con.cursor.return_value.execute.call_args_list
+    return [c.args for c in calls
+            if not c.args[0].startswith(("SELECT name", "PREPARE"))]
+
+
+AT = datetime.datetime(2025, 1, 13, 9, tzinfo=datetime.timezone.utc)
+
+
 def test_upload_message_request():
     mock_con = MagicMock()
-    mock_cur = MagicMock()
-    mock_con.cur.return_value = mock_cur
-    upload_message({"table": "request"}, mock_con)
-    assert mock_cur.execute.calledwith("""
-            INSERT INTO request_interaction
-                (event_at, request_id, exhibition_id)
-            VALUES
-                (%(event_at)s, %(value_id)s, %(exhibition_id)s)
-            ;
-            """, {"table": "request"})
+    upload_message({"table": "request", "event_at": AT, "exhibition_id": 3,
+                    "value_id": 2}, mock_con)
+    (sql, params), (bump_sql, bump_params) = writer_calls(mock_con)
+    assert sql == "EXECUTE mp_insert_request_row (%s, %s, %s);"
+    assert params == (AT, 3, 2)
+    assert "mp_bump_watermarks" in bump_sql
+    assert mock_con.commit.call_count == 1
 
 
 def test_upload_message_rating():
     mock_con = MagicMock()
-    mock_cur = MagicMock()
-    mock_con.cur.return_value = mock_cur
-    upload_message({"table": "rating"}, mock_con)
-    assert mock_cur.execute.calledwith("""
-            INSERT INTO rating_interaction
-                (event_at, rating_id, exhibition_id)
-            VALUES
-                (%(event_at)s, %(value_id)s, %(exhibition_id)s)
-            ;
-            """, {"table": "rating"})
+    upload_message({"table": "rating", "event_at": AT, "exhibition_id": 3,
+                    "value_id": 4}, mock_con)
+    (sql, params), _ = writer_calls(mock_con)
+    assert sql == "EXECUTE mp_insert_rating_row (%s, %s, %s);"
+    assert params == (AT, 3, 4)
+
+
+def test_upload_messages_bad_table():
+    with pytest.raises(ValueError) as e:
+        upload_messages([{"table": "rating"}, {}], MagicMock())
+    assert e.value.args[0] == "INVALID: Table name not recognised."
+
+
+def test_upload_messages_commits_once():
+    mock_con = MagicMock()
+    messages = [{"table": "rating", "exhibition_id": 1, "event_at": AT,
+                 "value_id": 4},
+                {"table": "request", "exhibition_id": 2, "event_at": AT,
+                 "value_id": 1},
+                {"table": "rating", "exhibition_id": 1, "event_at": AT,
+                 "value_id": 5}]
+    assert upload_messages(messages, mock_con) == 3
+    assert mock_con.commit.call_count == 1
+    [(sql, params)] = writer_calls(mock_con)
+    assert sql.count("EXECUTE") == 3
+    assert "mp_bump_watermarks" in sql
+    assert params == ([AT, AT], [1, 1], [4, 5], [AT], [2], [1], [1, 2],
+                      [2, 1])
+
+
+def test_parse_replay_bound_offset():
+    assert parse_replay_bound("1234") == ("offset", 1234)
+
+
+def test_parse_replay_bound_timestamp():
+    assert parse_replay_bound("2025-01-13T00:00:00+00:00") == (
+        "timestamp", 1736726400000)
+
+
+def test_parse_replay_bound_naive_is_utc():
+    assert parse_replay_bound("2025-01-13") == ("timestamp", 1736726400000)
+
+
+def test_parse_replay_bound_bad():
+    with pytest.raises(ValueError):
+        parse_replay_bound("yesterday")
+
+
+def test_resolve_offsets_clamps_offsets():
+    consumer = MagicMock()
+    consumer.get_watermark_offsets.side_effect = [(10, 50), (0, 5)]
+    assert _resolve_offsets(consumer, "lmnh", ("offset", 20), [0, 1]) == {
+        0: 20, 1: 5}
+
+
+def test_resolve_offsets_timestamp_past_end():
+    consumer = MagicMock()
+    consumer.get_watermark_offsets.side_effect = [(0, 50), (0, 5)]
+    consumer.offsets_for_times.return_value = [
+        TopicPartition("lmnh", 0, 42), TopicPartition("lmnh", 1, -1)]
+    assert _resolve_offsets(consumer, "lmnh", ("timestamp", 1), [0, 1]) == {
+        0: 42, 1: 5}
+
+
+def _kafka_message(value, offset=0):
+    msg = MagicMock()
+    msg.error.return_value = None
+    msg.value.return_value = value
+    msg.topic.return_value = "lmnh"
+    msg.partition.return_value = 0
+    msg.offset.return_value = offset
+    return msg
+
+
+GOOD_MESSAGE = b'{"at": "2025-01-13T09:23:20+00:00", "site": "1", "val": 2}'
+ID_DICT = {"rating": {2: 4}, "exhibition": {1: 3}}
+OPEN, CLOSE = datetime.time(hour=8), datetime.time(hour=18)
+
+
+def _replay(consumer, sink):
+    with patch("museum_pipeline.kafka_pipeline.get_replay_consumer",
+               return_value=(consumer, {0: 5})), \
+            patch("museum_pipeline.kafka_pipeline.get_env_conn"), \
+            patch("museum_pipeline.kafka_pipeline.load_id_dict",
+                  return_value=ID_DICT), \
+            patch("museum_pipeline.kafka_pipeline.open_sink",
+                  return_value=sink):
+        return run_replay("lmnh", OPEN, CLOSE, "0", "5", MagicMock())
+
+
+def test_replay_ends_at_a_gap_before_the_end_offset():
+    consumer = MagicMock()
+    # Offset 4 is a transaction marker, never delivered.
+    consumer.consume.side_effect = [
+        [_kafka_message(GOOD_MESSAGE, i) for i in range(4)], []]
+    consumer.position.side_effect = [[TopicPartition("lmnh", 0, 4)],
+                                     [TopicPartition("lmnh", 0, 5)]]
+    sink = MagicMock(return_value=4)
+    assert _replay(consumer, sink)["rows"] == 4
+    assert consumer.consume.call_count == 2
+    assert len(sink.call_args.args[0]) == 4
+
+
+def test_replay_ends_on_partition_eof():
+    eof = MagicMock()
+    eof.error.return_value = KafkaError(KafkaError._PARTITION_EOF)
+    eof.partition.return_value = 0
+    consumer = MagicMock()
+    consumer.consume.side_effect = [[_kafka_message(GOOD_MESSAGE, 2), eof]]
+    consumer.position.return_value = [TopicPartition("lmnh", 0, 3)]
+    sink = MagicMock(return_value=1)
+    assert _replay(consumer, sink)["rows"] == 1
+    assert consumer.consume.call_count == 1
+
+
+def test_consume_messages_batches_and_counts():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_kafka_message(GOOD_MESSAGE, 0),
+                                 _kafka_message(b'{}', 1),
+                                 _kafka_message(GOOD_MESSAGE, 2)]
+    write = MagicMock()
+    processed = MagicMock(value=0)
+    polls = iter([False, False, False, True])
+    consume_messages(consumer, write, ID_DICT, OPEN, CLOSE, MagicMock(),
+                     should_stop=lambda: next(polls), processed=processed,
+                     batch_size=10, flush_interval=60)
+    assert consumer.poll.call_count == 3
+    assert write.call_count == 1
+    assert len(write.call_args.args[0]) == 2
+    assert processed.value == 2
+    stored = consumer.store_offsets.call_args.kwargs["offsets"]
+    assert [(tp.partition, tp.offset) for tp in stored] == [(0, 3)]
+
+
+def test_consume_messages_reports_to_tuner():
+    consumer = MagicMock()
+    msg = _kafka_message(GOOD_MESSAGE, 0)
+    msg.timestamp.return_value = (TIMESTAMP_CREATE_TIME,
+                                  (time.time() - 30) * 1000)
+    consumer.poll.side_effect = [msg]
+    tuner = MagicMock(batch_size=1, flush_interval=60)
+    polls = iter([False, True])
+    consume_messages(consumer, MagicMock(return_value="db"), ID_DICT, OPEN,
+                     CLOSE, MagicMock(), should_stop=lambda: next(polls),
+                     tuner=tuner)
+    rows, seconds, lag = tuner.observe.call_args.args
+    assert rows == 1
+    assert seconds is not None
+    assert 29 < lag < 31
+
+
+def test_consume_messages_offsets_wait_for_write():
+    consumer = MagicMock()
+    consumer.poll.return_value = _kafka_message(GOOD_MESSAGE)
+    write = MagicMock(side_effect=RuntimeError("db down"))
+    with pytest.raises(RuntimeError):
+        consume_messages(consumer, write, ID_DICT, OPEN, CLOSE, MagicMock(),
+                         batch_size=1)
+    assert not consumer.store_offsets.called
+
+
+def test_consume_messages_pauses_when_spool_full():
+    consumer = MagicMock()
+    consumer.poll.return_value = _kafka_message(GOOD_MESSAGE)
+    write = MagicMock(side_effect=[SpoolFull("full"), None])
+    polls = iter([False, True])
+    consume_messages(consumer, write, ID_DICT, OPEN, CLOSE, MagicMock(),
+                     should_stop=lambda: next(polls), batch_size=1)
+    assert consumer.pause.called
+    assert consumer.resume.called
+    assert write.call_count == 2
+
+
+def test_messages_polled_while_paused_are_sought_back_to():
+    consumer = MagicMock()
+    # A rebalance assigns partition 0 while the batch waits on the spool.
+    consumer.poll.side_effect = [None, _kafka_message(GOOD_MESSAGE, 7)]
+    write = MagicMock(side_effect=[SpoolFull("full"), SpoolFull("full"),
+                                   "db"])
+    assert _write_batch(consumer, write, [{}], MagicMock()) == "db"
+    assert consumer.pause.call_count == 2
+    [seek] = consumer.seek.call_args_list
+    tp = seek.args[0]
+    assert (tp.topic, tp.partition, tp.offset) == ("lmnh", 0, 7)
+    consumer.resume.assert_called_once()
+
+
+def test_held_partitions_stay_paused_after_a_write():
+    consumer = MagicMock()
+    consumer.assignment.return_value = [TopicPartition("lmnh", 0),
+                                        TopicPartition("lmnh", 1)]
+    consumer.poll.return_value = None
+    write = MagicMock(side_effect=[SpoolFull("full"), "db"])
+    _write_batch(consumer, write, [{}], MagicMock(), (("lmnh", 1),))
+    [resumed] = consumer.resume.call_args.args
+    assert [tp.partition for tp in resumed] == [0]
+
+
+EMERGENCY_MESSAGE = b'{"at": "2025-01-13T09:23:20+00:00", "site": "1", ' \
+    b'"val": -1, "type": 1}'
+
+
+def _emergency(offset):
+    msg = _kafka_message(EMERGENCY_MESSAGE, offset)
+    msg.timestamp.return_value = (TIMESTAMP_CREATE_TIME, time.time() * 1000)
+    return msg
+
+
+def test_consume_messages_sends_emergencies_down_the_fast_lane():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_kafka_message(GOOD_MESSAGE, 0),
+                                 _emergency(1)]
+    write = MagicMock()
+    fast_lane = MagicMock(return_value=True)
+    fast_lane.accepts.side_effect = lambda m: m["table"] == "request"
+    polls = iter([False, False, True])
+    consume_messages(consumer, write, {**ID_DICT, "request": {1: 2}}, OPEN,
+                     CLOSE, MagicMock(), should_stop=lambda: next(polls),
+                     batch_size=10, flush_interval=60, fast_lane=fast_lane)
+    assert fast_lane.call_args.args[0]["value_id"] == 2
+    assert [m["table"] for m in write.call_args.args[0]] == ["rating"]
+    stored = consumer.store_offsets.call_args.kwargs["offsets"]
+    assert [(tp.partition, tp.offset) for tp in stored] == [(0, 2)]
+
+
+def test_consume_messages_flushes_a_failed_emergency_at_once():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_emergency(0)]
+    write = MagicMock()
+    fast_lane = MagicMock(return_value=False)
+    fast_lane.accepts.return_value = True
+    polls = iter([False, True])
+    consume_messages(consumer, write, {**ID_DICT, "request": {1: 2}}, OPEN,
+                     CLOSE, MagicMock(), should_stop=lambda: next(polls),
+                     batch_size=10, flush_interval=60, fast_lane=fast_lane)
+    assert write.call_count == 1
+    assert write.call_args.args[0][0]["value_id"] == 2
+
+
+def test_consume_messages_exactly_once_writes_offsets_with_rows():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_kafka_message(b'{}', 7)]
+    write = MagicMock(return_value="db")
+    polls = iter([False, True])
+    consume_messages(consumer, write, ID_DICT, OPEN, CLOSE, MagicMock(),
+                     should_stop=lambda: next(polls), exactly_once=True)
+    assert write.call_args.args == ([],)
+    assert write.call_args.kwargs == {"offsets": {("lmnh", 0): 8}}
+    assert not consumer.store_offsets.called
+
+
+def test_exactly_once_flushes_emergencies_without_a_fast_lane():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_kafka_message(GOOD_MESSAGE, 0),
+                                 _emergency(1)]
+    write = MagicMock(return_value="db")
+    consume_messages(consumer, write, {**ID_DICT, "request": {1: 2}}, OPEN,
+                     CLOSE, MagicMock(), should_stop=lambda: write.called,
+                     batch_size=10, flush_interval=60, exactly_once=True)
+    [flush] = write.call_args_list
+    assert len(flush.args[0]) == 2
+    assert flush.kwargs == {"offsets": {("lmnh", 0): 2}}
+
+
+def test_consume_messages_drops_a_batch_on_offset_conflict():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_kafka_message(GOOD_MESSAGE, 0)]
+    write = MagicMock(side_effect=OffsetConflict("moved"))
+    processed = MagicMock(value=0)
+    logger = MagicMock()
+    polls = iter([False, True])
+    consume_messages(consumer, write, ID_DICT, OPEN, CLOSE, logger,
+                     should_stop=lambda: next(polls), processed=processed,
+                     exactly_once=True)
+    assert processed.value == 0
+    logger.warning.assert_called_once_with("moved")
+
+
+def test_consume_messages_sketches_valid_messages():
+    consumer = MagicMock()
+    consumer.poll.side_effect = [_kafka_message(GOOD_MESSAGE, 0),
+                                 _kafka_message(b'{}', 1)]
+    sketches = MagicMock()
+    polls = iter([False, False, True])
+    consume_messages(consumer, MagicMock(), ID_DICT, OPEN, CLOSE, MagicMock(),
+                     should_stop=lambda: next(polls), sketches=sketches)
+    assert sketches.observe.call_count == 1
+    assert sketches.observe.call_args.args[0]["value_id"] == 4
+    sketches.flush.assert_called_once()
@@ -0,0 +1,219 @@
+#pylint: skip-file
+import datetime
+import shutil
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+import pytest
+
+from museum_pipeline.limiter import (_ADJUST, _FACTOR, _RESERVE, BACKFILL,
+                                     LIVE, WriteLimiter, debt_wait, limited,
+                                     paced_wait)
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.writer import ROW_WRITER, InteractionWriter
+
+AT = datetime.datetime(2025, 1, 13, 9)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def limiter_on(results, pipeline_class=BACKFILL):
+    """A started limiter whose cursor returns results, one per fetchone"""
+    conn = MagicMock(closed=False)
+    cur = conn.cursor.return_value
+    cur.fetchone.side_effect = results
+    clock = Clock()
+    limiter = WriteLimiter(clock=clock, pause=MagicMock())
+    limiter.start(MagicMock(return_value=conn), pipeline_class)
+    return limiter, cur, clock
+
+
+def test_debt_is_repaid_at_the_slower_rate():
+    assert debt_wait(10, 2, 100, 5) == 0
+    assert debt_wait(-500, 0, 1000, 5) == 0.5
+    assert debt_wait(-500, -3, 1000, 2) == 1.5
+    assert debt_wait(-500, -3, None, None) == 0
+
+
+def test_unstarted_or_unlimited_classes_cost_no_round_trips():
+    assert WriteLimiter().acquire(100) == 0.0
+    limiter, cur, clock = limiter_on([(None, None, None)])
+    for _ in range(3):
+        assert limiter.acquire(100) == 0.0
+    assert cur.execute.call_count == 1
+    clock.now = 5.0
+    cur.fetchone.side_effect = [None]
+    limiter.acquire(100)
+    assert cur.execute.call_count == 2
+
+
+def test_paced_writers_run_at_the_rate_factor():
+    assert paced_wait(0.2, 1.0) == 0
+    assert paced_wait(0.2, 0.5) == pytest.approx(0.2)
+    assert paced_wait(0.2, 0.25) == pytest.approx(0.6)
+
+
+def test_backfills_yield_to_the_live_latency_without_rates():
+    limiter, cur, clock = limiter_on([
+        (None, None, 250.0),
+        (0.5, 400.0),
+        None, (0.25,)])
+    assert limiter.acquire(100) == 0.0
+    limiter.observe(0.2)
+    clock.now = 1.0
+    assert limiter.acquire(100) == pytest.approx(0.2)
+    limiter.observe(0.4)
+    clock.now = 2.0
+    assert limiter.acquire(100) == pytest.approx(0.6)
+    queries = [c.args[0] for c in cur.execute.call_args_list]
+    assert queries[1:] == [_ADJUST, _ADJUST, _FACTOR]
+    assert METRICS.get("write_limit_backfill_rate_factor") == 0.25
+
+
+def test_writes_sleep_off_the_bucket_debt():
+    limiter, cur, clock = limiter_on([
+        (1000.0, None, None),
+        (-250.0, 0.0, 500.0, None, 0.5)])
+    before = METRICS.get("write_limit_backfill_wait_seconds_total")
+    assert limiter.acquire(750) == 0.5
+    limiter.pause.assert_called_once_with(0.5)
+    reserve = cur.execute.call_args_list[-1]
+    assert reserve.args[1] == {"rows": 750, "class": BACKFILL}
+    assert METRICS.get("write_limit_backfill_rate_factor") == 0.5
+    assert METRICS.get("write_limit_backfill_wait_seconds_total") \
+        - before == 0.5
+    assert limiter.state()["throttled_seconds"] == 0.5
+
+
+def test_backfills_adjust_to_the_live_latency_once_per_interval():
+    limiter, cur, clock = limiter_on([
+        (1000.0, None, 250.0),
+        (0.25, 900.0), (10.0, 0.0, 250.0, None, 0.25),
+        (10.0, 0.0, 250.0, None, 0.25),
+        (0.5, 100.0), (10.0, 0.0, 500.0, None, 0.5)])
+    limiter.acquire(10)
+    clock.now = 1.0
+    limiter.acquire(10)
+    clock.now = 2.0
+    limiter.acquire(10)
+    queries = [c.args[0] for c in cur.execute.call_args_list]
+    assert queries[1:] == [_ADJUST, _RESERVE, _RESERVE, _ADJUST, _RESERVE]
+    adjust = cur.execute.call_args_list[1].args[1]
+    assert (adjust["class"], adjust["live"]) == (BACKFILL, LIVE)
+    assert METRICS.get("write_limit_live_commit_p99_ms") == 100.0
+
+
+def test_unreachable_limits_let_writes_through():
+    connect = MagicMock(side_effect=psycopg2.OperationalError("down"))
+    clock = Clock()
+    limiter = WriteLimiter(clock=clock, pause=MagicMock())
+    limiter.start(connect, BACKFILL)
+    before = METRICS.get("write_limit_errors_total")
+    assert limiter.acquire(100) == 0.0
+    assert limiter.acquire(100) == 0.0
+    assert connect.call_count == 1
+    assert METRICS.get("write_limit_errors_total") - before == 1
+    clock.now = 5.0
+    limiter.acquire(100)
+    assert connect.call_count == 2
+
+
+def test_live_consumers_report_their_commit_p99():
+    limiter, cur, clock = limiter_on([], LIVE)
+    for ms in range(1, 101):
+        limiter.observe(ms / 1000)
+    [report] = cur.execute.call_args_list
+    assert report.args[1]["p99"] == 1.0
+    clock.now = 1.0
+    for ms in range(1, 101):
+        limiter.observe(ms / 1000)
+    assert cur.execute.call_args_list[-1].args[1]["p99"] == 99.0
+    backfill, cur, clock = limiter_on([], BACKFILL)
+    backfill.observe(1.0)
+    cur.execute.assert_not_called()
+
+
+def test_waits_are_left_out_of_the_reported_latency():
+    limiter, cur, clock = limiter_on([
+        (1000.0, None, None), (-500.0, 0.0, 1000.0, None, 1.0)], LIVE)
+    limiter.acquire(500)
+    limiter.observe(0.6)
+    assert cur.execute.call_args_list[-1].args[1]["p99"] == 100.0
+
+
+@patch("museum_pipeline.writer.LIMITER")
+def test_writer_waits_for_its_limits(limiter):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = []
+    data = {"rating": [{"event_at": AT, "exhibition_id": 1, "value_id": 2}],
+            "request": []}
+    InteractionWriter().write_tables(conn, data)
+    limiter.acquire.assert_called_once_with(1)
+    limiter.observe.assert_called_once()
+    InteractionWriter().write_tables(conn, data, commit=False)
+    assert limiter.observe.call_count == 1
+    ROW_WRITER.write_tables(conn, data)
+    assert limiter.acquire.call_count == 2
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_processes_share_the_class_buckets():
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.limiter import limit_status, set_limits
+    from museum_pipeline.loadtest import local_postgres
+
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        set_limits(conn, BACKFILL, rows_per_second=1000, burst_seconds=1,
+                   yield_above_ms=50)
+        first, second = (WriteLimiter(pause=MagicMock()) for _ in range(2))
+        for limiter in (first, second):
+            limiter.start(get_env_conn, BACKFILL)
+        waits = [first.acquire(800), second.acquire(800)]
+        assert waits[1] - waits[0] == pytest.approx(0.8, abs=0.05)
+        with limited(get_env_conn, LIVE) as live:
+            live.observe(0.2)
+        cur = conn.cursor()
+        cur.execute("UPDATE write_limit SET adjusted_at = NOW() - "
+                    "INTERVAL '1 minute';")
+        conn.commit()
+        second._adjusted_at = None
+        second.acquire(1)
+        [row] = [r for r in limit_status(conn)
+                 if r["pipeline_class"] == BACKFILL]
+        for limiter in (first, second):
+            limiter.stop()
+        conn.close()
+    assert row["rate_factor"] == 0.5
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_default_limits_slow_backfills_while_live_commits_are_slow():
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres
+
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        cur = conn.cursor()
+        cur.execute("UPDATE write_limit SET adjusted_at = NOW() - "
+                    "INTERVAL '1 minute';")
+        conn.commit()
+        with limited(get_env_conn, LIVE) as live:
+            live.observe(0.5)
+        backfill = WriteLimiter(pause=MagicMock())
+        backfill.start(get_env_conn, BACKFILL)
+        assert backfill.acquire(100) == 0.0
+        backfill.observe(0.2)
+        wait = backfill.acquire(100)
+        backfill.stop()
+        conn.close()
+    assert backfill.factor == 0.5
+    assert wait == pytest.approx(0.2)
@@ -0,0 +1,125 @@
+#pylint: skip-file
+import csv
+import json
+import shutil
+from time import perf_counter
+from unittest.mock import MagicMock
+
+import pytest
+
+from museum_pipeline.extract import download_files, get_filenames
+from museum_pipeline.loadtest import (LocalS3, GeneratedConsumer,
+                                      TimedConnection, write_shards,
+                                      local_postgres,
+                                      soak_batch, soak_distributed,
+                                      soak_kafka)
+from museum_pipeline.metrics import percentile
+
+
+def test_local_s3_works_with_extract(tmp_path, monkeypatch):
+    expected = write_shards(str(tmp_path / "s3"), "bucket", 100, 3,
+                            invalid_ratio=0.2)
+    client = LocalS3(str(tmp_path / "s3"))
+    files = get_filenames(client, "bucket")
+    assert files == [f"lmnh_hist_data_0{i}.csv" for i in range(3)]
+    (tmp_path / "data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    download_files(client, "bucket", files)
+    rows = []
+    for f in files:
+        with open(tmp_path / "data" / f, encoding="utf-8") as fp:
+            rows.extend(csv.DictReader(fp))
+    assert len(rows) == 100
+    assert sum(r["site"] != "99" for r in rows) == expected
+
+
+def test_generated_consumer_paces_messages():
+    consumer = GeneratedConsumer(rate=200)
+    started = perf_counter()
+    messages = consumer.consume(20, timeout=5)
+    assert len(messages) == 20
+    assert perf_counter() - started >= 19 / 200
+    assert [m.offset() for m in messages] == list(range(20))
+    assert "at" in json.loads(messages[0].value())
+
+
+def test_generated_consumer_poll_times_out():
+    consumer = GeneratedConsumer(rate=0.001)
+    consumer.poll()
+    assert consumer.poll(timeout=0.01) is None
+
+
+def test_timed_connection_records_latency():
+    consumer = GeneratedConsumer(rate=1000)
+    consumer.poll()
+    consumer.poll()
+    conn = TimedConnection(MagicMock(), consumer)
+    conn.commit()
+    assert len(conn.latencies) == 2
+    assert not consumer.in_flight
+
+
+def test_percentile():
+    assert percentile(list(range(1, 101)), 50) == 50
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile([], 50) is None
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_short_soak(tmp_path):
+    with local_postgres(fsync=False):
+        batch = soak_batch(2000, shards=2, invalid_ratio=0.1)
+        kafka = soak_kafka(2.0, 100, invalid_ratio=0.1)
+    assert batch["rows_correct"]
+    assert kafka["rows_correct"]
+    assert kafka["emergency"]["rows"] > 0
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_distributed_ingest_loads_each_shard_once():
+    with local_postgres(fsync=False):
+        report = soak_distributed(2000, shards=8, workers=3)
+    assert report["rows_correct"]
+    assert report["shards_done"] == 8
+    assert sum(report["shards_per_worker"]) == 8
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_writer_benchmark_modes():
+    from museum_pipeline.benchmark import benchmark_writer
+    result = benchmark_writer(3000)
+    assert result["single"]["bulk"]["round_trips"] == 3001
+    assert result["pipelined"]["bulk"]["round_trips"] \
+        < result["multi"]["bulk"]["round_trips"]
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_bulk_load_rejects_unknown_keys_and_rebuilds_indexes():
+    import datetime
+    from museum_pipeline.bulk_load import bulk_load, secondary_indexes
+    from museum_pipeline.extract import get_env_conn
+    at = datetime.datetime(2025, 1, 13, 9, tzinfo=datetime.timezone.utc)
+    data = {"rating": [{"event_at": at, "exhibition_id": 1, "value_id": 1},
+                       {"event_at": at, "exhibition_id": 99,
+                        "value_id": 1}],
+            "request": [{"event_at": at, "exhibition_id": 1,
+                         "value_id": 50}]}
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        cur = conn.cursor()
+        cur.execute("CREATE INDEX rating_at ON rating_interaction "
+                    "(event_at);")
+        conn.commit()
+        result = bulk_load(data, conn, drop_indexes=True)
+        cur.execute("SELECT COUNT(*) FROM rating_interaction;")
+        assert cur.fetchone()[0] == 1
+        assert [name for name, _ in secondary_indexes(cur, "rating")] == \
+            ["rating_at", "rating_interaction_event_at"]
+        conn.close()
+    assert result["rows_loaded"] == 1
+    assert result["rows_rejected"] == 2
+    assert "rating_at" in result["rebuilt"]["indexes"]
@@ -0,0 +1,129 @@
+#pylint: skip-file
+import datetime
+import json
+import logging
+import tracemalloc
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from museum_pipeline.benchmark import SEED_ID_DICT
+from museum_pipeline.kafka_pipeline import consume_messages
+from museum_pipeline.loadtest import GeneratedConsumer, LocalS3, write_shards
+from museum_pipeline.memory import MEMORY, MemoryProfiler, profiled
+from museum_pipeline.pipeline import run_batch
+from museum_pipeline.sinks import NullSink
+
+BATCH_ROWS = 20000
+# Peak Python heap use of each batch stage over BATCH_ROWS rows, in MB.
+# merge_csvs streams, so its budget doesn't grow with the input.
+BATCH_BUDGETS_MB = {
+    "download_files": 1,
+    "merge_csvs": 1,
+    "load_csv_data": 8,
+    "prepare_upload_data": 7,
+    "write": 1,
+}
+KAFKA_MESSAGES = 50000
+KAFKA_LEAK_BUDGET_KB = 256
+
+
+def quiet_logger():
+    logger = logging.getLogger("tests.memory")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.disabled = True
+    return logger
+
+
+@pytest.fixture
+def profiler():
+    profiler = MemoryProfiler(top=3)
+    profiler.start()
+    yield profiler
+    profiler.stop()
+
+
+def test_stage_records_peak_and_allocators(profiler):
+    with profiler.stage("allocate"):
+        kept = [bytes(1024) for _ in range(4096)]
+        transient = bytearray(8 * 2 ** 20)
+        del transient
+    stage = profiler.report()["stages"]["allocate"]
+    assert stage["calls"] == 1
+    assert stage["peak_traced_mb"] >= 12
+    assert stage["top_allocators"][0]["where"].startswith(__file__)
+    assert stage["top_allocators"][0]["size_kb"] >= 4096
+    assert stage["peak_rss_mb"] >= stage["rss_start_mb"]
+
+
+def test_nested_stage_peaks_fold_into_parent(profiler):
+    with profiler.stage("outer"):
+        with profiler.stage("inner"):
+            transient = bytearray(4 * 2 ** 20)
+            del transient
+    stages = profiler.report()["stages"]
+    assert stages["inner"]["peak_traced_mb"] >= 4
+    assert stages["outer"]["peak_traced_mb"] >= 4
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = MemoryProfiler()
+    with profiler.stage("idle"):
+        pass
+    assert profiler.report() == {"peak_rss_mb": None, "stages": {}}
+
+
+def test_profiled_writes_the_report(tmp_path):
+    report_path = tmp_path / "memory.json"
+    with profiled(str(report_path)):
+        with MEMORY.stage("work"):
+            pass
+    assert not MEMORY.enabled
+    assert json.loads(report_path.read_text())["stages"]["work"]["calls"] \
+        == 1
+
+
+def test_batch_stages_stay_within_budget(tmp_path, monkeypatch):
+    write_shards(str(tmp_path / "s3"), "bucket", BATCH_ROWS, 4,
+                 invalid_ratio=0.05)
+    (tmp_path / "data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    with patch("museum_pipeline.pipeline.load_id_dict",
+               return_value=SEED_ID_DICT), profiled(str(tmp_path / "m")):
+        summary = run_batch(LocalS3(str(tmp_path / "s3")), "bucket",
+                            MagicMock(), quiet_logger(), sinks=["null"])
+    assert summary["rows_uploaded"] > 0.9 * BATCH_ROWS
+    stages = MEMORY.report()["stages"]
+    over = {stage: stages[f"lmnh.{stage}"]["peak_traced_mb"]
+            for stage, budget in BATCH_BUDGETS_MB.items()
+            if stages[f"lmnh.{stage}"]["peak_traced_mb"] > budget}
+    assert not over, f"Stages over budget (MB): {over}"
+
+
+def test_kafka_loop_does_not_leak():
+    consumer = GeneratedConsumer(1e9, invalid_ratio=0.05)
+    sink = NullSink()
+    samples = []
+
+    def write(batch):
+        # The generator keeps every valid message's due time for latency
+        # reports; drop them so only the pipeline's memory is measured.
+        consumer.in_flight.clear()
+        samples.append(tracemalloc.get_traced_memory()[0])
+        return sink(batch)
+
+    tracemalloc.start()
+    try:
+        consume_messages(consumer, write, SEED_ID_DICT, datetime.time.min,
+                         datetime.time.max, quiet_logger(),
+                         should_stop=lambda: consumer.sent >= KAFKA_MESSAGES,
+                         batch_size=500, flush_interval=3600.0)
+    finally:
+        tracemalloc.stop()
+    assert sink.rows > 0.9 * KAFKA_MESSAGES
+    # Skip the first tenth, while caches and the metrics registry fill.
+    warm = samples[len(samples) // 10]
+    growth_kb = (max(samples[-10:]) - warm) / 1024
+    assert growth_kb < KAFKA_LEAK_BUDGET_KB, \
+        f"Kafka loop grew {growth_kb:.0f}KB over {KAFKA_MESSAGES} messages"
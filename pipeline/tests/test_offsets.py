@@ -0,0 +1,137 @@
+#pylint: skip-file
+from unittest.mock import MagicMock
+
+import psycopg2
+import pytest
+from confluent_kafka import OFFSET_BEGINNING, TopicPartition
+
+from museum_pipeline.offsets import (DatabaseUnavailable, ExactlyOnceWriter,
+                                     OffsetConflict)
+
+
+class OffsetTable:
+    """A kafka_offset table behind a mock cursor"""
+
+    def __init__(self, rows=None):
+        self.rows = dict(rows or {})
+        self.cur = MagicMock()
+        self.cur.execute.side_effect = self.execute
+        self.cur.fetchall.side_effect = lambda: [
+            (*key, offset) for key, offset in self.rows.items()]
+
+    def execute(self, sql, params):
+        if sql.startswith("INSERT"):
+            group, topic, partition, offset = params
+            self.cur.rowcount = int((topic, partition) not in self.rows)
+            self.rows.setdefault((topic, partition), offset)
+        elif sql.startswith("UPDATE"):
+            offset, group, topic, partition, previous = params
+            matched = self.rows.get((topic, partition)) == previous
+            self.cur.rowcount = int(matched)
+            if matched:
+                self.rows[(topic, partition)] = offset
+
+
+def writer_for(table, conn=None):
+    conn = conn or MagicMock(closed=False)
+    conn.cursor.return_value = table.cur
+    rows = MagicMock()
+    return ExactlyOnceWriter(MagicMock(return_value=conn), "group",
+                             MagicMock(), rows), conn, rows
+
+
+def test_assignment_starts_from_stored_offsets():
+    writer, conn, _ = writer_for(OffsetTable({("lmnh", 0): 42}))
+    consumer = MagicMock()
+    partitions = [TopicPartition("lmnh", 0), TopicPartition("lmnh", 1)]
+    writer.on_assign(consumer, partitions)
+    assert [tp.offset for tp in consumer.assign.call_args.args[0]] == [
+        42, OFFSET_BEGINNING]
+    assert writer.positions == {("lmnh", 0): 42, ("lmnh", 1): None}
+    writer.on_revoke(consumer, [TopicPartition("lmnh", 1)])
+    assert writer.positions == {("lmnh", 0): 42}
+
+
+def test_partitions_without_stored_offsets_start_from_kafkas():
+    table = OffsetTable({("lmnh", 0): 42})
+    writer, conn, _ = writer_for(table)
+    consumer = MagicMock()
+    consumer.committed.return_value = [TopicPartition("lmnh", 1, 17)]
+    writer.on_assign(consumer, [TopicPartition("lmnh", 0),
+                                TopicPartition("lmnh", 1)])
+    [missing] = consumer.committed.call_args.args[0]
+    assert (missing.topic, missing.partition) == ("lmnh", 1)
+    assert [tp.offset for tp in consumer.assign.call_args.args[0]] == [
+        42, 17]
+    assert table.rows == {("lmnh", 0): 42, ("lmnh", 1): 17}
+    assert writer.positions == {("lmnh", 0): 42, ("lmnh", 1): 17}
+
+
+def test_unreadable_offsets_pause_the_assignment_until_they_can_be_read():
+    table = OffsetTable({("lmnh", 0): 42})
+    conn = MagicMock(closed=False)
+    conn.cursor.return_value = table.cur
+    connect = MagicMock(side_effect=[psycopg2.OperationalError("down"),
+                                     conn])
+    writer = ExactlyOnceWriter(connect, "group", MagicMock(),
+                               retry_interval=0)
+    consumer = MagicMock()
+    partitions = [TopicPartition("lmnh", 0)]
+    writer.on_assign(consumer, partitions)
+    consumer.assign.assert_called_once_with(partitions)
+    consumer.pause.assert_called_once_with(partitions)
+    assert (writer.pending, writer.positions) == ([("lmnh", 0)], {})
+    writer.resume_pending()
+    [seek] = consumer.seek.call_args.args
+    assert (seek.partition, seek.offset) == (0, 42)
+    [resumed] = consumer.resume.call_args.args
+    assert [tp.partition for tp in resumed] == [0]
+    assert (writer.pending, writer.positions) == ([], {("lmnh", 0): 42})
+    writer.resume_pending()
+    consumer.resume.assert_called_once()
+
+
+def test_batch_and_offsets_commit_together():
+    table = OffsetTable({("lmnh", 0): 42})
+    writer, conn, rows = writer_for(table)
+    writer.on_assign(MagicMock(), [TopicPartition("lmnh", 0),
+                                   TopicPartition("lmnh", 1)])
+    assert writer(["row"], {("lmnh", 0): 50, ("lmnh", 1): 3}) == "db"
+    assert rows.write.call_args.args[1:] == (["row"],)
+    assert rows.write.call_args.kwargs == {"commit": False}
+    assert table.rows == {("lmnh", 0): 50, ("lmnh", 1): 3}
+    assert writer.positions == {("lmnh", 0): 50, ("lmnh", 1): 3}
+    conn.commit.assert_called()
+    conn.rollback.assert_not_called()
+
+
+def test_moved_offsets_drop_the_batch_and_rewind():
+    table = OffsetTable({("lmnh", 0): 42})
+    writer, conn, _ = writer_for(table)
+    consumer = MagicMock()
+    writer.on_assign(consumer, [TopicPartition("lmnh", 0)])
+    table.rows[("lmnh", 0)] = 60
+    with pytest.raises(OffsetConflict):
+        writer(["row"], {("lmnh", 0): 50})
+    conn.rollback.assert_called_once()
+    [seek] = consumer.seek.call_args.args
+    assert (seek.partition, seek.offset) == (0, 60)
+    assert writer.positions == {("lmnh", 0): 60}
+
+
+def test_revoked_partition_is_a_conflict():
+    writer, conn, _ = writer_for(OffsetTable())
+    writer.on_assign(MagicMock(), [])
+    with pytest.raises(OffsetConflict):
+        writer([], {("lmnh", 0): 5})
+
+
+def test_database_errors_can_be_retried():
+    table = OffsetTable()
+    writer, conn, rows = writer_for(table)
+    writer.on_assign(MagicMock(), [TopicPartition("lmnh", 0)])
+    rows.write.side_effect = psycopg2.OperationalError("down")
+    with pytest.raises(DatabaseUnavailable):
+        writer(["row"], {("lmnh", 0): 5})
+    assert table.rows == {}
+    assert writer.positions == {("lmnh", 0): None}
@@ -0,0 +1,95 @@
+#pylint: skip-file
+import datetime
+import threading
+from unittest.mock import MagicMock
+
+import psycopg2
+import pytest
+
+from museum_pipeline.parallel_load import ParallelLoader, slice_rows
+
+AT = datetime.datetime(2025, 1, 13, 9)
+
+
+def rows(n, days=5, exhibitions=3):
+    return [{"event_at": AT + datetime.timedelta(days=i % days),
+             "exhibition_id": 1 + i % exhibitions, "value_id": 1}
+            for i in range(n)]
+
+
+def test_slices_are_key_disjoint_and_balanced():
+    data = {"rating": rows(100), "request": rows(50)}
+    slices = slice_rows(data, 3)
+    days = [set(s["keys"]) for s in slices]
+    assert sum(len(d) for d in days) == len(set.union(*days)) == 5
+    for piece in slices:
+        for table in ("rating", "request"):
+            assert {r["event_at"].date().isoformat()
+                    for r in piece["data"][table]} <= set(piece["keys"])
+    sizes = [sum(map(len, s["data"].values())) for s in slices]
+    assert sum(sizes) == 150
+    assert max(sizes) - min(sizes) <= 30
+    by_exhibition = slice_rows(data, 8, by="exhibition")
+    assert [s["keys"] for s in by_exhibition] == [[1], [2], [3]]
+
+
+class RecordingWriter:
+    """Records each transaction's rows by connection"""
+
+    def __init__(self, fail_on=None):
+        self.transactions = []
+        self.fail_on = fail_on or (lambda conn, data: False)
+        self.lock = threading.Lock()
+
+    def write_tables(self, conn, data):
+        if self.fail_on(conn, data):
+            raise psycopg2.OperationalError("down")
+        with self.lock:
+            self.transactions.append((conn, data))
+        return sum(map(len, data.values()))
+
+
+def test_each_connection_commits_bounded_transactions():
+    writer = RecordingWriter()
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    loader = ParallelLoader(connect, 2, transaction_rows=40, writer=writer)
+    result = loader.load({"rating": rows(100), "request": rows(60)})
+    assert result["rows_loaded"] == 160
+    assert result["rows_failed"] == 0
+    assert connect.call_count == 2
+    assert all(sum(map(len, data.values())) <= 40
+               for _, data in writer.transactions)
+    [first, second] = result["connections"]
+    assert first["rows_loaded"] + second["rows_loaded"] == 160
+    assert first["transactions"] == -(-first["rows"] // 40)
+    assert not set(first["keys"]) & set(second["keys"])
+    assert all(c.close.called for c, _ in writer.transactions)
+
+
+def test_failed_slice_leaves_the_others_loaded():
+    bad_day = AT.date() + datetime.timedelta(days=1)
+    writer = RecordingWriter(lambda conn, data: any(
+        r["event_at"].date() == bad_day for r in data["rating"]))
+    loader = ParallelLoader(MagicMock(side_effect=lambda: MagicMock()), 5,
+                            transaction_rows=10, retries=2, writer=writer)
+    result = loader.load({"rating": rows(100), "request": []})
+    assert result["rows_loaded"] == 80
+    assert result["rows_failed"] == 20
+    [failed] = [c for c in result["connections"] if c["error"]]
+    assert failed["keys"] == [bad_day.isoformat()]
+    assert failed["retries"] == 2
+    assert "OperationalError" in failed["error"]
+    assert len(loader.unloaded["rating"]) == 20
+
+
+def test_transient_failure_is_retried_on_a_new_connection():
+    failures = iter([True])
+    writer = RecordingWriter(lambda conn, data: next(failures, False))
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    loader = ParallelLoader(connect, 1, writer=writer)
+    result = loader.load({"rating": rows(10), "request": []})
+    assert result["rows_loaded"] == 10
+    assert result["connections"][0]["retries"] == 1
+    assert connect.call_count == 2
+    with pytest.raises(ValueError):
+        ParallelLoader(connect, 0)
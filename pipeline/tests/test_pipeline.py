@@ -0,0 +1,175 @@
+#pylint: skip-file
+import logging
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from museum_pipeline.pipeline import run_batch, run_batches
+
+
+@pytest.fixture
+def batch_stages():
+    with patch("museum_pipeline.pipeline.download_files") as download, \
+            patch("museum_pipeline.pipeline.merge_csvs") as merge, \
+            patch("museum_pipeline.pipeline.load_csv_data") as load, \
+            patch("museum_pipeline.pipeline.load_id_dict") as id_dict, \
+            patch("museum_pipeline.pipeline._prepare_upload_data") as prep, \
+            patch("museum_pipeline.sinks._upload_data") as upload:
+        load.return_value = [{}] * 3
+        prep.return_value = {"rating": [{}], "request": [{}]}
+        yield {"download": download, "merge": merge, "id_dict": id_dict}
+
+
+def test_run_batch_uses_museum_pattern_and_paths(batch_stages):
+    files = ["lmnh_hist_data_0.csv", "lms_hist_data_0.csv",
+             "lms_hist_data_1.csv", "lms_hist_data.csv"]
+    summary = run_batch(MagicMock(), "bucket", MagicMock(),
+                        logging.getLogger(), museum="lms", files=files)
+    assert summary == {"files": 2, "files_skipped": 0, "rows_read": 3,
+                       "rows_uploaded": 2,
+                       "rows_rejected": 0, "rejects": {}}
+    assert batch_stages["download"].call_args.args[2] == [
+        "lms_hist_data_0.csv", "lms_hist_data_1.csv"]
+    assert batch_stages["merge"].call_args.args[2] == \
+        "data/lms_hist_data.csv"
+    assert batch_stages["id_dict"].call_args.args[1] == "lms"
+
+
+def test_run_batch_custom_pattern(batch_stages):
+    files = ["lms/2024.csv", "lms/notes.txt", "2024.csv"]
+    run_batch(MagicMock(), "bucket", MagicMock(), logging.getLogger(),
+              museum="lms", pattern=r"lms/.*\.csv", files=files)
+    assert batch_stages["download"].call_args.args[2] == ["lms/2024.csv"]
+
+
+@patch("museum_pipeline.pipeline.get_object_etags")
+@patch("museum_pipeline.pipeline.run_batch")
+def test_run_batches_isolates_failures(mock_run_batch, mock_filenames):
+    def fake_run_batch(client, bucket, conn, logger, rows, museum, pattern,
+                       files, **kwargs):
+        if museum == "lms":
+            raise ValueError("bad csv")
+        return {"files": 1, "rows_read": 10, "rows_uploaded": 9}
+    mock_run_batch.side_effect = fake_run_batch
+    mock_filenames.return_value = {"a": '"etag"'}
+    pool = MagicMock()
+    summaries = run_batches(MagicMock(), "bucket", pool, logging.getLogger(),
+                            {"lmnh": "x", "lms": "y"})
+    assert [s["museum"] for s in summaries] == ["lmnh", "lms"]
+    assert summaries[0]["rows_uploaded"] == 9
+    assert summaries[0]["error"] is None
+    assert summaries[1]["error"] == "ValueError: bad csv"
+    assert mock_filenames.call_count == 1
+    assert pool.getconn.call_count == pool.putconn.call_count == 2
+
+
+@patch("museum_pipeline.pipeline.get_object_etags")
+@patch("museum_pipeline.pipeline.run_batch")
+def test_run_batches_without_a_pool_opens_a_connection_each(mock_run_batch,
+                                                            mock_filenames):
+    mock_run_batch.return_value = {"rows_uploaded": 1}
+    mock_filenames.return_value = {}
+    connect = MagicMock(side_effect=lambda: MagicMock())
+    run_batches(MagicMock(), "bucket", None, logging.getLogger(),
+                {"lmnh": "x", "lms": "y"}, sinks=["parquet"],
+                connect=connect)
+    assert connect.call_count == 2
+    conns = [c.args[2] for c in mock_run_batch.call_args_list]
+    assert all(conn.close.called for conn in conns)
+
+
+@patch("museum_pipeline.sinks._upload_data")
+@patch("museum_pipeline.pipeline.load_id_dict")
+@patch("museum_pipeline.pipeline.load_csv_data")
+@patch("museum_pipeline.pipeline.merge_csvs")
+@patch("museum_pipeline.pipeline.download_files")
+def test_run_batch_writes_rejects(download, merge, load, id_dict, upload,
+                                  tmp_path):
+    load.return_value = [
+        {"at": "2023-03-06 15:09:21", "site": "4", "val": "0", "type": ""},
+        {"at": "2023-03-06 15:09:21", "site": "9", "val": "0", "type": ""}]
+    id_dict.return_value = {"exhibition": {4: 1}, "rating": {0: 1},
+                            "request": {}}
+    summary = run_batch(MagicMock(), "bucket", MagicMock(), MagicMock(),
+                        files=[], rejects_dir=str(tmp_path))
+    assert summary["rows_rejected"] == 1
+    assert summary["rejects"] == {"unknown_exhibition": 1}
+    with open(tmp_path / "lmnh_rejects.csv", encoding="utf-8") as fp:
+        assert len(fp.readlines()) == 2
+
+
+@patch("museum_pipeline.sinks._upload_data")
+@patch("museum_pipeline.pipeline.load_id_dict")
+def test_run_batch_date_range_uses_index(id_dict, upload, tmp_path,
+                                         monkeypatch):
+    from museum_pipeline.loadtest import LocalS3
+    from museum_pipeline.shard_index import ShardIndex
+    (tmp_path / "s3" / "bucket").mkdir(parents=True)
+    (tmp_path / "data").mkdir()
+    for i, day in enumerate(["01", "08", "15"]):
+        with open(tmp_path / "s3" / "bucket" / f"lmnh_hist_data_{i}.csv",
+                  "w", encoding="utf-8") as fp:
+            fp.write("at,site,val,type\n"
+                     f"2023-03-{day} 09:00:00,4,0,\n"
+                     f"2023-03-{day} 23:00:00,4,0,\n")
+    monkeypatch.chdir(tmp_path)
+    id_dict.return_value = {"exhibition": {4: 1}, "rating": {0: 1},
+                            "request": {}}
+    s3 = LocalS3(str(tmp_path / "s3"))
+    files = [o["Key"] for o in s3.list_objects_v2("bucket")["Contents"]]
+    index = ShardIndex()
+    index.reconcile({k: None for k in files})
+    index.scan(files[0], tmp_path / "s3" / "bucket" / files[0])
+
+    summary = run_batch(s3, "bucket", MagicMock(), MagicMock(), files=files,
+                        index=index, date_from="2023-03-08 00:00:00",
+                        date_to="2023-03-08 12:00:00")
+    assert summary["files"] == 2
+    assert summary["files_skipped"] == 1
+    assert summary["rows_uploaded"] == 1
+    assert set(index.objects) == set(files)
+
+
+@patch("museum_pipeline.sinks.bulk_load")
+def test_run_batch_bulk_loads(bulk, batch_stages):
+    bulk.return_value = {"rows_loaded": 1, "phases": {"stage": 0.5}}
+    summary = run_batch(MagicMock(), "bucket", MagicMock(),
+                        logging.getLogger(), files=[], bulk=True,
+                        drop_indexes=True)
+    assert bulk.call_args.args[2] is True
+    assert summary["rows_uploaded"] == 1
+    assert summary["phases"] == {"stage": 0.5}
+
+
+@patch("museum_pipeline.pipeline.ParallelLoader")
+def test_run_batch_reports_parallel_partial_failure(loader, batch_stages):
+    loader.return_value.load.return_value = {
+        "rows_loaded": 1, "rows_failed": 1, "connections": []}
+    connect = MagicMock()
+    summary = run_batch(MagicMock(), "bucket", MagicMock(),
+                        logging.getLogger(), files=[], connections=4,
+                        transaction_rows=100, connect=connect)
+    assert loader.call_args.args[:4] == (connect, 4, 100, "day")
+    assert summary["rows_uploaded"] == 1
+    assert summary["parallel"]["rows_failed"] == 1
+    assert summary["error"].startswith("1 rows not loaded")
+
+
+@patch("museum_pipeline.sinks._upload_data")
+@patch("museum_pipeline.pipeline.load_id_dict")
+@patch("museum_pipeline.pipeline.load_csv_data")
+@patch("museum_pipeline.pipeline.merge_csvs")
+@patch("museum_pipeline.pipeline.download_files")
+def test_run_batch_writes_to_file_sinks(download, merge, load, id_dict,
+                                        upload, tmp_path):
+    load.return_value = [
+        {"at": "2023-03-06 15:09:21", "site": "4", "val": "0", "type": ""}]
+    id_dict.return_value = {"exhibition": {4: 1}, "rating": {0: 1},
+                            "request": {}}
+    summary = run_batch(MagicMock(), "bucket", MagicMock(), MagicMock(),
+                        museum="lms", files=[], sinks=["jsonl", "null"],
+                        sink_dir=str(tmp_path))
+    assert summary["rows_uploaded"] == 1
+    upload.assert_not_called()
+    assert len((tmp_path / "lms" / "jsonl" / "rating.jsonl")
+               .read_text().splitlines()) == 1
@@ -0,0 +1,102 @@
+#pylint: skip-file
+import json
+import logging
+import queue
+
+import pytest
+
+from museum_pipeline.benchmark import reference_log_format
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.pipeline_logger import (BatchingFileHandler,
+                                             BatchingQueueListener,
+                                             BoundedQueueHandler,
+                                             JSONFormatter)
+
+FMT_KEYS = {"level": "levelname", "message": "message",
+            "timestamp": "timestamp", "logger": "name", "line": "lineno"}
+
+
+def record(msg="hello %s", args=(1,), level=logging.INFO, exc_info=None):
+    return logging.LogRecord("test", level, __file__, 7, msg, args, exc_info)
+
+
+@pytest.mark.parametrize("fmt_keys", [FMT_KEYS, {"level": "levelname"}, {}])
+def test_json_formatter_matches_reference(fmt_keys):
+    formatter = JSONFormatter(fmt_keys=fmt_keys)
+    for created in [1.7e9, 1.7e9 + 0.5, 1.7e9 + 0.999999, 1.7e9 + 1.25]:
+        r = record()
+        r.created = created
+        assert formatter.format(r) == reference_log_format(formatter, r)
+
+
+def test_json_formatter_exc_info():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        import sys
+        r = record(exc_info=sys.exc_info())
+    out = json.loads(JSONFormatter(fmt_keys=FMT_KEYS).format(r))
+    assert "ValueError: boom" in out["exc_info"]
+
+
+def test_bounded_handler_drops_when_full():
+    handler = BoundedQueueHandler(queue.Queue(maxsize=2))
+    before = METRICS.get("log_records_dropped_total")
+    for _ in range(5):
+        handler.handle(record())
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+    assert METRICS.get("log_records_dropped_total") - before == 3
+
+
+def test_bounded_handler_aggregates_when_full():
+    q = queue.Queue(maxsize=1)
+    handler = BoundedQueueHandler(q, policy="aggregate")
+    for i in range(4):
+        handler.handle(record("row %s skipped", (i,)))
+    assert q.get_nowait().getMessage() == "row 0 skipped"
+    handler.handle(record("next", ()))
+    assert q.get_nowait().getMessage() == \
+        "Suppressed 3 records like: row %s skipped"
+
+
+def test_bounded_handler_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(queue.Queue(), policy="block")
+
+
+def test_batching_listener_writes_everything(tmp_path):
+    q = queue.Queue(maxsize=10000)
+    file_handler = BatchingFileHandler(tmp_path / "log.jsonl")
+    file_handler.setLevel(logging.WARNING)
+    file_handler.setFormatter(JSONFormatter(fmt_keys=FMT_KEYS))
+    handler = BoundedQueueHandler(q)
+    listener = BatchingQueueListener(q, file_handler,
+                                     respect_handler_level=True)
+    listener.start()
+    for i in range(2000):
+        handler.handle(record("row %s", (i,), level=logging.WARNING))
+        handler.handle(record("debug", (), level=logging.DEBUG))
+    listener.stop()
+    file_handler.close()
+    with open(tmp_path / "log.jsonl", encoding="utf-8") as fp:
+        lines = [json.loads(line) for line in fp]
+    assert handler.dropped == 0
+    assert len(lines) == 2000
+    assert all(line["level"] == "WARNING" for line in lines)
+    messages = [line["message"] for line in lines]
+    assert messages == sorted(messages, key=lambda m: int(m.split()[1]))
+
+
+def test_batching_listener_stops_with_full_queue(tmp_path):
+    q = queue.Queue(maxsize=1)
+    file_handler = BatchingFileHandler(tmp_path / "log.jsonl")
+    handler = BoundedQueueHandler(q)
+    listener = BatchingQueueListener(q, file_handler)
+    listener.start()
+    for i in range(1000):
+        handler.handle(record())
+    listener.stop()
+    file_handler.close()
+    with open(tmp_path / "log.jsonl", encoding="utf-8") as fp:
+        assert sum(1 for _ in fp) == 1000 - handler.dropped
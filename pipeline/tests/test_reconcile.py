@@ -0,0 +1,197 @@
+#pylint: skip-file
+import datetime
+import random
+import shutil
+from unittest.mock import MagicMock, patch
+from zoneinfo import ZoneInfo
+
+import pytest
+from confluent_kafka import TIMESTAMP_CREATE_TIME
+
+from museum_pipeline.loadtest import LocalS3, write_shards
+from museum_pipeline.benchmark import SEED_ID_DICT
+from museum_pipeline.reconcile import (Digests, compare, csv_digests,
+                                       csv_bucket_rows, recording_digests,
+                                       reload_buckets)
+from museum_pipeline.recording import RecordedMessage, Recorder
+from museum_pipeline.shard_index import ShardIndex
+
+UTC = ZoneInfo("UTC")
+AT = datetime.datetime(2025, 1, 13, 9, 30)
+
+
+def rows(n, seed=0):
+    rng = random.Random(seed)
+    return [("rating", {"event_at": AT + datetime.timedelta(
+                            minutes=rng.randrange(3000)),
+                        "exhibition_id": rng.randrange(1, 4),
+                        "value_id": rng.randrange(1, 6)})
+            for _ in range(n)]
+
+
+def digests_of(table_rows):
+    digests = Digests()
+    for table, row in table_rows:
+        digests.add_row("lmnh", table, row, UTC)
+    return digests
+
+
+def test_digests_are_order_independent_and_sensitive():
+    data = rows(500)
+    shuffled = data[:]
+    random.Random(1).shuffle(shuffled)
+    assert digests_of(data).buckets == digests_of(shuffled).buckets
+    halves = digests_of(data[:200])
+    halves.merge(digests_of(data[200:]))
+    assert halves.buckets == digests_of(data).buckets
+
+    moved = [(t, dict(r)) for t, r in data]
+    moved[7][1]["event_at"] += datetime.timedelta(seconds=1)
+    differences = compare(digests_of(moved), digests_of(data))
+    assert len(differences) == 1
+    assert differences[0]["difference"] == "rows"
+    [repeated] = compare(digests_of(data + data[:1]), digests_of(data))
+    assert (repeated["source_rows"], repeated["difference"]) == (
+        repeated["db_rows"] + 1, "count")
+    [missing] = compare(digests_of(data[1:]), digests_of(data))
+    assert missing["source_rows"] == missing["db_rows"] - 1
+
+
+def test_compacted_buckets_are_compared_by_hour():
+    data = rows(300)
+    source = digests_of(data)
+    database = Digests({key: [count, 0, coarse, count]
+                        for key, (count, fine, coarse, _)
+                        in source.buckets.items()})
+    assert compare(source, database) == []
+    within_hour = [(t, dict(r)) for t, r in data]
+    within_hour[0][1]["event_at"] = within_hour[0][1]["event_at"].replace(
+        minute=59)
+    assert compare(digests_of(within_hour), database) == []
+    assert compare(digests_of(within_hour), digests_of(data)) != []
+
+
+def test_aware_times_are_bucketed_in_the_database_time_zone():
+    row = {"event_at": datetime.datetime(2025, 1, 13, 23, 30,
+                                         tzinfo=datetime.timezone.utc),
+           "exhibition_id": 1, "value_id": 1}
+    naive = {**row, "event_at": datetime.datetime(2025, 1, 14, 0, 30)}
+    berlin = ZoneInfo("Europe/Berlin")
+    aware, local = Digests(), Digests()
+    aware.add_row("lmnh", "rating", row, berlin)
+    local.add_row("lmnh", "rating", naive, berlin)
+    assert aware.buckets == local.buckets
+    assert list(aware.buckets) == [("lmnh", 1, "2025-01-14")]
+
+
+def test_csv_digests_are_kept_per_shard(tmp_path):
+    write_shards(str(tmp_path), "bucket", 600, 3, invalid_ratio=0.1)
+    s3 = LocalS3(str(tmp_path))
+    keys = sorted(o["Key"] for o in
+                  s3.list_objects_v2("bucket")["Contents"])
+    index = ShardIndex()
+    index.reconcile({key: s3._etag(str(tmp_path / "bucket" / key))
+                     for key in keys})
+    s3.download_file = MagicMock(side_effect=s3.download_file)
+    first = csv_digests(s3, "bucket", index, "lmnh", keys, SEED_ID_DICT, UTC)
+    assert s3.download_file.call_count == 3
+    assert index.get(keys[0])["rows"] == 200
+    again = csv_digests(s3, "bucket", index, "lmnh", keys, SEED_ID_DICT, UTC)
+    assert s3.download_file.call_count == 3
+    assert again.buckets == first.buckets
+    assert 400 < sum(d[0] for d in first.buckets.values()) < 600
+
+    wanted = set(list(first.buckets)[:2])
+    by_bucket = csv_bucket_rows(s3, "bucket", index, "lmnh", keys,
+                                SEED_ID_DICT, UTC, wanted)
+    reloaded = Digests()
+    for key, data in by_bucket.items():
+        for table in ("rating", "request"):
+            for row in data[table]:
+                reloaded.add_row("lmnh", table, row, UTC)
+    assert reloaded.buckets == {key: first.buckets[key] for key in wanted}
+
+
+@patch("museum_pipeline.reconcile._download")
+@patch("museum_pipeline.reconcile._csv_rows")
+def test_csv_bucket_rows_match_the_digest_buckets(csv_rows, download):
+    row = {"event_at": datetime.datetime(2025, 1, 13, 23, 30,
+                                         tzinfo=datetime.timezone.utc),
+           "exhibition_id": 1, "value_id": 1}
+    csv_rows.return_value = [("rating", row)]
+    berlin = ZoneInfo("Europe/Berlin")
+    digests = Digests()
+    digests.add_row("lmnh", "rating", row, berlin)
+    by_bucket = csv_bucket_rows(MagicMock(), "bucket", ShardIndex(), "lmnh",
+                                ["a.csv"], SEED_ID_DICT, berlin,
+                                set(digests.buckets))
+    assert by_bucket == {("lmnh", 1, "2025-01-14"): {"rating": [row],
+                                                     "request": []}}
+
+
+def test_recording_digests_read_every_worker(tmp_path):
+    value = (b'{"at": "2025-01-13T09:00:00+00:00", "site": "1", '
+             b'"val": 2}')
+    for worker in range(2):
+        recorder = Recorder(str(tmp_path / "lmnh" / str(worker)))
+        recorder.record(RecordedMessage(value, "lmnh", 0, worker,
+                                        TIMESTAMP_CREATE_TIME, 0))
+        recorder.record(RecordedMessage(b"not json", "lmnh", 0, 9,
+                                        TIMESTAMP_CREATE_TIME, 0))
+        recorder.close()
+    id_dict = {"rating": {2: 4}, "request": {}, "exhibition": {1: 3}}
+    digests = recording_digests(str(tmp_path / "lmnh"), "lmnh", id_dict,
+                                datetime.time(8), datetime.time(18), UTC)
+    assert {key: d[0] for key, d in digests.buckets.items()} == {
+        ("lmnh", 3, "2025-01-13"): 2}
+
+
+@patch("museum_pipeline.reconcile.WRITER")
+def test_reload_replaces_each_bucket_in_its_own_transaction(writer):
+    conn = MagicMock()
+    data = {"rating": [{}], "request": []}
+    writer.write_tables.return_value = 1
+    assert reload_buckets(conn, {("lmnh", 1, "2025-01-13"): data,
+                                 ("lmnh", 2, "2025-01-13"): data},
+                          UTC) == 2
+    statements = [c.args for c in conn.cursor.return_value.execute.mock_calls]
+    assert len(statements) == 8
+    assert statements[0][1] == {"exhibition_id": 1, "day": "2025-01-13",
+                                "tz": "UTC"}
+    assert {s[0].split()[2] for s in statements} == {
+        "rating_interaction", "rating_hourly", "request_interaction",
+        "request_hourly"}
+    assert writer.write_tables.call_args.kwargs == {"commit": False}
+    assert conn.commit.call_count == 2
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_database_digests_match_the_source():
+    from museum_pipeline.compaction import compact
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres
+    from museum_pipeline.reconcile import database_timezone, reconcile
+    from museum_pipeline.writer import WRITER
+
+    data = rows(400)
+    with local_postgres(fsync=False):
+        conn = get_env_conn()
+        WRITER.write_tables(conn, {"rating": [r for _, r in data],
+                                   "request": []})
+        tz = database_timezone(conn)
+        source = Digests()
+        for table, row in data:
+            source.add_row("lmnh", table, row, tz)
+        assert reconcile(conn, {"lmnh": source})[1] == []
+        compact(conn, datetime.timedelta(days=1),
+                now=datetime.datetime.now(datetime.timezone.utc))
+        assert reconcile(conn, {"lmnh": source})[1] == []
+        cur = conn.cursor()
+        cur.execute("INSERT INTO rating_interaction (exhibition_id, "
+                    "rating_id, event_at) VALUES (1, 1, %s);", (AT,))
+        conn.commit()
+        [difference] = reconcile(conn, {"lmnh": source})[1]
+        conn.close()
+    assert difference["day"] == AT.date().isoformat()
+    assert difference["db_rows"] == difference["source_rows"] + 1
@@ -0,0 +1,137 @@
+#pylint: skip-file
+import datetime
+import gzip
+import logging
+import os
+
+import pytest
+from confluent_kafka import TIMESTAMP_CREATE_TIME, TIMESTAMP_NOT_AVAILABLE
+
+from museum_pipeline.kafka_pipeline import run_playback
+from museum_pipeline.recording import (RecordedMessage, Recorder,
+                                       RecordingConsumer, list_segments,
+                                       read_recording)
+
+ID_DICT = {"rating": {2: 4}, "request": {}, "exhibition": {1: 3}}
+OPEN, CLOSE = datetime.time(hour=8), datetime.time(hour=18)
+VALID = b'{"at": "2025-01-13T09:00:00+00:00", "site": "1", "val": 2}'
+INVALID = b'{"at": "2025-01-13T09:00:00+00:00", "site": "7", "val": 2}'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def message(value, offset, ms, timestamp_type=TIMESTAMP_CREATE_TIME):
+    return RecordedMessage(value, "lmnh", offset % 2, offset,
+                           timestamp_type, ms)
+
+
+def fields(msg):
+    return (msg.value(), msg.topic(), msg.partition(), msg.offset(),
+            msg.timestamp())
+
+
+def record(directory, messages, **kwargs):
+    recorder = Recorder(str(directory), **kwargs)
+    for msg in messages:
+        recorder.record(msg)
+    recorder.close()
+
+
+def test_recording_round_trip(tmp_path):
+    messages = [message(VALID, 0, 1000), message(None, 1, 1500),
+                message(b"not json", 2, -1, TIMESTAMP_NOT_AVAILABLE)]
+    record(tmp_path, messages)
+    assert list_segments(str(tmp_path)) == ["00000000.rec.gz"]
+    assert [fields(m) for m in read_recording(str(tmp_path))] == \
+        [fields(m) for m in messages]
+
+
+def test_recorder_rotates_and_resumes_numbering(tmp_path):
+    record(tmp_path, [message(VALID, i, i) for i in range(3)],
+           segment_bytes=50)
+    record(tmp_path, [message(VALID, 3, 3)])
+    assert list_segments(str(tmp_path)) == [
+        "00000000.rec.gz", "00000001.rec.gz", "00000002.rec.gz",
+        "00000003.rec.gz"]
+    assert [m.offset() for m in read_recording(str(tmp_path))] == [0, 1, 2, 3]
+
+
+def test_reader_stops_at_torn_segment(tmp_path):
+    record(tmp_path, [message(VALID, i, i) for i in range(50)])
+    with open(tmp_path / "00000000.rec.gz", "rb") as fp:
+        data = fp.read()
+    with open(tmp_path / "00000001.rec.gz.part", "wb") as fp:
+        fp.write(data[:len(data) // 2])
+    read = list(read_recording(str(tmp_path)))
+    assert 50 <= len(read) < 100
+    assert [m.offset() for m in read[:50]] == list(range(50))
+
+
+def test_playback_keeps_recorded_spacing(tmp_path):
+    record(tmp_path, [message(VALID, 0, 10000), message(VALID, 1, 12000),
+                      message(VALID, 2, 13000)])
+    clock = Clock()
+    consumer = RecordingConsumer(str(tmp_path), speed=2.0, clock=clock,
+                                 wall_clock=clock, sleeper=clock.sleep)
+    released = []
+    while not consumer.exhausted:
+        msg = consumer.poll(0.25)
+        if msg is not None:
+            released.append(clock.now)
+    assert released == [0.0, 1.0, 1.5]
+    assert consumer.recorded_seconds == 3.0
+    assert msg is None
+
+
+def test_played_messages_carry_release_time(tmp_path):
+    record(tmp_path, [message(VALID, 0, 10000)])
+    consumer = RecordingConsumer(str(tmp_path), speed=None,
+                                 wall_clock=lambda: 50.0)
+    msg = consumer.poll()
+    assert msg.timestamp() == (TIMESTAMP_CREATE_TIME, 50000)
+    assert msg.recorded_timestamp == 10000
+
+
+def test_playback_speed_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        RecordingConsumer(str(tmp_path), speed=0)
+
+
+def test_run_playback_through_pipeline(tmp_path):
+    record(tmp_path, [message(VALID, 0, 0), message(INVALID, 1, 1),
+                      message(None, 2, 2), message(VALID, 3, 3)])
+    batches = []
+    summary = run_playback(str(tmp_path), lambda b: batches.append(b), ID_DICT,
+                           OPEN, CLOSE, logging.getLogger("playback-test"),
+                           speed=None, batch_size=10)
+    assert [len(b) for b in batches] == [2]
+    assert batches[0][0]["exhibition_id"] == 3
+    assert summary["messages"] == 4
+    assert summary["rows_written"] == 2
+    assert summary["messages_rejected"] == 2
+
+
+def test_consume_messages_records_every_message(tmp_path):
+    from museum_pipeline.kafka_pipeline import consume_messages
+    original = [message(VALID, 0, 0), message(INVALID, 1, 1),
+                message(None, 2, 2)]
+    record(tmp_path / "a", original)
+    consumer = RecordingConsumer(str(tmp_path / "a"), speed=None)
+    recorder = Recorder(str(tmp_path / "b"))
+    consume_messages(consumer, lambda b: "db", ID_DICT, OPEN, CLOSE,
+                     logging.getLogger("playback-test"),
+                     should_stop=lambda: consumer.exhausted,
+                     recorder=recorder)
+    recorder.close()
+    assert [(m.value(), m.offset())
+            for m in read_recording(str(tmp_path / "b"))] == \
+        [(m.value(), m.offset()) for m in original]
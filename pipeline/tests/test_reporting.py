@@ -0,0 +1,229 @@
+#pylint: skip-file
+import datetime
+import json
+import threading
+from unittest.mock import MagicMock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import psycopg2
+import pytest
+
+from museum_pipeline.reporting import (REPORTS, Reporter, TTLCache,
+                                       make_server, parse_bound)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_connect(watermarks, results):
+    """Returns a connect function whose cursors answer from fixed data"""
+    queries = []
+
+    def execute(sql, params=None):
+        queries.append((sql, params))
+
+    def fetchall():
+        sql, params = queries[-1]
+        if "write_watermark" in sql:
+            return [{"museum_name": k, "rows_written": v}
+                    for k, v in watermarks.items()]
+        return list(results)
+
+    def connect():
+        conn = MagicMock(closed=False)
+        cur = conn.cursor.return_value.__enter__.return_value
+        cur.execute.side_effect = execute
+        cur.fetchall.side_effect = fetchall
+        return conn
+
+    return connect, queries
+
+
+def report_queries(queries):
+    return [q for q in queries if "write_watermark" not in q[0]]
+
+
+def test_parse_bound():
+    utc = datetime.timezone.utc
+    assert parse_bound(None) is None
+    assert parse_bound("2025-01-13") == datetime.datetime(2025, 1, 13,
+                                                          tzinfo=utc)
+    assert parse_bound("2025-01-13T09:30:00+01:00").utcoffset() \
+        == datetime.timedelta(hours=1)
+    with pytest.raises(ValueError):
+        parse_bound("yesterday")
+
+
+def test_cache_expires_after_ttl():
+    clock = Clock()
+    cache = TTLCache(ttl=10, clock=clock)
+    cache.put("k", 1, "v")
+    clock.now = 9
+    assert cache.get("k", 1) == "v"
+    clock.now = 10
+    assert cache.get("k", 1) != "v"
+    assert len(cache) == 0
+
+
+def test_cache_tag_mismatch_is_a_miss():
+    cache = TTLCache()
+    cache.put("k", 1, "v")
+    assert cache.get("k", 2) != "v"
+    assert len(cache) == 0
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TTLCache(max_entries=2)
+    cache.put("a", 0, 1)
+    cache.put("b", 0, 2)
+    cache.get("a", 0)
+    cache.put("c", 0, 3)
+    assert cache.get("a", 0) == 1
+    assert cache.get("c", 0) == 3
+    assert len(cache) == 2
+
+
+def test_reporter_caches_until_watermark_moves():
+    clock = Clock()
+    watermarks = {"lmnh": 10, "lms": 5}
+    connect, queries = fake_connect(watermarks, [{"number": 3}])
+    reporter = Reporter(connect, watermark_interval=5, clock=clock)
+    assert reporter.report("num_requests", "lmnh") == [{"number": 3}]
+    reporter.report("num_requests", "lmnh")
+    assert len(report_queries(queries)) == 1
+
+    watermarks["lms"] = 6
+    clock.now = 5
+    reporter.report("num_requests", "lmnh")
+    assert len(report_queries(queries)) == 1
+
+    watermarks["lmnh"] = 11
+    clock.now = 6
+    reporter.report("num_requests", "lmnh")
+    assert len(report_queries(queries)) == 1
+    clock.now = 10
+    reporter.report("num_requests", "lmnh")
+    assert len(report_queries(queries)) == 2
+
+
+def test_reporter_passes_filters():
+    connect, queries = fake_connect({}, [])
+    reporter = Reporter(connect)
+    start = parse_bound("2025-01-01")
+    reporter.report("request_over_time", "lms", start, None)
+    [(sql, params)] = report_queries(queries)
+    assert sql == REPORTS["request_over_time"]
+    assert params == {"museum": "lms", "start": start, "end": None,
+                      "bucket_seconds": 3600}
+
+
+def test_reporter_merges_sketches():
+    from museum_pipeline.sketches import BucketSketch
+    sketch = BucketSketch()
+    sketch.count = 1
+    sketch.ratings = {4: 1}
+    row = {"museum_name": "lmnh", "exhibition_name": "Cetology",
+           "public_id": "EXH_01", "bucket_seconds": 900,
+           "sketch": sketch.to_dict()}
+    connect, queries = fake_connect({}, [row, row])
+    [summary] = Reporter(connect).report("approx_stats", "lmnh",
+                                         bucket_seconds=900)
+    assert summary["interactions"] == 2
+    assert summary["median_rating"] == 4
+    assert "bucket_seconds = %(bucket_seconds)s" in queries[-1][0]
+    assert queries[-1][1]["bucket_seconds"] == 900
+
+
+def test_reporter_shares_a_bounded_pool_of_connections():
+    connect, queries = fake_connect({"lmnh": 1}, [])
+    connect = MagicMock(side_effect=connect)
+    reporter = Reporter(connect, TTLCache(ttl=0), max_connections=2)
+    threads = [threading.Thread(target=reporter.report,
+                                args=("num_requests", "lmnh"))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(report_queries(queries)) == 8
+    assert 1 <= connect.call_count <= 2
+    opened = list(reporter._idle)
+    assert len(opened) == connect.call_count
+    reporter.close()
+    assert all(conn.close.called for conn in opened)
+
+
+def test_reporter_drops_a_connection_a_query_failed_on():
+    connect, queries = fake_connect({}, [])
+
+    def closing_connect():
+        conn = connect()
+        conn.close.side_effect = lambda: setattr(conn, "closed", True)
+        return conn
+
+    reporter = Reporter(MagicMock(side_effect=closing_connect))
+    with pytest.raises(psycopg2.OperationalError):
+        with reporter._cursor():
+            raise psycopg2.OperationalError("gone")
+    assert reporter._idle == []
+    reporter.report("num_requests")
+    assert reporter.connect.call_count == 2
+    assert len(reporter._idle) == 1
+
+
+def test_reporter_unknown_report():
+    with pytest.raises(KeyError):
+        Reporter(MagicMock()).report("drop_tables")
+
+
+@pytest.fixture
+def server():
+    reporter = MagicMock()
+    reporter.report.return_value = [
+        {"day": datetime.datetime(2025, 1, 13), "number": 2}]
+    server = make_server(reporter, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, reporter
+    server.shutdown()
+    server.server_close()
+
+
+def get(server, path):
+    host, port = server.server_address
+    with urlopen(f"http://{host}:{port}{path}") as response:
+        return json.loads(response.read())
+
+
+def test_server_serves_report(server):
+    server, reporter = server
+    body = get(server, "/request_over_time?museum=lmnh&from=2025-01-01")
+    assert body == [{"day": "2025-01-13T00:00:00", "number": 2}]
+    name, museum, start, end, width = reporter.report.call_args.args
+    assert (name, museum, end, width) == ("request_over_time", "lmnh", None,
+                                          3600)
+    assert start == parse_bound("2025-01-01")
+    get(server, "/approx_stats?bucket_seconds=900")
+    assert reporter.report.call_args.args[-1] == 900
+
+
+def test_server_lists_reports(server):
+    assert get(server[0], "/") == {"reports": sorted(REPORTS)}
+
+
+def test_server_rejects_bad_requests(server):
+    with pytest.raises(HTTPError) as e:
+        get(server[0], "/nope")
+    assert e.value.code == 404
+    with pytest.raises(HTTPError) as e:
+        get(server[0], "/num_requests?from=soon")
+    assert e.value.code == 400
+    with pytest.raises(HTTPError) as e:
+        get(server[0], "/approx_stats?bucket_seconds=hourly")
+    assert e.value.code == 400
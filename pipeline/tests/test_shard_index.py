@@ -0,0 +1,92 @@
+#pylint: skip-file
+import csv
+import logging
+
+import pytest
+
+from museum_pipeline.loadtest import LocalS3
+from museum_pipeline.pipeline import build_index
+from museum_pipeline.shard_index import (INDEX_KEY, ShardIndex, format_bound,
+                                         in_range, normalize_at, scan_csv)
+
+
+def write_csv(filepath, times, sites="1"):
+    with open(filepath, "w", encoding="utf-8", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["at", "site", "val", "type"])
+        for i, at in enumerate(times):
+            writer.writerow([at, sites[i % len(sites)], "2", ""])
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    (tmp_path / "bucket").mkdir()
+    write_csv(tmp_path / "bucket" / "lmnh_hist_data_00.csv",
+              ["2023-03-01 09:00:00", "2023-03-02 17:00:00", "garbage"], "12")
+    write_csv(tmp_path / "bucket" / "lmnh_hist_data_01.csv",
+              ["2023-03-08 09:00:00", "2023-03-09 17:00:00"])
+    return LocalS3(str(tmp_path))
+
+
+def test_format_bound():
+    assert format_bound(None) is None
+    assert format_bound("2023-03-01") == "2023-03-01 00:00:00"
+    assert format_bound("2023-03-01T09:30:00") == "2023-03-01 09:30:00"
+
+
+def test_in_range():
+    assert in_range("2023-03-01 00:00:00", "2023-03-01 00:00:00", None)
+    assert not in_range("2023-03-02 00:00:00", None, "2023-03-02 00:00:00")
+
+
+def test_scan_csv(tmp_path):
+    write_csv(tmp_path / "a.csv", ["2023-03-02 17:00:00", "bad",
+                                   "2023-03-01 09:00:00"], "21")
+    assert scan_csv(tmp_path / "a.csv") == {
+        "min_at": "2023-03-01 09:00:00", "max_at": "2023-03-02 17:00:00",
+        "rows": 3, "sites": ["1", "2"]}
+
+
+def test_scan_csv_reads_one_digit_times_as_rows_are_validated(tmp_path):
+    write_csv(tmp_path / "a.csv", ["2023-3-1 9:05:00", "2023-03-10 10:00:00",
+                                   "2023-2-30 9:00:00"])
+    entry = scan_csv(tmp_path / "a.csv")
+    assert (entry["min_at"], entry["max_at"]) == ("2023-03-01 09:05:00",
+                                                  "2023-03-10 10:00:00")
+    index = ShardIndex()
+    index.update("a.csv", entry)
+    assert index.select(["a.csv"], "2023-03-11 00:00:00", None) == []
+    assert normalize_at("2023-3-1 9:05:00") == "2023-03-01 09:05:00"
+    assert normalize_at("2023-2-30 9:00:00") is None
+
+
+def test_build_index_round_trip(bucket):
+    patterns = [r"lmnh_hist_data_\d+.csv"]
+    assert build_index(bucket, "bucket", logging.getLogger(), patterns) == 2
+    assert build_index(bucket, "bucket", logging.getLogger(), patterns) == 0
+    index = ShardIndex.load(bucket, "bucket")
+    assert index.get("lmnh_hist_data_00.csv")["rows"] == 3
+    assert INDEX_KEY not in index.objects
+    week = ("2023-03-06 00:00:00", "2023-03-13 00:00:00")
+    keys = sorted(index.objects)
+    assert index.select(keys, *week) == ["lmnh_hist_data_01.csv"]
+    assert index.select(keys + ["new.csv"], *week) == [
+        "lmnh_hist_data_01.csv", "new.csv"]
+
+
+def test_index_drops_changed_objects(bucket, tmp_path):
+    build_index(bucket, "bucket", logging.getLogger(),
+                [r"lmnh_hist_data_\d+.csv"])
+    write_csv(tmp_path / "bucket" / "lmnh_hist_data_00.csv",
+              ["2023-03-07 09:00:00"])
+    index = ShardIndex.load(bucket, "bucket")
+    index.reconcile({k: v["ETag"] for k, v in
+                     ((o["Key"], o) for o in
+                      bucket.list_objects_v2("bucket")["Contents"])})
+    assert index.get("lmnh_hist_data_00.csv") is None
+    assert index.get("lmnh_hist_data_01.csv") is not None
+
+
+def test_load_missing_index(tmp_path):
+    (tmp_path / "empty").mkdir()
+    assert ShardIndex.load(LocalS3(str(tmp_path)), "empty").objects == {}
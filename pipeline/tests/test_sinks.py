@@ -0,0 +1,121 @@
+#pylint: skip-file
+import datetime
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from museum_pipeline.sinks import (JsonlSink, NullSink, ParquetSink,
+                                   PostgresSink, TeeSink, open_sink,
+                                   split_tables)
+from museum_pipeline.spool import SpoolFull
+
+UTC = datetime.timezone.utc
+
+
+def row(day=13, value_id=1, exhibition_id=2):
+    return {"event_at": datetime.datetime(2025, 1, day, 9, tzinfo=UTC),
+            "exhibition_id": exhibition_id, "value_id": value_id}
+
+
+def test_split_tables_rejects_unknown_tables():
+    data = split_tables([{"table": "rating", **row()},
+                         {"table": "request", **row()}])
+    assert [len(data["rating"]), len(data["request"])] == [1, 1]
+    with pytest.raises(ValueError):
+        split_tables([{"table": "visitor"}])
+
+
+def test_null_sink_counts_messages():
+    sink = NullSink()
+    assert sink([{"table": "rating", **row()}] * 3) == 3
+    assert sink.write_tables({"request": [row()]}) == 1
+    assert sink.rows == 4
+
+
+def test_jsonl_sink_appends_canonical_columns(tmp_path):
+    sink = JsonlSink(str(tmp_path))
+    sink.write_tables({"rating": [row(value_id=4)], "request": []})
+    sink.close()
+    sink = JsonlSink(str(tmp_path))
+    sink([{"table": "rating", **row(value_id=5)}])
+    sink.close()
+    lines = (tmp_path / "rating.jsonl").read_text().splitlines()
+    assert [json.loads(l) for l in lines] == [
+        {"event_at": "2025-01-13T09:00:00+00:00", "exhibition_id": 2,
+         "rating_id": 4},
+        {"event_at": "2025-01-13T09:00:00+00:00", "exhibition_id": 2,
+         "rating_id": 5}]
+    assert not (tmp_path / "request.jsonl").exists()
+
+
+def test_parquet_sink_partitions_by_day_in_row_groups(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    sink = ParquetSink(str(tmp_path), row_group_size=4, file_row_groups=2)
+    sink.write_tables({"rating": [row(13, i) for i in range(10)]
+                       + [row(14)], "request": [row(13, 2)]})
+    sink.close()
+    day = tmp_path / "rating" / "event_date=2025-01-13"
+    files = sorted(day.iterdir())
+    assert [pq.ParquetFile(f).num_row_groups for f in files] == [2, 1]
+    table = pq.read_table(str(day))
+    assert table.column_names == ["event_at", "exhibition_id", "rating_id"]
+    assert sorted(table.column("rating_id").to_pylist()) == list(range(10))
+    assert pq.read_table(str(tmp_path / "rating" /
+                             "event_date=2025-01-14")).num_rows == 1
+    assert pq.read_table(str(tmp_path / "request")).column_names[2] == \
+        "request_id"
+
+
+@patch("museum_pipeline.sinks._upload_data")
+def test_postgres_sink_writes_through_upload_data(upload):
+    conn = MagicMock()
+    assert PostgresSink(conn)({"table": "rating", **row()}
+                              for _ in range(2)) == 2
+    assert upload.call_args.args[1] is conn
+
+
+@patch("museum_pipeline.sinks.bulk_load")
+def test_postgres_sink_bulk_keeps_phases(bulk_load):
+    bulk_load.return_value = {"rows_loaded": 1, "phases": {"move": 0.1}}
+    sink = PostgresSink(MagicMock(), bulk=True, drop_indexes=True)
+    assert sink.write_tables({"rating": [row(), row()]}) == 1
+    assert bulk_load.call_args.args[2] is True
+    assert sink.phases == {"move": 0.1}
+
+
+def test_tee_returns_what_the_first_sink_returned(tmp_path):
+    spooled = MagicMock(return_value="spool")
+    null = NullSink()
+    tee = TeeSink([spooled, null])
+    assert tee([{"table": "rating", **row()}]) == "spool"
+    assert null.rows == 1
+    tee.close()
+    spooled.close.assert_called_once()
+
+
+def test_tee_retries_only_the_sinks_a_batch_didnt_reach():
+    spooled = MagicMock(side_effect=[SpoolFull("full"), "db", "db"])
+    null = NullSink()
+    tee = TeeSink([null, spooled])
+    batch = [{"table": "rating", **row()}]
+    with pytest.raises(SpoolFull):
+        tee(batch)
+    assert tee(batch) == 1
+    assert null.rows == 1
+    assert spooled.call_count == 2
+    tee([{"table": "rating", **row()}])
+    assert null.rows == 2
+
+
+def test_open_sink(tmp_path):
+    from museum_pipeline.cli import SINKS as CLI_SINKS
+    from museum_pipeline.sinks import SINKS
+    assert CLI_SINKS == tuple(SINKS)
+    assert isinstance(open_sink(["null"], str(tmp_path)), NullSink)
+    with pytest.raises(ValueError):
+        open_sink(["postgres"], str(tmp_path))
+    writer = MagicMock()
+    tee = open_sink(["jsonl", "postgres"], str(tmp_path), writer)
+    assert tee.sinks[0] is writer
+    assert tee.sinks[1].directory == str(tmp_path / "jsonl")
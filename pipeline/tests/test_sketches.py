@@ -0,0 +1,135 @@
+#pylint: skip-file
+import datetime
+import json
+import random
+from unittest.mock import MagicMock
+
+import psycopg2
+import pytest
+
+from museum_pipeline.sketches import (BucketSketch, HyperLogLog,
+                                      QuantileSketch, SketchAggregator,
+                                      merge_rows, save_sketches)
+
+UTC = datetime.timezone.utc
+AT = datetime.datetime(2025, 1, 13, 9, tzinfo=UTC)
+ID_DICT = {"rating": {value: value + 1 for value in range(5)},
+           "request": {0: 1, 1: 2}}
+
+
+def message(seconds, value=3, exhibition_id=7, table="rating"):
+    return {"table": table, "exhibition_id": exhibition_id,
+            "value_id": ID_DICT[table][value],
+            "event_at": AT + datetime.timedelta(seconds=seconds)}
+
+
+def test_quantiles_are_within_relative_accuracy():
+    rng = random.Random(1)
+    values = sorted(rng.expovariate(0.1) for _ in range(20000))
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    for q in (0.1, 0.5, 0.9, 0.99):
+        true = values[int(q * (len(values) - 1))]
+        assert abs(sketch.quantile(q) - true) <= 0.02 * true
+
+
+def test_quantile_sketches_merge():
+    left, right, both = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for i in range(1, 1001):
+        (left if i % 2 else right).add(i)
+        both.add(i)
+    left.merge(right)
+    assert left.to_dict() == both.to_dict()
+    assert QuantileSketch.from_dict(json.loads(json.dumps(
+        left.to_dict()))).quantile(0.5) == both.quantile(0.5)
+
+
+def test_hyperloglog_estimates_and_merges_unions():
+    left, right = HyperLogLog(), HyperLogLog()
+    for i in range(20000):
+        left.add(f"key-{i}")
+    for i in range(10000, 30000):
+        right.add(f"key-{i}")
+    assert abs(left.estimate() - 20000) < 0.1 * 20000
+    left.merge(right)
+    assert abs(left.estimate() - 30000) < 0.1 * 30000
+    small = HyperLogLog()
+    for _ in range(3):
+        for i in range(50):
+            small.add(str(i))
+    assert abs(small.estimate() - 50) <= 3
+
+
+def test_aggregator_buckets_by_exhibition_and_hour():
+    sketches = SketchAggregator(MagicMock(), ID_DICT, MagicMock())
+    for seconds, value in ((0, 4), (10, 4), (30, 1), (3600, 2)):
+        sketches.observe(message(seconds, value))
+    sketches.observe(message(30, 1))
+    sketches.observe(message(40, 1, table="request"))
+    sketches.observe(message(50, exhibition_id=8))
+    hour = sketches.buckets[(7, AT)].summary()
+    assert hour["interactions"] == 5
+    assert hour["distinct_events"] == 4
+    assert hour["rating_counts"] == {"1": 2, "4": 2}
+    assert hour["median_rating"] == 1
+    assert hour["mean_rating"] == 2.5
+    assert hour["request_counts"] == {"1": 1}
+    assert hour["gap_seconds"]["p50"] is not None
+    next_hour = sketches.buckets[(7, AT + datetime.timedelta(hours=1))]
+    assert next_hour.count == 1
+    assert 3400 < next_hour.gaps.quantile(0.5) < 3640
+    assert sketches.buckets[(8, AT)].gaps.count == 0
+
+
+def test_save_merges_into_stored_rows():
+    stored = BucketSketch()
+    stored.count = 2
+    stored.ratings = {3: 2}
+    new = BucketSketch()
+    new.count = 1
+    new.ratings = {4: 1}
+    cur = MagicMock()
+    cur.fetchall.return_value = [(7, AT, stored.to_dict()),
+                                 (8, AT, None)]
+    conn = MagicMock()
+    conn.cursor.return_value = cur
+    save_sketches(conn, {(7, AT): new, (8, AT): BucketSketch()}, 900)
+    [(first, *key), (second, *_)] = cur.executemany.call_args.args[1]
+    assert key == [7, 900, AT]
+    for call in cur.execute.call_args_list:
+        assert call.args[1][0] == 900
+    assert "bucket_seconds = %s" in cur.execute.call_args_list[1].args[0]
+    assert json.loads(first)["ratings"] == {"3": 2, "4": 1}
+    assert json.loads(second)["count"] == 0
+    conn.commit.assert_called_once()
+
+
+def test_failed_flush_keeps_the_sketches():
+    conn = MagicMock(closed=False)
+    conn.cursor.return_value.execute.side_effect = \
+        psycopg2.OperationalError("down")
+    sketches = SketchAggregator(MagicMock(return_value=conn), ID_DICT,
+                                MagicMock())
+    sketches.observe(message(0))
+    assert sketches.flush() == 0
+    assert len(sketches.buckets) == 1
+    conn.close.assert_called_once()
+
+
+def test_merge_rows_combines_workers_per_exhibition():
+    rows = []
+    for worker in range(2):
+        sketch = BucketSketch()
+        sketch.count = 3
+        sketch.ratings = {worker + 2: 3}
+        sketch.distinct.add(f"{worker}")
+        rows.append({"museum_name": "lmnh", "exhibition_name": "Cetology",
+                     "public_id": "EXH_01", "bucket_seconds": 3600,
+                     "sketch": sketch.to_dict()})
+    [summary] = merge_rows(rows)
+    assert summary["interactions"] == 6
+    assert summary["mean_rating"] == 2.5
+    assert summary["distinct_events"] == 2
+    with pytest.raises(ValueError):
+        merge_rows([rows[0], {**rows[1], "bucket_seconds": 900}])
@@ -0,0 +1,81 @@
+#pylint: skip-file
+import datetime
+from unittest.mock import MagicMock, patch
+
+import psycopg2
+import pytest
+
+from museum_pipeline.spool import (Spool, SpoolDrainer, SpooledWriter,
+                                   SpoolFull)
+
+MESSAGE = {"table": "rating", "value_id": 4, "exhibition_id": 3,
+           "event_at": datetime.datetime(2025, 1, 13, 9, 23, 20,
+                                         tzinfo=datetime.timezone.utc)}
+
+
+def test_spool_round_trip(tmp_path):
+    spool = Spool(str(tmp_path), 2 ** 20)
+    spool.append([MESSAGE, MESSAGE])
+    assert spool.depth_rows == 2
+    [segment] = spool.closed_segments()
+    assert spool.read_segment(segment) == [MESSAGE, MESSAGE]
+
+
+def test_spool_survives_restart(tmp_path):
+    Spool(str(tmp_path), 2 ** 20).append([MESSAGE])
+    with open(tmp_path / "00000000.jsonl", "a", encoding="utf-8") as fp:
+        fp.write('{"table": "rat')
+    spool = Spool(str(tmp_path), 2 ** 20)
+    assert spool.depth_rows == 1
+    spool.append([MESSAGE])
+    assert spool.closed_segments() == ["00000000.jsonl", "00000001.jsonl"]
+
+
+def test_spool_full(tmp_path):
+    spool = Spool(str(tmp_path), 100)
+    with pytest.raises(SpoolFull):
+        spool.append([MESSAGE, MESSAGE])
+    assert spool.depth_rows == 0
+
+
+@patch("museum_pipeline.spool.upload_messages")
+def test_drainer_empties_spool(mock_upload, tmp_path):
+    spool = Spool(str(tmp_path), 2 ** 20)
+    spool.append([MESSAGE])
+    spool.append([MESSAGE])
+    drainer = SpoolDrainer(spool, MagicMock(), MagicMock())
+    assert drainer.drain_once() == 2
+    assert spool.depth_rows == 0
+    assert spool.depth_bytes == 0
+    assert spool.closed_segments() == []
+
+
+@patch("museum_pipeline.spool.upload_messages")
+def test_drainer_keeps_segment_on_failure(mock_upload, tmp_path):
+    mock_upload.side_effect = psycopg2.OperationalError("down")
+    spool = Spool(str(tmp_path), 2 ** 20)
+    spool.append([MESSAGE])
+    drainer = SpoolDrainer(spool, MagicMock(), MagicMock())
+    with pytest.raises(psycopg2.OperationalError):
+        drainer.drain_once()
+    assert spool.depth_rows == 1
+
+
+@patch("museum_pipeline.spool.upload_messages")
+def test_writer_spools_when_db_fails(mock_upload, tmp_path):
+    mock_upload.side_effect = psycopg2.OperationalError("down")
+    spool = Spool(str(tmp_path), 2 ** 20)
+    connect = MagicMock()
+    writer = SpooledWriter(connect, spool, MagicMock(), retry_interval=60)
+    assert writer([MESSAGE]) == "spool"
+    assert writer([MESSAGE]) == "spool"
+    assert mock_upload.call_count == 1
+    assert spool.depth_rows == 2
+
+
+@patch("museum_pipeline.spool.upload_messages")
+def test_writer_prefers_db(mock_upload, tmp_path):
+    spool = Spool(str(tmp_path), 2 ** 20)
+    writer = SpooledWriter(MagicMock(), spool, MagicMock())
+    assert writer([MESSAGE]) == "db"
+    assert spool.depth_rows == 0
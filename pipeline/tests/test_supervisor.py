@@ -0,0 +1,122 @@
+#pylint: skip-file
+import os
+import signal
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from museum_pipeline.supervisor import (throughput_report, MUSEUM_HOURS,
+                                        supervise)
+
+
+def test_throughput_report():
+    report = throughput_report([100, 40], [50, 10], 10.0)
+    assert report == {"rows_per_second": [5.0, 3.0],
+                      "total_rows_per_second": 8.0,
+                      "total_rows": 140}
+
+
+def test_museum_hours():
+    assert set(MUSEUM_HOURS) == {"lmnh", "lms"}
+
+
+def _mark(args, index, event):
+    with open(os.path.join(args.dir, f"{index}.{event}"), "a") as fp:
+        fp.write("x")
+
+
+def crashing_worker(index, museum, start, end, id_dict, log_config, args,
+                    processed):
+    _mark(args, index, "started")
+    raise SystemExit(1)
+
+
+def draining_worker(index, museum, start, end, id_dict, log_config, args,
+                    processed):
+    stopping = []
+    signal.signal(signal.SIGTERM, signal.SIG_IGN if args.stuck
+                  else lambda *_: stopping.append(True))
+    _mark(args, index, "ready")
+    while not stopping:
+        time.sleep(0.05)
+    _mark(args, index, "drained")
+
+
+def _marks(path, event):
+    return sorted(p for p in os.listdir(path) if p.endswith(event))
+
+
+@pytest.fixture
+def run_supervisor(tmp_path):
+    """Runs supervise with a stub worker, sending SIGTERM to this process
+    once every worker is ready or after stop_after seconds"""
+    handlers = [signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)]
+
+    def run(target, workers, stop_after=None, stuck=False, **kwargs):
+        args = SimpleNamespace(dir=str(tmp_path), stuck=stuck,
+                               spool_dir=str(tmp_path / "spool"),
+                               spool_max_mb=1.0, db_timeout=1.0)
+
+        def stop():
+            started = time.monotonic()
+            while stop_after is None \
+                    and len(_marks(tmp_path, "ready")) < workers \
+                    and time.monotonic() - started < 30:
+                time.sleep(0.05)
+            if stop_after is not None:
+                time.sleep(stop_after)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Thread(target=stop, daemon=True).start()
+        logger = MagicMock()
+        with patch("museum_pipeline.supervisor.get_env_conn"), \
+                patch("museum_pipeline.supervisor.load_id_dict",
+                      return_value={}):
+            supervise("lmnh", workers, args, {}, logger, target=target,
+                      **kwargs)
+        return logger
+
+    yield run
+    for s, handler in zip((signal.SIGTERM, signal.SIGINT), handlers):
+        signal.signal(s, handler)
+
+
+def test_crashed_workers_restart_after_restart_delay(run_supervisor,
+                                                     tmp_path):
+    # Checks at about 1s (too soon), 2s (restart) and 3s (too soon again).
+    run_supervisor(crashing_worker, 1, stop_after=3.6, restart_delay=1.5)
+    with open(tmp_path / "0.started") as fp:
+        assert fp.read() == "xx"
+
+
+def test_sigterm_reaches_every_worker(run_supervisor, tmp_path):
+    logger = run_supervisor(draining_worker, 2)
+    assert _marks(tmp_path, "drained") == ["0.drained", "1.drained"]
+    assert not logger.warning.called
+
+
+def test_workers_which_dont_drain_are_killed(run_supervisor, tmp_path):
+    started = time.monotonic()
+    logger = run_supervisor(draining_worker, 1, stuck=True, drain_timeout=1.0)
+    assert time.monotonic() - started < 10
+    assert _marks(tmp_path, "drained") == []
+    assert "killing" in logger.warning.call_args.args[0]
+
+
+@patch("museum_pipeline.supervisor.SpoolDrainer")
+def test_spools_of_removed_workers_are_drained(drainer, run_supervisor,
+                                               tmp_path):
+    for index in range(4):
+        spool = tmp_path / "spool" / "lmnh" / str(index)
+        spool.mkdir(parents=True)
+        if index != 2:
+            (spool / "00000000.jsonl").write_text("")
+    drainer.return_value.spool.depth_rows = 0
+    run_supervisor(draining_worker, 2)
+    [orphan] = drainer.call_args_list
+    assert orphan.args[0].directory == str(tmp_path / "spool" / "lmnh" / "3")
+    drainer.return_value.start.assert_called_once()
+    drainer.return_value.stop.assert_called_once()
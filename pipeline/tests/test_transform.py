@@ -1,10 +1,11 @@
 #pylint: skip-file
+import csv
 from unittest.mock import MagicMock
 
 import pytest
 import datetime
 
-from museum_pipeline.transform import (_prepare_upload_data, _prepare_upload_data_row, filter_strings)
+from museum_pipeline.transform import (_prepare_upload_data, _prepare_upload_data_row, _validate_row, filter_strings, RejectReport)
 
 
 ID_DICT = {
@@ -168,8 +169,52 @@ def test_prepare_upload_data_bad_log():
             ]
     }
     logger = MagicMock()
-    _prepare_upload_data(inp, ID_DICT, logger) == out
-    assert logger.exception.called
+    assert _prepare_upload_data(inp, ID_DICT, logger) == out
+    assert not logger.exception.called
+    [message] = logger.warning.call_args.args
+    assert message == ("Rejected 1 rows; bad_type: 1 "
+                       "(Illegal value for type: f.0)")
+
+
+def test_prepare_upload_data_reject_report(tmp_path):
+    inp = [
+        {"at": "2023-03-06 15:09:21", "site": "4", "val": "0", "type": ""},
+        {"at": "2023-03-06 15:09:21", "site": "99", "val": "0", "type": ""},
+        {"at": "2023-03-06 15:09:21", "site": "98", "val": "0", "type": ""},
+        {"at": "2023-13-06 15:09:21", "site": "4", "val": "0", "type": ""},
+        "not a row",
+    ]
+    report = RejectReport(max_samples=1, keep_rows=True)
+    logger = MagicMock()
+    out = _prepare_upload_data(inp, ID_DICT, logger, rejects=report)
+    assert len(out["rating"]) == 1
+    assert not logger.warning.called
+    assert report.total == 4
+    summary = report.summary()
+    assert summary["unknown_exhibition"] == {
+        "count": 2, "message": "Exhibition 99 not recognised.",
+        "samples": [inp[1]]}
+    assert summary["bad_at"]["message"] == "month must be in 1..12"
+    assert summary["not_a_dict"]["count"] == 1
+
+    report.write_csv(tmp_path / "rejects.csv")
+    with open(tmp_path / "rejects.csv", encoding="utf-8") as fp:
+        rows = list(csv.DictReader(fp))
+    assert [r["reason"] for r in rows] == [
+        "unknown_exhibition", "unknown_exhibition", "bad_at", "not_a_dict"]
+    assert rows[0]["site"] == "99"
+
+
+@pytest.mark.parametrize("row,reason", [
+    [{"at": "2023-03-06 15:09:21", "site": "²", "val": "0", "type": ""},
+     "site_not_numeric"],
+    [{"at": "2023-03-06 15:09:21", "site": "4", "val": "9", "type": ""},
+     "unknown_value"],
+    [{"at": "2023-03-06 15:09:21", "site": "4", "type": "1.0"}, None],
+    [{"at": "2023-03-06", "site": "4", "val": "0", "type": ""}, "bad_at"],
+])
+def test_validate_row_reasons(row, reason):
+    assert _validate_row(row, ID_DICT)[1] == reason
 
 
 @pytest.mark.parametrize("inp,pattern,out",
@@ -0,0 +1,56 @@
+#pylint: skip-file
+import pytest
+
+from museum_pipeline.metrics import METRICS
+from museum_pipeline.tuning import BatchTuner
+
+
+def test_tuner_clamps_starting_values():
+    tuner = BatchTuner(batch_size=10, flush_interval=9, min_size=50,
+                       max_interval=2.0)
+    assert (tuner.batch_size, tuner.flush_interval) == (50, 2.0)
+
+
+def test_tuner_rejects_inverted_bounds():
+    with pytest.raises(ValueError):
+        BatchTuner(min_size=100, max_size=10)
+
+
+def test_tuner_shrinks_slow_batches():
+    tuner = BatchTuner(batch_size=1000, target_latency=0.25)
+    tuner.observe(1000, 1.0, None)
+    assert tuner.batch_size == 500
+    assert tuner.reason == "latency_above_target"
+    assert METRICS.get("batch_size") == 500
+    assert METRICS.get("batch_tuning_reason") == "latency_above_target"
+
+
+def test_tuner_grows_only_full_batches():
+    tuner = BatchTuner(batch_size=1000, target_latency=0.25, max_size=1500)
+    tuner.observe(20, 0.01, None)
+    assert tuner.batch_size == 1000
+    tuner.observe(1000, 0.1, None)
+    assert tuner.batch_size == 1500
+    assert tuner.reason == "latency_below_target"
+
+
+def test_tuner_ignores_small_deviations_and_spooled_batches():
+    tuner = BatchTuner(batch_size=1000, target_latency=0.25)
+    tuner.observe(1000, 0.26, None)
+    tuner.observe(1000, None, None)
+    assert tuner.batch_size == 1000
+    assert tuner.reason is None
+
+
+def test_tuner_interval_follows_lag():
+    tuner = BatchTuner(flush_interval=1.0, min_interval=0.1,
+                       max_interval=2.0, max_lag=5.0)
+    before = METRICS.get("batch_tuning_lagging_total")
+    tuner.observe(0, None, 30.0)
+    assert tuner.flush_interval == 2.0
+    assert tuner.reason == "lagging"
+    tuner.observe(0, None, 20.0)
+    assert METRICS.get("batch_tuning_lagging_total") - before == 1
+    tuner.observe(0, None, 0.5)
+    assert tuner.flush_interval == 0.1
+    assert tuner.reason == "caught_up"
@@ -0,0 +1,155 @@
+#pylint: skip-file
+import logging
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from museum_pipeline.work_queue import (Heartbeat, claim_shard,
+                                        enqueue_shards,
+                                        load_shard, queue_bucket,
+                                        release_shard, run_worker)
+
+ID_DICT = {"exhibition": {4: 1}, "rating": {0: 1}, "request": {}}
+CSV = "at,site,val,type\n2023-03-06 15:09:21,4,0,\n2023-03-06 15:09:22,9,0,\n"
+
+
+def shard(key="lmnh_hist_data_0.csv", attempts=1):
+    return {"object_key": key, "museum_name": "lmnh", "etag": '"e"',
+            "attempts": attempts}
+
+
+def s3_with(text):
+    s3 = MagicMock()
+    s3.download_file.side_effect = lambda bucket, key, filename: \
+        open(filename, "w").write(text)
+    return s3
+
+
+@patch("museum_pipeline.work_queue.execute_values")
+def test_enqueue_counts_new_and_requeued(mock_values):
+    mock_values.return_value = [("a",)]
+    conn = MagicMock()
+    conn.cursor.return_value.rowcount = 2
+    queued = enqueue_shards(conn, {"a": ("lmnh", "1"), "b": ("lms", "2")},
+                            requeue_failed=True)
+    assert queued == 3
+    assert mock_values.call_args.args[2] == [("a", "lmnh", "1"),
+                                             ("b", "lms", "2")]
+    assert "DO NOTHING" in mock_values.call_args.args[1]
+    conn.commit.assert_called_once()
+
+
+@patch("museum_pipeline.work_queue.enqueue_shards")
+@patch("museum_pipeline.work_queue.get_object_etags")
+def test_queue_bucket_matches_each_museum(etags, enqueue):
+    etags.return_value = {"lmnh_hist_data_0.csv": "1",
+                          "lms_hist_data_0.csv": "2", "notes.txt": "3"}
+    queue_bucket(MagicMock(), "bucket", MagicMock(),
+                 {"lmnh": r"lmnh_hist_data_\d+.csv",
+                  "lms": r"lms_hist_data_\d+.csv"})
+    assert enqueue.call_args.args[1] == {
+        "lmnh_hist_data_0.csv": ("lmnh", "1"),
+        "lms_hist_data_0.csv": ("lms", "2")}
+
+
+def test_claim_uses_skip_locked_and_commits():
+    conn = MagicMock()
+    cur = conn.cursor.return_value
+    cur.fetchone.return_value = shard()
+    assert claim_shard(conn, "host:1", 30, 3) == shard()
+    expire_sql, claim_sql = [c.args[0] for c in cur.execute.call_args_list]
+    assert "'failed'" in expire_sql
+    assert "FOR UPDATE SKIP LOCKED" in claim_sql
+    assert cur.execute.call_args.args[1] == {"owner": "host:1", "lease": 30,
+                                             "max_attempts": 3}
+    conn.commit.assert_called_once()
+
+
+def test_claim_returns_none_when_queue_is_empty():
+    conn = MagicMock()
+    conn.cursor.return_value.fetchone.return_value = None
+    assert claim_shard(conn, "host:1") is None
+
+
+def test_load_shard_commits_rows_with_done():
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.rowcount = 1
+    with patch("museum_pipeline.work_queue._upload_data") as upload:
+        result = load_shard(s3_with(CSV), "bucket", conn,
+                            logging.getLogger(), shard(), ID_DICT, "host:1")
+    assert result == {"key": "lmnh_hist_data_0.csv", "committed": True,
+                      "rows_read": 2, "rows_uploaded": 1, "rows_rejected": 1}
+    assert upload.call_args.kwargs == {"commit": False}
+    assert cur.execute.call_args.args[1] == (1, 1, "lmnh_hist_data_0.csv",
+                                             "host:1")
+    conn.commit.assert_called_once()
+    conn.rollback.assert_not_called()
+
+
+def test_load_shard_rolls_back_when_lease_was_taken_over():
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value.rowcount = 0
+    with patch("museum_pipeline.work_queue._upload_data"):
+        result = load_shard(s3_with(CSV), "bucket", conn,
+                            logging.getLogger(), shard(), ID_DICT, "host:1")
+    assert result == {"key": "lmnh_hist_data_0.csv", "committed": False}
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+
+def test_load_shard_skips_write_when_heartbeat_lost():
+    conn = MagicMock()
+    heartbeat = MagicMock(lost=threading.Event())
+    heartbeat.lost.set()
+    with patch("museum_pipeline.work_queue._upload_data") as upload:
+        result = load_shard(s3_with(CSV), "bucket", conn,
+                            logging.getLogger(), shard(), ID_DICT, "host:1",
+                            heartbeat)
+    assert not result["committed"]
+    upload.assert_not_called()
+
+
+def test_heartbeat_renews_until_lease_is_lost():
+    conn = MagicMock()
+    renewals = iter([True, True, False])
+    with patch("museum_pipeline.work_queue.renew_lease",
+               side_effect=lambda *args: next(renewals)) as renew:
+        heartbeat = Heartbeat(lambda: conn, "host:1", "k", 1.0, 0.01)
+        heartbeat.start()
+        assert heartbeat.lost.wait(5)
+        heartbeat.stop()
+    assert renew.call_count == 3
+    assert renew.call_args.args == (conn, "host:1", "k", 1.0)
+    conn.close.assert_called_once()
+
+
+@patch("museum_pipeline.work_queue.release_shard")
+@patch("museum_pipeline.work_queue.load_shard")
+@patch("museum_pipeline.work_queue.load_id_dict")
+@patch("museum_pipeline.work_queue.claim_shard")
+def test_run_worker_releases_failed_shards(claim, id_dict, load, release):
+    claim.side_effect = [shard("a"), shard("b"), shard("c"), None]
+    load.side_effect = [
+        {"key": "a", "committed": True, "rows_read": 3, "rows_uploaded": 2,
+         "rows_rejected": 1},
+        ValueError("bad csv"),
+        {"key": "c", "committed": False}]
+    summary = run_worker(MagicMock(), "bucket", MagicMock, MagicMock(),
+                         "host:1", heartbeat_interval=60)
+    assert {k: summary[k] for k in ("shards", "shards_failed", "leases_lost",
+                                    "rows_uploaded", "rows_rejected")} == {
+        "shards": 1, "shards_failed": 1, "leases_lost": 1,
+        "rows_uploaded": 2, "rows_rejected": 1}
+    [call] = release.call_args_list
+    assert call.args[1:] == ("host:1", "b", "ValueError: bad csv", 3)
+    assert id_dict.call_count == 1
+
+
+def test_release_shard_fails_after_max_attempts():
+    conn = MagicMock()
+    release_shard(conn, "host:1", "k", "boom", max_attempts=2)
+    sql, params = conn.cursor.return_value.execute.call_args.args
+    assert "THEN 'failed' ELSE 'pending'" in sql
+    assert params == (2, "boom", 2, "k", "host:1")
@@ -0,0 +1,126 @@
+#pylint: skip-file
+import datetime
+import shutil
+from unittest.mock import MagicMock
+
+import pytest
+
+from museum_pipeline.writer import WATERMARK_SLOTS, InteractionWriter
+
+AT = datetime.datetime(2025, 1, 13, 9, tzinfo=datetime.timezone.utc)
+
+
+def rows(n, exhibition_id=1):
+    return [{"event_at": AT, "exhibition_id": exhibition_id, "value_id": i}
+            for i in range(n)]
+
+
+def connection(prepared=()):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = [(n,) for n in prepared]
+    return conn
+
+
+def statements(conn):
+    return [c.args for c in conn.cursor.return_value.execute.call_args_list]
+
+
+def sends(conn):
+    return [s for s in statements(conn)
+            if not s[0].startswith(("SELECT name", "PREPARE"))]
+
+
+def test_single_mode_sends_a_row_per_round_trip():
+    conn = connection()
+    writer = InteractionWriter("single")
+    assert writer.write_tables(conn, {"rating": rows(3),
+                                      "request": rows(2)}) == 5
+    assert [s[0].split()[1] for s in sends(conn)] == \
+        ["mp_insert_rating_row"] * 3 + ["mp_insert_request_row"] * 2 \
+        + ["mp_bump_watermarks"]
+
+
+def test_multi_mode_pages_rows_into_arrays():
+    conn = connection()
+    writer = InteractionWriter("multi", page_size=2)
+    writer.write_tables(conn, {"rating": rows(5), "request": []})
+    sent = sends(conn)
+    assert [s[0].split()[1] for s in sent] == ["mp_insert_rating"] * 3 \
+        + ["mp_bump_watermarks"]
+    assert [s[1][2] for s in sent[:3]] == [[0, 1], [2, 3], [4]]
+    assert sent[3][1] == ([1], [5])
+
+
+def test_pipelined_mode_sends_depth_statements_per_round_trip():
+    conn = connection()
+    writer = InteractionWriter("pipelined", page_size=2, depth=3)
+    writer.write_tables(conn, {"rating": rows(5), "request": rows(2, 2)})
+    sent = sends(conn)
+    assert [s[0].count("EXECUTE") for s in sent] == [3, 2]
+    assert "mp_bump_watermarks" in sent[-1][0]
+    assert len(sent[0][1]) == 9
+
+
+def test_statements_are_prepared_once_per_connection():
+    conn, other = connection(), connection()
+    writer = InteractionWriter()
+    writer.write(conn, [{"table": "rating", **rows(1)[0]}])
+    writer.write(conn, [{"table": "request", **rows(1)[0]}])
+    writer.write(other, [{"table": "request", **rows(1)[0]}])
+    prepares = [s for s in statements(conn) if s[0].startswith("PREPARE")]
+    assert len(prepares) == 1
+    assert prepares[0][0].count("PREPARE") == 5
+    assert len([s for s in statements(other)
+                if s[0].startswith("PREPARE")]) == 1
+
+
+def test_statements_already_in_the_session_are_not_prepared_again():
+    conn = connection(prepared=["mp_insert_rating", "mp_insert_rating_row",
+                                "mp_insert_request", "mp_insert_request_row",
+                                "mp_bump_watermarks"])
+    InteractionWriter().write_tables(conn, {"rating": rows(1)})
+    assert not [s for s in statements(conn) if s[0].startswith("PREPARE")]
+
+
+def test_commit_can_be_left_to_the_caller():
+    conn = connection()
+    InteractionWriter().write_tables(conn, {"rating": rows(1)}, commit=False)
+    conn.commit.assert_not_called()
+
+
+def test_empty_write_sends_nothing():
+    conn = connection()
+    assert InteractionWriter().write(conn, []) == 0
+    assert statements(conn) == []
+    conn.commit.assert_called_once()
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        InteractionWriter("async")
+
+
+@pytest.mark.skipif(shutil.which("initdb") is None,
+                    reason="needs local Postgres binaries")
+def test_connections_bump_their_own_watermark_rows():
+    from museum_pipeline.extract import get_env_conn
+    from museum_pipeline.loadtest import local_postgres
+    from museum_pipeline.reporting import Reporter
+
+    data = {"rating": [{"event_at": AT, "exhibition_id": 1, "value_id": 1}]
+            * 3, "request": []}
+    with local_postgres(fsync=False):
+        conns = [get_env_conn(), get_env_conn()]
+        for conn in conns:
+            InteractionWriter().write_tables(conn, data)
+        slots = {conn.get_backend_pid() % WATERMARK_SLOTS for conn in conns}
+        cur = conns[0].cursor()
+        cur.execute("SELECT slot, rows_written FROM write_watermark;")
+        rows_by_slot = dict(cur.fetchall())
+        reporter = Reporter(get_env_conn, watermark_interval=0)
+        watermarks = reporter.watermarks()
+        reporter.close()
+        for conn in conns:
+            conn.close()
+    assert set(rows_by_slot) == slots
+    assert list(watermarks.values()) == [6]